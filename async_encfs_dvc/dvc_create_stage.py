@@ -26,10 +26,14 @@ import datetime
 import re
 import glob
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 from jinja2 import Environment, BaseLoader, meta, StrictUndefined
 from dvc.repo import Repo
 import async_encfs_dvc
+from async_encfs_dvc.dvc_layout import get_layout, get_shard_dvc_yaml
+from async_encfs_dvc import stage_fingerprint
+from async_encfs_dvc import stage_compression
 
 
 def run_shell_cmd(command):
@@ -267,26 +271,74 @@ def get_expanded_path(template_filename):
     filename = get_expanded_path_template(template_filename)
     # The following is to resolve the filename path (abs/rel unchanged)
     if os.path.isabs(filename):
-        return os.path.abspath(filename)
-    else:
+        return os.path.normpath(filename)
+    filename = os.path.normpath(filename)
+    if filename.startswith('..'):  # may resolve above the file system root
         return os.path.relpath(os.path.abspath(filename), os.getcwd())
+    return filename
+
+
+# Directory listings (name -> is_symlink, None for missing directories) to check the existence of many paths with
+# one scandir per directory instead of one stat per path (each a network round-trip on EncFS/Lustre)
+_dir_entries_cache = dict()
+
+
+def _list_dir(path):
+    path = os.path.abspath(path)
+    if path not in _dir_entries_cache:
+        try:
+            with os.scandir(path) as it:
+                _dir_entries_cache[path] = {entry.name: entry.is_symlink() for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            _dir_entries_cache[path] = None
+    return _dir_entries_cache[path]
+
+
+def invalidate_dir_cache(path):
+    """Drop cached listings of a directory and its parents (after creating or removing paths under them)"""
+    path = os.path.abspath(path)
+    for cached_path in list(_dir_entries_cache):
+        if path == cached_path or path.startswith(cached_path.rstrip(os.sep) + os.sep):
+            del _dir_entries_cache[cached_path]
+
+
+def path_exists(path):
+    """os.path.exists from the cached listing of the parent directory"""
+    dirname, basename = os.path.split(os.path.abspath(path))
+    entries = _list_dir(dirname)
+    if entries is None or basename not in entries:
+        return False
+    return os.path.exists(path) if entries[basename] else True  # follow symlinks (broken links don't exist)
+
+
+def get_validated_paths(yaml_filenames, max_workers=16):
+    """Validate (yaml_filename, is_input) pairs like get_validated_path, listing all parent directories concurrently
+    and once each, raise a RuntimeError with the messages of all invalid paths"""
+    expanded_paths = [(get_expanded_path(yaml_filename), is_input) for yaml_filename, is_input in yaml_filenames]
+    dirs = list(set(os.path.dirname(os.path.abspath(path)) for path, _ in expanded_paths))
+    if len(dirs) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(dirs))) as executor:
+            list(executor.map(_list_dir, dirs))
+
+    errors = []
+    for expanded_path, is_input in expanded_paths:
+        exists = path_exists(expanded_path)
+        if is_input and not exists:  # input path should exist
+            dir_content = '\n' + '\n'.join(glob.glob(os.path.join(os.getcwd(), os.path.dirname(expanded_path), '*')))
+            errors.append(f"input dep {expanded_path} not found - "
+                          f"filename options: {dir_content}")
+        elif not is_input and exists:  # output path should not yet exist
+            dir_content = '\n' + '\n'.join(glob.glob(os.path.join(os.getcwd(), os.path.dirname(expanded_path), '*')))
+            errors.append(f"output path {expanded_path} already exists - "
+                          f"base path contains: {dir_content}")
+    if len(errors) > 0:
+        raise RuntimeError('\n'.join(errors))
+    return [expanded_path for expanded_path, _ in expanded_paths]
 
 
 def get_validated_path(yaml_filename, is_input=True):
     """For input paths check their existence, for output paths make sure they don't exist"""
-    expanded_path = get_expanded_path(yaml_filename)
-    if is_input and not os.path.exists(expanded_path):  # input path should exist
-        dir_content = '\n' + '\n'.join(glob.glob(os.path.join(os.getcwd(), os.path.dirname(expanded_path), '*')))
-        raise RuntimeError(
-            f"input dep {expanded_path} not found - "
-            f"filename options: {dir_content}")
-    elif not is_input and os.path.exists(expanded_path):  # output path should not yet exist
-        dir_content = '\n' + '\n'.join(glob.glob(os.path.join(os.getcwd(), os.path.dirname(expanded_path), '*')))
-        raise RuntimeError(
-            f"output path {expanded_path} already exists - "
-            f"base path contains: {dir_content}")
-    else:
-        return expanded_path
+    return get_validated_paths([(yaml_filename, is_input)])[0]
 
 
 # 2. step: Find all Jinja2 template variables in dvc_app.yaml, parse args and substitute
@@ -311,6 +363,8 @@ def parse_stage_args_and_substitute(full_app_yaml_template_file, stage, default_
                         help="Label (suffix) of DVC stage (defaults to <timestamp>_<hostname>)")
     parser.add_argument("--strict-mode", action='store_true',
                         help="Fail on undefined Jinja2 variables in app YAML file (disregarding defaults)")
+    parser.add_argument("--reuse-identical", action='store_true',
+                        help="Reuse an existing stage identical up to its run label instead of creating a new one")
     parser.add_argument("--show-opts", action='store_true',
                         help="Show options from stage definition yaml files for completing the current command")
 
@@ -476,11 +530,9 @@ def create_dvc_stage(full_app_yaml_file, args, load_orig_dvc_root):
     stage_label = f"{full_app_yaml['app']['name'].replace('/','_')}_{args.stage}"
     stage_name = f"{stage_label}_{full_app_yaml['original']['run_label']}"
 
-    # Working directory of dvc stage add (e.g. <output_dep>/.. in ML stages), move rendered dvc_app.yaml there
-    dvc_dir = get_validated_path([full_app_yaml['host_data']['dvc_config']] + stage_def['dvc'], is_input=False)
-    os.makedirs(dvc_dir)
-    full_app_yaml_basename = os.path.basename(args.app_yaml)
-    shutil.move(full_app_yaml_file, os.path.join(dvc_dir, full_app_yaml_basename))
+    # Working directory of dvc stage add (e.g. <output_dep>/.. in ML stages), validated with the data deps below
+    dvc_dir_yaml_path = [full_app_yaml['host_data']['dvc_config']] + stage_def['dvc']
+    dvc_dir = get_expanded_path(dvc_dir_yaml_path)
 
     # Accumulate dvc stage add command, starting with host (-> encfs) -> container (runtime) mount mappings
     mounts = dict()
@@ -526,14 +578,48 @@ def create_dvc_stage(full_app_yaml_file, args, load_orig_dvc_root):
         else:
             mounts[mount_name]['container'] = full_app_yaml['container_data']['mount'][mount_name]
 
+    stage_data_els = [(data_flow, el) for data_flow in ['input', 'output'] for el in stage_def.get(data_flow, dict())]
+
+    # look up an identical stage (up to the run_label) of a previous run, e.g. of a sweep (cf. stage_fingerprint.py)
+    app_stage_def = full_app_yaml['app']['stages'][args.stage]
+    fingerprint = stage_fingerprint.get_fingerprint(
+        full_app_yaml, full_app_yaml['original']['run_label'],
+        input_paths=[get_expanded_path([mounts['data']['origin']] + stage_def['input'][el]['stage_data'])
+                     for data_flow, el in stage_data_els if data_flow == 'input'],
+        command=[get_expanded_path(app_stage_def['script']),
+                 {el: stage_def[data_flow][el].get('command_line_options', dict())
+                  for data_flow, el in stage_data_els},
+                 app_stage_def.get('extra_command_line_options')])
+    identical_stage = stage_fingerprint.find_identical(host_dvc_root, fingerprint)
+    if identical_stage is not None:
+        identical_address = stage_fingerprint.get_stage_address(identical_stage)
+        if args.reuse_identical:
+            print(f"Reusing identical stage {identical_address} (run label {identical_stage['run_label']}) - "
+                  f"not creating a new stage.")
+            if not load_orig_dvc_root:
+                os.remove(full_app_yaml_file)  # temporary full app-yaml file no longer required
+            return
+        print(f"Identical stage {identical_address} (run label {identical_stage['run_label']}) exists - "
+              f"use --reuse-identical to reuse it instead of creating a new stage.")
+
+    # check dvc_dir and outputs don't exist and inputs are available (all paths at once, listing each directory once)
+    validated_paths = get_validated_paths([(dvc_dir_yaml_path, False)] +
+                                          [([mounts['data']['origin']] + stage_def[data_flow][el]['stage_data'],
+                                            data_flow == 'input') for data_flow, el in stage_data_els])
+    host_stage_data = dict(zip(stage_data_els, validated_paths[1:]))
+
+    # move rendered dvc_app.yaml to dvc_dir
+    os.makedirs(dvc_dir)
+    invalidate_dir_cache(dvc_dir)
+    full_app_yaml_basename = os.path.basename(args.app_yaml)
+    shutil.move(full_app_yaml_file, os.path.join(dvc_dir, full_app_yaml_basename))
+
     stage_data_deps = dict()
     for data_flow in ['input', 'output']:
         stage_data_deps[data_flow] = []
         for el in stage_def.get(data_flow, dict()):
             stage_data_deps[data_flow].append(
-                dict(host_stage_data=get_validated_path([mounts['data']['origin']] +
-                                                        stage_def[data_flow][el]['stage_data'],
-                                                        is_input=data_flow == 'input'),
+                dict(host_stage_data=host_stage_data[(data_flow, el)],
                      host_mounted_stage_data=get_expanded_path([mounts['data']['host']] +
                                                                stage_def[data_flow][el]['stage_data']),
                      container_stage_data=get_expanded_path([mounts['data']['container']] +
@@ -593,8 +679,9 @@ def create_dvc_stage(full_app_yaml_file, args, load_orig_dvc_root):
     # script to execute (path composed with code_root)
     script = get_expanded_path(full_app_yaml['app']['stages'][args.stage]['script'])
 
-    # SLURM-/MPI-command
+    # SLURM-/local executor-/MPI-command
     using_slurm = 'slurm_opts' in full_app_yaml['app']['stages'][args.stage]
+    using_local = not using_slurm and 'local_opts' in full_app_yaml['app']['stages'][args.stage]
     if using_slurm:
         # Submits DVC stage and commit jobs that complete asynchronously, hence always use
         #   dvc repro --no-commit --no-lock <stage-name>
@@ -603,13 +690,18 @@ def create_dvc_stage(full_app_yaml_file, args, load_orig_dvc_root):
         container_command = f"slurm_enqueue.sh " \
                             f"{stage_name} {os.path.basename(args.app_yaml)} {args.stage} {container_command}"
     else:
+        if using_local:
+            # Same asynchronous run-then-commit workflow as with SLURM on the local machine (stages run concurrently
+            # by the local executor of the repo, commits serialized), hence also use dvc repro --no-commit --no-lock
+            container_command = f"local_enqueue.sh " \
+                                f"{stage_name} {os.path.basename(args.app_yaml)} {args.stage} {container_command}"
         if 'mpi_opts' in full_app_yaml['app']['stages'][args.stage]:
             mpi_exec = full_app_yaml['app']['stages'][args.stage].get('mpi_exec', 'mpiexec')
             mpi_opts = render_cli_opts(full_app_yaml['app']['stages'][args.stage]['mpi_opts'])
             mpi_command = f"{mpi_exec} {mpi_opts}"
             script = f"time {mpi_command} {script}"  # TODO: make call to time optional
             # container_command = f"{mpi_command} {container_command}"
-        else:
+        elif not using_local:
             print("Not using SLURM or MPI in this DVC stage.")
 
     os.chdir(dvc_dir)
@@ -666,30 +758,76 @@ def create_dvc_stage(full_app_yaml_file, args, load_orig_dvc_root):
     # Create output directories (necessary for no-op stages that are never executed)
     for stage_output_dep in host_stage_rel_output_deps:
         os.makedirs(stage_output_dep)
+        invalidate_dir_cache(stage_output_dep)
+
+    # outputs compressed by the stage job after the payload (cf. stage_compression.py), with encfs in the encrypted root
+    compressed_outputs = []
+    for el, data_dep in zip(stage_def.get('output', dict()), stage_data_deps['output']):
+        compression = stage_compression.get_spec(stage_def['output'][el].get('compression'))
+        if compression is None:
+            continue
+        output_path = os.path.relpath(data_dep['host_stage_data'], dvc_dir)
+        if using_encfs:
+            compressed_outputs.append(dict(output=el, encfs_root=os.path.normpath(encfs_root_dir),
+                                           path=os.path.relpath(output_path, encfs_root_dir), compression=compression))
+        else:
+            compressed_outputs.append(dict(output=el, path=output_path, compression=compression))
+    removed_compression_spec = False
+    if len(compressed_outputs) > 0:
+        with open(stage_compression.SPEC_FILE, 'w') as f:
+            yaml.dump(dict(outputs=compressed_outputs), f, sort_keys=False)
+    elif os.path.exists(stage_compression.SPEC_FILE):  # of a previous stage definition, no longer applied
+        os.remove(stage_compression.SPEC_FILE)
+        removed_compression_spec = True
+
+    # dvc.yaml of the stage - in the stage directory or shared by the stages of the app stage (cf. dvc_layout.py),
+    # in both cases the stage is run in the stage directory (wdir) with deps/outs relative to it
+    dvc_layout = get_layout(full_app_yaml, args.stage)
+    if dvc_layout['type'] == 'sharded':
+        stage_dvc_yaml = os.path.relpath(get_shard_dvc_yaml(host_dvc_root, stage_label,
+                                                            int(dvc_layout['stages_per_shard'])), dvc_dir)
+        os.makedirs(os.path.dirname(stage_dvc_yaml), exist_ok=True)
+        stage_address = f"{stage_dvc_yaml}:{stage_name}"
+        stage_wdir_opt = f"--wdir {os.path.relpath(dvc_dir, os.path.dirname(os.path.abspath(stage_dvc_yaml)))} "
+    else:
+        stage_dvc_yaml = 'dvc.yaml'
+        stage_address = stage_name
+        stage_wdir_opt = ''
 
-    print(f"Writing DVC stage to {os.path.relpath(os.getcwd(), host_dvc_root)}")
+    if stage_wdir_opt:
+        print(f"Writing DVC stage to {os.path.relpath(os.path.abspath(stage_dvc_yaml), host_dvc_root)}:{stage_name} "
+              f"(working directory {os.path.relpath(os.getcwd(), host_dvc_root)})")
+    else:
+        print(f"Writing DVC stage to {os.path.relpath(os.getcwd(), host_dvc_root)}")
     if using_encfs:
         print(f"Using encfs - don't forget to set ENCFS_PW_FILE/ENCFS_INSTALL_DIR when running "
-              f"\'dvc repro{' --no-commit --no-lock' if using_slurm else ''}\'.")
+              f"\'dvc repro{' --no-commit --no-lock' if using_slurm or using_local else ''}\'.")
 
     stage_create_command = os.path.relpath(sys.argv[0], git_root) + ' ' + ' '.join(sys.argv[1:])
-    sp.run(f"dvc stage add --name {stage_name} "
+    sp.run(f"dvc stage add --name {stage_name} {stage_wdir_opt}"
            f"{' '.join(['--deps {}'.format(dep) for dep in host_stage_rel_input_deps])} " 
-           f"{' '.join([('--outs-persist ' if using_slurm else '--outs ') + dep for dep in host_stage_rel_output_deps])} "
+           f"{' '.join([('--outs-persist ' if using_slurm or using_local else '--outs ') + dep for dep in host_stage_rel_output_deps])} "
            f"--desc \"Generated with {stage_create_command} at commit {commit_sha}\" "
-           f"\"dvc_cmd {stage_name} {container_command} \\\"{script} {command_line_options}\\\" \" ",
-           shell=True, check=True)
+           f"\"dvc_cmd {stage_address} {container_command} \\\"{script} {command_line_options}\\\" \" ",
+           shell=True, check=True, cwd=os.path.dirname(os.path.abspath(stage_dvc_yaml)))
     # mkdir host_stage_rel_output_deps only required when not using slurm (as already integrated in dvc_run_sbatch)
+    stage_fingerprint.record(host_dvc_root, fingerprint, stage_name, stage_dvc_yaml, '.', full_app_yaml['app']['name'],
+                             args.stage, full_app_yaml['original']['run_label'])
 
     # optionally freeze stage (manually executed stages, etc.)
     if full_app_yaml['app']['stages'][args.stage].get('frozen', False):
-        print(f"Freezing stage for execution outside of DVC - run 'dvc commit {stage_name}' when outputs are done.")
-        sp.run(f"dvc freeze {stage_name} ", shell=True, check=True)
+        print(f"Freezing stage for execution outside of DVC - run 'dvc commit {stage_address}' when outputs are "
+              f"done.")
+        sp.run(f"dvc freeze {stage_address} ", shell=True, check=True)
 
     # if autostage is true add instantiated YAML to git
     if Repo().config['core']['autostage']:
-       sp.run(f"git add {full_app_yaml_basename}", shell=True, check=True)
-       print(f"Added `{full_app_yaml_basename}` to Git staging area.")
+       staged_files = [full_app_yaml_basename] + ([stage_compression.SPEC_FILE] if len(compressed_outputs) > 0 else [])
+       sp.run(f"git add {' '.join(staged_files)}", shell=True, check=True)
+       print(f"Added `{'`, `'.join(staged_files)}` to Git staging area.")
+       if removed_compression_spec:
+           sp.run(f"git rm --cached --quiet --ignore-unmatch {stage_compression.SPEC_FILE}", shell=True, check=True)
+           print(f"Removed `{stage_compression.SPEC_FILE}` from Git staging area.")
 
 
 def main():
@@ -726,6 +864,8 @@ def main():
                             help="DVC stage generation configuration file")
         parser.add_argument("--stage", type=str, required=True,
                             help="DVC stage to run under app/stages in app-yaml")
+        parser.add_argument("--reuse-identical", action='store_true',
+                            help="Reuse an existing stage identical up to its run label instead of creating a new one")
         args = parser.parse_args()
         # 3. step: Assemble dvc-run command from rendered dvc_app.yaml
         create_dvc_stage(full_app_yaml_file=args.app_yaml, args=args, load_orig_dvc_root=True)
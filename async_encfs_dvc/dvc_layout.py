@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Layout of DVC stages in dvc.yaml files
+#
+# By default (layout type stage_dir), dvc_create_stage writes every stage into a dvc.yaml in its own directory
+# (stage_def['dvc'], e.g. <output>/..). With
+#   dvc_layout:
+#     type: sharded
+#     stages_per_shard: 100
+# in an app stage (or for all stages of the app under app), the stages of the app stage are appended to shared
+# dvc.yaml files <dvc root>/.dvc_shards/<app>_<app stage>/<shard number>/dvc.yaml with at most stages_per_shard stages
+# each, so that DVC has to collect and parse far fewer files on every dvc command. Each stage keeps its directory as
+# its working directory (wdir), hence its command, deps/outs, status files (<stage>.dvc_pending/started/complete/
+# failed) and logs stay where they are with the stage_dir layout. The stage command passes the stage address
+# (<dvc.yaml relative to wdir>:<stage name>) to dvc_cmd, which exports the dvc.yaml as DVC_STAGE_DVC_YAML to
+# slurm_enqueue.sh/local_enqueue.sh and the jobs of the stage.
+#
+# Usage: python3 -m async_encfs_dvc.dvc_layout unlock [DVC_YAML:]STAGE
+#          removes the entry of a stage from the dvc.lock next to DVC_YAML (while holding DVC's repo lock), so that
+#          the stage gets re-executed upon dvc repro (sbatch_dvc_cleanup.sh, removes dvc.lock if no other stage in it)
+
+import os
+import sys
+import time
+import argparse
+
+import yaml
+
+
+LAYOUT_TYPES = ['stage_dir', 'sharded']
+SHARDS_DIR = '.dvc_shards'
+DEFAULT_STAGES_PER_SHARD = 100
+
+
+def log(message):
+    print(f"dvc_layout: {message}", file=sys.stderr)
+
+
+def get_layout(app_yaml, app_stage):
+    """Layout policy of an app stage (stage setting overrides app setting)"""
+    layout = dict(type='stage_dir', stages_per_shard=DEFAULT_STAGES_PER_SHARD)
+    layout.update(app_yaml['app'].get('dvc_layout') or dict())
+    layout.update(app_yaml['app']['stages'][app_stage].get('dvc_layout') or dict())
+    if layout['type'] not in LAYOUT_TYPES:
+        raise RuntimeError(f"Unsupported dvc_layout type {layout['type']} (choose one of {', '.join(LAYOUT_TYPES)}).")
+    if int(layout['stages_per_shard']) < 1:
+        raise RuntimeError(f"dvc_layout stages_per_shard must be positive (got {layout['stages_per_shard']}).")
+    return layout
+
+
+def get_shard_dvc_yaml(dvc_root, shard_label, stages_per_shard):
+    """dvc.yaml of the last shard of shard_label with fewer than stages_per_shard stages (path of a new one if full)"""
+    shard_label_dir = os.path.join(dvc_root, SHARDS_DIR, shard_label)
+    shards = sorted(int(d) for d in os.listdir(shard_label_dir) if d.isdigit()) \
+        if os.path.isdir(shard_label_dir) else []
+    shard = shards[-1] if len(shards) > 0 else 0
+    dvc_yaml_filename = os.path.join(shard_label_dir, f"{shard:04d}", 'dvc.yaml')
+    if os.path.exists(dvc_yaml_filename):
+        with open(dvc_yaml_filename) as f:
+            dvc_yaml = yaml.load(f, Loader=yaml.FullLoader)
+        if len((dvc_yaml or dict()).get('stages') or dict()) >= stages_per_shard:
+            dvc_yaml_filename = os.path.join(shard_label_dir, f"{shard + 1:04d}", 'dvc.yaml')
+    return dvc_yaml_filename
+
+
+def get_stage_dvc_yaml():
+    """dvc.yaml of the stage run in the current directory (exported by dvc_cmd)"""
+    return os.environ.get('DVC_STAGE_DVC_YAML') or 'dvc.yaml'
+
+
+def split_stage_address(address, default_dvc_yaml=None):
+    """dvc.yaml and stage name of a stage address [DVC_YAML:]STAGE (DVC_YAML defaults to the stage's dvc.yaml)"""
+    dvc_yaml_filename, _, stage_name = address.rpartition(':')
+    return dvc_yaml_filename or default_dvc_yaml or get_stage_dvc_yaml(), stage_name
+
+
+def get_stage_wdir(dvc_yaml_filename, stage):
+    """Working directory of a stage (directory of dvc.yaml unless wdir is set)"""
+    return os.path.normpath(os.path.join(os.path.dirname(dvc_yaml_filename), stage.get('wdir', '.')))
+
+
+def get_stage_wdirs(dvc_yaml_filename):
+    """Working directories of the stages in a dvc.yaml (empty if it cannot be read)"""
+    try:
+        with open(dvc_yaml_filename) as f:
+            dvc_yaml = yaml.load(f, Loader=yaml.FullLoader) or dict()
+    except (OSError, yaml.YAMLError):
+        return set()
+    return set(get_stage_wdir(dvc_yaml_filename, stage) for stage in (dvc_yaml.get('stages') or dict()).values())
+
+
+def unlock_stage(dvc_yaml_filename, stage_name, retries=60, interval=5.):
+    """Remove a stage from the dvc.lock next to dvc_yaml_filename (the whole file if no other stage is in it)"""
+    from dvc.repo import Repo
+    from dvc.lock import LockError
+
+    dvc_lock_filename = os.path.join(os.path.dirname(dvc_yaml_filename), 'dvc.lock')
+    repo = Repo(os.path.dirname(os.path.abspath(dvc_yaml_filename)) or '.')
+    for attempt in range(retries):
+        try:
+            with repo.lock:  # dvc commit of other stages rewrites the same dvc.lock
+                if not os.path.exists(dvc_lock_filename):
+                    return
+                with open(dvc_lock_filename) as f:
+                    dvc_lock = yaml.load(f, Loader=yaml.FullLoader) or dict()
+                stages = dvc_lock.get('stages') or dict()
+                if stage_name not in stages:
+                    return
+                del stages[stage_name]
+                if len(stages) == 0:
+                    os.remove(dvc_lock_filename)
+                    return
+                with open(dvc_lock_filename + f".tmp{os.getpid()}", 'w') as f:
+                    yaml.dump(dvc_lock, f, sort_keys=False)
+                os.replace(dvc_lock_filename + f".tmp{os.getpid()}", dvc_lock_filename)
+                return
+        except LockError:
+            log(f"Repo lock held by another dvc command - retrying in {interval} secs ({attempt + 1}/{retries}).")
+            time.sleep(interval)
+    raise RuntimeError(f"Failed to acquire the repo lock to remove {stage_name} from {dvc_lock_filename}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Layout of DVC stages in dvc.yaml files.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    unlock_parser = subparsers.add_parser('unlock', help="Remove a stage from its dvc.lock (re-executed on dvc repro)")
+    unlock_parser.add_argument('stage', type=str, help="[DVC_YAML:]STAGE (DVC_YAML defaults to DVC_STAGE_DVC_YAML or "
+                                                       "./dvc.yaml)")
+    args = parser.parse_args()
+
+    if args.subcommand == 'unlock':
+        unlock_stage(*split_stage_address(args.stage))
+
+
+if __name__ == '__main__':
+    main()
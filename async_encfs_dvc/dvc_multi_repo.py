@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Operations on all DVC repos (plain and encfs, as initialized by dvc_init_repo) under one or more root directories
+#
+# Usage: dvc_multi_repo [--root ROOT ...] [--max-depth N] [--jobs N] [--json] list
+#        dvc_multi_repo [--root ROOT ...] [--max-depth N] [--jobs N] [--json] status [--dvc]
+#        dvc_multi_repo [--root ROOT ...] [--max-depth N] [--jobs N] [--json] repro [DVC_REPRO_ARGS ...]
+#          (--all-pipelines is added if no targets are given, stage repos usually have no dvc.yaml at the root)
+#        dvc_multi_repo [--root ROOT ...] [--max-depth N] [--jobs N] [--json] {show,hold,release,cancel} DVC_JOB_TYPES
+#
+# Repos are processed concurrently by up to --jobs workers (one worker per repo at a time), followed by a combined
+# summary. status reports the stage states of each repo (as dvc_scontrol watch, optionally with 'dvc status'), repro
+# runs 'dvc repro' in each repo (which enqueues the SLURM stages, output in .dvc/tmp/dvc_multi_repo_repro.log) and the
+# control commands act on the SLURM jobs of all repos like dvc_scontrol. All SLURM information is taken from a single
+# squeue snapshot and actions are batched across repos. Job names, the commit singleton and DVC's rwlock remain scoped
+# per repo, so commits of different repos proceed in parallel while those within a repo stay serialized. A per-repo
+# lock file (.dvc/tmp/dvc_multi_repo.lock) keeps concurrent invocations from running dvc repro twice in the same repo.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from async_encfs_dvc.slurm_int.dvc_scontrol import DVC_JOB_TYPES, squeue_snapshot, get_dvc_jobs, \
+    get_dvc_slurm_job_suffix, hold_jobs, release_jobs, cancel_jobs
+
+
+SKIP_DIRS = ['.git', '.dvc', '.dvc_policies', 'node_modules', '__pycache__']
+
+
+def log(message):
+    print(f"dvc_multi_repo: {message}", file=sys.stderr)
+
+
+def get_repo_policy(dvc_root):
+    """Repo policy (plain or encfs) from .dvc_policies/repo/dvc_root.yaml (None if not initialized by dvc_init_repo)"""
+    policy_file = os.path.join(dvc_root, '.dvc_policies', 'repo', 'dvc_root.yaml')
+    if not os.path.exists(policy_file):
+        return None
+    with open(policy_file) as f:
+        repo_policy = yaml.load(f, Loader=yaml.FullLoader) or dict()
+    mount = repo_policy.get('host_data', dict()).get('mount', dict()).get('data', dict())
+    return 'encfs' if mount.get('type') == 'encfs' else 'plain'
+
+
+def find_dvc_repos(roots, max_depth=4):
+    """DVC repos (directories with a .dvc directory) under roots, not descending into repos (or EncFS mounts)"""
+    repos = []
+    for root in roots:
+        root = os.path.realpath(root)
+        pending = [(root, 0)]
+        while len(pending) > 0:
+            path, depth = pending.pop()
+            try:
+                entries = [e for e in os.scandir(path) if e.is_dir(follow_symlinks=False)]
+            except (PermissionError, FileNotFoundError):
+                continue
+            if any(e.name == '.dvc' for e in entries):
+                repos.append(path)
+                continue
+            if depth < max_depth:
+                pending += [(e.path, depth + 1) for e in entries if e.name not in SKIP_DIRS]
+    return [dict(dvc_root=r, policy=get_repo_policy(r), job_suffix=get_dvc_slurm_job_suffix(r))
+            for r in sorted(set(repos))]
+
+
+def run_concurrently(func, repos, jobs):
+    """Apply func to every repo with up to jobs workers, results (or errors) in repo order"""
+    def run(repo):
+        start = time.time()
+        try:
+            result = func(repo)
+            error = None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        return dict(repo, result=result, error=error, duration=time.time() - start)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return list(executor.map(run, repos))
+
+
+def repo_status(repo, jobs, with_dvc_status=False):
+    """Stage states of a repo (as dvc_scontrol watch) and optionally the stages changed according to dvc status"""
+    from async_encfs_dvc.slurm_int.dvc_watch import PipelineWatch
+    watch = PipelineWatch(repo['dvc_root'])
+    watch.refresh(jobs)
+    result = dict(counts=watch.summary()['counts'],
+                  failed=sorted(s['name'] for s in watch.stages.values() if s['state'] == 'failed'))
+    if with_dvc_status:
+        p = sp.run(['dvc', 'status', '--json'], cwd=repo['dvc_root'], capture_output=True)
+        if p.returncode == 0:
+            result['dvc_status'] = sorted(json.loads(p.stdout.decode('utf-8') or '{}'))
+        else:  # e.g. rwlock held by a running dvc repro/commit
+            result['dvc_status'] = None
+            result['dvc_status_error'] = p.stderr.decode('utf-8').strip().split('\n')[-1]
+    return result
+
+
+def repo_repro(repo, repro_args):
+    """Run dvc repro in a repo unless another dvc_multi_repo invocation already does (enqueues SLURM stages)"""
+    lock_file = os.path.join(repo['dvc_root'], '.dvc', 'tmp', 'dvc_multi_repo.lock')
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return dict(returncode=None, skipped="dvc repro already running from another dvc_multi_repo")
+        log_file = os.path.join(repo['dvc_root'], '.dvc', 'tmp', 'dvc_multi_repo_repro.log')
+        with open(log_file, 'w') as log_f:
+            p = sp.run(['dvc', 'repro'] + repro_args, cwd=repo['dvc_root'], stdout=log_f, stderr=sp.STDOUT)
+    return dict(returncode=p.returncode, log=log_file)
+
+
+def control(command, job_types, repos, jobs, verbose):
+    """Apply a dvc_scontrol command to the jobs of all repos from one squeue snapshot (batched across repos)"""
+    repo_jobs = [get_dvc_jobs(job_types, repo['dvc_root'], jobs) for repo in repos]
+    all_jobs = [job for dvc_jobs in repo_jobs for job in dvc_jobs]
+    commands = dict(hold=hold_jobs, release=release_jobs, cancel=cancel_jobs)
+    failed = commands[command](all_jobs, verbose=verbose) if command in commands else []
+    results = []
+    for repo, dvc_jobs in zip(repos, repo_jobs):
+        counts = {job_type: sum(job['type'] == job_type for job in dvc_jobs) for job_type in job_types}
+        results.append(dict(repo, result=dict(counts=counts, jobs=dvc_jobs,
+                                              failed=[job['job_id'] for job in dvc_jobs if job['job_id'] in failed]),
+                            error=None))
+    return results
+
+
+def print_summary(subcommand, results, columns):
+    """Table of per-repo results and totals"""
+    name_width = max([len('REPO')] + [len(r['dvc_root']) for r in results]) + 2
+    print(f"{'REPO':<{name_width}}{'POLICY':<8}" + ''.join(f"{c.upper():>11}" for c in columns))
+    totals = {c: 0 for c in columns}
+    for r in results:
+        if r['error'] is not None:
+            print(f"{r['dvc_root']:<{name_width}}{r['policy'] or '-':<8}  error: {r['error']}")
+            continue
+        values = r['result'].get('counts', r['result'])
+        for c in columns:
+            totals[c] += values.get(c) or 0
+        print(f"{r['dvc_root']:<{name_width}}{r['policy'] or '-':<8}" +
+              ''.join(f"{values.get(c) if values.get(c) is not None else '-':>11}" for c in columns))
+    print(f"{'total (' + str(len(results)) + ' repos)':<{name_width}}{'':<8}" +
+          ''.join(f"{totals[c]:>11}" for c in columns))
+    errors = sum(r['error'] is not None for r in results)
+    if errors > 0:
+        print(f"{subcommand} failed in {errors} repo(s).")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run status, repro (enqueue) and SLURM job control operations on "
+                                                 "all DVC repos under root directories concurrently.")
+    parser.add_argument('--root', type=str, action='append', default=[],
+                        help="Directory to search for DVC repos (repeatable, default: current directory)")
+    parser.add_argument('--max-depth', type=int, default=4, help="Maximum directory depth of repos below a root")
+    parser.add_argument('--jobs', type=int, default=8, help="Number of repos processed concurrently (default: 8)")
+    parser.add_argument('--json', action='store_true', help="Print per-repo results as JSON")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    subparsers.add_parser('list', help="List DVC repos and their repo policy")
+    status_parser = subparsers.add_parser('status', help="Stage states of all repos (as dvc_scontrol watch)")
+    status_parser.add_argument('--dvc', action='store_true', help="Also run 'dvc status' in every repo")
+    repro_parser = subparsers.add_parser('repro', help="Run 'dvc repro' in all repos (enqueues SLURM stages)")
+    repro_parser.add_argument('repro_args', nargs='*', help="Arguments passed to dvc repro (--all-pipelines added "
+                                                            "without targets, use --no-commit with SLURM stages)")
+    for command in ['show', 'hold', 'release', 'cancel']:
+        control_parser = subparsers.add_parser(command, help=f"{command} DVC SLURM jobs of all repos "
+                                                             f"(as dvc_scontrol {command})")
+        control_parser.add_argument('job_types', type=str, help="Comma-separated list of stage, commit, push, "
+                                                                "cleanup (or all)")
+    args, unknown = parser.parse_known_args()
+    if args.subcommand == 'repro':
+        args.repro_args = args.repro_args + unknown
+        if all(arg.startswith('-') for arg in args.repro_args):  # no targets
+            args.repro_args.append('--all-pipelines')
+    elif len(unknown) > 0:
+        parser.error(f"unrecognized arguments: {' '.join(unknown)}")
+
+    repos = find_dvc_repos(args.root or ['.'], args.max_depth)
+    if len(repos) == 0:
+        log(f"No DVC repos found under {', '.join(args.root or ['.'])}.")
+        sys.exit(1)
+
+    if args.subcommand == 'list':
+        results = [dict(repo, result=dict(), error=None) for repo in repos]
+        columns = []
+    elif args.subcommand == 'status':
+        jobs = squeue_snapshot()
+        results = run_concurrently(lambda repo: repo_status(repo, jobs, args.dvc), repos, args.jobs)
+        columns = ['running', 'pending', 'held', 'complete', 'failed', 'committed']
+        if args.dvc:
+            for r in results:
+                if r['result'] is not None:
+                    r['result']['counts']['changed'] = len(r['result']['dvc_status']) \
+                        if r['result']['dvc_status'] is not None else None
+            columns.append('changed')
+    elif args.subcommand == 'repro':
+        log(f"Running dvc repro {' '.join(args.repro_args)} in {len(repos)} repos ({args.jobs} concurrently).")
+        results = run_concurrently(lambda repo: repo_repro(repo, args.repro_args), repos, args.jobs)
+        for r in results:
+            if r['result'] is not None and r['result']['returncode'] not in [0, None]:
+                r['error'] = f"dvc repro failed with exit code {r['result']['returncode']} (see {r['result']['log']})"
+        columns = ['returncode']
+    else:
+        job_types = DVC_JOB_TYPES if args.job_types == 'all' else args.job_types.split(',')
+        results = control(args.subcommand, job_types, repos, squeue_snapshot(), verbose=not args.json)
+        columns = job_types
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_summary(args.subcommand, results, columns)
+    failed_jobs = [job_id for r in results if args.subcommand in ['hold', 'release', 'cancel']
+                   for job_id in r['result']['failed']]
+    if len(failed_jobs) > 0:
+        log(f"Error: {args.subcommand} failed for some of the jobs {','.join(failed_jobs)}.")
+    if len(failed_jobs) > 0 or any(r['error'] is not None for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
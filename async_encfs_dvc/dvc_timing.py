@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Span recorder for timing the phases of the DVC stage lifecycle (enqueue, dependency resolution, submission, queue
+# wait, EncFS mount, container run, commit, push, ...) from Python and bash. Every span is appended as a JSON line
+# {"stage": ..., "phase": ..., "start": ..., "end": ..., ...} to the file in DVC_TIMING_LOG (recording is disabled if
+# unset). slurm_enqueue.sh exports it to all jobs of a stage (set DVC_TIMING_LOG in the dvc repro environment).
+#
+# Usage: python3 -m async_encfs_dvc.dvc_timing record [--stage STAGE] [--attr KEY=VALUE ...] PHASE START [END]
+#        eval "$(python3 -m async_encfs_dvc.dvc_timing shell)"   # defines dvc_timing_start/dvc_timing_end PHASE
+#        python3 -m async_encfs_dvc.dvc_timing report [--json] [--since TIMESTAMP] LOG_FILE [LOG_FILE ...]
+#
+# The report aggregates the spans of a (dvc repro) run into per-phase percentiles and the critical path through the
+# stage dependencies (as recorded on submission).
+
+import os
+import json
+import time
+import socket
+import argparse
+from contextlib import contextmanager
+
+
+def get_log_file():
+    return os.environ.get('DVC_TIMING_LOG') or None
+
+
+def record_span(phase, start, end, stage=None, log_file=None, **attrs):
+    """Append a span to the timing log (no-op if no log file is configured)"""
+    log_file = log_file or get_log_file()
+    if log_file is None:
+        return
+    record = dict(stage=stage or os.environ.get('DVC_TIMING_STAGE', ''), phase=phase, start=start, end=end,
+                  job_id=os.environ.get('SLURM_JOB_ID', ''), host=socket.gethostname(),
+                  rank=os.environ.get('SLURM_PROCID', ''), **attrs)
+    # a single write of a short line to a file opened with O_APPEND does not interleave with concurrent writers
+    with open(log_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def span(phase, stage=None, **attrs):
+    """Record the duration of a with-block as a span"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_span(phase, start, time.time(), stage, **attrs)
+
+
+SHELL_FUNCTIONS = r"""
+dvc_timing_start () {  # PHASE
+    declare -g "dvc_timing_start_${1}=${EPOCHREALTIME:-$(date +%s.%N)}"
+}
+dvc_timing_end () {  # PHASE [START] [KEY=VALUE...] (START defaults to time of dvc_timing_start PHASE)
+    local phase="$1" start_var="dvc_timing_start_${1}" end="${EPOCHREALTIME:-$(date +%s.%N)}"
+    local start="${2:-${!start_var:-${end}}}" attrs="" attr
+    for attr in "${@:3}"; do
+        attrs+=", \"${attr%%=*}\": \"${attr#*=}\""
+    done
+    printf '{"stage": "%s", "phase": "%s", "start": %s, "end": %s, "job_id": "%s", "host": "%s", "rank": "%s"%s}\n' \
+        "${DVC_TIMING_STAGE:-}" "${phase}" "${start/,/.}" "${end/,/.}" "${SLURM_JOB_ID:-}" "${HOSTNAME:-}" \
+        "${SLURM_PROCID:-}" "${attrs}" >> "${DVC_TIMING_LOG}"
+}
+"""
+
+
+def load_spans(log_files, since=None):
+    spans = []
+    for log_file in log_files:
+        with open(log_file) as f:
+            for line in f:
+                line = line.strip()
+                if line == '':
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # partially written line
+                    continue
+                if since is None or record['start'] >= since:
+                    spans.append(record)
+    return spans
+
+
+def percentile(sorted_values, q):
+    """Percentile with linear interpolation of sorted values"""
+    if len(sorted_values) == 0:
+        return None
+    pos = (len(sorted_values) - 1) * q / 100.
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+def phase_statistics(spans):
+    """Per-phase count, total and percentiles of durations (in secs)"""
+    durations = dict()
+    for s in spans:
+        durations.setdefault(s['phase'], []).append(s['end'] - s['start'])
+    stats = dict()
+    for phase, values in durations.items():
+        values.sort()
+        stats[phase] = dict(count=len(values), total=sum(values), p50=percentile(values, 50),
+                            p90=percentile(values, 90), p99=percentile(values, 99), max=values[-1])
+    return stats
+
+
+def union_length(intervals):
+    """Total length covered by intervals (e.g. spans of the same phase on all ranks count once)"""
+    length, covered_until = 0., None
+    for start, end in sorted(intervals):
+        if covered_until is None or start > covered_until:
+            length += end - start
+            covered_until = end
+        elif end > covered_until:
+            length += end - covered_until
+            covered_until = end
+    return length
+
+
+def critical_path(spans):
+    """Chain of stages ending with the last stage to finish, following the last-finishing dependency of each stage"""
+    stages = dict()
+    for s in spans:
+        if s['stage'] == '':
+            continue
+        stage = stages.setdefault(s['stage'], dict(start=s['start'], end=s['end'], deps=[], phases=dict()))
+        stage['start'] = min(stage['start'], s['start'])
+        stage['end'] = max(stage['end'], s['end'])
+        if 'deps' in s:
+            stage['deps'] = [d for d in s['deps'].split(',') if d != ''] if isinstance(s['deps'], str) else s['deps']
+        stage['phases'].setdefault(s['phase'], []).append((s['start'], s['end']))
+    if len(stages) == 0:
+        return []
+
+    path = [max(stages, key=lambda name: stages[name]['end'])]
+    while True:
+        deps = [d for d in stages[path[-1]]['deps'] if d in stages and d not in path]
+        if len(deps) == 0:
+            break
+        path.append(max(deps, key=lambda name: stages[name]['end']))
+    return [dict(stage=name, start=stages[name]['start'], end=stages[name]['end'],
+                 phases={phase: union_length(intervals) for phase, intervals in
+                         sorted(stages[name]['phases'].items(), key=lambda item: min(item[1])[0])})
+            for name in reversed(path)]
+
+
+def report(spans):
+    if len(spans) == 0:
+        return dict(stages=0, makespan=0, phases=dict(), critical_path=[])
+    return dict(stages=len(set(s['stage'] for s in spans if s['stage'] != '')),
+                makespan=max(s['end'] for s in spans) - min(s['start'] for s in spans),
+                phases=phase_statistics(spans), critical_path=critical_path(spans))
+
+
+def print_report(result):
+    print(f"Stages: {result['stages']}, makespan: {result['makespan']:.2f} s\n")
+    print(f"{'phase':<24}{'count':>8}{'total':>12}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for phase, stats in sorted(result['phases'].items(), key=lambda item: -item[1]['total']):
+        print(f"{phase:<24}{stats['count']:>8}{stats['total']:>12.2f}{stats['p50']:>10.2f}{stats['p90']:>10.2f}"
+              f"{stats['p99']:>10.2f}{stats['max']:>10.2f}")
+    if len(result['critical_path']) > 0:
+        path_start = result['critical_path'][0]['start']
+        print(f"\nCritical path ({len(result['critical_path'])} stages, "
+              f"{result['critical_path'][-1]['end'] - path_start:.2f} s):")
+        for stage in result['critical_path']:
+            phases = ', '.join(f"{phase} {duration:.2f}" for phase, duration in stage['phases'].items())
+            print(f"  {stage['stage']} [+{stage['start'] - path_start:.2f} s, {stage['end'] - stage['start']:.2f} s]: "
+                  f"{phases}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and report timing spans of the DVC stage lifecycle.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    record_parser = subparsers.add_parser('record', help="Append a span to DVC_TIMING_LOG")
+    record_parser.add_argument('phase', type=str)
+    record_parser.add_argument('start', type=float, help="Start time (secs since epoch)")
+    record_parser.add_argument('end', type=float, nargs='?', default=None, help="End time (default: now)")
+    record_parser.add_argument('--stage', type=str, default=None, help="DVC stage (default: DVC_TIMING_STAGE)")
+    record_parser.add_argument('--attr', type=str, action='append', default=[], metavar='KEY=VALUE',
+                               help="Additional attribute of the span")
+    subparsers.add_parser('shell', help="Print bash functions dvc_timing_start/dvc_timing_end (to eval)")
+    report_parser = subparsers.add_parser('report', help="Aggregate spans into per-phase percentiles and "
+                                                         "the critical path")
+    report_parser.add_argument('log_file', nargs='*', help="Timing logs (default: DVC_TIMING_LOG)")
+    report_parser.add_argument('--since', type=float, default=None, help="Only spans starting at/after this time")
+    report_parser.add_argument('--json', action='store_true', help="Print report as JSON")
+    args = parser.parse_args()
+
+    if args.subcommand == 'record':
+        record_span(args.phase, args.start, args.end if args.end is not None else time.time(), args.stage,
+                    **dict(attr.split('=', 1) for attr in args.attr))
+    elif args.subcommand == 'shell':
+        print(SHELL_FUNCTIONS)
+    elif args.subcommand == 'report':
+        log_files = args.log_file or ([get_log_file()] if get_log_file() is not None else [])
+        if len(log_files) == 0:
+            parser.error("No timing log given (and DVC_TIMING_LOG not set).")
+        result = report(load_spans(log_files, args.since))
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print_report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+# FUSE-free access to files in an EncFS volume for Python stages: reads and writes the encrypted files under the EncFS
+# root directly with in-process block decryption/encryption (compatible with the EncFS volume config of the repo, i.e.
+# ssl/aes version 3 with nameio/null filenames, per-file IV headers and no block MACs), so that no mount (and no mount
+# barrier in encfs_mount_and_run) is needed. Non-Python payloads keep using the EncFS mount.
+#
+# Usage: python3 -m async_encfs_dvc.encfs_int.encfs_io check ENCFS_ROOT
+#        python3 -m async_encfs_dvc.encfs_int.encfs_io {ls,cat} ENCFS_ROOT [PATH]
+#        python3 -m async_encfs_dvc.encfs_int.encfs_io {decrypt,encrypt} ENCFS_ROOT SRC DST
+#
+# The password is taken from ENCFS_PW or the file in ENCFS_PW_FILE (as in encfs_mount_and_run), the volume config from
+# ENCFS6_CONFIG or <ENCFS_ROOT>/.encfs6.xml. In Python:
+#
+#   from async_encfs_dvc.encfs_int.encfs_io import EncfsVolume
+#   volume = EncfsVolume(encfs_root, mount_dir=decrypt_dir)   # paths under mount_dir map to the volume
+#   with volume.open(os.path.join(decrypt_dir, 'in/data.npy'), 'rb') as f: ...
+#
+# Files are read with random access and written sequentially (a new file per open with mode 'wb'). Reads spanning many
+# blocks are split into chunks that are read and decrypted in a thread pool (ENCFS_IO_THREADS, default: number of
+# CPUs), so that reading from the file system overlaps with decryption. Every block of blockSize bytes is encrypted
+# with AES-CBC using an IV derived from the block number and the file IV, the last partial block and the file header
+# with EncFS's stream encoding (two passes of AES-CFB with byte shuffling). All-zero blocks are holes (allowHoles).
+
+import io
+import os
+import sys
+import hmac
+import base64
+import hashlib
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+try:
+    from cryptography.hazmat.decrepit.ciphers.modes import CFB  # cryptography >= 47
+except ImportError:
+    CFB = modes.CFB
+
+
+HEADER_SIZE = 8  # per-file IV (uniqueIV)
+KEY_CHECKSUM_BYTES = 4
+IV_LENGTH = 16
+CHUNK_BLOCKS = 256  # blocks read and decrypted per task in the thread pool
+
+
+class EncfsConfig:
+    """Parameters of an EncFS volume from its .encfs6.xml (only those supported by this module)"""
+
+    def __init__(self, config_file):
+        cfg = ET.parse(config_file).getroot().find('cfg')
+
+        def get(name):
+            return cfg.find(name).text.strip()
+        self.cipher = get('cipherAlg/name')
+        self.cipher_major = int(get('cipherAlg/major'))
+        self.name_alg = get('nameAlg/name')
+        self.key_size = int(get('keySize')) // 8
+        self.block_size = int(get('blockSize'))
+        self.unique_iv = bool(int(get('uniqueIV')))
+        self.block_mac_bytes = int(get('blockMACBytes')) + int(get('blockMACRandBytes'))
+        self.plain_data = bool(int(get('plainData')))
+        self.allow_holes = bool(int(get('allowHoles')))
+        self.encoded_key = base64.b64decode(get('encodedKeyData'))
+        self.salt = base64.b64decode(get('saltData'))
+        self.kdf_iterations = int(get('kdfIterations'))
+        if self.cipher != 'ssl/aes' or self.cipher_major < 3:
+            raise NotImplementedError(f"Unsupported EncFS cipher {self.cipher} (version {self.cipher_major}, "
+                                      "only ssl/aes from version 3 is supported).")
+        if self.name_alg != 'nameio/null':
+            raise NotImplementedError(f"Unsupported EncFS filename encoding {self.name_alg} (only nameio/null is "
+                                      "supported).")
+        if self.block_mac_bytes > 0 or self.plain_data:
+            raise NotImplementedError("Unsupported EncFS config with block MAC headers or plain data.")
+
+
+class EncfsKey:
+    """AES key and IV data of an EncFS key with its HMAC-SHA1-based MACs and IV derivation (cf. EncFS' SSL_Cipher)"""
+
+    def __init__(self, key_data):
+        self.key = key_data[:-IV_LENGTH]
+        self.iv_data = key_data[-IV_LENGTH:]
+        self.aes = algorithms.AES(self.key)
+
+    def mac64(self, data):
+        md = hmac.digest(self.key, data, 'sha1')
+        h = bytearray(8)
+        for i in range(len(md) - 1):  # all but the last byte folded into 64 bits
+            h[i % 8] ^= md[i]
+        return int.from_bytes(h, 'big')
+
+    def mac32(self, data):
+        mac = self.mac64(data)
+        return ((mac >> 32) & 0xffffffff) ^ (mac & 0xffffffff)
+
+    def ivec(self, seed):
+        return hmac.digest(self.key, self.iv_data + (seed & 0xffffffffffffffff).to_bytes(8, 'little'),
+                           'sha1')[:IV_LENGTH]
+
+    def block_decode(self, data, iv64):
+        return Cipher(self.aes, modes.CBC(self.ivec(iv64))).decryptor().update(data)
+
+    def block_encode(self, data, iv64):
+        return Cipher(self.aes, modes.CBC(self.ivec(iv64))).encryptor().update(data)
+
+    def _cfb(self, data, iv64, encrypt):
+        cipher = Cipher(self.aes, CFB(self.ivec(iv64)))
+        return bytearray((cipher.encryptor() if encrypt else cipher.decryptor()).update(bytes(data)))
+
+    def stream_decode(self, data, iv64):
+        buf = self._cfb(data, iv64 + 1, encrypt=False)
+        unshuffle_bytes(buf)
+        flip_bytes(buf)
+        buf = self._cfb(buf, iv64, encrypt=False)
+        unshuffle_bytes(buf)
+        return bytes(buf)
+
+    def stream_encode(self, data, iv64):
+        buf = bytearray(data)
+        shuffle_bytes(buf)
+        buf = self._cfb(buf, iv64, encrypt=True)
+        flip_bytes(buf)
+        shuffle_bytes(buf)
+        return bytes(self._cfb(buf, iv64 + 1, encrypt=True))
+
+
+def shuffle_bytes(buf):
+    for i in range(len(buf) - 1):
+        buf[i + 1] ^= buf[i]
+
+
+def unshuffle_bytes(buf):
+    for i in range(len(buf) - 1, 0, -1):
+        buf[i] ^= buf[i - 1]
+
+
+def flip_bytes(buf):
+    """Reverse the bytes in every chunk of 64 bytes"""
+    for start in range(0, len(buf), 64):
+        buf[start:start + 64] = buf[start:start + 64][::-1]
+
+
+def read_password():
+    if os.environ.get('ENCFS_PW'):
+        return os.environ['ENCFS_PW']
+    if os.environ.get('ENCFS_PW_FILE'):
+        with open(os.path.expandvars(os.path.expanduser(os.environ['ENCFS_PW_FILE']))) as f:
+            return f.read().rstrip('\n')
+    raise ValueError("EncFS password not set (ENCFS_PW or ENCFS_PW_FILE).")
+
+
+class EncfsVolume:
+    """EncFS volume at encfs_root, optionally with the paths under mount_dir (where encfs_mount_and_run would mount
+    it) mapped to the volume"""
+
+    def __init__(self, encfs_root, password=None, config_file=None, mount_dir=None, threads=None):
+        self.root = os.path.realpath(encfs_root)
+        self.mount_dir = os.path.abspath(mount_dir) if mount_dir is not None else None
+        self.config = EncfsConfig(config_file or os.environ.get('ENCFS6_CONFIG') or
+                                  os.path.join(self.root, '.encfs6.xml'))
+        self.key = self._read_volume_key(password if password is not None else read_password())
+        self.threads = threads or int(os.environ.get('ENCFS_IO_THREADS') or os.cpu_count() or 1)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _read_volume_key(self, password):
+        cfg = self.config
+        user_key = EncfsKey(hashlib.pbkdf2_hmac('sha1', password.encode('utf-8'), cfg.salt, cfg.kdf_iterations,
+                                                cfg.key_size + IV_LENGTH))
+        checksum = int.from_bytes(cfg.encoded_key[:KEY_CHECKSUM_BYTES], 'big')
+        key_data = user_key.stream_decode(cfg.encoded_key[KEY_CHECKSUM_BYTES:], checksum)
+        if user_key.mac32(key_data) != checksum:
+            raise ValueError(f"Invalid EncFS password for {self.root}.")
+        return EncfsKey(key_data)
+
+    @property
+    def executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='encfs_io')
+            return self._executor
+
+    def encrypted_path(self, path):
+        """Path of the encrypted file of path (relative to the volume root or absolute under mount_dir)"""
+        if os.path.isabs(path):
+            path = os.path.abspath(path)
+            if self.mount_dir is None or os.path.commonpath([path, self.mount_dir]) != self.mount_dir:
+                raise ValueError(f"Path {path} is not under the mount directory {self.mount_dir} of {self.root}.")
+            path = os.path.relpath(path, self.mount_dir)
+        return os.path.join(self.root, path)  # nameio/null: names are not encrypted
+
+    def open(self, path, mode='rb', buffering=-1):
+        """Binary file object of a file in the volume (read with random access, written sequentially)"""
+        if mode in ['r', 'rb']:
+            raw = EncfsReader(self, self.encrypted_path(path))
+            return raw if buffering == 0 else io.BufferedReader(raw, buffer_size=self.read_size(buffering))
+        if mode in ['w', 'wb']:
+            raw = EncfsWriter(self, self.encrypted_path(path))
+            return raw if buffering == 0 else io.BufferedWriter(raw, buffer_size=self.read_size(buffering))
+        raise ValueError(f"Unsupported mode {mode} (only 'rb' and 'wb').")
+
+    def read_size(self, buffering=-1):
+        """Default buffer size (a chunk per thread)"""
+        return buffering if buffering > 0 else CHUNK_BLOCKS * self.config.block_size * self.threads
+
+    def read_bytes(self, path):
+        with self.open(path, 'rb', buffering=0) as f:
+            return f.readall()
+
+    def write_bytes(self, path, data):
+        with self.open(path, 'wb', buffering=0) as f:
+            f.write(data)
+
+    def getsize(self, path):
+        size = os.path.getsize(self.encrypted_path(path))
+        return max(size - HEADER_SIZE, 0) if self.config.unique_iv else size
+
+    def listdir(self, path='.'):
+        return sorted(name for name in os.listdir(self.encrypted_path(path)) if name != '.encfs6.xml')
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class EncfsReader(io.RawIOBase):
+    """Random access reads of an encrypted file"""
+
+    def __init__(self, volume, encrypted_path):
+        super().__init__()
+        self.volume = volume
+        self.block_size = volume.config.block_size
+        self.fd = os.open(encrypted_path, os.O_RDONLY)
+        raw_size = os.fstat(self.fd).st_size
+        self.offset = HEADER_SIZE if volume.config.unique_iv else 0
+        self.size = max(raw_size - self.offset, 0)
+        self.file_iv = 0
+        if volume.config.unique_iv and raw_size > 0:
+            header = volume.key.stream_decode(os.pread(self.fd, HEADER_SIZE, 0), 0)  # external IV 0 (nameio/null)
+            self.file_iv = int.from_bytes(header, 'big')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.pos = max({io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence] + offset, 0)
+        return self.pos
+
+    def _read_blocks(self, first, last):
+        """Plaintext of blocks first to last (exclusive)"""
+        bs, key, allow_holes = self.block_size, self.volume.key, self.volume.config.allow_holes
+        data = os.pread(self.fd, (last - first) * bs, self.offset + first * bs)
+        out = []
+        for i in range(0, len(data), bs):
+            block = data[i:i + bs]
+            iv64 = (first + i // bs) ^ self.file_iv
+            if allow_holes and block.count(0) == len(block):
+                out.append(block)
+            elif len(block) == bs:
+                out.append(key.block_decode(block, iv64))
+            else:
+                out.append(key.stream_decode(block, iv64))
+        return b''.join(out)
+
+    def readinto(self, b):
+        n = max(min(len(b), self.size - self.pos), 0)
+        if n == 0:
+            return 0
+        bs = self.block_size
+        first, last = self.pos // bs, (self.pos + n - 1) // bs + 1
+        if last - first > CHUNK_BLOCKS and self.volume.threads > 1:
+            chunks = list(self.volume.executor.map(lambda c: self._read_blocks(c, min(c + CHUNK_BLOCKS, last)),
+                                                   range(first, last, CHUNK_BLOCKS)))
+            data = b''.join(chunks)
+        else:
+            data = self._read_blocks(first, last)
+        start = self.pos - first * bs
+        b[:n] = data[start:start + n]
+        self.pos += n
+        return n
+
+    def readall(self):
+        b = bytearray(max(self.size - self.pos, 0))
+        n = self.readinto(b)
+        return bytes(b[:n])
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+class EncfsWriter(io.RawIOBase):
+    """Sequential writes of a new encrypted file (the last partial block is written on close)"""
+
+    def __init__(self, volume, encrypted_path):
+        super().__init__()
+        self.volume = volume
+        self.block_size = volume.config.block_size
+        self.fd = os.open(encrypted_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.offset = HEADER_SIZE if volume.config.unique_iv else 0
+        self.file_iv = 0
+        self.pending = bytearray()  # plaintext of the current partial block
+        self.block = 0  # number of the next block to write
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def _write_header(self):
+        while self.file_iv == 0:
+            self.file_iv = int.from_bytes(os.urandom(HEADER_SIZE), 'big')
+        os.pwrite(self.fd, self.volume.key.stream_encode(self.file_iv.to_bytes(HEADER_SIZE, 'big'), 0), 0)
+
+    def _encode_blocks(self, data, first):
+        bs, key = self.block_size, self.volume.key
+        return b''.join(key.block_encode(data[i:i + bs], (first + i // bs) ^ self.file_iv)
+                        for i in range(0, len(data), bs))
+
+    def _write_blocks(self, data):
+        """Encrypt and write full blocks at the current block"""
+        if self.volume.config.unique_iv and self.file_iv == 0:
+            self._write_header()
+        bs, first = self.block_size, self.block
+        num_blocks = len(data) // bs
+        chunk = CHUNK_BLOCKS * bs
+        if num_blocks > CHUNK_BLOCKS and self.volume.threads > 1:
+            encoded = b''.join(self.volume.executor.map(
+                lambda i: self._encode_blocks(data[i:i + chunk], first + i // bs), range(0, len(data), chunk)))
+        else:
+            encoded = self._encode_blocks(data, first)
+        os.pwrite(self.fd, encoded, self.offset + first * bs)
+        self.block += num_blocks
+
+    def write(self, b):
+        data = memoryview(b).cast('B')
+        n = len(data)
+        bs = self.block_size
+        if len(self.pending) > 0:
+            fill = min(bs - len(self.pending), len(data))
+            self.pending += data[:fill]
+            data = data[fill:]
+            if len(self.pending) == bs:
+                self._write_blocks(bytes(self.pending))
+                self.pending = bytearray()
+        full = len(data) // bs * bs
+        if full > 0:
+            self._write_blocks(bytes(data[:full]))
+        self.pending += data[full:]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            try:
+                if len(self.pending) > 0:
+                    if self.volume.config.unique_iv and self.file_iv == 0:
+                        self._write_header()
+                    os.pwrite(self.fd, self.volume.key.stream_encode(self.pending, self.block ^ self.file_iv),
+                              self.offset + self.block * self.block_size)
+                    self.pending = bytearray()
+            finally:
+                os.close(self.fd)
+        super().close()
+
+
+_volumes = dict()
+
+
+def get_volume(encfs_root, mount_dir=None):
+    """Volume for encfs_root, cached per process (the key derivation takes about a second)"""
+    key = (os.path.realpath(encfs_root), os.path.abspath(mount_dir) if mount_dir else None)
+    if key not in _volumes:
+        _volumes[key] = EncfsVolume(encfs_root, mount_dir=mount_dir)
+    return _volumes[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FUSE-free access to files in an EncFS volume.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    check_parser = subparsers.add_parser('check', help="Check the password and print the volume config")
+    check_parser.add_argument('encfs_root', type=str)
+    ls_parser = subparsers.add_parser('ls', help="List a directory in the volume with plaintext sizes")
+    ls_parser.add_argument('encfs_root', type=str)
+    ls_parser.add_argument('path', type=str, nargs='?', default='.')
+    cat_parser = subparsers.add_parser('cat', help="Write the plaintext of a file in the volume to stdout")
+    cat_parser.add_argument('encfs_root', type=str)
+    cat_parser.add_argument('path', type=str)
+    for name, help_text in [('decrypt', "Copy the file SRC in the volume to the plain file DST"),
+                            ('encrypt', "Copy the plain file SRC to the file DST in the volume")]:
+        copy_parser = subparsers.add_parser(name, help=help_text)
+        copy_parser.add_argument('encfs_root', type=str)
+        copy_parser.add_argument('src', type=str)
+        copy_parser.add_argument('dst', type=str)
+    args = parser.parse_args()
+
+    volume = EncfsVolume(args.encfs_root)
+    if args.subcommand == 'check':
+        cfg = volume.config
+        print(f"EncFS volume {volume.root}: {cfg.cipher} ({8 * cfg.key_size} bit key), {cfg.name_alg}, block size "
+              f"{cfg.block_size}, unique IV {int(cfg.unique_iv)}, holes {int(cfg.allow_holes)} - password valid.")
+    elif args.subcommand == 'ls':
+        for name in volume.listdir(args.path):
+            path = os.path.join(args.path, name)
+            if os.path.isdir(volume.encrypted_path(path)):
+                print(f"{'-':>14}  {name}/")
+            else:
+                print(f"{volume.getsize(path):>14}  {name}")
+    else:
+        src_volume = volume if args.subcommand in ['cat', 'decrypt'] else None
+        with (src_volume.open(args.src if args.subcommand == 'decrypt' else args.path) if src_volume else
+              open(args.src, 'rb')) as src:
+            if args.subcommand == 'cat':
+                dst = sys.stdout.buffer
+            else:
+                dst = volume.open(args.dst, 'wb') if args.subcommand == 'encrypt' else open(args.dst, 'wb')
+            try:
+                while True:
+                    data = src.read(volume.read_size())
+                    if not data:
+                        break
+                    dst.write(data)
+            finally:
+                if dst is not sys.stdout.buffer:
+                    dst.close()
+    volume.close()
+
+
+if __name__ == '__main__':
+    main()
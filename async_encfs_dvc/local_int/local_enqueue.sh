@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+set -euo pipefail
+
+# A dvc stage with this script should be created with dvc_create_stage (local_opts in the app policy), i.e.
+#   dvc stage add --name <stage-name> --desc ... --deps ... --outs-persist ... --no-exec dvc_cmd <stage-name> local_enqueue.sh <stage-name> <app-policy> <app-stage> command
+# and run with
+#   dvc repro --no-commit --no-lock <stage-name>
+# The stage is run and committed asynchronously by the local executor of the repo (cf. local_executor.py).
+
+exec python3 -m async_encfs_dvc.local_int.local_executor enqueue "$@"
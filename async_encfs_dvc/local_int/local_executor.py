@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+
+# Local executor backend for asynchronous DVC stages without SLURM (counterpart of slurm_enqueue.sh)
+#
+# Usage: local_enqueue.sh DVC_STAGE_NAME INST_APP_POLICY APP_STAGE COMMAND [PARAMS...]  (stage command, cf. dvc_cmd)
+#        dvc_local status [--json]
+#        dvc_local wait [--timeout SECS]
+#        dvc_local cancel
+#        python3 -m async_encfs_dvc.local_int.local_executor serve DVC_ROOT  (started on demand by enqueue)
+#
+# Stages created with local_opts (cf. dvc_create_stage) are run with dvc repro --no-commit --no-lock, which enqueues
+# them to a per-repo executor process instead of running them. Each stage goes through the same status files as with
+# SLURM (<stage>.dvc_pending -> .dvc_started -> .dvc_complete (removed by the commit) or .dvc_failed) and is started
+# as soon as the stage jobs of its DVC dependencies completed and enough CPU slots are free. A stage takes
+# --ntasks x --cpus-per-task slots of its local_opts, the executor has DVC_LOCAL_SLOTS (default: all CPUs available to
+# it, stages requesting more are limited to it when enqueued and again by the running executor, which keeps the slots
+# it was started with). Stages are started in submission order, smaller ones may start ahead of a stage waiting for
+# slots. Commits are run one at a time by a background worker (retried while dvc repro or another dvc command holds
+# the repo lock).
+#
+# The executor keeps its state in .dvc/tmp/local_executor: a JSON file per active (queued/running) job in jobs/,
+# finished jobs in history.jsonl and its own log in executor.log. It exits when it has been idle for
+# DVC_LOCAL_IDLE_TIMEOUT (default: 60) seconds and is restarted by the next enqueue.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import queue
+import signal
+import argparse
+import threading
+import subprocess as sp
+
+import yaml
+
+from async_encfs_dvc import stage_compression
+from async_encfs_dvc.dvc_layout import get_stage_dvc_yaml, unlock_stage
+from async_encfs_dvc.dvc_timing import record_span
+from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root, get_dvc_slurm_job_suffix
+
+
+ACTIVE_STATES = ['queued', 'running']
+POLL_INTERVAL = 0.2  # secs between checks of the executor for new/finished jobs
+LOCK_ERROR = 'Unable to acquire lock'  # dvc commit error while dvc repro (or another dvc command) holds the repo lock
+
+
+def log(message):
+    print(f"local_executor: {message}", file=sys.stderr, flush=True)
+
+
+def get_state_dir(dvc_root):
+    return os.path.join(dvc_root, '.dvc', 'tmp', 'local_executor')
+
+
+def get_total_slots():
+    return int(os.environ.get('DVC_LOCAL_SLOTS') or len(os.sched_getaffinity(0)))
+
+
+def get_job_name(stage_name, dvc_root):
+    """Job name of a stage (as the SLURM job name in slurm_enqueue.sh)"""
+    return f"dvc_{stage_name}_{get_dvc_slurm_job_suffix(dvc_root)}"
+
+
+def get_local_opts(app_yaml_filename, app_stage):
+    """Number of tasks and CPUs per task of a stage from the local_opts in the instantiated app policy"""
+    with open(app_yaml_filename) as f:
+        dvc_app_yaml = yaml.load(f, Loader=yaml.FullLoader)
+    opts = dvc_app_yaml['app']['stages'][app_stage].get('local_opts') or dict()
+    return int(opts.get('--ntasks', opts.get('-n', 1))), int(opts.get('--cpus-per-task', opts.get('-c', 1)))
+
+
+def get_job_dvc_yaml(job):
+    """dvc.yaml of the stage of a job (absolute, cf. dvc_layout.py)"""
+    return job.get('dvc_yaml') or os.path.join(job['stage_dir'], 'dvc.yaml')
+
+
+def set_status(stage_dir, stage_name, old, new):
+    """Rename status file of a stage (as mv + fsync in sbatch_dvc_*.sh), False if it does not exist"""
+    old_file = os.path.join(stage_dir, f"{stage_name}.dvc_{old}")
+    new_file = os.path.join(stage_dir, f"{stage_name}.dvc_{new}")
+    try:
+        os.rename(old_file, new_file)
+    except FileNotFoundError:
+        return False
+    fd = os.open(new_file, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return True
+
+
+class JobStore:
+    """Active jobs as JSON files in jobs/ and finished ones in history.jsonl, ids allocated under state.lock"""
+
+    def __init__(self, dvc_root):
+        self.dvc_root = dvc_root
+        self.state_dir = get_state_dir(dvc_root)
+        self.jobs_dir = os.path.join(self.state_dir, 'jobs')
+        self.history_file = os.path.join(self.state_dir, 'history.jsonl')
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def locked(self):
+        """Exclusive lock on the job store (submission vs. idle shutdown of the executor)"""
+        lock = open(os.path.join(self.state_dir, 'state.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def next_id(self):
+        """Next job id (call with the lock held)"""
+        id_file = os.path.join(self.state_dir, 'next_jobid')
+        job_id = int(open(id_file).read()) if os.path.exists(id_file) else 1
+        with open(id_file, 'w') as f:
+            f.write(str(job_id + 1))
+        return job_id
+
+    def write(self, job):
+        job_file = os.path.join(self.jobs_dir, f"{job['id']}.json")
+        fd = os.open(job_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  # contains the job env
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(job_file + '.tmp', job_file)
+
+    def submit(self, **job):
+        with self.locked():
+            job.update(id=self.next_id(), state='queued', submit_time=time.time())
+            self.write(job)
+        return job
+
+    def load(self):
+        """Active jobs by id"""
+        jobs = dict()
+        for entry in os.scandir(self.jobs_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    with open(entry.path) as f:
+                        job = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):  # finished or being written
+                    continue
+                jobs[job['id']] = job
+        return jobs
+
+    def finish(self, job):
+        record = {k: v for k, v in job.items() if k != 'env'}
+        # a single write of a short line to a file opened with O_APPEND does not interleave with concurrent writers
+        with open(self.history_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        os.remove(os.path.join(self.jobs_dir, f"{job['id']}.json"))
+
+    def load_history(self, since=None):
+        if not os.path.exists(self.history_file):
+            return []
+        with open(self.history_file) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+        return [job for job in history if since is None or (job.get('end_time') or 0) >= since]
+
+
+def executor_running(store):
+    """Whether an executor holds executor.lock of the repo"""
+    with open(os.path.join(store.state_dir, 'executor.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return False
+
+
+def start_executor(store):
+    """Start the executor of the repo unless one is running (a concurrently started one exits immediately)"""
+    if executor_running(store):
+        return
+    with open(os.path.join(store.state_dir, 'executor.log'), 'a') as log_f:
+        sp.Popen([sys.executable, '-m', 'async_encfs_dvc.local_int.local_executor', 'serve', store.dvc_root],
+                 cwd=store.dvc_root, stdin=sp.DEVNULL, stdout=log_f, stderr=sp.STDOUT, start_new_session=True)
+
+
+class Executor:
+    """Runs the stage jobs of a repo in subprocesses with CPU-slot accounting and commits them one at a time"""
+
+    def __init__(self, dvc_root):
+        self.store = JobStore(dvc_root)
+        self.total_slots = get_total_slots()
+        self.cpus = sorted(os.sched_getaffinity(0))
+        self.bind_cpus = os.environ.get('DVC_LOCAL_CPU_BIND', 'NO') == 'YES'
+        self.idle_timeout = float(os.environ.get('DVC_LOCAL_IDLE_TIMEOUT', 60))
+        self.jobs = dict()      # active jobs by id
+        self.finished = dict()  # final state of jobs finished by this executor by id
+        self.procs = dict()     # running stage jobs: id -> (Popen, CPUs, log files)
+        self.free_cpus = list(self.cpus)
+        self.used_slots = 0
+        self.commit_queue = queue.Queue()
+        self.lock = threading.Lock()  # jobs/finished shared with the commit worker
+
+    # -- job bookkeeping
+
+    def update(self, job, **attrs):
+        with self.lock:
+            job.update(attrs)
+            if job['state'] in ACTIVE_STATES:
+                self.store.write(job)
+            else:
+                self.finished[job['id']] = job['state']
+                self.jobs.pop(job['id'], None)
+                self.store.finish(job)
+
+    def load_new_jobs(self):
+        for job_id, job in self.store.load().items():
+            if job_id in self.jobs or job_id in self.finished:  # read before the commit worker finished it
+                continue
+            with self.lock:
+                self.jobs[job_id] = job
+            if job['state'] == 'running':  # left over by a previous executor that did not shut down cleanly
+                log(f"Job {job_id} ({job['name']}) was running when the previous executor exited - failing it.")
+                if job['type'] == 'stage':
+                    self.cleanup(job)
+                self.update(job, state='failed', end_time=time.time(), returncode=None)
+            elif job['type'] == 'commit':
+                self.commit_queue.put(job)
+            elif job['slots'] > self.total_slots:  # enqueued with a larger DVC_LOCAL_SLOTS than the executor's
+                log(f"Warning: Job {job_id} ({job['name']}) requests {job['slots']} slots of {self.total_slots} - "
+                    f"limiting it to {self.total_slots}.")
+                self.update(job, slots=self.total_slots)
+
+    def dep_state(self, job_id):
+        if job_id in self.jobs:
+            return self.jobs[job_id]['state']
+        if job_id in self.finished:
+            return self.finished[job_id]
+        for job in reversed(self.store.load_history()):  # finished before this executor started
+            if job['id'] == job_id:
+                return job['state']
+        return 'failed'
+
+    # -- stage jobs
+
+    def start(self, job):
+        if not set_status(job['stage_dir'], job['stage'], 'pending', 'started'):
+            log(f"Status file {job['stage']}.dvc_pending of job {job['id']} ({job['name']}) not found - "
+                f"not starting it.")
+            self.update(job, state='failed', end_time=time.time(), returncode=None)
+            return
+        cpus = self.free_cpus[:job['slots']]
+        self.free_cpus = self.free_cpus[job['slots']:]
+        self.used_slots += job['slots']
+
+        env = dict(job['env'], DVC_LOCAL_JOB_ID=str(job['id']), DVC_LOCAL_NTASKS=str(job['ntasks']),
+                   DVC_LOCAL_CPUS_PER_TASK=str(job['cpus_per_task']))
+        env.setdefault('OMP_NUM_THREADS', str(job['cpus_per_task']))
+        log_dir = os.path.join(job['stage_dir'], 'output')
+        os.makedirs(log_dir, exist_ok=True)
+        log_prefix = os.path.join(log_dir, f"dvc_local.{job['name']}.{job['id']}")
+        log_files = (open(log_prefix + '.out', 'w'), open(log_prefix + '.err', 'w'))
+        preexec_fn = (lambda: os.sched_setaffinity(0, cpus)) if self.bind_cpus and len(cpus) > 0 else None
+        start_time = time.time()
+        proc = sp.Popen(job['command'], cwd=job['stage_dir'], env=env, stdin=sp.DEVNULL, stdout=log_files[0],
+                        stderr=log_files[1], start_new_session=True, preexec_fn=preexec_fn)
+        self.procs[job['id']] = (proc, cpus, log_files)
+        log(f"Started job {job['id']} ({job['name']}, {job['slots']} slots, pid {proc.pid}).")
+        record_span('queue_wait', job['submit_time'], start_time, job['stage'], job['env'].get('DVC_TIMING_LOG'))
+        self.update(job, state='running', start_time=start_time, pid=proc.pid, cpus=cpus)
+
+    def complete(self, job, returncode):
+        proc, cpus, log_files = self.procs.pop(job['id'])
+        for f in log_files:
+            f.close()
+        self.free_cpus = sorted(self.free_cpus + cpus)
+        self.used_slots -= job['slots']
+        end_time = time.time()
+        record_span('stage', job['start_time'], end_time, job['stage'], job['env'].get('DVC_TIMING_LOG'),
+                    returncode=returncode)
+        if returncode == 0:
+            set_status(job['stage_dir'], job['stage'], 'started', 'complete')
+            log(f"Job {job['id']} ({job['name']}) completed in {end_time - job['start_time']:.1f} s.")
+            if job['env'].get('DVC_SLURM_RUNTIME_HISTORY', 'NO') == 'YES':
+                self.record_runtime(job)
+            commit_job = self.store.submit(type='commit', name=get_job_name('op', self.store.dvc_root),
+                                           stage=job['stage'], stage_dir=job['stage_dir'],
+                                           dvc_yaml=get_job_dvc_yaml(job), env=job['env'], after=[job['id']])
+            with open(os.path.join(job['stage_dir'], f"{job['stage']}.dvc_commit_jobid"), 'w') as f:
+                f.write(f"{commit_job['id']}\n")
+            with self.lock:
+                self.jobs[commit_job['id']] = commit_job
+            self.commit_queue.put(commit_job)
+            self.update(job, state='complete', end_time=end_time, returncode=returncode)
+        else:
+            log(f"Job {job['id']} ({job['name']}) failed with exit code {returncode} "
+                f"(see {os.path.relpath(log_files[1].name, self.store.dvc_root)}).")
+            self.cleanup(job)
+            self.update(job, state='failed', end_time=end_time, returncode=returncode)
+
+    def record_runtime(self, job):
+        p = sp.run([sys.executable, '-m', 'async_encfs_dvc.slurm_int.stage_runtime_history', 'record',
+                    job['app_yaml'], job['app_stage'], job['stage'], str(job['start_time'])],
+                   cwd=job['stage_dir'], env=job['env'], capture_output=True)
+        if p.returncode != 0:
+            log(f"Warning: Failed to record runtime of {job['stage']}: {p.stderr.decode('utf-8').strip()}")
+
+    def cleanup(self, job):
+        """Mark a failed stage (as sbatch_dvc_cleanup.sh), keeping its outputs for post-mortem analysis"""
+        if not set_status(job['stage_dir'], job['stage'], 'pending', 'failed'):
+            set_status(job['stage_dir'], job['stage'], 'started', 'failed')
+        dvc_yaml = get_job_dvc_yaml(job)  # ensure that this stage gets re-executed upon dvc repro
+        if os.path.dirname(dvc_yaml) == job['stage_dir']:
+            lock_file = os.path.join(job['stage_dir'], 'dvc.lock')
+            if os.path.exists(lock_file):
+                os.remove(lock_file)
+        else:  # shared dvc.yaml of a sharded stage layout (only remove this stage's entry)
+            unlock_stage(dvc_yaml, job['stage'])
+
+    def schedule(self):
+        """Start queued stage jobs whose dependencies completed in submission order as long as slots are free"""
+        with self.lock:
+            queued = sorted([j for j in self.jobs.values() if j['type'] == 'stage' and j['state'] == 'queued'],
+                            key=lambda j: j['id'])
+        for job in queued:
+            dep_states = [self.dep_state(dep) for dep in job['after']]
+            if any(state not in ACTIVE_STATES + ['complete'] for state in dep_states):
+                log(f"Dependency of job {job['id']} ({job['name']}) failed - not starting it.")
+                self.cleanup(job)
+                self.update(job, state='failed', end_time=time.time(), returncode=None)
+            elif all(state == 'complete' for state in dep_states) and \
+                    self.used_slots + job['slots'] <= self.total_slots:
+                self.start(job)
+
+    def cancel(self):
+        log("Cancelling all queued and running jobs.")
+        for job_id, (proc, _, _) in list(self.procs.items()):
+            os.killpg(proc.pid, signal.SIGTERM)
+        with self.lock:
+            queued = [job for job in self.jobs.values() if job['type'] == 'stage' and job['state'] == 'queued']
+        for job in queued:
+            self.cleanup(job)
+            self.update(job, state='cancelled', end_time=time.time(), returncode=None)
+
+    # -- commits
+
+    def commit_worker(self):
+        while True:
+            job = self.commit_queue.get()
+            try:
+                self.commit(job)
+            except Exception as e:
+                log(f"Commit job {job['id']} of {job['stage']} failed: {type(e).__name__}: {e}")
+                self.update(job, state='failed', end_time=time.time(), returncode=None)
+            finally:
+                self.commit_queue.task_done()
+
+    def commit(self, job):
+        """dvc commit of a completed stage (as sbatch_dvc_commit.sh in-repo), waiting for the repo lock"""
+        retry_interval = float(job['env'].get('DVC_LOCAL_COMMIT_RETRY_INTERVAL', 5))
+        log_prefix = os.path.join(job['stage_dir'], f"dvc_local.dvc_commit.{job['id']}")
+        dvc_yaml = os.path.relpath(get_job_dvc_yaml(job), job['stage_dir'])
+        self.update(job, state='running', start_time=time.time())
+        while True:
+            with open(log_prefix + '.out', 'w') as out, open(log_prefix + '.err', 'w') as err:
+                p = sp.run(['dvc', 'commit', '--verbose', '--force', f"{dvc_yaml}:{job['stage']}"],
+                           cwd=job['stage_dir'], env=job['env'], stdin=sp.DEVNULL, stdout=out, stderr=err)
+            if p.returncode == 0 or LOCK_ERROR not in open(log_prefix + '.err').read():
+                break
+            time.sleep(retry_interval)  # dvc repro (or another dvc command) is running in the repo
+        if p.returncode == 0:
+            autostage = sp.run([sys.executable, '-c', "from dvc.repo import Repo; "
+                                                      "print(Repo().config['core']['autostage'])"],
+                               cwd=job['stage_dir'], capture_output=True).stdout.decode('utf-8').strip()
+            if autostage == 'True':
+                sp.run(['git', 'add', os.path.join(os.path.dirname(dvc_yaml), 'dvc.lock')], cwd=job['stage_dir'],
+                       check=True)
+            os.remove(os.path.join(job['stage_dir'], f"{job['stage']}.dvc_complete"))
+            log(f"Committed {job['stage']} (job {job['id']}).")
+        else:
+            log(f"Commit job {job['id']} of {job['stage']} failed with exit code {p.returncode} "
+                f"(see {os.path.relpath(log_prefix + '.err', self.store.dvc_root)}).")
+        record_span('commit', job['start_time'], time.time(), job['stage'], job['env'].get('DVC_TIMING_LOG'),
+                    returncode=p.returncode)
+        self.update(job, state='complete' if p.returncode == 0 else 'failed', end_time=time.time(),
+                    returncode=p.returncode)
+
+    # -- main loop
+
+    def idle(self):
+        with self.lock:
+            return len(self.jobs) == 0 and len(self.procs) == 0
+
+    def serve(self):
+        executor_lock = open(os.path.join(self.store.state_dir, 'executor.lock'), 'a')
+        try:
+            fcntl.flock(executor_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # another executor is running for this repo
+        log(f"Executor started for {self.store.dvc_root} with {self.total_slots} slots (pid {os.getpid()}).")
+        threading.Thread(target=self.commit_worker, daemon=True).start()
+        cancel_file = os.path.join(self.store.state_dir, 'cancel')
+        idle_since = time.time()
+        while True:
+            self.load_new_jobs()
+            if os.path.exists(cancel_file):
+                os.remove(cancel_file)
+                self.cancel()
+            for job_id, (proc, _, _) in list(self.procs.items()):
+                returncode = proc.poll()
+                if returncode is not None:
+                    self.complete(self.jobs[job_id], returncode)
+            self.schedule()
+            if not self.idle():
+                idle_since = time.time()
+            elif time.time() - idle_since > self.idle_timeout:
+                with self.store.locked():  # no submission between the last check and releasing executor.lock
+                    self.load_new_jobs()
+                    if self.idle():
+                        log("Executor idle - exiting.")
+                        executor_lock.close()
+                        return
+            time.sleep(POLL_INTERVAL)
+
+
+def get_stage_deps(stage_address):
+    """DVC stage dependencies of a stage as (dependency, stage dir, stage name)"""
+    p = sp.run([sys.executable, '-m', 'async_encfs_dvc.slurm_int.dvc_get_stage_deps', stage_address],
+               capture_output=True, check=True)
+    deps = []
+    for line in p.stdout.decode('utf-8').split('\n'):
+        if len(line) > 0:
+            dep_dir, dep = line.split('\t')
+            deps.append((dep, os.path.realpath(dep_dir), dep.rpartition(':')[2]))
+    return deps
+
+
+def get_stage_outs(stage_name, dvc_yaml_filename='dvc.yaml'):
+    with open(dvc_yaml_filename) as f:
+        dvc_yaml = yaml.load(f, Loader=yaml.FullLoader)
+    return [p for out in dvc_yaml['stages'][stage_name]['outs'] for p in (out if isinstance(out, dict) else [out])]
+
+
+def enqueue(stage_name, app_yaml, app_stage, command):
+    """Submit a stage to the local executor of the repo (same checks and status files as slurm_enqueue.sh)"""
+    def stage_log(message):
+        print(f"local_enqueue.sh[{stage_name}]: {message}", flush=True)
+
+    dvc_root = find_dvc_root()
+    store = JobStore(dvc_root)
+    ntasks, cpus_per_task = get_local_opts(app_yaml, app_stage)
+    total_slots = get_total_slots()
+    slots = ntasks * cpus_per_task
+    if slots > total_slots:
+        stage_log(f"Warning: Stage requests {slots} slots ({ntasks} tasks x {cpus_per_task} CPUs) of "
+                  f"{total_slots} - limiting it to {total_slots}.")
+        slots = total_slots
+    stage_dir = os.path.realpath('.')
+    dvc_yaml = os.path.realpath(get_stage_dvc_yaml())  # exported by dvc_cmd (cf. dvc_layout.py)
+    stage_address = f"{os.path.relpath(dvc_yaml)}:{stage_name}"
+    jobs = store.load().values()
+
+    def find_job(job_type, job_stage_dir, job_stage_name):
+        return next((job for job in jobs if job['type'] == job_type and job['stage_dir'] == job_stage_dir and
+                     job['stage'] == job_stage_name), None)
+
+    def has_status(status_dir, status_stage_name, *states):
+        return any(os.path.exists(os.path.join(status_dir, f"{status_stage_name}.dvc_{s}")) for s in states)
+
+    # Get status of dependencies - queued/running local job, complete (not yet committed), failed or committed
+    after = []
+    for dep, dep_dir, dep_stage_name in get_stage_deps(stage_address):
+        dep_job = find_job('stage', dep_dir, dep_stage_name)
+        if dep_job is not None:
+            after.append(dep_job['id'])
+        elif has_status(dep_dir, dep_stage_name, 'pending', 'started'):
+            stage_log(f"Error: Could not find local job for {dep} despite status pending or started - abort. Handle "
+                      f"this stage manually by removing its status file and running 'dvc repro {dep}'.")
+            sys.exit(1)
+        elif has_status(dep_dir, dep_stage_name, 'failed'):
+            stage_log(f"Error: DVC dependency {dep} failed - abort.")
+            sys.exit(1)
+        elif has_status(dep_dir, dep_stage_name, 'complete'):
+            stage_log(f"DVC dependency {dep} completed (but not yet committed) - no need to wait for it.")
+        else:
+            stage_log(f"No status (pending/started/complete/failed) set for DVC dependency {dep} - assuming "
+                      f"committed, skipping this dependency.")
+
+    # Make sure stage is not already to be run, running, to be committed or committing
+    stage_job = find_job('stage', stage_dir, stage_name)
+    if stage_job is not None:
+        stage_log(f"DVC stage {stage_name} already {stage_job['state']} as local job {stage_job['id']} - "
+                  f"do not resubmit.")
+        return
+    if has_status(stage_dir, stage_name, 'pending', 'started'):
+        stage_log(f"Error: Could not find local job for {stage_name} despite status pending or started - abort. "
+                  f"Handle this stage manually by removing its status file and running 'dvc repro {stage_address}' "
+                  f"(or 'dvc commit {stage_address}' if the stage has completed).")
+        sys.exit(1)
+    if has_status(stage_dir, stage_name, 'complete'):
+        commit_job = find_job('commit', stage_dir, stage_name)
+        if commit_job is not None:
+            stage_log(f"DVC stage {stage_name} completed and found commit job {commit_job['id']} - do not resubmit.")
+            return
+        commit_job = store.submit(type='commit', name=get_job_name('op', dvc_root), stage=stage_name,
+                                  stage_dir=stage_dir, dvc_yaml=dvc_yaml, env=dict(os.environ), after=[])
+        with open(f"{stage_name}.dvc_commit_jobid", 'w') as f:
+            f.write(f"{commit_job['id']}\n")
+        stage_log(f"DVC stage {stage_name} completed, but no commit job found - submitted commit job "
+                  f"{commit_job['id']}.")
+        start_executor(store)
+        return
+    # read-only equivalent of dvc status (dvc repro holds the rwlock, cf. dvc_stage_status.py)
+    p = sp.run([sys.executable, '-m', 'async_encfs_dvc.slurm_int.dvc_stage_status', '--json', stage_address],
+               capture_output=True, check=True)
+    if p.stdout.decode('utf-8').strip() == '{}':
+        stage_log(f"DVC stage {stage_name} committed in the meantime - do not resubmit.")
+        return
+
+    # Clean up of any left-overs from previous run (outs-persist handling coordinated with dvc_create_stage)
+    sp.run([sys.executable, '-m', 'async_encfs_dvc.slurm_int.dvc_reset_outs'] + get_stage_outs(stage_name, dvc_yaml),
+           check=True)
+    for state in ['pending', 'started', 'complete', 'failed']:
+        if os.path.exists(f"{stage_name}.dvc_{state}"):
+            os.remove(f"{stage_name}.dvc_{state}")
+
+    env = dict(os.environ)
+    env.setdefault('DVC_SLURM_RUNTIME_HISTORY', 'YES')  # same default as slurm_enqueue.sh
+    if env.get('DVC_TIMING_LOG'):
+        env['DVC_TIMING_LOG'] = os.path.realpath(env['DVC_TIMING_LOG'])
+    if os.path.exists(stage_compression.SPEC_FILE):  # compress declared outputs after the payload succeeded
+        command = ['bash', '-c', f'"$@" && exec {sys.executable} -m async_encfs_dvc.stage_compression apply '
+                   f'--stage {stage_name}', 'local_enqueue.sh'] + command
+    with open(f"{stage_name}.dvc_pending", 'w') as f:  # before submission, the executor starts with pending->started
+        f.write(' '.join(command) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    stage_job = store.submit(type='stage', name=get_job_name(stage_name, dvc_root), stage=stage_name,
+                             stage_dir=stage_dir, dvc_yaml=dvc_yaml, command=command, ntasks=ntasks,
+                             cpus_per_task=cpus_per_task, slots=slots, after=after, env=env,
+                             app_yaml=os.path.realpath(app_yaml), app_stage=app_stage)
+    with open(f"{stage_name}.dvc_stage_jobid", 'w') as f:
+        f.write(f"{stage_job['id']}\n")
+    start_executor(store)
+    stage_log(f"Submitted stage {stage_name} as local job {stage_job['id']} ({slots} slots"
+              f"{', after jobs ' + ','.join(str(a) for a in after) if len(after) > 0 else ''}).")
+
+
+def print_status(store, as_json):
+    jobs = sorted(store.load().values(), key=lambda j: j['id'])
+    if as_json:
+        print(json.dumps([{k: v for k, v in job.items() if k != 'env'} for job in jobs], indent=2))
+        return
+    running = executor_running(store)
+    used_slots = sum(job.get('slots', 0) for job in jobs if job['type'] == 'stage' and job['state'] == 'running')
+    print(f"Executor {'running' if running else 'not running'}, {used_slots}/{get_total_slots()} slots used, "
+          f"{len(jobs)} active jobs.")
+    if len(jobs) > 0:
+        print(f"{'ID':>6}  {'TYPE':<7}{'STATE':<9}{'SLOTS':>6}{'ELAPSED':>10}  STAGE")
+        for job in jobs:
+            elapsed = f"{time.time() - job['start_time']:.0f}s" if job['state'] == 'running' else '-'
+            stage = os.path.relpath(get_job_dvc_yaml(job), store.dvc_root) + ':' + job['stage']
+            print(f"{job['id']:>6}  {job['type']:<7}{job['state']:<9}{job.get('slots', '-'):>6}{elapsed:>10}  "
+                  f"{stage}")
+
+
+def wait(store, timeout=None):
+    """Wait until all jobs finished, True if none of those finishing meanwhile failed"""
+    start = time.time()
+    while len(store.load()) > 0:
+        if not executor_running(store):
+            start_executor(store)  # e.g. after a crash or reboot, left-over running jobs are failed
+        if timeout is not None and time.time() - start > timeout:
+            log(f"Timeout - {len(store.load())} jobs still active.")
+            return False
+        time.sleep(1)
+    failed = [job for job in store.load_history(since=start) if job['state'] != 'complete']
+    for job in failed:
+        log(f"Job {job['id']} ({job['type']} of {job['stage']}) {job['state']}.")
+    return len(failed) == 0
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'enqueue':  # command of the stage is passed through unparsed
+        if len(sys.argv) < 6:
+            print("Usage: local_enqueue.sh DVC_STAGE_NAME INST_APP_POLICY APP_STAGE COMMAND [PARAMS...]")
+            sys.exit(1)
+        enqueue(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5:])
+        return
+
+    parser = argparse.ArgumentParser(description="Local executor for asynchronous DVC stages without SLURM.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    serve_parser = subparsers.add_parser('serve', help="Run the executor of a repo (started on demand by enqueue)")
+    serve_parser.add_argument('dvc_root', type=str)
+    status_parser = subparsers.add_parser('status', help="Show queued and running jobs")
+    status_parser.add_argument('--json', action='store_true', help="Print active jobs as JSON")
+    wait_parser = subparsers.add_parser('wait', help="Wait until all stages ran and are committed (exit code 1 "
+                                                     "if any failed)")
+    wait_parser.add_argument('--timeout', type=float, default=None, help="Maximum time to wait in seconds")
+    subparsers.add_parser('cancel', help="Cancel all queued and running stage jobs")
+    args = parser.parse_args()
+
+    if args.subcommand == 'serve':
+        Executor(os.path.realpath(args.dvc_root)).serve()
+        return
+    store = JobStore(find_dvc_root())
+    if args.subcommand == 'status':
+        print_status(store, args.json)
+    elif args.subcommand == 'wait':
+        if not wait(store, args.timeout):
+            sys.exit(1)
+    elif args.subcommand == 'cancel':
+        if executor_running(store):
+            open(os.path.join(store.state_dir, 'cancel'), 'w').close()
+        else:
+            log("Executor not running.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Log sink for stage/rank output with bounded memory: reads stdin, batches writes to a log file and rotates it at a
+# size threshold into gzip-compressed segments (<log>.<n>.gz), optionally keeping only the first (head) and
+# last (tail) segments. The segments are listed in an index file (<log>.index) that is used to quickly show the
+# last lines of a log.
+#
+# Usage: <command> 2>&1 | python3 -m async_encfs_dvc.log_sink [--tee] [--append] [--max-bytes SIZE]
+#                                                              [--keep-head N] [--keep-tail N] LOG_FILE
+#        python3 -m async_encfs_dvc.log_sink --tail N LOG_FILE
+#
+# Defaults can be set with DVC_LOG_MAX_BYTES (e.g. 100M, no rotation if unset or 0), DVC_LOG_KEEP_HEAD and
+# DVC_LOG_KEEP_TAIL (number of compressed segments to keep, all if unset).
+
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import select
+import argparse
+import threading
+import queue
+from collections import deque
+
+
+BUFFER_SIZE = 1 << 20   # max. bytes buffered before writing
+FLUSH_INTERVAL = 1.     # max. secs until buffered output is written
+READ_SIZE = 1 << 16
+
+
+def parse_size(size):
+    """Parse size with optional suffix K, M, G (powers of 1024), None if unset or 0"""
+    if size is None or size == '':
+        return None
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    value = str(size).strip().upper().rstrip('B')
+    value = int(float(value[:-1]) * units[value[-1]]) if value[-1] in units else int(value)
+    if value < 0:
+        raise ValueError(f"Invalid size {size} (must not be negative).")
+    return value if value > 0 else None
+
+
+def get_index_file(log_file):
+    return log_file + '.index'
+
+
+def load_index(log_file):
+    index_file = get_index_file(log_file)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return dict(segments=[])
+
+
+def write_index(log_file, index):
+    index_file = get_index_file(log_file)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_file + '.tmp', index_file)
+
+
+class LogSink:
+    """Batched log file writer with size-based rotation into compressed segments"""
+
+    def __init__(self, log_file, max_bytes=None, keep_head=None, keep_tail=None, append=False):
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError(f"Invalid max_bytes {max_bytes} (must be positive, None for no rotation).")
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.keep_head = keep_head
+        self.keep_tail = keep_tail
+
+        if append:
+            self.index = load_index(log_file)
+        else:
+            for segment in load_index(log_file)['segments']:  # like tee, start a new log
+                if os.path.exists(os.path.join(os.path.dirname(log_file), segment['file'])):
+                    os.remove(os.path.join(os.path.dirname(log_file), segment['file']))
+            self.index = dict(segments=[])
+            if os.path.exists(get_index_file(log_file)):
+                os.remove(get_index_file(log_file))
+        self.file = open(log_file, 'ab' if append else 'wb')
+        self.size = self.file.tell()
+
+        self.index_lock = threading.Lock()
+        self.compress_queue = queue.Queue()  # compression in background to not block the producer
+        self.compress_thread = threading.Thread(target=self._compress_worker, daemon=True)
+        self.compress_thread.start()
+
+    def write(self, data):
+        while self.max_bytes is not None and self.size + len(data) >= self.max_bytes:
+            split = data.rfind(b'\n', 0, max(self.max_bytes - self.size, 0)) + 1  # rotate at line boundary if possible
+            if split == 0 and self.size == 0:  # single line longer than max_bytes
+                split = data.find(b'\n') + 1 or len(data)
+            self.file.write(data[:split])
+            self.size += split
+            self.rotate()
+            data = data[split:]
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def rotate(self):
+        """Move current log to the next segment and compress it in the background"""
+        self.file.close()
+        number = self.index['segments'][-1]['number'] + 1 if len(self.index['segments']) > 0 else 1
+        segment_file = f"{self.log_file}.{number}"
+        os.rename(self.log_file, segment_file)
+        with self.index_lock:
+            self.index['segments'].append(dict(number=number, file=os.path.basename(segment_file) + '.gz',
+                                               bytes=self.size, dropped=False))
+        self.compress_queue.put(segment_file)
+        self.file = open(self.log_file, 'wb')
+        self.size = 0
+
+    def _drop_segments(self):
+        """Delete compressed segments between head and tail (if configured)"""
+        segments = [s for s in self.index['segments'] if not s['dropped']]
+        keep_head = self.keep_head if self.keep_head is not None else len(segments)
+        keep_tail = self.keep_tail if self.keep_tail is not None else len(segments)
+        if len(segments) <= keep_head + keep_tail:
+            return
+        for segment in segments[keep_head:len(segments) - keep_tail]:
+            segment_path = os.path.join(os.path.dirname(self.log_file), segment['file'])
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
+            segment['dropped'] = True
+
+    def _compress_worker(self):
+        while True:
+            segment_file = self.compress_queue.get()
+            if segment_file is None:
+                break
+            with open(segment_file, 'rb') as f_in, gzip.open(segment_file + '.gz', 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(segment_file)
+            with self.index_lock:
+                self._drop_segments()
+                write_index(self.log_file, self.index)
+
+    def close(self):
+        self.file.close()
+        self.compress_queue.put(None)
+        self.compress_thread.join()
+        if len(self.index['segments']) > 0:
+            write_index(self.log_file, self.index)
+
+
+def run_sink(sink, tee=False, input_fd=0):
+    """Copy input to sink (and stdout with tee) with bounded buffering"""
+    buffer = bytearray()
+    last_flush = time.monotonic()
+    while True:
+        timeout = max(FLUSH_INTERVAL - (time.monotonic() - last_flush), 0) if len(buffer) > 0 else None
+        ready, _, _ = select.select([input_fd], [], [], timeout)
+        data = os.read(input_fd, READ_SIZE) if ready else None
+        if data is not None and len(data) > 0:
+            if tee:
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+            buffer += data
+        if data == b'' or len(buffer) >= BUFFER_SIZE or time.monotonic() - last_flush >= FLUSH_INTERVAL:
+            if len(buffer) > 0:
+                sink.write(bytes(buffer))
+                sink.flush()
+                buffer.clear()
+            last_flush = time.monotonic()
+        if data == b'':
+            break
+
+
+def _tail_lines(path, num_lines, compressed=False, block_size=1 << 16):
+    """Last num_lines lines of an (optionally compressed) file"""
+    if compressed:
+        with gzip.open(path, 'rb') as f:
+            return list(deque(f, maxlen=num_lines))
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        while pos > 0 and data.count(b'\n') <= num_lines:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            data = f.read(read_size) + data
+        lines = data.splitlines(keepends=True)
+        return lines[-num_lines:] if num_lines > 0 else []
+
+
+def tail(log_file, num_lines):
+    """Last num_lines lines of a log and its (not dropped) segments, newest last"""
+    lines = _tail_lines(log_file, num_lines) if os.path.exists(log_file) else []
+    for segment in reversed(load_index(log_file)['segments']):
+        if len(lines) >= num_lines:
+            break
+        if segment['dropped']:
+            lines = [f"... [segment {segment['number']} with {segment['bytes']} bytes dropped] ...\n".encode()] + lines
+            continue
+        segment_path = os.path.join(os.path.dirname(log_file), segment['file'])
+        if not os.path.exists(segment_path):  # not yet compressed
+            segment_path = segment_path[:-len('.gz')]
+        lines = _tail_lines(segment_path, num_lines - len(lines), segment_path.endswith('.gz')) + lines
+    return lines[-num_lines:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write stdin to a log file with batching and size-based rotation "
+                                                 "(or show the last lines of a log).")
+    parser.add_argument("log_file", type=str, help="Log file")
+    parser.add_argument("--tee", action='store_true', help="Also copy input to stdout")
+    parser.add_argument("--append", action='store_true', help="Append to the log file (and its segments)")
+    parser.add_argument("--max-bytes", type=str, default=os.environ.get('DVC_LOG_MAX_BYTES'),
+                        help="Rotate log at this size (with suffix K, M or G, 0 for no rotation)")
+    parser.add_argument("--keep-head", type=int, default=os.environ.get('DVC_LOG_KEEP_HEAD'),
+                        help="Number of first segments to keep")
+    parser.add_argument("--keep-tail", type=int, default=os.environ.get('DVC_LOG_KEEP_TAIL'),
+                        help="Number of last segments to keep")
+    parser.add_argument("--tail", type=int, default=None, metavar='N', help="Print the last N lines of the log")
+    args = parser.parse_args()
+
+    if args.tail is not None:
+        sys.stdout.buffer.write(b''.join(tail(args.log_file, args.tail)))
+        return
+
+    sink = LogSink(args.log_file, parse_size(args.max_bytes),
+                   int(args.keep_head) if args.keep_head is not None else None,
+                   int(args.keep_tail) if args.keep_tail is not None else None, append=args.append)
+    try:
+        run_sink(sink, tee=args.tee)
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
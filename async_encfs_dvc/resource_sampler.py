@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# Resource usage sampler for stage payloads: records the CPU time, RSS and read/write bytes of a process tree (a rank of
+# encfs_mount_and_run or the command of dvc_cmd) and of the EncFS FUSE daemon serving its mount from /proc at a fixed
+# interval, and summarizes the samples to flag over-provisioned and I/O-bound stages.
+#
+# Usage: python3 -m async_encfs_dvc.resource_sampler record --output CSV_FILE [--pid PID] [--interval SECS]
+#                                                           [--label LABEL] [--rank RANK] [--mem-share N]
+#                                                           [--fuse-mount MOUNT_DIR]
+#        python3 -m async_encfs_dvc.resource_sampler summary [--ranks] [--json] [PATH ...]
+#
+# With DVC_RESOURCE_SAMPLE_INTERVAL (secs) set in the environment, encfs_mount_and_run samples every rank into
+# <rank log without .log>.resources.csv (local rank 0 also samples the EncFS daemon) and dvc_cmd samples synchronous
+# stage commands into output/dvc_stage_resources.csv. The first line of a file is a comment with the allocation (CPUs
+# the process may run on, memory from SLURM_MEM_PER_CPU/SLURM_MEM_PER_NODE divided by the ranks on the node), followed
+# by a CSV header and one row per sample with cumulative counters. CPU time includes terminated child processes (as
+# cutime/cstime), read/write bytes are counted at the syscall level (rchar/wchar, i.e. including reads through FUSE and
+# network file systems). summary searches the given directories for *resources.csv files and reports per stage (or
+# rank with --ranks) the CPU utilization of the allocated CPUs, the peak RSS, the I/O rate and the CPU time of the
+# EncFS daemon relative to the payload's. Docker and podman run the container payload outside of the process tree of
+# their client (under the container daemon or conmon), so ranks with such a client in their process tree are reported
+# as not measured instead of with the usage of the client only.
+
+import os
+import re
+import sys
+import csv
+import json
+import time
+import signal
+import socket
+import argparse
+
+
+CSV_FIELDS = ['time', 'procs', 'cpu_secs', 'rss_bytes', 'hwm_bytes', 'read_bytes', 'write_bytes',
+              'fuse_cpu_secs', 'fuse_rss_bytes', 'fuse_read_bytes', 'fuse_write_bytes', 'container_clients']
+DETACHED_CONTAINER_ENGINES = ['docker', 'podman']  # container processes not descendants of the client
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_proc_stats():
+    """Parent pid, CPU ticks (incl. waited-for children) and RSS bytes of all processes by pid"""
+    stats = dict()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):  # terminated meanwhile
+            continue
+        stats[int(pid)] = dict(ppid=int(fields[1]), ticks=sum(int(v) for v in fields[11:15]),
+                               rss=int(fields[21]) * PAGE_SIZE)
+    return stats
+
+
+def read_io(pid):
+    """Bytes read and written by a process (incl. waited-for children) at the syscall level"""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def read_hwm(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            match = re.search(r"^VmHWM:\s+(\d+) kB", f.read(), re.MULTILINE)
+        return int(match.group(1)) * 1024 if match else 0
+    except OSError:
+        return 0
+
+
+def get_process_tree(stats, root_pid, exclude_pid=None):
+    """Pids of root_pid and its descendants (without exclude_pid and its descendants)"""
+    children = dict()
+    for pid, stat in stats.items():
+        children.setdefault(stat['ppid'], []).append(pid)
+    tree, stack = [], [root_pid] if root_pid in stats else []
+    while stack:
+        pid = stack.pop()
+        if pid == exclude_pid:
+            continue
+        tree.append(pid)
+        stack += children.get(pid, [])
+    return tree
+
+
+def read_cmdline(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            return f.read().decode('utf-8', 'replace').split('\0')
+    except OSError:
+        return ['']
+
+
+def is_container_client(pid):
+    """Whether a process is a docker/podman client running a container (whose processes are outside its tree)"""
+    args = read_cmdline(pid)
+    return os.path.basename(args[0]) in DETACHED_CONTAINER_ENGINES and \
+        any(a in ['run', 'exec', 'start'] for a in args[1:3])
+
+
+def find_fuse_daemons(mount_dir):
+    """Pids of the EncFS processes serving mount_dir"""
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        args = read_cmdline(pid)
+        if os.path.basename(args[0]) == 'encfs' and any(os.path.realpath(a) == mount_dir for a in args[1:] if a):
+            pids.append(int(pid))
+    return pids
+
+
+def get_allocation(pid, mem_share=1):
+    """CPUs the process may run on and its share of the allocated memory in bytes (None if unknown)"""
+    try:
+        cpus = len(os.sched_getaffinity(pid))
+    except OSError:
+        cpus = os.cpu_count()
+    mem_bytes = None
+    if os.environ.get('SLURM_MEM_PER_CPU'):
+        mem_bytes = int(os.environ['SLURM_MEM_PER_CPU']) * cpus << 20
+    elif os.environ.get('SLURM_MEM_PER_NODE'):
+        mem_bytes = (int(os.environ['SLURM_MEM_PER_NODE']) << 20) // max(mem_share, 1)
+    return cpus, mem_bytes
+
+
+def sample(root_pid, start, fuse_pids=()):
+    """Cumulative resource usage of the process tree of root_pid (without this sampler) and the FUSE daemons"""
+    stats = read_proc_stats()
+    tree = get_process_tree(stats, root_pid, exclude_pid=os.getpid())
+    io = [read_io(pid) for pid in tree]
+    fuse = [pid for pid in fuse_pids if pid in stats]
+    fuse_io = [read_io(pid) for pid in fuse]
+    return dict(time=f"{time.time() - start:.1f}", procs=len(tree),
+                cpu_secs=f"{sum(stats[pid]['ticks'] for pid in tree) / CLOCK_TICKS:.2f}",
+                rss_bytes=sum(stats[pid]['rss'] for pid in tree),
+                hwm_bytes=max([read_hwm(pid) for pid in tree] + [0]),
+                read_bytes=sum(r for r, _ in io), write_bytes=sum(w for _, w in io),
+                fuse_cpu_secs=f"{sum(stats[pid]['ticks'] for pid in fuse) / CLOCK_TICKS:.2f}",
+                fuse_rss_bytes=sum(stats[pid]['rss'] for pid in fuse),
+                fuse_read_bytes=sum(r for r, _ in fuse_io), fuse_write_bytes=sum(w for _, w in fuse_io),
+                container_clients=sum(is_container_client(pid) for pid in tree))
+
+
+def record(output, root_pid, interval, label, rank, mem_share=1, fuse_mount=None):
+    """Sample the process tree of root_pid into output until it terminates (or on SIGTERM)"""
+    stop = []
+    signal.signal(signal.SIGTERM, lambda *_: stop.append(True))
+    cpus, mem_bytes = get_allocation(root_pid, mem_share)
+    start = time.time()
+    meta = dict(label=label, rank=rank, host=socket.gethostname(), job_id=os.environ.get('SLURM_JOB_ID', ''),
+                start=start, interval=interval, cpus=cpus, mem_bytes=mem_bytes, fuse_mount=fuse_mount)
+    fuse_mount = os.path.realpath(fuse_mount) if fuse_mount else None
+    fuse_pids = []
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', newline='') as f:
+        f.write(f"# {json.dumps(meta)}\n")
+        writer = csv.DictWriter(f, CSV_FIELDS)
+        writer.writeheader()
+        while True:
+            if fuse_mount is not None and len(fuse_pids) == 0:  # mounted after the sampler was started
+                fuse_pids = find_fuse_daemons(fuse_mount)
+            if not os.path.exists(f"/proc/{root_pid}"):
+                break
+            writer.writerow(sample(root_pid, start, fuse_pids))
+            f.flush()
+            if stop:
+                break
+            deadline = time.time() + interval
+            while not stop and time.time() < deadline and os.path.exists(f"/proc/{root_pid}"):
+                time.sleep(min(0.1, interval))
+
+
+def load_samples(path):
+    """Allocation and samples of a resource file"""
+    with open(path) as f:
+        first = f.readline()
+        meta = json.loads(first[1:]) if first.startswith('#') else dict()
+        rows = list(csv.DictReader(f if first.startswith('#') else [first] + f.readlines()))
+    return meta, [{k: float(v) for k, v in row.items()} for row in rows]
+
+
+def find_resource_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d not in ['.git', '.dvc']]
+            files += [os.path.join(dirpath, fn) for fn in sorted(filenames) if fn.endswith('resources.csv')]
+    return files
+
+
+def summarize_rank(meta, samples):
+    """Usage of a rank over its samples (counters as differences between the first and last sample, utilization not
+    measured with a detached container payload)"""
+    first, last = samples[0], samples[-1]
+    measured = max(s.get('container_clients', 0) for s in samples) == 0
+    duration = last['time'] - first['time']
+    cpu_secs = last['cpu_secs'] - first['cpu_secs']
+    fuse_cpu_secs = last['fuse_cpu_secs'] - first['fuse_cpu_secs']
+    io_bytes = last['read_bytes'] - first['read_bytes'] + last['write_bytes'] - first['write_bytes']
+    peak_rss = max(max(s['rss_bytes'] for s in samples), max(s['hwm_bytes'] for s in samples))
+    return dict(label=meta.get('label', ''), rank=meta.get('rank', ''), host=meta.get('host', ''),
+                samples=len(samples), duration=duration, cpus=meta.get('cpus'), cpu_secs=cpu_secs,
+                cpu_util=cpu_secs / (duration * meta['cpus']) if measured and duration > 0 and meta.get('cpus')
+                else None,
+                peak_rss_bytes=int(peak_rss), mem_bytes=meta.get('mem_bytes'),
+                mem_util=peak_rss / meta['mem_bytes'] if measured and meta.get('mem_bytes') else None,
+                io_bytes=int(io_bytes), io_rate=io_bytes / duration if measured and duration > 0 else None,
+                measured=measured, fuse_cpu_secs=fuse_cpu_secs,
+                fuse_share=fuse_cpu_secs / (cpu_secs + fuse_cpu_secs) if cpu_secs + fuse_cpu_secs > 0 else None)
+
+
+def summarize_stage(label, ranks):
+    """Usage of a stage over its ranks (mean utilization, max peak RSS, total I/O)"""
+    def mean(key):
+        values = [r[key] for r in ranks if r[key] is not None]
+        return sum(values) / len(values) if len(values) > 0 else None
+    duration = max(r['duration'] for r in ranks)
+    io_bytes = sum(r['io_bytes'] for r in ranks)
+    cpu_secs = sum(r['cpu_secs'] for r in ranks)
+    fuse_cpu_secs = sum(r['fuse_cpu_secs'] for r in ranks)
+    measured = all(r['measured'] for r in ranks)
+    return dict(label=label, ranks=len(ranks), duration=duration, cpus=max(r['cpus'] or 0 for r in ranks),
+                cpu_secs=cpu_secs, cpu_util=mean('cpu_util') if measured else None,
+                peak_rss_bytes=max(r['peak_rss_bytes'] for r in ranks),
+                mem_bytes=max(r['mem_bytes'] or 0 for r in ranks) or None, mem_util=max(
+                    [r['mem_util'] for r in ranks if r['mem_util'] is not None], default=None) if measured else None,
+                io_bytes=io_bytes, io_rate=io_bytes / duration / len(ranks) if measured and duration > 0 else None,
+                measured=measured, fuse_cpu_secs=fuse_cpu_secs,
+                fuse_share=fuse_cpu_secs / (cpu_secs + fuse_cpu_secs) if cpu_secs + fuse_cpu_secs > 0 else None)
+
+
+def get_flags(usage, cpu_threshold, mem_threshold, io_rate_threshold, fuse_share_threshold):
+    """Flags of a stage/rank: io-bound (low CPU utilization with high I/O rate or EncFS overhead),
+    cpu-overprovisioned (low CPU utilization otherwise) and mem-overprovisioned (low peak RSS), or not-measured
+    (detached container payload)"""
+    if not usage['measured']:
+        return ['not-measured']
+    flags = []
+    low_cpu = usage['cpu_util'] is not None and usage['cpu_util'] < cpu_threshold
+    io_heavy = (usage['io_rate'] or 0) >= io_rate_threshold or (usage['fuse_share'] or 0) >= fuse_share_threshold
+    if low_cpu and io_heavy:
+        flags.append('io-bound')
+    elif low_cpu and (usage['cpus'] or 1) > 1:
+        flags.append('cpu-overprovisioned')
+    if usage['mem_util'] is not None and usage['mem_util'] < mem_threshold:
+        flags.append('mem-overprovisioned')
+    return flags
+
+
+def format_bytes(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if size < 1024. or unit == 'TiB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024.
+
+
+def format_percent(value):
+    return f"{100. * value:.0f} %" if value is not None else '-'
+
+
+def print_summary(rows, key):
+    print(f"{key.upper():<40}{'SECS':>8}{'CPUS':>6}{'CPU_UTIL':>10}{'PEAK_RSS':>12}{'MEM_UTIL':>10}"
+          f"{'IO_RATE':>14}{'FUSE_CPU':>10}  FLAGS")
+    for row in rows:
+        io_rate = f"{format_bytes(row['io_rate'])}/s" if row['io_rate'] is not None else '-'
+        print(f"{str(row[key])[:39]:<40}{row['duration']:>8.0f}{row['cpus'] or '-':>6}"
+              f"{format_percent(row['cpu_util']):>10}{format_bytes(row['peak_rss_bytes']):>12}"
+              f"{format_percent(row['mem_util']):>10}{io_rate:>14}{format_percent(row['fuse_share']):>10}  "
+              f"{','.join(row['flags']) or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resource usage sampler for stage payloads.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    record_parser = subparsers.add_parser('record', help="Sample the process tree of PID until it terminates")
+    record_parser.add_argument('--output', type=str, required=True, help="CSV file to write samples to")
+    record_parser.add_argument('--pid', type=int, default=os.getppid(), help="Root of the process tree "
+                                                                             "(default: parent process)")
+    record_parser.add_argument('--interval', type=float,
+                               default=float(os.environ.get('DVC_RESOURCE_SAMPLE_INTERVAL') or 10),
+                               help="Secs between samples (default: DVC_RESOURCE_SAMPLE_INTERVAL or 10)")
+    record_parser.add_argument('--label', type=str, default=None, help="Stage label (default: SLURM job name or "
+                                                                       "working directory)")
+    record_parser.add_argument('--rank', type=str, default=os.environ.get('SLURM_PROCID', '0'))
+    record_parser.add_argument('--mem-share', type=int, default=1, help="Number of ranks sharing the node's memory")
+    record_parser.add_argument('--fuse-mount', type=str, default=None, help="Also sample the EncFS daemon of this "
+                                                                            "mount point")
+    summary_parser = subparsers.add_parser('summary', help="Summarize resource files and flag over-provisioned "
+                                                           "and I/O-bound stages")
+    summary_parser.add_argument('paths', nargs='*', default=['.'], help="Resource files or directories to search "
+                                                                        "for *resources.csv (default: .)")
+    summary_parser.add_argument('--ranks', action='store_true', help="Report every rank instead of every stage")
+    summary_parser.add_argument('--json', action='store_true', help="Print as JSON")
+    summary_parser.add_argument('--cpu-threshold', type=float, default=0.5,
+                                help="CPU utilization below which CPUs are over-provisioned (default: 0.5)")
+    summary_parser.add_argument('--mem-threshold', type=float, default=0.5,
+                                help="Peak RSS fraction of the memory below which it is over-provisioned "
+                                     "(default: 0.5)")
+    summary_parser.add_argument('--io-rate', type=float, default=10 << 20,
+                                help="I/O bytes/s per rank above which a stage with low CPU utilization is I/O-bound "
+                                     "(default: 10 MiB/s)")
+    summary_parser.add_argument('--fuse-share', type=float, default=0.25,
+                                help="Fraction of CPU time spent in the EncFS daemon above which a stage with low "
+                                     "CPU utilization is I/O-bound (default: 0.25)")
+    args = parser.parse_args()
+
+    if args.subcommand == 'record':
+        label = args.label or os.environ.get('SLURM_JOB_NAME') or os.path.basename(os.getcwd())
+        record(args.output, args.pid, args.interval, label, args.rank, args.mem_share, args.fuse_mount)
+        return
+
+    ranks = []
+    for path in find_resource_files(args.paths):
+        meta, samples = load_samples(path)
+        if len(samples) >= 2:
+            ranks.append(dict(summarize_rank(meta, samples), file=path))
+    if args.ranks:
+        rows = ranks
+    else:
+        stages = dict()
+        for rank in ranks:
+            stages.setdefault(rank['label'], []).append(rank)
+        rows = [summarize_stage(label, stage_ranks) for label, stage_ranks in stages.items()]
+    for row in rows:
+        row['flags'] = get_flags(row, args.cpu_threshold, args.mem_threshold, args.io_rate, args.fuse_share)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_summary(rows, 'file' if args.ranks else 'label')
+        print(f"{len(ranks)} ranks with at least 2 samples.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
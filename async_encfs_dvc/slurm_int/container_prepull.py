@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Pre-pull the container images of DVC stages (docker/sarus) once per image and pin stage commands to their digests
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.container_prepull pin -- COMMAND [PARAMS...]
+#          pulls the image of the container command (as generated by dvc_create_stage) unless already recorded and
+#          prints the command with the image pinned to its digest (NUL-terminated arguments, used by slurm_enqueue.sh)
+#        python3 -m async_encfs_dvc.slurm_int.container_prepull warm [--refresh] [DVC_YAML ...]
+#          pre-flight pull of the images of all stages in the dvc.yaml files (default: all tracked by git)
+#        python3 -m async_encfs_dvc.slurm_int.container_prepull pull -- COMMAND [PARAMS...]
+#          pull the (pinned) image of the command into the node-local image store unless present (run once per node)
+#        python3 -m async_encfs_dvc.slurm_int.container_prepull show
+#
+# Digests are recorded in <dvc root>/.dvc/tmp/container_images.json, so that every image is pulled only once per repo
+# (concurrent enqueues wait for a running pull). Images loaded into sarus (load/...) or only available locally
+# (docker images without a registry digest) are not pulled and not pinned. Sarus images are pulled once into the
+# (shared) sarus image store, but not pinned as sarus does not report their full digest.
+# The container CLIs can be overridden with DVC_CONTAINER_DOCKER and DVC_CONTAINER_SARUS (e.g. for a fake CLI).
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shlex
+import argparse
+import subprocess as sp
+from contextlib import contextmanager
+
+import yaml
+
+
+CONTAINER_ENGINES = ['docker', 'sarus']
+
+
+def get_container_cli(engine):
+    return shlex.split(os.environ.get(f"DVC_CONTAINER_{engine.upper()}", engine))
+
+
+def find_container_image(cmd_args):
+    """Find engine and index of the image in a container command (... <engine> run ... --entrypoint bash <image> ...)"""
+    for i, arg in enumerate(cmd_args[:-1]):
+        if os.path.basename(arg) in CONTAINER_ENGINES and cmd_args[i + 1] == 'run':
+            for j in range(i + 2, len(cmd_args) - 2):
+                if cmd_args[j] == '--entrypoint':
+                    return os.path.basename(arg), j + 2
+    return None, None
+
+
+def is_pinned(image):
+    return '@' in image
+
+
+def is_local_image(engine, image):
+    return engine == 'sarus' and image.startswith('load/')
+
+
+def get_cache_file():
+    dvc_root = sp.run(['dvc', 'root'], capture_output=True, check=True).stdout.decode('utf-8').strip()
+    return os.path.join(dvc_root, '.dvc', 'tmp', 'container_images.json')
+
+
+@contextmanager
+def locked_cache(cache_file):
+    """Load image digest records under an exclusive file lock and write them back on exit"""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        records = dict()
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                records = json.load(f)
+        yield records
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(records, f, indent=2)
+        os.replace(cache_file + '.tmp', cache_file)
+
+
+def docker_repo_digest(image):
+    """Registry digest (repo@sha256:...) of a local docker image (None if it has none)"""
+    inspect = sp.run(get_container_cli('docker') + ['image', 'inspect', '--format', '{{json .RepoDigests}}', image],
+                     capture_output=True)
+    if inspect.returncode != 0:
+        return None
+    repo_digests = json.loads(inspect.stdout.decode('utf-8').strip() or '[]') or []
+    repo = image.rsplit(':', 1)[0] if ':' in image.split('/')[-1] else image
+    for repo_digest in repo_digests:
+        if repo_digest.split('@')[0] == repo:
+            return repo_digest
+    return repo_digests[0] if len(repo_digests) > 0 else None
+
+
+def is_present(image):
+    """Whether a docker image is in the local image store"""
+    return sp.run(get_container_cli('docker') + ['image', 'inspect', '--format', '{{.Id}}', image],
+                  capture_output=True).returncode == 0
+
+
+def pull_image(engine, image):
+    """Pull image and return its digest reference to pin commands to (None if not pinnable)"""
+    pull = sp.run(get_container_cli(engine) + ['pull', image], stdout=sys.stderr)
+    if engine == 'docker':
+        digest = docker_repo_digest(image)
+        if pull.returncode != 0 and digest is None:
+            raise RuntimeError(f"Failed to pull docker image {image}.")
+        return digest
+    if pull.returncode != 0:
+        raise RuntimeError(f"Failed to pull sarus image {image}.")
+    return None
+
+
+def resolve_image(records, engine, image, refresh=False):
+    """Pull image unless recorded (or refresh) and return the image reference to use in stage commands"""
+    if is_pinned(image) or is_local_image(engine, image):
+        return image
+    if refresh or image not in records:
+        print(f"container_prepull: Pulling {engine} image {image}.", file=sys.stderr)
+        records[image] = dict(engine=engine, digest=pull_image(engine, image), pulled=time.time())
+    return records[image]['digest'] or image
+
+
+def pin_command(cmd_args, cache_file=None):
+    """Return container command with image pinned to its digest (pulling it once per repo)"""
+    engine, index = find_container_image(cmd_args)
+    if engine is None:
+        return cmd_args
+    with locked_cache(cache_file or get_cache_file()) as records:
+        pinned_image = resolve_image(records, engine, cmd_args[index])
+    return cmd_args[:index] + [pinned_image] + cmd_args[index + 1:]
+
+
+def get_stage_commands(dvc_yaml_files):
+    """Split commands of all stages in dvc.yaml files"""
+    commands = []
+    for dvc_yaml_file in dvc_yaml_files:
+        with open(dvc_yaml_file) as f:
+            dvc_yaml = yaml.load(f, Loader=yaml.FullLoader)
+        for stage in (dvc_yaml or dict()).get('stages', dict()).values():
+            cmds = stage.get('cmd', [])
+            for cmd in (cmds if isinstance(cmds, list) else [cmds]):
+                try:
+                    commands.append(shlex.split(cmd))
+                except ValueError:
+                    continue
+    return commands
+
+
+def warm(dvc_yaml_files, refresh=False, cache_file=None):
+    """Pull the images of all stages in dvc_yaml_files once (per unique image)"""
+    images = dict()
+    for cmd_args in get_stage_commands(dvc_yaml_files):
+        engine, index = find_container_image(cmd_args)
+        if engine is not None:
+            images[cmd_args[index]] = engine
+    with locked_cache(cache_file or get_cache_file()) as records:
+        for image, engine in images.items():
+            print(f"{image} -> {resolve_image(records, engine, image, refresh)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-pull container images of DVC stages and pin them to digests.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    pin_parser = subparsers.add_parser('pin', help="Print container command with pinned image (NUL-terminated)")
+    pin_parser.add_argument('command', nargs=argparse.REMAINDER)
+    pull_parser = subparsers.add_parser('pull', help="Pull image of container command into node-local image store")
+    pull_parser.add_argument('command', nargs=argparse.REMAINDER)
+    warm_parser = subparsers.add_parser('warm', help="Pull images of all stages in dvc.yaml files")
+    warm_parser.add_argument('dvc_yaml', nargs='*', help="dvc.yaml files (default: all dvc.yaml files tracked by git)")
+    warm_parser.add_argument('--refresh', action='store_true', help="Pull again already recorded images")
+    subparsers.add_parser('show', help="Show recorded image digests")
+    args = parser.parse_args()
+
+    if args.subcommand in ['pin', 'pull']:
+        cmd_args = args.command[1:] if len(args.command) > 0 and args.command[0] == '--' else args.command
+
+    if args.subcommand == 'pin':
+        try:
+            cmd_args = pin_command(cmd_args)
+        except (RuntimeError, OSError, sp.CalledProcessError) as e:
+            print(f"container_prepull: Warning - not pinning container image ({e}).", file=sys.stderr)
+        sys.stdout.write(''.join(arg + '\0' for arg in cmd_args))
+    elif args.subcommand == 'pull':
+        engine, index = find_container_image(cmd_args)
+        if engine == 'docker' and not is_present(cmd_args[index]):
+            try:
+                pull_image(engine, cmd_args[index])
+            except RuntimeError as e:
+                print(f"container_prepull: Warning - {e}", file=sys.stderr)
+                sys.exit(1)
+    elif args.subcommand == 'warm':
+        dvc_yaml_files = args.dvc_yaml
+        if len(dvc_yaml_files) == 0:
+            dvc_yaml_files = sp.run(['git', 'ls-files', '--full-name', ':(top)*dvc.yaml'], capture_output=True,
+                                    check=True).stdout.decode('utf-8').split()
+            git_root = sp.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True,
+                              check=True).stdout.decode('utf-8').strip()
+            dvc_yaml_files = [os.path.join(git_root, f) for f in dvc_yaml_files]
+        warm(dvc_yaml_files, args.refresh)
+    elif args.subcommand == 'show':
+        with locked_cache(get_cache_file()) as records:
+            for image, record in records.items():
+                print(f"{image} ({record['engine']}): {record['digest'] or 'not pinned'}, pulled at "
+                      f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['pulled']))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -18,11 +18,13 @@ case $1 in
 esac
 dvc_stage_name="$2"
 shift 2
+dvc_stage_dvc_yaml="${DVC_STAGE_DVC_YAML:-dvc.yaml}"  # shared dvc.yaml of a sharded stage layout (cf. dvc_layout.py)
 
 
 if [[ ${in_repo} == NO ]]; then
   source "$(dirname "$0")"/dvc_out_of_repo.sh
   stage_dir=$(realpath --relative-to=$(dvc root) .)
+  stage_dvc_yaml=$(realpath --relative-to=$(dvc root) "${dvc_stage_dvc_yaml}")
   repo_dir=$(realpath --relative-to=$(dvc root)/.. $(dvc root))
   
   # setup auxiliary repo
@@ -31,14 +33,14 @@ if [[ ${in_repo} == NO ]]; then
 
   # 1. commit out-of-repo (analogous for out-of-repo dvc pull, out-of-repo dvc push first needs a pull from the main repo)
   echo "Committing dvc stage $@ out of repo (prepare step)."
-  time dvc commit --verbose --force "${stage_dir}/dvc.yaml:${dvc_stage_name}"
+  time dvc commit --verbose --force "${stage_dvc_yaml}:${dvc_stage_name}"
 
   cd ../${repo_dir}
 
   # 2. pull commit from main repo
   dvc remote add --verbose local_temp ../${aux_repo_dir}/.dvc/cache  # extra local dvc pull (safest option)
   echo "Committing dvc stage $@ out of repo (commit step)."
-  time dvc pull --remote local_temp "${stage_dir}/dvc.yaml:${dvc_stage_name}"  # FIXME: still triggers hash computation on pulled files - need to find a way to pull also cache.db content
+  time dvc pull --remote local_temp "${stage_dvc_yaml}:${dvc_stage_name}"  # FIXME: still triggers hash computation on pulled files - need to find a way to pull also cache.db content
   dvc remote remove --verbose local_temp
 
   # cleanup auxiliary repo
@@ -47,6 +49,6 @@ if [[ ${in_repo} == NO ]]; then
 else
   # commit in the main repo
   echo "Committing dvc stage $@."
-  time dvc commit --verbose --force "${dvc_stage_name}" 
+  time dvc commit --verbose --force "${dvc_stage_dvc_yaml}:${dvc_stage_name}"
 fi
 
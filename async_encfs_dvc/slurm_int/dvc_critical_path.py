@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Critical-path-aware priorities of SLURM DVC stage jobs
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.dvc_critical_path nice STAGE_NAME   (prints --nice=N, slurm_enqueue.sh)
+#        python3 -m async_encfs_dvc.slurm_int.dvc_critical_path show [--json] [--active]
+#
+# The remaining critical-path length of a stage is its expected duration plus the longest remaining critical path of
+# the stages depending on it (stage graph from the deps/outs of all dvc.yaml files of the repo, cached in
+# .dvc/tmp/critical_path_graph.json). The expected duration of a stage is the median runtime of its app and stage type
+# in the runtime history (cf. stage_runtime_history.py), else the --time declared in its app policy, else the median of
+# the other stages. With DVC_SLURM_CRITICAL_PATH=YES, slurm_enqueue.sh submits stage jobs with
+#   --nice = DVC_SLURM_CRITICAL_PATH_NICE_RANGE (default: 1000) x (1 - critical path of stage / longest critical path)
+# so that the scheduler prefers the stages of the longest chain over short side branches when they compete for nodes,
+# assuming all downstream stages will be run. dvc_scontrol release recomputes the critical paths over the stage jobs
+# actually queued (from the same squeue snapshot) and raises the nice values of jobs whose remaining chain is shorter.
+# Only non-negative nice values are used (unprivileged users cannot set negative ones).
+
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess as sp
+
+import yaml
+
+from async_encfs_dvc.dvc_layout import get_stage_wdir
+from async_encfs_dvc.slurm_int.dvc_scontrol import MAX_IDS_PER_CALL, find_dvc_root, get_dvc_jobs, \
+    get_dvc_slurm_job_suffix
+from async_encfs_dvc.slurm_int.stage_runtime_history import get_history_file, get_static_time_limit, load_history, \
+    matching_runtimes
+
+
+ENQUEUE_COMMAND = re.compile(r'(?:slurm|local)_enqueue\.sh\s+(\S+)\s+(\S+)\s+(\S+)')
+GRAPH_CACHE_VERSION = 2
+
+
+def log(message):
+    print(f"dvc_critical_path: {message}", file=sys.stderr)
+
+
+def get_nice_range():
+    return int(os.environ.get('DVC_SLURM_CRITICAL_PATH_NICE_RANGE', 1000))
+
+
+def get_dvc_yaml_files(dvc_root):
+    """dvc.yaml files of the repo (tracked or untracked, not ignored by git, as in dvc_watch.py)"""
+    output = sp.run(['git', 'ls-files', '--cached', '--others', '--exclude-standard', ':(top)*dvc.yaml'],
+                    capture_output=True, cwd=dvc_root).stdout.decode('utf-8')
+    git_root = sp.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True,
+                      cwd=dvc_root).stdout.decode('utf-8').strip() or dvc_root
+    files = [os.path.join(git_root, f) for f in output.split('\n') if f.endswith('dvc.yaml')]
+    return sorted(f for f in files if f.startswith(dvc_root + os.sep) and os.path.exists(f))
+
+
+def get_stage_policy(stage_dir, cmd):
+    """App name, stage type and declared --time (secs) of a stage from the app policy in its enqueue command"""
+    match = ENQUEUE_COMMAND.search(cmd if isinstance(cmd, str) else ' '.join(cmd))
+    if match is None:
+        return None, None, None
+    app_yaml_filename, stage_type = os.path.join(stage_dir, match.group(2)), match.group(3)
+    try:
+        with open(app_yaml_filename) as f:
+            dvc_app_yaml = yaml.load(f, Loader=yaml.FullLoader)
+        return dvc_app_yaml['app']['name'], stage_type, get_static_time_limit(dvc_app_yaml, stage_type)
+    except (OSError, KeyError, TypeError, ValueError):
+        return None, stage_type, None
+
+
+def read_stages(dvc_yaml_filename, dvc_root):
+    """Stages of a dvc.yaml (keyed by working dir and name) with absolute deps/outs paths and app policy information"""
+    with open(dvc_yaml_filename) as f:
+        dvc_yaml = yaml.load(f, Loader=yaml.FullLoader) or dict()
+    stages = dict()
+    for name, stage in (dvc_yaml.get('stages') or dict()).items():
+        if 'foreach' in stage:  # templated stages are not expanded (no SLURM jobs of their own)
+            continue
+        stage_dir = get_stage_wdir(dvc_yaml_filename, stage)
+        app, stage_type, time_limit = get_stage_policy(stage_dir, stage.get('cmd', ''))
+        key = f"{os.path.relpath(stage_dir, dvc_root)}:{name}"
+        stages[key] = dict(dir=stage_dir, name=name, app=app, stage_type=stage_type, time_limit=time_limit,
+                           frozen=stage.get('frozen', False),
+                           deps=[os.path.normpath(os.path.join(stage_dir, d if isinstance(d, str) else list(d)[0]))
+                                 for d in stage.get('deps') or []],
+                           outs=[os.path.normpath(os.path.join(stage_dir, o if isinstance(o, str) else list(o)[0]))
+                                 for o in stage.get('outs') or []])
+    return stages
+
+
+def get_producers(stages):
+    """Stage key by out path"""
+    return {out: key for key, stage in stages.items() for out in stage['outs']}
+
+
+def find_producer(producers, path, dvc_root):
+    """Key of the stage with an out equal to or containing path (None if not produced by a stage)"""
+    while path.startswith(dvc_root):
+        if path in producers:
+            return producers[path]
+        path = os.path.dirname(path)
+    return None
+
+
+def link_stages(stages, dvc_root):
+    """Add the keys of the downstream stages (children) of each stage (deps equal to or inside outs of a stage)"""
+    producers = get_producers(stages)
+    for stage in stages.values():
+        stage['children'] = []
+    for key, stage in stages.items():
+        parents = set(find_producer(producers, dep, dvc_root) for dep in stage['deps']) - {None}
+        for parent in parents:
+            if parent != key:
+                stages[parent]['children'].append(key)
+
+
+def load_stage_graph(dvc_root):
+    """Stage graph of the repo, reused from the cache as long as no dvc.yaml file changed"""
+    dvc_yaml_files = get_dvc_yaml_files(dvc_root)
+    signature = []
+    for f in dvc_yaml_files:
+        st = os.stat(f)
+        signature.append([os.path.relpath(f, dvc_root), st.st_mtime_ns, st.st_size])
+    cache_file = os.path.join(dvc_root, '.dvc', 'tmp', 'critical_path_graph.json')
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache.get('version') == GRAPH_CACHE_VERSION and cache['signature'] == signature:
+                return cache['stages']
+        except (json.JSONDecodeError, KeyError):
+            pass
+    stages = dict()
+    for f in dvc_yaml_files:
+        stages.update(read_stages(f, dvc_root))
+    link_stages(stages, dvc_root)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + f".tmp{os.getpid()}", 'w') as f:
+        json.dump(dict(version=GRAPH_CACHE_VERSION, signature=signature, stages=stages), f)
+    os.replace(cache_file + f".tmp{os.getpid()}", cache_file)
+    return stages
+
+
+def get_durations(stages, records):
+    """Expected duration (secs) of every stage from the runtime history, the declared --time or the other stages"""
+    medians = dict()
+    durations = dict()
+    for key, stage in stages.items():
+        type_key = (stage['app'], stage['stage_type'])
+        if type_key not in medians:
+            runtimes = matching_runtimes(records, *type_key) if stage['app'] is not None else []
+            medians[type_key] = statistics.median(runtimes) if len(runtimes) > 0 else None
+        durations[key] = medians[type_key] if medians[type_key] is not None else stage['time_limit']
+    known = [d for d in durations.values() if d is not None]
+    default = statistics.median(known) if len(known) > 0 else 1.
+    return {key: d if d is not None else default for key, d in durations.items()}
+
+
+def critical_paths(stages, durations, active=None):
+    """Remaining critical-path length of every stage (only active stages, if given, count with their duration)"""
+    remaining = {key: len(stage['children']) for key, stage in stages.items()}
+    parents = {key: [] for key in stages}
+    for key, stage in stages.items():
+        for child in stage['children']:
+            parents[child].append(key)
+    ready = [key for key, count in remaining.items() if count == 0]  # leaves first (reverse topological order)
+    paths = dict()
+    while len(ready) > 0:
+        key = ready.pop()
+        own = durations[key] if (active is None and not stages[key]['frozen']) or \
+            (active is not None and key in active) else 0.
+        paths[key] = own + max([paths[child] for child in stages[key]['children']], default=0.)
+        for parent in parents[key]:
+            remaining[parent] -= 1
+            if remaining[parent] == 0:
+                ready.append(parent)
+    if len(paths) < len(stages):
+        log("Warning: Stage graph contains a cycle - ignoring the stages on it.")
+    return paths
+
+
+def get_nice(path, longest_path, nice_range=None):
+    nice_range = get_nice_range() if nice_range is None else nice_range
+    if longest_path <= 0:
+        return 0
+    return int(round(nice_range * (1. - path / longest_path)))
+
+
+def get_stage_priorities(dvc_root, active=None):
+    """Expected duration, remaining critical path and nice value of every stage"""
+    stages = load_stage_graph(dvc_root)
+    durations = get_durations(stages, load_history(get_history_file(dvc_root)))
+    full_paths = critical_paths(stages, durations)
+    longest_path = max(full_paths.values(), default=0.)  # same normalization for enqueue and release (nice only rises)
+    paths = full_paths if active is None else critical_paths(stages, durations, active)
+    return {key: dict(duration=durations[key], critical_path=paths[key], nice=get_nice(paths[key], longest_path))
+            for key in paths}
+
+
+def stage_key(dvc_root, stage_dir, stage_name):
+    """Stage key <working dir relative to dvc root>:<stage name> (independent of the dvc.yaml layout)"""
+    return f"{os.path.relpath(os.path.realpath(stage_dir), dvc_root)}:{stage_name}"
+
+
+def job_stage_key(dvc_root, job, job_suffix):
+    """Stage key of a stage job in the squeue snapshot (job name dvc_<stage name>_<job suffix>)"""
+    return stage_key(dvc_root, job['work_dir'], job['name'][len('dvc_'):-len('_' + job_suffix)])
+
+
+def prioritize_jobs(stage_jobs, dvc_root=None, verbose=True):
+    """Raise the nice value of queued stage jobs off the critical path of the stage jobs in the squeue snapshot"""
+    dvc_root = dvc_root or find_dvc_root()
+    job_suffix = get_dvc_slurm_job_suffix(dvc_root)
+    job_keys = {job['job_id']: job_stage_key(dvc_root, job, job_suffix) for job in stage_jobs}
+    priorities = get_stage_priorities(dvc_root, active=set(job_keys.values()))
+    by_nice = dict()
+    for job in stage_jobs:
+        priority = priorities.get(job_keys[job['job_id']])
+        if priority is not None and job['state'] == 'PENDING':
+            job['nice'] = priority['nice']
+            by_nice.setdefault(priority['nice'], []).append(job['job_id'])
+    failed = []
+    for nice, job_ids in sorted(by_nice.items()):  # one scontrol call per distinct nice value
+        for i in range(0, len(job_ids), MAX_IDS_PER_CALL):
+            batch = job_ids[i:i + MAX_IDS_PER_CALL]
+            if sp.run(['scontrol', 'update', f"JobId={','.join(batch)}", f"Nice={nice}"]).returncode != 0:
+                failed += batch
+    if len(failed) > 0:
+        log(f"Warning: Failed to set the nice value of stage jobs {','.join(failed)} (releasing them nevertheless).")
+    if verbose:
+        log(f"Set nice values of {sum(len(ids) for ids in by_nice.values())} stage jobs by remaining critical path "
+            f"({len(by_nice)} distinct values).")
+    return failed
+
+
+def print_priorities(priorities, as_json):
+    if as_json:
+        print(json.dumps(priorities, indent=2))
+        return
+    width = max([len('STAGE')] + [len(key) for key in priorities]) + 2
+    print(f"{'STAGE':<{width}}{'DURATION':>10}{'CRIT_PATH':>11}{'NICE':>7}")
+    for key, p in sorted(priorities.items(), key=lambda item: (-item[1]['critical_path'], item[0])):
+        print(f"{key:<{width}}{p['duration']:>10.0f}{p['critical_path']:>11.0f}{p['nice']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Critical-path-aware priorities of SLURM DVC stage jobs.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    nice_parser = subparsers.add_parser('nice', help="Print the sbatch --nice option of a stage in ./dvc.yaml")
+    nice_parser.add_argument('stage_name', type=str)
+    show_parser = subparsers.add_parser('show', help="Show durations, critical paths and nice values of all stages")
+    show_parser.add_argument('--json', action='store_true', help="Print as JSON")
+    show_parser.add_argument('--active', action='store_true', help="Only count stages with queued/running jobs")
+    args = parser.parse_args()
+
+    dvc_root = find_dvc_root()
+    if args.subcommand == 'nice':
+        priority = get_stage_priorities(dvc_root).get(stage_key(dvc_root, '.', args.stage_name))
+        if priority is None:
+            log(f"Warning: Stage {args.stage_name} not found in the stage graph - not setting --nice.")
+            return
+        print(f"--nice={priority['nice']}", end='')
+    elif args.subcommand == 'show':
+        active = None
+        if args.active:
+            job_suffix = get_dvc_slurm_job_suffix(dvc_root)
+            active = set(job_stage_key(dvc_root, job, job_suffix) for job in get_dvc_jobs(['stage'], dvc_root))
+        print_priorities(get_stage_priorities(dvc_root, active), args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,38 @@
 #!/usr/bin/env python
 
-# Return list of stage dependencies of DVC stage sys.argv[1] in this directory (dvc.yaml)
+# Return list of stage dependencies of DVC stage sys.argv[1] ([DVC_YAML:]STAGE, DVC_YAML defaults to the stage's
+# dvc.yaml in DVC_STAGE_DVC_YAML or ./dvc.yaml) as lines "<working directory>\t<stage address>" relative to this
+# directory
 
+import os
 import sys
 import subprocess as sp
+import yaml
 import pydot
 
-assert ':' not in sys.argv[1]  # else process with abspath
+from async_encfs_dvc.dvc_layout import get_stage_wdir, split_stage_address
 
-dvc_dag_dot = sp.run(f"dvc dag --dot {sys.argv[1]}",  # requires DVC rwlock to be available
-                     shell=True, capture_output=True).stdout.decode('utf-8')
+
+def get_address(dvc_yaml_filename, stage_name):
+    """Stage address as printed by dvc dag (stage name only for ./dvc.yaml)"""
+    dvc_yaml_filename = os.path.normpath(dvc_yaml_filename)
+    return stage_name if dvc_yaml_filename == 'dvc.yaml' else f"{dvc_yaml_filename}:{stage_name}"
+
+
+target = get_address(*split_stage_address(sys.argv[1]))
+dvc_dag_dot = sp.run(['dvc', 'dag', '--dot', target],  # requires DVC rwlock to be available
+                     capture_output=True).stdout.decode('utf-8')
 graph = pydot.graph_from_dot_data(dvc_dag_dot)[0]
 
+dvc_yamls = dict()
 deps = []
 for edge in graph.get_edges():
-    if edge.get_destination().strip('"') == sys.argv[1]:
-        deps.append(edge.get_source().strip('"'))
+    if edge.get_destination().strip('"') == target:
+        dep = edge.get_source().strip('"')
+        dvc_yaml_filename, dep_stage_name = split_stage_address(dep, 'dvc.yaml')
+        if dvc_yaml_filename not in dvc_yamls:
+            with open(dvc_yaml_filename) as f:
+                dvc_yamls[dvc_yaml_filename] = yaml.load(f, Loader=yaml.FullLoader)
+        dep_stage = dvc_yamls[dvc_yaml_filename]['stages'][dep_stage_name]
+        deps.append(f"{get_stage_wdir(dvc_yaml_filename, dep_stage)}\t{dep}")
 print('\n'.join(deps), end='')
@@ -1,19 +1,17 @@
 #!/usr/bin/env python
 
-# Return list of stage outputs of DVC stage in sys.argv[1]
+# Return list of stage outputs of DVC stage in sys.argv[1] ([DVC_YAML:]STAGE, DVC_YAML defaults to the stage's
+# dvc.yaml in DVC_STAGE_DVC_YAML or ./dvc.yaml) relative to the working directory of the stage
 
 import sys
 import yaml
 
-if ':' in sys.argv[1]:
-    filename, stage_name = sys.argv[1].split(':')
-else:
-    filename = 'dvc.yaml'
-    stage_name = sys.argv[1]
+from async_encfs_dvc.dvc_layout import split_stage_address
+
+filename, stage_name = split_stage_address(sys.argv[1])
 
 with open(filename) as f:
     dvc_yaml = yaml.load(f, Loader=yaml.FullLoader)
 
 print('\n'.join([p for out in dvc_yaml['stages'][stage_name]['outs']
                    for p in (out if isinstance(out, dict) else [out])]), end='')
-
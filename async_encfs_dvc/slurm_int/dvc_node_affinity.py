@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+# Node affinity of chained SLURM DVC stages, so that a stage can read the outputs of its upstream stages from the nodes
+# that wrote them (e.g. still in their page cache or node-local storage) instead of cold from the shared file system
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity record STAGE_NAME   (sbatch_dvc_stage.sh)
+#        python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity prefer STAGE_NAME JOB_ID   (slurm_enqueue.sh)
+#        python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity fallback [--interval SECS]
+#        python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity report [--json] [--since TIMESTAMP]
+#
+# With DVC_SLURM_NODE_AFFINITY=YES, every stage job appends the nodes it ran on and the bytes of its deps it read from
+# nodes of the upstream stage jobs to <dvc root>/.dvc/tmp/node_affinity.jsonl when its payload completed. It then sets
+# the ReqNodeList of the pending stage jobs depending on it (scontrol update) to the nodes of their upstream stages,
+# ranked by the bytes written on each node, so that SLURM places them there as soon as their dependencies are
+# satisfied. Upstream stages that are still queued or running are skipped (the last one to complete sets the nodes).
+# slurm_enqueue.sh does the same on submission for stage jobs whose upstream stages have all completed already.
+#
+# As ReqNodeList is a hard constraint in SLURM, a preferred node list is cleared again once the job has been eligible
+# to start (pending for resources or priority) for DVC_SLURM_NODE_AFFINITY_TIMEOUT secs (default: 300). Whenever
+# preferred node lists are set, a singleton fallback job (sbatch_dvc_node_affinity.sh, with the sbatch options of the
+# dvc jobs in DVC_SLURM_NODE_AFFINITY_JOB_OPTS) is submitted unless one is queued already. It starts after half the
+# timeout (--begin), applies the fallback and resubmits itself as long as any preferred node list is set. The fallback
+# is also applied whenever a stage job records its nodes and by the fallback subcommand (e.g. with --interval on the
+# login node). Preferred node lists and the job id of the fallback job are kept in .dvc/tmp/node_affinity_hints.json
+# and node_affinity_fallback_jobid (guarded by an flock) until the stage job records its nodes.
+#
+# report prints the hit rate (stages that ran on at least one node of an upstream stage) and the bytes read from
+# upstream nodes, separately for stage jobs with a preferred node list (hints) and overall.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shlex
+import argparse
+import contextlib
+import subprocess as sp
+
+from async_encfs_dvc.slurm_int.dvc_critical_path import find_producer, get_producers, job_stage_key, \
+    load_stage_graph, stage_key
+from async_encfs_dvc.slurm_int.dvc_scontrol import MAX_IDS_PER_CALL, find_dvc_root, get_dvc_jobs, \
+    get_dvc_slurm_job_suffix, squeue_snapshot
+from async_encfs_dvc.slurm_int.hostlist import Hostlist
+from async_encfs_dvc.slurm_int.stage_runtime_history import get_path_size, load_history
+
+
+INELIGIBLE_REASONS = ['Dependency', 'DependencyNeverSatisfied', 'JobHeldUser', 'JobHeldAdmin', 'BeginTime']
+
+
+def log(message):
+    print(f"dvc_node_affinity: {message}", file=sys.stderr)
+
+
+def get_timeout():
+    return float(os.environ.get('DVC_SLURM_NODE_AFFINITY_TIMEOUT', 300))
+
+
+def get_fallback_jobid_file(dvc_root):
+    return os.path.join(dvc_root, '.dvc', 'tmp', 'node_affinity_fallback_jobid')
+
+
+def get_records_file(dvc_root):
+    return os.path.join(dvc_root, '.dvc', 'tmp', 'node_affinity.jsonl')
+
+
+def get_hints_file(dvc_root):
+    return os.path.join(dvc_root, '.dvc', 'tmp', 'node_affinity_hints.json')
+
+
+@contextlib.contextmanager
+def locked_hints(dvc_root):
+    """Preferred node lists by job id, written back on exit (exclusive flock on a separate lock file)"""
+    hints_file = get_hints_file(dvc_root)
+    os.makedirs(os.path.dirname(hints_file), exist_ok=True)
+    with open(hints_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        hints = dict()
+        if os.path.exists(hints_file):
+            try:
+                with open(hints_file) as f:
+                    hints = json.load(f)
+            except json.JSONDecodeError:
+                log(f"Warning: Ignoring corrupt {hints_file}.")
+        yield hints
+        with open(hints_file + f".tmp{os.getpid()}", 'w') as f:
+            json.dump(hints, f)
+        os.replace(hints_file + f".tmp{os.getpid()}", hints_file)
+
+
+def read_fallback_jobid(dvc_root):
+    """Job id of the last submitted fallback job (None if there is none, call with the hints locked)"""
+    try:
+        with open(get_fallback_jobid_file(dvc_root)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def submit_fallback_job(dvc_root):
+    """Submit a fallback job starting after half the timeout (call with the hints locked), returns its job id"""
+    job_name = f"dvc_node_affinity_fallback_{get_dvc_slurm_job_suffix(dvc_root)}"
+    result = sp.run(['sbatch', '--parsable', '--job-name', job_name, '--begin', f"now+{int(get_timeout() / 2)}",
+                     '--chdir', dvc_root, '--output', os.path.join('.dvc', 'tmp', 'node_affinity_fallback.%j.out'),
+                     '--nodes', '1', '--ntasks', '1'] +
+                    shlex.split(os.environ.get('DVC_SLURM_NODE_AFFINITY_JOB_OPTS', '')) +
+                    [os.path.join(os.path.dirname(os.path.realpath(__file__)), 'sbatch_dvc_node_affinity.sh')],
+                    capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"sbatch of the fallback job failed: {result.stderr.decode('utf-8').strip()}")
+    job_id = result.stdout.decode('utf-8').strip().split(';')[0]
+    with open(get_fallback_jobid_file(dvc_root) + f".tmp{os.getpid()}", 'w') as f:
+        f.write(job_id + '\n')
+    os.replace(get_fallback_jobid_file(dvc_root) + f".tmp{os.getpid()}", get_fallback_jobid_file(dvc_root))
+    return job_id
+
+
+def ensure_fallback_job(dvc_root, jobs):
+    """Submit a fallback job unless the last one is queued or running in the squeue snapshot jobs (call with the hints
+    locked, so that a fallback job about to exit sees the new preferred node lists)"""
+    job_id = read_fallback_jobid(dvc_root)
+    if job_id is not None and any(job['job_id'] == job_id for job in jobs):
+        return job_id
+    return submit_fallback_job(dvc_root)
+
+
+def latest_records(records):
+    """Latest record of every stage"""
+    latest = dict()
+    for r in records:
+        if r['stage'] not in latest or r['end'] >= latest[r['stage']]['end']:
+            latest[r['stage']] = r
+    return latest
+
+
+def get_parents(stages, key):
+    return [parent for parent, stage in stages.items() if key in stage['children']]
+
+
+def preferred_nodes(stages, latest, key, num_nodes, active=()):
+    """Nodes of the completed upstream stages ranked by the bytes of their outputs written there (at most num_nodes)"""
+    node_bytes = dict()
+    for parent in get_parents(stages, key):
+        record = latest.get(parent)
+        if parent in active or record is None or len(record['nodes']) == 0:
+            continue
+        for node in record['nodes']:  # outputs assumed evenly distributed over the nodes of the upstream job
+            node_bytes[node] = node_bytes.get(node, 0) + max(record['out_bytes'], 1) / len(record['nodes'])
+    return sorted(node_bytes, key=lambda node: (-node_bytes[node], node))[:num_nodes]
+
+
+def prefer(dvc_root, stage_jobs, jobs, exclude=(), verbose=True):
+    """Set the ReqNodeList of pending stage jobs to the nodes of their upstream stages (not queued/running in the
+    squeue snapshot jobs except for exclude), returns the updated job ids"""
+    stages = load_stage_graph(dvc_root)
+    latest = latest_records(load_history(get_records_file(dvc_root)))
+    job_suffix = get_dvc_slurm_job_suffix(dvc_root)
+    active = set(job_stage_key(dvc_root, job, job_suffix) for job in get_dvc_jobs(['stage'], dvc_root, jobs)
+                 if job['job_id'] not in exclude)
+    preferred = dict()
+    for job in stage_jobs:
+        key = job_stage_key(dvc_root, job, job_suffix)
+        if job['state'] != 'PENDING' or key not in stages:
+            continue
+        nodes = preferred_nodes(stages, latest, key, int(job.get('num_nodes') or 1), active)
+        if len(nodes) > 0:
+            preferred[job['job_id']] = (key, nodes)
+
+    updated = []
+    with locked_hints(dvc_root) as hints:
+        for job_id, (key, nodes) in preferred.items():
+            if sp.run(['scontrol', 'update', f"JobId={job_id}", f"ReqNodeList={','.join(nodes)}"]).returncode != 0:
+                log(f"Warning: Failed to set the preferred nodes of stage job {job_id} ({key}).")
+                continue
+            hints[job_id] = dict(stage=key, nodes=nodes, since=time.time(), eligible_since=None, fallback=False)
+            updated.append(job_id)
+            if verbose:
+                log(f"Preferring nodes {','.join(nodes)} for stage job {job_id} ({key}).")
+        if len(updated) > 0:  # ReqNodeList is only cleared again if the fallback is applied
+            try:
+                ensure_fallback_job(dvc_root, jobs)
+            except RuntimeError as e:
+                log(f"Warning: {e} - run the fallback subcommand with --interval to clear preferred node lists.")
+    return updated
+
+
+def fallback(dvc_root, jobs=None, timeout=None, verbose=True):
+    """Clear the preferred node lists of stage jobs eligible to start for longer than timeout, drop stale hints"""
+    timeout = get_timeout() if timeout is None else timeout
+    jobs = {job['job_id']: job for job in (jobs if jobs is not None else squeue_snapshot())}
+    now = time.time()
+    expired = []
+    with locked_hints(dvc_root) as hints:
+        for job_id, hint in list(hints.items()):
+            job = jobs.get(job_id)
+            if job is None:
+                if now - hint['since'] >= timeout:  # cancelled or completed without recording its nodes
+                    del hints[job_id]
+            elif job['state'] != 'PENDING' or hint['fallback']:
+                continue
+            elif job['reason'] in INELIGIBLE_REASONS:
+                hint['eligible_since'] = None
+            elif hint['eligible_since'] is None:
+                hint['eligible_since'] = now
+            elif now - hint['eligible_since'] >= timeout:
+                expired.append(job_id)
+        failed = []
+        for i in range(0, len(expired), MAX_IDS_PER_CALL):
+            batch = expired[i:i + MAX_IDS_PER_CALL]
+            if sp.run(['scontrol', 'update', f"JobId={','.join(batch)}", 'ReqNodeList=']).returncode != 0:
+                failed += batch
+        for job_id in expired:
+            if job_id not in failed:
+                hints[job_id]['fallback'] = True
+    if len(failed) > 0:
+        log(f"Warning: Failed to clear the preferred nodes of stage jobs {','.join(failed)}.")
+    if verbose and len(expired) > len(failed):
+        log(f"Cleared the preferred nodes of {len(expired) - len(failed)} stage jobs pending for more than "
+            f"{timeout:.0f} secs.")
+    return [job_id for job_id in expired if job_id not in failed]
+
+
+def record(dvc_root, stage_name, job_id, nodelist, stage_dir='.'):
+    """Append the nodes of a completed stage job and the bytes of its deps read from upstream nodes"""
+    stages = load_stage_graph(dvc_root)
+    key = stage_key(dvc_root, stage_dir, stage_name)
+    records_file = get_records_file(dvc_root)
+    latest = latest_records(load_history(records_file))
+    nodes = list(Hostlist(nodelist)) if nodelist else []
+    with locked_hints(dvc_root) as hints:
+        hint = hints.pop(job_id, None)
+
+    stage = stages.get(key, dict(deps=[], outs=[]))
+    producers = get_producers(stages)
+    inputs = dict()
+    for dep in stage['deps']:
+        parent = find_producer(producers, dep, dvc_root)
+        if parent is None or parent == key or parent not in latest:
+            continue
+        parent_nodes = latest[parent]['nodes']
+        size = get_path_size(dep)
+        local = size * len(set(parent_nodes) & set(nodes)) / len(parent_nodes) if len(parent_nodes) > 0 else 0
+        entry = inputs.setdefault(parent, dict(stage=parent, nodes=parent_nodes, bytes=0, local_bytes=0))
+        entry['bytes'] += size
+        entry['local_bytes'] += int(local)
+    entry = dict(stage=key, job_id=job_id, end=time.time(), nodes=nodes,
+                 out_bytes=sum(get_path_size(out) for out in stage['outs']),
+                 preferred=hint['nodes'] if hint is not None else None,
+                 fallback=hint['fallback'] if hint is not None else False,
+                 inputs=list(inputs.values()),
+                 input_bytes=sum(i['bytes'] for i in inputs.values()),
+                 local_bytes=sum(i['local_bytes'] for i in inputs.values()),
+                 hit=any(len(set(i['nodes']) & set(nodes)) > 0 for i in inputs.values()))
+    os.makedirs(os.path.dirname(records_file), exist_ok=True)
+    with open(records_file, 'a') as f:  # single short write with O_APPEND (as in stage_runtime_history.py)
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def summarize(records, since=None):
+    """Hit rate and bytes read from upstream nodes of stage jobs with upstream inputs (all and with hints)"""
+    summary = dict()
+    records = [r for r in records if len(r['inputs']) > 0 and (since is None or r['end'] >= since)]
+    for label, selected in [('all', records), ('hinted', [r for r in records if r['preferred'] is not None])]:
+        input_bytes = sum(r['input_bytes'] for r in selected)
+        local_bytes = sum(r['local_bytes'] for r in selected)
+        hits = sum(1 for r in selected if r['hit'])
+        summary[label] = dict(stages=len(selected), hits=hits,
+                              hit_rate=hits / len(selected) if len(selected) > 0 else None,
+                              fallbacks=sum(1 for r in selected if r['fallback']),
+                              input_bytes=input_bytes, local_bytes=local_bytes,
+                              local_fraction=local_bytes / input_bytes if input_bytes > 0 else None)
+    return summary
+
+
+def format_bytes(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if size < 1024. or unit == 'TiB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024.
+
+
+def print_summary(summary):
+    print(f"{'JOBS':<8}{'STAGES':>8}{'HITS':>8}{'HIT_RATE':>10}{'FALLBACKS':>11}{'INPUT':>14}{'FROM_UPSTREAM':>15}"
+          f"{'FRACTION':>10}")
+    for label, s in summary.items():
+        hit_rate = f"{100. * s['hit_rate']:.1f} %" if s['hit_rate'] is not None else '-'
+        fraction = f"{100. * s['local_fraction']:.1f} %" if s['local_fraction'] is not None else '-'
+        print(f"{label:<8}{s['stages']:>8}{s['hits']:>8}{hit_rate:>10}{s['fallbacks']:>11}"
+              f"{format_bytes(s['input_bytes']):>14}{format_bytes(s['local_bytes']):>15}{fraction:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Node affinity of chained SLURM DVC stages.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    record_parser = subparsers.add_parser('record', help="Record the nodes of a completed stage job in ./dvc.yaml "
+                                                         "and prefer them for its pending downstream stage jobs")
+    record_parser.add_argument('stage_name', type=str)
+    prefer_parser = subparsers.add_parser('prefer', help="Prefer the nodes of the upstream stages for a stage job")
+    prefer_parser.add_argument('stage_name', type=str)
+    prefer_parser.add_argument('job_id', type=str)
+    fallback_parser = subparsers.add_parser('fallback', help="Clear preferred nodes of stage jobs pending for more "
+                                                             "than DVC_SLURM_NODE_AFFINITY_TIMEOUT secs")
+    fallback_parser.add_argument('--interval', type=float, help="Repeat every SECS secs while preferred nodes are set")
+    fallback_parser.add_argument('--resubmit', action='store_true',
+                                 help="Resubmit this fallback job while preferred nodes are set "
+                                      "(sbatch_dvc_node_affinity.sh)")
+    report_parser = subparsers.add_parser('report', help="Report hit rate and bytes read from upstream nodes")
+    report_parser.add_argument('--json', action='store_true', help="Print as JSON")
+    report_parser.add_argument('--since', type=float, help="Only stage jobs completed after TIMESTAMP (epoch secs)")
+    args = parser.parse_args()
+
+    dvc_root = find_dvc_root()
+    if args.subcommand == 'record':
+        job_id = os.environ.get('SLURM_JOB_ID', '')
+        entry = record(dvc_root, args.stage_name, job_id, os.environ.get('SLURM_JOB_NODELIST', ''))
+        log(f"Stage {entry['stage']} ran on {','.join(entry['nodes'])} and read "
+            f"{format_bytes(entry['local_bytes'])} of {format_bytes(entry['input_bytes'])} from upstream nodes.")
+        jobs = squeue_snapshot()
+        job_suffix = get_dvc_slurm_job_suffix(dvc_root)
+        children = load_stage_graph(dvc_root).get(entry['stage'], dict(children=[]))['children']
+        prefer(dvc_root, [job for job in get_dvc_jobs(['stage'], dvc_root, jobs)
+                          if job_stage_key(dvc_root, job, job_suffix) in children], jobs, exclude=[job_id])
+        fallback(dvc_root, jobs)
+    elif args.subcommand == 'prefer':
+        jobs = squeue_snapshot()
+        prefer(dvc_root, [job for job in get_dvc_jobs(['stage'], dvc_root, jobs) if job['job_id'] == args.job_id], jobs)
+    elif args.subcommand == 'fallback' and args.resubmit:
+        jobs = squeue_snapshot()
+        fallback(dvc_root, jobs)
+        job_id = os.environ.get('SLURM_JOB_ID')
+        with locked_hints(dvc_root) as hints:
+            last_job_id = read_fallback_jobid(dvc_root)
+            if last_job_id not in [None, job_id] and any(job['job_id'] == last_job_id for job in jobs):
+                log(f"Fallback job {last_job_id} is queued already.")  # submitted concurrently by prefer
+            elif any(not hint['fallback'] for hint in hints.values()):
+                log(f"Resubmitted the fallback job as {submit_fallback_job(dvc_root)}.")
+            elif last_job_id is not None:
+                os.remove(get_fallback_jobid_file(dvc_root))
+    elif args.subcommand == 'fallback':
+        while True:
+            fallback(dvc_root)
+            if args.interval is None:
+                break
+            with locked_hints(dvc_root) as hints:
+                if not any(not hint['fallback'] for hint in hints.values()):
+                    break
+            time.sleep(args.interval)
+    elif args.subcommand == 'report':
+        summary = summarize(load_history(get_records_file(dvc_root)), args.since)
+        if args.json:
+            print(json.dumps(summary, indent=2))
+        else:
+            print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,9 @@ dvc_out_of_repo_init() {
   for file in "${sym_links[@]}"; do
     ln -s ../${repo_dir}/${file} ${file}
   done
+  if [ -d ../${repo_dir}/.dvc_shards ]; then  # shared dvc.yaml files of a sharded stage layout (cf. dvc_layout.py)
+    ln -s ../${repo_dir}/.dvc_shards .dvc_shards
+  fi
 
   dvc init --no-scm
   for remote in "${dvc_remotes[@]}"; do  # for out of repo pushing/pulling
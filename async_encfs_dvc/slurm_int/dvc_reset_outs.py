@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Reset the outputs of a DVC stage (declared with --outs-persist) before (re-)running it
+#
+# Each output directory in sys.argv[1:] is renamed aside in a single step and recreated empty, moving only the
+# files to keep (by default dvc_stage_out.log and the partial outputs dvc_resume_* of resumable payloads) back to their
+# original path. The renamed directory is then deleted in a detached background process using a bounded thread pool,
+# so that the stage can start immediately.
+# Leftovers of interrupted deletions (e.g. when the enclosing SLURM job ended before) are picked up on the next reset.
+
+import os
+import sys
+import argparse
+import fnmatch
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from async_encfs_dvc.dvc_timing import span
+
+
+# coordinate with dvc_cmd (the stage log of dvc repro incl. its rotated segments must survive a requeue) and with
+# resumable payloads (partial outputs and progress named dvc_resume_*, e.g. examples/ex_vit/inference.py)
+KEEP_DEFAULT = ['dvc_stage_out.log', 'dvc_stage_out.log.*', 'dvc_resume_*']
+TRASH_PREFIX = '.dvc_reset_'
+
+
+def get_trash_prefix(out):
+    """Prefix of the directories that an output is renamed to (hidden siblings on the same filesystem)"""
+    return f".{os.path.basename(os.path.normpath(out))}{TRASH_PREFIX}"
+
+
+def reset_out(out, keep=KEEP_DEFAULT):
+    """Rename output directory aside, recreate it and restore files to keep. Returns the directory to delete."""
+
+    out = os.path.normpath(out)
+    parent = os.path.dirname(out) or '.'
+
+    if not os.path.lexists(out):
+        os.makedirs(out)
+        return None
+    if not os.path.isdir(out) or os.path.islink(out):  # only directories are reset (as with ls -I ... | xargs rm)
+        return None
+
+    trash = tempfile.mkdtemp(prefix=get_trash_prefix(out), dir=parent)
+    trash_out = os.path.join(trash, os.path.basename(out))
+    os.rename(out, trash_out)
+    os.mkdir(out)
+
+    # restore files to keep at their original path (path-dependent IVs of EncFS stay valid)
+    with os.scandir(trash_out) as it:
+        for entry in it:
+            if any(fnmatch.fnmatch(entry.name, pattern) for pattern in keep):
+                os.rename(entry.path, os.path.join(out, entry.name))
+    return trash
+
+
+def find_stale_trash(out):
+    """Find directories of previous resets of this output whose deletion was interrupted"""
+
+    out = os.path.normpath(out)
+    parent = os.path.dirname(out) or '.'
+    prefix = get_trash_prefix(out)
+    if not os.path.isdir(parent):
+        return []
+    with os.scandir(parent) as it:
+        return [entry.path for entry in it
+                if entry.name.startswith(prefix) and entry.is_dir(follow_symlinks=False)]
+
+
+def _unlink_dir_entries(path):
+    """Remove all non-directory entries of path and return its subdirectories"""
+
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:  # concurrently deleted by another reset
+                        pass
+    except FileNotFoundError:
+        pass
+    return subdirs
+
+
+def remove_tree(root, max_workers=8):
+    """Delete a directory tree traversing it with os.scandir and unlinking files in a bounded thread pool"""
+
+    dirs = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_unlink_dir_entries, root): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirs.append(pending.pop(future))
+                for subdir in future.result():
+                    pending[executor.submit(_unlink_dir_entries, subdir)] = subdir
+
+    # directories are empty now, remove them bottom-up
+    for path in sorted(dirs, key=lambda p: p.count(os.sep), reverse=True):
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_trees(paths, max_workers=8):
+    threads = [threading.Thread(target=remove_tree, args=(path, max_workers)) for path in paths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def detach():
+    """Fork a detached child process (returns True in the child, False in the parent)"""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() != 0:
+        return False
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reset DVC stage output directories (--outs-persist) "
+                                                 "keeping only the stage log and partial outputs (dvc_resume_*).")
+    parser.add_argument("outs", nargs='*', help="DVC stage output directories")
+    parser.add_argument("--keep", action='append', default=None,
+                        help=f"Glob pattern of files to keep in the output directories (default: {KEEP_DEFAULT})")
+    parser.add_argument("--max-workers", type=int, default=int(os.environ.get('DVC_RESET_OUTS_MAX_WORKERS', 8)),
+                        help="Number of threads used for deleting (default: 8)")
+    parser.add_argument("--foreground", action='store_true',
+                        help="Wait for the deletion of the previous outputs to complete")
+    args = parser.parse_args()
+
+    keep = args.keep if args.keep is not None else KEEP_DEFAULT
+
+    to_remove = []
+    with span('reset_outs'):
+        for out in args.outs:
+            to_remove += find_stale_trash(out)
+            trash = reset_out(out, keep)
+            if trash is not None:
+                to_remove.append(trash)
+
+    if len(to_remove) == 0:
+        return
+
+    if args.foreground:
+        remove_trees(to_remove, args.max_workers)
+    elif detach():
+        try:
+            remove_trees(to_remove, args.max_workers)
+        finally:
+            os._exit(0)
+    else:
+        print(f"dvc_reset_outs: Deleting previous outputs in the background ({', '.join(to_remove)}).")
+
+
+if __name__ == '__main__':
+    main()
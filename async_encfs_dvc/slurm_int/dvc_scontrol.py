@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# scontrol-like DVC SLURM job monitoring and control tool (invoked through dvc_scontrol):
+# show, put on hold, release, cancel (groups of) stage/commit/push/cleanup jobs
+#
+# Usage: dvc_scontrol [--json] {show,hold,release,cancel} DVC_JOB_TYPES
+#        dvc_scontrol log LOG_FILE [LINES]
+#        dvc_scontrol watch [--interval SECS] [--once] [--json]
+#
+# All job types are selected from a single squeue snapshot of the user's jobs, the actions are issued as batched
+# scontrol/scancel calls (one per action instead of one per job).
+
+import os
+import sys
+import json
+import getpass
+import hashlib
+import argparse
+import subprocess as sp
+
+
+DVC_JOB_TYPES = ['stage', 'commit', 'cleanup', 'push']
+SQUEUE_FIELDS = ['job_id', 'name', 'state', 'reason', 'user', 'time', 'time_left', 'work_dir', 'num_nodes', 'command']
+SQUEUE_FORMAT = '%A|%j|%T|%r|%u|%M|%L|%Z|%D|%o'  # command last (may contain the separator)
+MAX_IDS_PER_CALL = 1000
+
+
+def log(message):
+    print(f"dvc_scontrol: {message}")
+
+
+def find_dvc_root(path='.'):
+    """DVC root directory (closest parent directory with a .dvc directory, as dvc root)"""
+    path = os.path.realpath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, '.dvc')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise RuntimeError(f"Not inside a DVC repository: {os.getcwd()}")
+        path = parent
+
+
+def get_dvc_slurm_job_suffix(dvc_root):
+    """Suffix of SLURM job names of a DVC repo (same as in slurm_enqueue.sh)"""
+    return hashlib.sha1(os.path.realpath(dvc_root).encode("utf-8")).hexdigest()[:12]
+
+
+def get_job_type(job, job_suffix):
+    """DVC job type (stage, commit, cleanup, push) of a SLURM job in this repo (None if not a DVC job)"""
+    if not (job['name'].startswith('dvc_') and job['name'].endswith('_' + job_suffix)):
+        return None
+    command = job['command'].split()
+    if len(command) == 0:
+        return None
+    script = os.path.basename(command[0])
+    for job_type in DVC_JOB_TYPES:
+        if script.startswith(f"sbatch_dvc_{job_type}"):
+            return job_type
+    return None
+
+
+def squeue_snapshot(user=None):
+    """All pending/running jobs of user from a single squeue call"""
+    output = sp.run(['squeue', '-u', user or getpass.getuser(), f"--format={SQUEUE_FORMAT}", '--sort=-S', '-h'],
+                    capture_output=True, check=True).stdout.decode('utf-8')
+    jobs = []
+    for line in output.splitlines():
+        values = line.split('|', len(SQUEUE_FIELDS) - 1)
+        if len(values) == len(SQUEUE_FIELDS):
+            jobs.append(dict(zip(SQUEUE_FIELDS, [v.strip() for v in values])))
+    return jobs
+
+
+def get_dvc_jobs(job_types, dvc_root=None, jobs=None):
+    """DVC jobs of the given types in this repo (from one squeue snapshot), annotated with their job type"""
+    job_suffix = get_dvc_slurm_job_suffix(dvc_root or find_dvc_root())
+    dvc_jobs = []
+    for job in (jobs if jobs is not None else squeue_snapshot()):
+        job_type = get_job_type(job, job_suffix)
+        if job_type in job_types:
+            dvc_jobs.append(dict(job, type=job_type))
+    return dvc_jobs
+
+
+def run_batched(command, job_ids, sep=','):
+    """Run command on job ids in batches (e.g. scontrol hold id1,id2,...) and return the ids that failed"""
+    failed = []
+    for i in range(0, len(job_ids), MAX_IDS_PER_CALL):
+        batch = job_ids[i:i + MAX_IDS_PER_CALL]
+        args = command + ([sep.join(batch)] if sep is not None else batch)
+        if sp.run(args).returncode != 0:
+            failed += batch
+    return failed
+
+
+def job_label(job):
+    return f"{job['name']}[{os.path.basename(job['command'].split()[0])}]"
+
+
+def hold_jobs(dvc_jobs, verbose=True):
+    """Put pending jobs on hold, requeue running ones on hold"""
+    to_hold, to_requeue = [], []
+    for job in dvc_jobs:
+        if job['reason'] == 'JobHeldUser':
+            job['action'] = None
+        elif job['state'] == 'PENDING':
+            job['action'] = 'hold'
+            to_hold.append(job['job_id'])
+            if verbose:
+                log(f"Putting pending job {job_label(job)} (reason {job['reason']} != JobHeldUser) at {job['job_id']} "
+                    f"on hold (release using 'dvc_scontrol release {job['type']}').")
+        elif job['state'] == 'RUNNING':
+            job['action'] = 'requeuehold'
+            to_requeue.append(job['job_id'])
+            if verbose:
+                log(f"Requeuing on hold running job {job_label(job)} (reason {job['reason']} != JobHeldUser) at "
+                    f"{job['job_id']} (release using 'dvc_scontrol release {job['type']}').")
+        else:
+            job['action'] = None
+            if verbose:
+                log(f"Ignoring job {job_label(job)} at {job['job_id']} with status {job['state']}.")
+    failed = run_batched(['scontrol', 'hold'], to_hold) if len(to_hold) > 0 else []
+    failed += run_batched(['scontrol', 'requeuehold'], to_requeue) if len(to_requeue) > 0 else []
+    return failed
+
+
+def release_jobs(dvc_jobs, verbose=True):
+    stage_jobs = [job for job in dvc_jobs if job['type'] == 'stage']
+    if os.environ.get('DVC_SLURM_CRITICAL_PATH', 'NO') == 'YES' and len(stage_jobs) > 0:
+        from async_encfs_dvc.slurm_int.dvc_critical_path import prioritize_jobs
+        prioritize_jobs(stage_jobs, verbose=verbose)  # nice values by critical path of the queued stages
+    to_release = []
+    for job in dvc_jobs:
+        if job['state'] == 'PENDING':
+            job['action'] = 'release'
+            to_release.append(job['job_id'])
+            if verbose:
+                log(f"Releasing job {job_label(job)} (reason {job['reason']}) at {job['job_id']}.")
+        else:
+            job['action'] = None
+    return run_batched(['scontrol', 'release'], to_release) if len(to_release) > 0 else []
+
+
+def cancel_jobs(dvc_jobs, verbose=True):
+    for job in dvc_jobs:
+        job['action'] = 'cancel'
+        if verbose:
+            log(f"Cancelling job {job_label(job)} at {job['job_id']}.")
+    job_ids = [job['job_id'] for job in dvc_jobs]
+    return run_batched(['scancel'], job_ids, sep=None) if len(job_ids) > 0 else []
+
+
+def show_jobs(dvc_jobs, job_type):
+    """Print jobs of a type like squeue --format="%.15u %.15A %.10r %.10M %.10L %.60j %.130Z" """
+    log(f"DVC {job_type} jobs:")
+    columns = [('USER', 'user', 15), ('JOBID', 'job_id', 15), ('REASON', 'reason', 10), ('TIME', 'time', 10),
+               ('TIME_LEFT', 'time_left', 10), ('NAME', 'name', 60), ('WORK_DIR', 'work_dir', 130)]
+    print(' '.join(title.rjust(width)[:width] for title, _, width in columns))
+    for job in dvc_jobs:
+        if job['type'] == job_type:
+            print(' '.join(job[field].rjust(width)[:width] for _, field, width in columns))
+
+
+def print_usage():
+    print("""Usage: dvc_scontrol [--json] COMMAND DVC_JOB_TYPES
+
+COMMAND is the action to take on a DVC job group, one of: show, hold, release, cancel
+
+DVC_JOB_TYPES is the group of DVC jobs to control, a comma-separated list that can include: stage, commit, push or cleanup (or simply all)
+
+--json prints the selected jobs (and the action taken on them) as JSON instead of log messages
+
+       dvc_scontrol log LOG_FILE [LINES]
+
+Show the last LINES (default: 20) lines of a stage or rank log (incl. its rotated segments, cf. log_sink.py)
+
+       dvc_scontrol watch [--interval SECS] [--once] [--json]
+
+Live progress view of all stages of this DVC repo (pending, held, running, complete, committed, failed) with throughput and ETA (cf. dvc_watch.py)""")
+
+
+def main():
+    if len(sys.argv) == 1 or '--help' in sys.argv[1:]:
+        print_usage()
+        return
+
+    if sys.argv[1] == 'log':
+        if len(sys.argv) not in [3, 4]:
+            log(f"Error: Wrong number of parameters (expected 2 or 3): '{' '.join(sys.argv[1:])}'")
+            sys.exit(1)
+        from async_encfs_dvc.log_sink import tail
+        sys.stdout.buffer.write(b''.join(tail(sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else 20)))
+        return
+
+    if sys.argv[1] == 'watch':
+        from async_encfs_dvc.slurm_int.dvc_watch import main as watch_main
+        watch_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(prog='dvc_scontrol', add_help=False)
+    parser.add_argument('command', type=str)
+    parser.add_argument('job_types', type=str)
+    parser.add_argument('--json', action='store_true')
+    args, unknown = parser.parse_known_args()
+    if len(unknown) > 0:
+        log(f"Error: Wrong number of parameters (expected 2): '{' '.join(sys.argv[1:])}'")
+        sys.exit(1)
+
+    job_types = DVC_JOB_TYPES if args.job_types == 'all' else args.job_types.split(',')
+    commands = dict(hold=hold_jobs, release=release_jobs, cancel=cancel_jobs)
+    if args.command not in list(commands) + ['show']:
+        print(f"Unknown option '{args.command}' (choose either hold, release [combined with a dvc operation such as "
+              f"commit, push, cleanup], or show, cancel [additionally with stage], or log)")
+        sys.exit(1)
+
+    dvc_jobs = get_dvc_jobs(job_types)
+    failed = []
+    if args.command == 'show':
+        if not args.json:
+            for job_type in job_types:
+                show_jobs(dvc_jobs, job_type)
+    else:
+        failed = commands[args.command](dvc_jobs, verbose=not args.json)
+        if args.command == 'hold' and not args.json:
+            log(f"All jobs of {getpass.getuser()} held. To make sure that no other users run DVC commands on this "
+                f"repo use 'dvc_scontrol show {args.job_types}'.")
+
+    if args.json:
+        for job in dvc_jobs:
+            job['failed'] = job['job_id'] in failed
+        print(json.dumps(dvc_jobs, indent=2))
+    if len(failed) > 0:
+        if not args.json:
+            log(f"Error: {args.command} failed for some of the jobs {','.join(failed)}.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
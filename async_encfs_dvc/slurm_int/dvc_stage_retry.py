@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# Automatic resubmission of SLURM DVC stage jobs that failed for transient reasons (node failure, preemption)
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.dvc_stage_retry retry STAGE_NAME   (sbatch_dvc_cleanup.sh)
+#        python3 -m async_encfs_dvc.slurm_int.dvc_stage_retry classify JOB_ID
+#
+# With DVC_SLURM_RETRY=YES, slurm_enqueue.sh writes the sbatch arguments of the stage and cleanup jobs to
+# <stage>.dvc_{stage,cleanup}_sbatch_args and the cleanup job (afternotok) first runs retry in the stage directory. The
+# failed stage job is classified from its SLURM state (sacct, or scontrol if accounting is unavailable) as transient
+# (one of DVC_SLURM_RETRY_STATES, default: NODE_FAIL,PREEMPTED,BOOT_FAIL), timeout (TIMEOUT, DEADLINE), cancelled or
+# application error. Transient failures are resubmitted up to DVC_SLURM_RETRY_MAX times (default: 2) per enqueue,
+# starting DVC_SLURM_RETRY_BACKOFF * 2^(attempt - 1) secs later (default: 60, via --begin) and excluding the failed
+# nodes after a node failure. Timeouts are only resubmitted if TIMEOUT is listed in DVC_SLURM_RETRY_STATES.
+#
+# On resubmission, a new cleanup job is submitted for the new stage job, the job id files and the pending status file
+# are updated (dvc.lock is kept) and the dependencies of the pending jobs of this repo on the failed stage job (the
+# commit job and downstream stage jobs) are rewired to the new job with scontrol update. This requires that SLURM keeps
+# jobs with a failed dependency pending (DependencyNeverSatisfied), i.e. kill_invalid_depend not in
+# SchedulerParameters. Every attempt is appended to <stage>.dvc_retries (JSON lines). Otherwise, retry exits with 1 and
+# the cleanup job marks the stage failed.
+
+import os
+import re
+import sys
+import json
+import time
+import getpass
+import argparse
+import subprocess as sp
+
+from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root, get_dvc_slurm_job_suffix
+
+
+TIMEOUT_STATES = ['TIMEOUT', 'DEADLINE']
+APPLICATION_STATES = ['FAILED', 'OUT_OF_MEMORY']
+NODE_STATES = ['NODE_FAIL', 'BOOT_FAIL']  # failed nodes excluded on resubmission
+
+
+def log(message):
+    print(f"dvc_stage_retry: {message}", file=sys.stderr)
+
+
+def get_retry_states():
+    return [s.strip() for s in os.environ.get('DVC_SLURM_RETRY_STATES', 'NODE_FAIL,PREEMPTED,BOOT_FAIL').split(',')
+            if s.strip() != '']
+
+
+def get_max_retries():
+    return int(os.environ.get('DVC_SLURM_RETRY_MAX', 2))
+
+
+def get_backoff(attempt):
+    """Delay in secs before the start of a resubmitted stage job (exponential in the attempt)"""
+    return int(float(os.environ.get('DVC_SLURM_RETRY_BACKOFF', 60)) * 2 ** (attempt - 1))
+
+
+def get_job_state(job_id):
+    """State, exit code and node list of a finished job (sacct, scontrol show job as fallback)"""
+    result = sp.run(['sacct', '--jobs', job_id, '-X', '-n', '-P', '--format=State,ExitCode,NodeList'],
+                    capture_output=True)
+    lines = result.stdout.decode('utf-8').strip().splitlines() if result.returncode == 0 else []
+    if len(lines) > 0 and len(lines[0].split('|')) == 3:
+        state, exit_code, nodelist = lines[0].split('|')
+        return dict(state=state.split()[0] if state.strip() != '' else 'UNKNOWN', exit_code=exit_code,
+                    nodelist=nodelist if nodelist not in ['None assigned', '(null)'] else '')
+    result = sp.run(['scontrol', 'show', 'job', job_id], capture_output=True)
+    fields = dict(re.findall(r"(\w+)=(\S*)", result.stdout.decode('utf-8'))) if result.returncode == 0 else dict()
+    nodelist = fields.get('NodeList', '')
+    return dict(state=fields.get('JobState', 'UNKNOWN'), exit_code=fields.get('ExitCode', ''),
+                nodelist=nodelist if nodelist != '(null)' else '')
+
+
+def classify(state):
+    """Failure class of a SLURM job state (transient, timeout, cancelled, application or unknown)"""
+    if state in get_retry_states() and state not in TIMEOUT_STATES:
+        return 'transient'
+    if state in TIMEOUT_STATES:
+        return 'timeout'
+    if state == 'CANCELLED':
+        return 'cancelled'
+    if state in APPLICATION_STATES:
+        return 'application'
+    return 'unknown'
+
+
+def is_retryable(state):
+    return state in get_retry_states()
+
+
+def get_retries_file(stage_name):
+    return f"{stage_name}.dvc_retries"
+
+
+def load_retries(stage_name):
+    try:
+        with open(get_retries_file(stage_name)) as f:
+            return [json.loads(line) for line in f if line.strip() != '']
+    except FileNotFoundError:
+        return []
+
+
+def read_sbatch_args(filename):
+    with open(filename, 'rb') as f:
+        return [arg.decode('utf-8') for arg in f.read().split(b'\0')[:-1]]
+
+
+def sbatch(args, env=None):
+    result = sp.run(['sbatch', '--parsable'] + args, capture_output=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f"sbatch {' '.join(args)} failed: {result.stderr.decode('utf-8').strip()}")
+    return result.stdout.decode('utf-8').strip().split(';')[0]
+
+
+def rewire_dependency(dependency, old_job_id, new_job_id):
+    """Dependency expression (as in squeue %E) with old_job_id replaced by new_job_id (None if not referenced)"""
+    if dependency in ['', '(null)']:
+        return None
+    sep = '?' if '?' in dependency else ','
+    rewired, found = [], False
+    for dep in re.split(r"[,?]", dependency):
+        dep = re.sub(r"\(\w+\)$", '', dep)  # (unfulfilled), (failed)
+        dep_type, colon, ids = dep.partition(':')
+        new_ids = []
+        for job_id in ids.split(':') if colon else []:
+            base = re.split(r"[+_]", job_id)[0]
+            if base == old_job_id:
+                found = True
+                job_id = new_job_id + (job_id[len(base):] if job_id[len(base):].startswith('+') else '')  # +time
+            new_ids.append(job_id)
+        rewired.append(dep_type + (':' + ':'.join(new_ids) if colon else ''))
+    return sep.join(rewired) if found else None
+
+
+def rewire_dependants(dvc_root, old_job_id, new_job_id):
+    """Rewire the dependencies of the pending jobs of this repo from old_job_id to new_job_id"""
+    job_suffix = get_dvc_slurm_job_suffix(dvc_root)
+    output = sp.run(['squeue', '-u', getpass.getuser(), '-t', 'PENDING', '--format=%A|%j|%E', '-h'],
+                    capture_output=True, check=True).stdout.decode('utf-8')
+    rewired = []
+    for line in output.splitlines():
+        values = [v.strip() for v in line.split('|', 2)]
+        if len(values) != 3 or not (values[1].startswith('dvc_') and values[1].endswith('_' + job_suffix)):
+            continue
+        job_id, name, dependency = values
+        new_dependency = rewire_dependency(dependency, old_job_id, new_job_id)
+        if new_dependency is None:
+            continue
+        if sp.run(['scontrol', 'update', f"JobId={job_id}", f"Dependency={new_dependency}"]).returncode != 0:
+            log(f"Warning: Failed to rewire the dependency of job {job_id} ({name}) to {new_dependency}.")
+            continue
+        rewired.append(job_id)
+    return rewired
+
+
+def retry(stage_name):
+    """Resubmit the failed stage job of stage_name (in the current directory) if it failed transiently, returns
+    whether it was resubmitted"""
+    with open(f"{stage_name}.dvc_stage_jobid") as f:
+        old_job_id = f.read().strip()
+    job = get_job_state(old_job_id)
+    failure = classify(job['state'])
+    log(f"Stage job {old_job_id} of {stage_name} ended with {job['state']} (exit code {job['exit_code']}, "
+        f"nodes {job['nodelist'] or '-'}) - {failure} failure.")
+    retries = load_retries(stage_name)
+    if not is_retryable(job['state']):
+        return False
+    if len(retries) >= get_max_retries():
+        log(f"Retry budget of {stage_name} exhausted ({len(retries)}/{get_max_retries()} retries, "
+            "cf. DVC_SLURM_RETRY_MAX).")
+        return False
+    for filename in [f"{stage_name}.dvc_stage_sbatch_args", f"{stage_name}.dvc_cleanup_sbatch_args"]:
+        if not os.path.exists(filename):
+            log(f"Cannot resubmit {stage_name} without {filename} (enqueued without DVC_SLURM_RETRY=YES).")
+            return False
+
+    attempt = len(retries) + 1
+    delay = get_backoff(attempt)
+    retry_opts = [f"--begin=now+{delay}"] if delay > 0 else []
+    if job['state'] in NODE_STATES and job['nodelist'] != '':
+        retry_opts.append(f"--exclude={job['nodelist']}")
+    env = dict(os.environ, DVC_TIMING_SUBMIT_TIME=f"{time.time():.6f}")  # queue wait of the new stage job
+    if os.path.exists(f"{stage_name}.dvc_started"):  # pending again until the new stage job starts
+        os.replace(f"{stage_name}.dvc_started", f"{stage_name}.dvc_pending")
+    new_job_id = sbatch(retry_opts + read_sbatch_args(f"{stage_name}.dvc_stage_sbatch_args"), env)
+    with open(f"{stage_name}.dvc_stage_jobid", 'w') as f:
+        f.write(new_job_id + '\n')
+    cleanup_job_id = sbatch(['--dependency', f"afternotok:{new_job_id}"] +
+                            read_sbatch_args(f"{stage_name}.dvc_cleanup_sbatch_args"))
+    with open(f"{stage_name}.dvc_cleanup_jobid", 'w') as f:
+        f.write(cleanup_job_id + '\n')
+    rewired = rewire_dependants(find_dvc_root(), old_job_id, new_job_id)
+
+    entry = dict(attempt=attempt, time=time.time(), failed_job_id=old_job_id, state=job['state'],
+                 exit_code=job['exit_code'], nodelist=job['nodelist'], job_id=new_job_id,
+                 cleanup_job_id=cleanup_job_id, delay=delay, rewired=rewired)
+    with open(get_retries_file(stage_name), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    log(f"Resubmitted {stage_name} as job {new_job_id} (retry {attempt}/{get_max_retries()}, starting in {delay} "
+        f"secs{' without nodes ' + job['nodelist'] if '--exclude' in ' '.join(retry_opts) else ''}), cleanup job "
+        f"{cleanup_job_id}, rewired {len(rewired)} dependent jobs.")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resubmission of transiently failed SLURM DVC stage jobs.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    retry_parser = subparsers.add_parser('retry', help="Resubmit the failed stage job of a stage in the current "
+                                                       "directory if it failed transiently (exit code 1 if not)")
+    retry_parser.add_argument('stage_name', type=str)
+    classify_parser = subparsers.add_parser('classify', help="Print the state and failure class of a job")
+    classify_parser.add_argument('job_id', type=str)
+    args = parser.parse_args()
+
+    if args.subcommand == 'retry':
+        try:
+            resubmitted = retry(args.stage_name)
+        except (OSError, RuntimeError, sp.CalledProcessError) as e:
+            log(f"Error: Failed to resubmit {args.stage_name}: {e}")
+            resubmitted = False
+        sys.exit(0 if resubmitted else 1)
+    elif args.subcommand == 'classify':
+        job = get_job_state(args.job_id)
+        print(json.dumps(dict(job, failure=classify(job['state']), retryable=is_retryable(job['state']))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# Read-only, incremental equivalent of 'dvc status --json STAGE' for a single stage (used by slurm_enqueue.sh, which
+# would otherwise have to move DVC's rwlock aside to run dvc status while dvc repro holds it)
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.dvc_stage_status [--json] [--jobs N] [[DVC_YAML:]STAGE]
+#
+# The stage's entry in dvc.lock is compared against dvc.yaml (command, params, deps/outs) and the workspace. Sizes and
+# file counts of deps/outs are compared first. File hashes are then taken from DVC's state DB if the recorded
+# (inode, mtime, size) checksum still matches the file, only the remaining files are hashed (md5 as in DVC 2.x,
+# concurrently). Directory hashes are derived from the file hashes like DVC's .dir objects. Never acquires DVC's
+# locks and never writes to the state DB or cache. Prints {} if the stage is clean, else its changes like dvc status
+# (stages whose status cannot be determined this way, e.g. with non-YAML/JSON params, are reported as changed).
+
+import os
+import sys
+import json
+import getpass
+import hashlib
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root
+
+
+TEXT_CHARS = bytes(range(32, 127)) + b"\n\r\t\f\b"
+
+
+def read_dvc_config(dvc_root):
+    """Flat {section: {key: value}} of .dvc/config and .dvc/config.local"""
+    config = dict()
+    for filename in ['config', 'config.local']:
+        path = os.path.join(dvc_root, '.dvc', filename)
+        if not os.path.exists(path):
+            continue
+        section = None
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('[') and line.endswith(']'):
+                    section = config.setdefault(line[1:-1].strip("'"), dict())  # e.g. 'remote "name"'
+                elif '=' in line and section is not None:
+                    key, value = line.split('=', 1)
+                    section[key.strip()] = value.strip()
+    return config
+
+
+def get_state_db_candidates(dvc_root, config):
+    """Locations of DVC's state DB (site cache dir of DVC >= 2.x, .dvc/tmp of earlier 2.x versions)"""
+    site_cache_dir = os.environ.get('DVC_SITE_CACHE_DIR') or config.get('core', {}).get('site_cache_dir') or \
+        '/var/tmp/dvc'
+    repo_token = hashlib.md5(str((dvc_root, getpass.getuser())).encode()).hexdigest()
+    return [os.path.join(site_cache_dir, 'repo', repo_token, 'hashes', 'local', 'cache.db'),
+            os.path.join(dvc_root, '.dvc', 'tmp', 'hashes', 'local', 'cache.db')]
+
+
+class StateDB:
+    """Read-only view of DVC's state DB (path -> (checksum, md5) of files hashed by DVC)"""
+
+    def __init__(self, candidates):
+        self.connection = None
+        for path in candidates:
+            if os.path.exists(path):
+                try:
+                    self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+                    self.connection.execute("SELECT 1 FROM Cache LIMIT 1")
+                    break
+                except sqlite3.Error:
+                    self.connection = None
+
+    def get(self, path):
+        if self.connection is None:
+            return None
+        try:
+            row = self.connection.execute("SELECT value FROM Cache WHERE key = ? AND raw = 1 AND mode = 1",
+                                          (path,)).fetchone()
+            entry = json.loads(row[0]) if row is not None else None
+        except (sqlite3.Error, ValueError, TypeError):
+            return None
+        if entry is None or 'md5' not in entry.get('hash_info', {}):
+            return None
+        return entry['checksum'], entry['hash_info']['md5']
+
+
+def state_checksum(st):
+    """Checksum of a file's (inode, mtime, size) as recorded in DVC's state DB"""
+    return str(int(hashlib.md5(str(([st.st_ino, st.st_mtime, st.st_size],)).encode()).hexdigest(), 16))
+
+
+def istextblock(block):
+    if not block:
+        return True
+    if b"\x00" in block:
+        return False
+    return float(len(block.translate(None, TEXT_CHARS))) / len(block) <= 0.30
+
+
+def md5_of_chunks(chunks):
+    """md5 as computed by DVC 2.x (CRLF converted to LF in text files as detected on the first 512 bytes)"""
+    hasher, is_text = hashlib.md5(), None
+    for chunk in chunks:
+        if is_text is None and chunk:
+            is_text = istextblock(chunk[:512])
+        hasher.update(chunk.replace(b"\r\n", b"\n") if is_text else chunk)
+    return hasher.hexdigest()
+
+
+def file_md5(path, chunk_size=2**20):
+    with open(path, 'rb') as f:
+        return md5_of_chunks(iter(lambda: f.read(chunk_size), b''))
+
+
+def list_files(path, ignore=None):
+    """Files under path (relpath, stat) as collected by DVC (no symlinked directories)"""
+    files = []
+    for root, dirs, fnames in os.walk(path):
+        rel_root = os.path.relpath(root, path)
+        for fname in fnames:
+            relpath = fname if rel_root == '.' else os.path.join(rel_root, fname)
+            if ignore is not None and ignore(os.path.join(root, fname)):
+                continue
+            try:
+                files.append((relpath.replace(os.sep, '/'), os.stat(os.path.join(root, fname))))
+            except FileNotFoundError:  # broken symlink
+                continue
+        if ignore is not None:
+            dirs[:] = [d for d in dirs if not ignore(os.path.join(root, d) + os.sep)]
+    return files
+
+
+class StatusChecker:
+    """Status of the deps/outs of a stage from their dvc.lock entries (hashes from the state DB where valid)"""
+
+    def __init__(self, dvc_root, jobs=8):
+        self.dvc_root = dvc_root
+        self.config = read_dvc_config(dvc_root)
+        self.state = StateDB(get_state_db_candidates(dvc_root, self.config))
+        self.jobs = jobs
+        self.ignore = self.load_dvcignore()
+        self.stats = dict(state_hits=0, hashed=0)
+
+    def load_dvcignore(self):
+        path = os.path.join(self.dvc_root, '.dvcignore')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            patterns = [line.rstrip('\n') for line in f if line.strip() != '' and not line.startswith('#')]
+        if len(patterns) == 0:
+            return None
+        import pathspec  # dependency of DVC
+        spec = pathspec.PathSpec.from_lines('gitwildmatch', patterns)
+        return lambda p: spec.match_file(os.path.relpath(p, self.dvc_root) + ('/' if p.endswith(os.sep) else ''))
+
+    def get_md5s(self, paths_and_stats):
+        """md5 of files from the state DB if (inode, mtime, size) unchanged, else by hashing them"""
+        md5s, to_hash = dict(), []
+        for path, st in paths_and_stats:
+            entry = self.state.get(path)
+            if entry is not None and entry[0] == state_checksum(st):
+                md5s[path] = entry[1]
+                self.stats['state_hits'] += 1
+            else:
+                to_hash.append(path)
+        if len(to_hash) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(to_hash)))) as executor:
+                md5s.update(zip(to_hash, executor.map(file_md5, to_hash)))
+            self.stats['hashed'] += len(to_hash)
+        return md5s
+
+    def status(self, path, lock_entry):
+        """None if path matches its dvc.lock entry, else 'deleted' or 'modified'"""
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return 'deleted'
+        if 'md5' not in lock_entry:  # not in dvc.lock or other hash type (e.g. etag)
+            return 'modified'
+        if os.path.isdir(path):
+            files = list_files(path, self.ignore)
+            if ('size' in lock_entry and sum(st.st_size for _, st in files) != lock_entry['size']) or \
+                    ('nfiles' in lock_entry and len(files) != lock_entry['nfiles']):
+                return 'modified'
+            md5s = self.get_md5s([(os.path.join(path, relpath), st) for relpath, st in files])
+            tree = sorted(({'md5': md5s[os.path.join(path, relpath)], 'relpath': relpath} for relpath, _ in files),
+                          key=lambda entry: entry['relpath'])
+            md5 = md5_of_chunks([json.dumps(tree, sort_keys=True).encode('utf-8')]) + '.dir'
+        else:
+            st = os.stat(path)
+            if 'size' in lock_entry and st.st_size != lock_entry['size']:
+                return 'modified'
+            md5 = self.get_md5s([(path, st)])[path]
+        return None if md5 == lock_entry['md5'] else 'modified'
+
+    def in_cache(self, md5):
+        """Whether the object (and for .dir objects all entries) is in the DVC cache"""
+        # cache.dir in .dvc/config is relative to .dvc (join keeps absolute paths)
+        cache_dir = os.path.join(self.dvc_root, '.dvc', self.config.get('cache', {}).get('dir', 'cache'))
+        obj = os.path.join(cache_dir, md5[:2], md5[2:])
+        if not os.path.exists(obj):
+            return False
+        if md5.endswith('.dir'):
+            with open(obj) as f:
+                entries = json.load(f)
+            listings = dict()
+            for entry in entries:
+                prefix = entry['md5'][:2]
+                if prefix not in listings:
+                    prefix_dir = os.path.join(cache_dir, prefix)
+                    listings[prefix] = set(os.listdir(prefix_dir)) if os.path.isdir(prefix_dir) else set()
+                if entry['md5'][2:] not in listings[prefix]:
+                    return False
+        return True
+
+
+def get_params(params_file, keys):
+    with open(params_file) as f:
+        params = yaml.load(f, Loader=yaml.FullLoader) or dict()  # YAML is a superset of JSON
+    values = dict()
+    for key in keys:
+        value = params
+        for part in key.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                value = None
+                break
+            value = value[part]
+        values[key] = value
+    return values
+
+
+def get_out_paths(outs):
+    """Paths and options of deps/outs in dvc.yaml (strings or single-key dicts)"""
+    paths = dict()
+    for out in outs or []:
+        if isinstance(out, dict):
+            for path, opts in out.items():
+                paths[path] = opts or dict()
+        else:
+            paths[out] = dict()
+    return paths
+
+
+def stage_status(stage, dvc_yaml_filename='dvc.yaml', checker=None):
+    """Changes of a stage w.r.t. dvc.lock like 'dvc status --json' (empty list if clean)"""
+    with open(dvc_yaml_filename) as f:
+        stage_def = yaml.load(f, Loader=yaml.FullLoader)['stages'][stage]
+    dvc_lock_filename = os.path.join(os.path.dirname(dvc_yaml_filename), 'dvc.lock')
+    lock = dict()  # stage never run (or dvc.lock not committed), all deps and outs count as changed
+    if os.path.exists(dvc_lock_filename):
+        with open(dvc_lock_filename) as f:
+            lock = (yaml.load(f, Loader=yaml.FullLoader) or dict()).get('stages', dict()).get(stage, dict())
+    if stage_def.get('always_changed', False):
+        return ['always changed']
+    checker = checker or StatusChecker(find_dvc_root(os.path.dirname(os.path.abspath(dvc_yaml_filename))))
+    wdir = os.path.join(os.path.dirname(dvc_yaml_filename), stage_def.get('wdir', '.'))
+
+    changes = []
+    cmd = stage_def['cmd']
+    lock_cmd = lock.get('cmd')
+    if '${' in (cmd if isinstance(cmd, str) else ' '.join(cmd)):  # interpolated by DVC (cannot be checked here)
+        changes.append('changed command (interpolated, status unknown)')
+    elif cmd != lock_cmd:
+        changes.append('changed command')
+    if len(lock) > 0 and any(set(get_out_paths(stage_def.get(key))) != set(d['path'] for d in lock.get(key, []))
+                             for key in ['deps', 'outs']):  # deps/outs added or removed in dvc.yaml
+        changes.append('changed checksum')
+
+    if not stage_def.get('frozen', False):  # dvc status doesn't check deps of frozen stages
+        changed_deps = dict()
+        lock_deps = {dep['path']: dep for dep in lock.get('deps', [])}
+        for path in get_out_paths(stage_def.get('deps')):
+            dep_status = checker.status(os.path.join(wdir, path), lock_deps.get(path, dict()))
+            if dep_status is not None:
+                changed_deps[path] = dep_status
+
+        params = stage_def.get('params', [])
+        lock_params = lock.get('params', dict())
+        for param in params:
+            params_file, keys = (list(param.items())[0] if isinstance(param, dict) else ('params.yaml', [param]))
+            if os.path.splitext(params_file)[1] not in ['.yaml', '.yml', '.json']:
+                changed_deps[params_file] = 'unknown'
+                continue
+            params_path = os.path.join(wdir, params_file)
+            if not os.path.exists(params_path):
+                changed_deps[params_file] = 'deleted'
+                continue
+            current = get_params(params_path, keys)
+            recorded = lock_params.get(params_file, dict())
+            changed = {key: 'modified' for key in keys if key not in recorded or current[key] != recorded[key]}
+            if len(changed) > 0:
+                changed_deps[params_file] = changed
+        if len(changed_deps) > 0:
+            changes.append({'changed deps': changed_deps})
+
+    changed_outs = dict()
+    lock_outs = {out['path']: out for out in lock.get('outs', [])}
+    for path, opts in get_out_paths(stage_def.get('outs')).items():
+        out_status = checker.status(os.path.join(wdir, path), lock_outs.get(path, dict()))
+        if out_status is None and opts.get('cache', True) and not checker.in_cache(lock_outs[path]['md5']):
+            out_status = 'not in cache'
+        if out_status is not None:
+            changed_outs[path] = out_status
+    if len(changed_outs) > 0:
+        changes.append({'changed outs': changed_outs})
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read-only, incremental 'dvc status' of a single DVC stage "
+                                                 "(without acquiring DVC's locks).")
+    parser.add_argument('stage', type=str, help="[DVC_YAML:]STAGE (DVC_YAML defaults to ./dvc.yaml)")
+    parser.add_argument('--json', action='store_true', help="Print status as JSON (as dvc status --json)")
+    parser.add_argument('--jobs', type=int, default=8, help="Number of threads hashing files (default: 8)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print state DB hits and hashed files")
+    args = parser.parse_args()
+
+    dvc_yaml_filename, _, stage = args.stage.rpartition(':')
+    dvc_yaml_filename = dvc_yaml_filename or 'dvc.yaml'
+    checker = StatusChecker(find_dvc_root(os.path.dirname(os.path.abspath(dvc_yaml_filename))), args.jobs)
+    changes = stage_status(stage, dvc_yaml_filename, checker)
+    result = {stage: changes} if len(changes) > 0 else dict()
+    if args.json:
+        print(json.dumps(result))
+    elif len(changes) == 0:
+        print("Data and pipelines are up to date.")
+    else:
+        print(yaml.dump(result, default_flow_style=False), end='')
+    if args.verbose:
+        print(f"dvc_stage_status: {checker.stats['state_hits']} file hashes from state DB, "
+              f"{checker.stats['hashed']} files hashed.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
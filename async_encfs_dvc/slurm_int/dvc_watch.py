@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Live progress view of the asynchronous SLURM stages of a DVC repo (invoked through dvc_scontrol watch)
+#
+# Usage: dvc_scontrol watch [--interval SECS] [--once] [--json]
+#
+# Stages are discovered from the <stage>.dvc_stage_jobid files written by slurm_enqueue.sh next to the dvc.yaml files
+# tracked by git or in the wdirs of the stages in shared dvc.yaml files (cf. dvc_layout.py, rescanned periodically),
+# their state is derived from one squeue snapshot and the status files (<stage>.dvc_pending/started/complete/failed)
+# of each refresh:
+#   pending, held (stage job on hold), running, complete (not yet committed), committed, failed
+# Stage and commit durations are taken from the timing log in DVC_TIMING_LOG if available (cf. dvc_timing.py) and from
+# the status file transitions observed while watching, and used to estimate the time to completion.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import statistics
+import subprocess as sp
+
+from async_encfs_dvc.dvc_layout import SHARDS_DIR, get_stage_wdirs
+from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root, get_dvc_jobs, get_dvc_slurm_job_suffix
+
+
+STATUS_SUFFIXES = ['dvc_pending', 'dvc_started', 'dvc_complete', 'dvc_failed']
+STATES = ['running', 'pending', 'held', 'complete', 'failed', 'committed']
+
+
+def format_duration(secs):
+    if secs is None:
+        return 'n/a'
+    return str(datetime.timedelta(seconds=int(secs)))
+
+
+class PipelineWatch:
+    """Incremental view of the SLURM stages of a DVC repo"""
+
+    def __init__(self, dvc_root, rescan_interval=10):
+        self.dvc_root = dvc_root
+        self.job_suffix = get_dvc_slurm_job_suffix(dvc_root)
+        self.rescan_interval = rescan_interval  # refreshes between rescans for new stage directories
+        self.refreshes = 0
+        self.stage_dirs = []
+        self.stages = dict()  # stage name -> dict(dir, state, job_id, since, ...)
+        self.start_time = time.time()
+        self.transitions = dict(complete=[], committed=[])  # times of observed transitions
+        self.stage_durations = []   # observed (started -> complete)
+        self.commit_durations = []  # observed (complete -> committed)
+
+    def scan_stage_dirs(self):
+        """Directories with a dvc.yaml (tracked or untracked, not ignored by git) or a stage of a shared dvc.yaml"""
+        output = sp.run(['git', 'ls-files', '--cached', '--others', '--exclude-standard', '--full-name',
+                         ':(top)*dvc.yaml'], capture_output=True, cwd=self.dvc_root).stdout.decode('utf-8')
+        git_root = sp.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True,
+                          cwd=self.dvc_root).stdout.decode('utf-8').strip() or self.dvc_root
+        dvc_yaml_files = [os.path.join(git_root, f) for f in output.split('\n') if f.endswith('dvc.yaml')]
+        dirs = set(os.path.dirname(f) for f in dvc_yaml_files)
+        for f in dvc_yaml_files:  # working dirs of the stages in shared dvc.yaml files (cf. dvc_layout.py)
+            if os.sep + SHARDS_DIR + os.sep in f:
+                dirs.update(get_stage_wdirs(f))
+        self.stage_dirs = sorted(d for d in dirs if d.startswith(self.dvc_root))
+
+    def read_status_files(self):
+        """Status files of all stages with a job id file (stage name -> {suffix: ctime})"""
+        status = dict()
+        for stage_dir in self.stage_dirs:
+            try:
+                entries = list(os.scandir(stage_dir))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                name, _, suffix = entry.name.rpartition('.')
+                if suffix == 'dvc_stage_jobid' or suffix in STATUS_SUFFIXES:
+                    try:
+                        ctime = entry.stat().st_ctime  # status files are renamed (mv keeps mtime)
+                    except FileNotFoundError:
+                        continue
+                    status.setdefault(name, dict(dir=stage_dir))[suffix] = ctime
+        return status
+
+    def refresh(self, jobs=None):
+        """Update stage states from one squeue snapshot and the status files"""
+        if self.refreshes % self.rescan_interval == 0:
+            self.scan_stage_dirs()
+        self.refreshes += 1
+        now = time.time()
+
+        stage_jobs = dict()
+        for job in get_dvc_jobs(['stage'], self.dvc_root, jobs):
+            stage_jobs[job['name'][len('dvc_'):-len('_' + self.job_suffix)]] = job
+        for name, files in self.read_status_files().items():
+            job = stage_jobs.get(name)
+            if 'dvc_failed' in files:
+                state, since = 'failed', files['dvc_failed']
+            elif 'dvc_complete' in files:
+                state, since = 'complete', files['dvc_complete']
+            elif 'dvc_started' in files or (job is not None and job['state'] == 'RUNNING'):
+                state, since = 'running', files.get('dvc_started', now)
+            elif job is not None or 'dvc_pending' in files:
+                held = job is not None and job['reason'] == 'JobHeldUser'
+                state, since = 'held' if held else 'pending', files.get('dvc_pending', files.get('dvc_stage_jobid'))
+            else:
+                state, since = 'committed', None
+            self.update_stage(name, files['dir'], state, since, job, now)
+
+    def update_stage(self, name, stage_dir, state, since, job, now):
+        previous = self.stages.get(name)
+        if previous is not None and previous['state'] != state:
+            if state == 'complete':
+                self.transitions['complete'].append(since)
+                if previous['state'] == 'running' and previous['since'] is not None:
+                    self.stage_durations.append(since - previous['since'])
+            elif state == 'committed' and previous['state'] == 'complete':
+                self.transitions['committed'].append(now)
+                self.commit_durations.append(now - previous['since'])
+        if state == 'committed' and previous is not None and previous['state'] == 'committed':
+            since = previous['since']
+        self.stages[name] = dict(name=name, dir=stage_dir, state=state, since=since,
+                                 job_id=job['job_id'] if job is not None else None)
+
+    def recorded_durations(self, now):
+        """Stage and commit durations and completion rates (per hour) from the timing log (cf. dvc_timing.py) if
+        available, else from the transitions observed while watching"""
+        stage_durations, commit_durations = list(self.stage_durations), list(self.commit_durations)
+        hours = max(now - self.start_time, 1.) / 3600.
+        rates = dict(completed=len(self.transitions['complete']) / hours,
+                     committed=len(self.transitions['committed']) / hours)
+        timing_log = os.environ.get('DVC_TIMING_LOG')
+        if timing_log and os.path.exists(timing_log):
+            from async_encfs_dvc.dvc_timing import load_spans
+            ends = dict(stage=[], commit=[])
+            for s in load_spans([timing_log]):
+                if s['phase'] in ends:
+                    (stage_durations if s['phase'] == 'stage' else commit_durations).append(s['end'] - s['start'])
+                    ends[s['phase']].append(s['end'])
+            rates = dict(completed=sum(now - end < 3600. for end in ends['stage']),
+                         committed=sum(now - end < 3600. for end in ends['commit']))
+        return stage_durations, commit_durations, rates
+
+    def summary(self):
+        now = time.time()
+        counts = {state: 0 for state in STATES}
+        for stage in self.stages.values():
+            counts[stage['state']] += 1
+        stage_durations, commit_durations, rates = self.recorded_durations(now)
+        stage_duration = statistics.median(stage_durations) if len(stage_durations) > 0 else None
+        commit_duration = statistics.median(commit_durations) if len(commit_durations) > 0 else 0.
+
+        eta = None
+        if stage_duration is not None or counts['running'] + counts['pending'] + counts['held'] == 0:
+            stage_duration = stage_duration or 0.
+            remaining_work = sum(max(stage_duration - (now - s['since']), 0.) for s in self.stages.values()
+                                 if s['state'] == 'running' and s['since'] is not None) + \
+                (counts['pending'] + counts['held']) * stage_duration
+            # stages run concurrently (at the currently observed degree), commits are serialized (singleton)
+            eta = remaining_work / max(counts['running'], 1) + \
+                (counts['complete'] + counts['running'] + counts['pending'] + counts['held']) * commit_duration
+        return dict(dvc_root=self.dvc_root, time=now, stages=len(self.stages), counts=counts,
+                    completed_per_hour=rates['completed'], committed_per_hour=rates['committed'],
+                    commit_backlog=counts['complete'], median_stage_duration=stage_duration,
+                    median_commit_duration=commit_duration, eta=eta)
+
+    def render(self, interval, max_lines=None):
+        summary = self.summary()
+        counts = summary['counts']
+        lines = [f"DVC pipeline {self.dvc_root} at {time.strftime('%Y-%m-%d %H:%M:%S')} (refresh every {interval} s)",
+                 f"stages: {summary['stages']} | " + ' | '.join(f"{state} {counts[state]}" for state in STATES),
+                 f"throughput: {summary['completed_per_hour']:.1f} completed/h, "
+                 f"{summary['committed_per_hour']:.1f} committed/h | commit backlog {summary['commit_backlog']} | "
+                 f"median stage {format_duration(summary['median_stage_duration'])} | "
+                 f"ETA {format_duration(summary['eta'])}" +
+                 (" (held stages need 'dvc_scontrol release stage')" if counts['held'] > 0 else ''),
+                 '',
+                 f"{'STATE':<10}{'JOBID':>10}{'SINCE':>12}  STAGE"]
+        stages = sorted((s for s in self.stages.values() if s['state'] != 'committed'),
+                        key=lambda s: (STATES.index(s['state']), s['since'] or 0))
+        now = time.time()
+        for stage in stages:
+            elapsed = format_duration(now - stage['since']) if stage['since'] is not None else ''
+            lines.append(f"{stage['state']:<10}{stage['job_id'] or '':>10}{elapsed:>12}  "
+                         f"{os.path.relpath(stage['dir'], self.dvc_root)}:{stage['name']}")
+        if max_lines is not None and len(lines) > max_lines:
+            lines = lines[:max_lines - 1] + [f"... ({len(lines) - max_lines + 1} more stages)"]
+        return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='dvc_scontrol watch', description="Live progress view of the asynchronous "
+                                                                            "SLURM stages of this DVC repo.")
+    parser.add_argument('--interval', type=float, default=10., help="Refresh interval in secs (default: 10)")
+    parser.add_argument('--once', action='store_true', help="Print the view once and exit")
+    parser.add_argument('--json', action='store_true', help="Print summary and stages as JSON (implies --once)")
+    args = parser.parse_args(argv)
+
+    watch = PipelineWatch(find_dvc_root())
+    if args.once or args.json:
+        watch.refresh()
+        if args.json:
+            print(json.dumps(dict(watch.summary(), stages=list(watch.stages.values())), indent=2))
+        else:
+            print(watch.render(args.interval))
+        return
+
+    try:
+        while True:
+            start = time.time()
+            watch.refresh()
+            view = watch.render(args.interval, max_lines=shutil.get_terminal_size().lines - 1)
+            sys.stdout.write('\033[H\033[2J' + view + '\n')
+            sys.stdout.flush()
+            time.sleep(max(args.interval - (time.time() - start), 0.))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
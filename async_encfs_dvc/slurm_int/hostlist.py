@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Compact representation of SLURM node lists (e.g. SLURM_STEP_NODELIST) and tasks-per-node lists
+# (e.g. SLURM_STEP_TASKS_PER_NODE) that answers "index of this host" and "tasks on this host" in O(log runs)
+# without expanding the lists.
+#
+# Node lists are stored as runs of hosts <prefix><zero-padded integer><suffix> with contiguous integers, e.g.
+#   nid0[2285-2289,2718-2723],nid04280  ->  (nid, 5 digits, 2285..2289), (nid, 5 digits, 2718..2723), (nid, 5 digits, 4280)
+#   rack[1-2]n[01-16]                   ->  (rack1n, 2 digits, 1..16), (rack2n, 2 digits, 1..16)
+#   c[8-12]                             ->  (c, 1 digit, 8..9), (c, 2 digits, 10..12)
+# Tasks per node are stored as runs of (number of nodes, tasks), e.g. 2(x21),1(x6) -> (21, 2), (6, 1).
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.hostlist [--index] [--hostname HOST] [--nodelist NODELIST]
+#                                                      [--tasks-per-node TASKS_PER_NODE]
+# prints the number of tasks on the local host in the current SLURM step (or its index with --index).
+# With --export-env, prints shell export statements of the number of tasks on every node of the node list
+# (evaluated once per stage in sbatch_dvc_stage.sh, so that encfs_mount_and_run needs no Python on each rank).
+
+import os
+import re
+import shlex
+import socket
+import argparse
+from bisect import bisect_right
+
+
+_host_pattern = re.compile(r"^(.*?)(\d*)(\D*)$")
+
+
+def split_hostname(hostname):
+    """Split hostname into lookup key (prefix, suffix, number of digits) and its integer value"""
+    prefix, digits, suffix = _host_pattern.match(hostname).groups()
+    return (prefix, suffix, len(digits)), int(digits) if digits else 0
+
+
+def _split_top_level(expr):
+    """Split expression at commas outside of brackets"""
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(expr):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+            if depth < 0:
+                raise ValueError(f"Unbalanced brackets in node list '{expr}'")
+        elif c == ',' and depth == 0:
+            parts.append(expr[start:i])
+            start = i + 1
+    if depth != 0:
+        raise ValueError(f"Unbalanced brackets in node list '{expr}'")
+    parts.append(expr[start:])
+    return [p for p in parts if len(p) > 0]
+
+
+def _parse_ranges(ranges):
+    """Parse the content of a bracket expression into a list of (first, last, width) with zero-padding width"""
+    parsed = []
+    for r in ranges.split(','):
+        if '-' in r:
+            begin, end = r.split('-')
+        else:
+            begin, end = r, r
+        if not begin.isdigit() or not end.isdigit():
+            raise ValueError(f"Invalid range '{r}' in node list")
+        width = len(begin) if begin.startswith('0') else 0
+        parsed.append((int(begin), int(end), width))
+    return parsed
+
+
+def _format_number(n, width):
+    return str(n).zfill(width)
+
+
+def _expand_prefixes(expr):
+    """Expand all but the last bracket expression of a host expression into a list of (prefix, ranges, suffix)"""
+    match = re.match(r"^([^\[]*)\[([^\]]*)\](.*)$", expr)
+    if match is None:
+        return [(expr, None, '')]
+    head, ranges, tail = match.groups()
+    if '[' not in tail:
+        return [(head, _parse_ranges(ranges), tail)]
+    return [expanded
+            for first, last, width in _parse_ranges(ranges)
+            for n in range(first, last + 1)
+            for expanded in _expand_prefixes(head + _format_number(n, width) + tail)]
+
+
+class Hostlist:
+    """SLURM node list stored as runs of hosts with contiguous integer values"""
+
+    def __init__(self, nodelist):
+        self.runs = []  # (key, first value, last value, index of first host) in node list order
+        size = 0
+        for expr in _split_top_level(nodelist.strip()):
+            for prefix, ranges, suffix in _expand_prefixes(expr):
+                if ranges is None or _host_pattern.match(suffix).group(2) != '':
+                    # single host or ambiguous suffix with digits, store each host as a run
+                    hosts = [prefix] if ranges is None else \
+                        [prefix + _format_number(n, width) + suffix
+                         for first, last, width in ranges for n in range(first, last + 1)]
+                    for host in hosts:
+                        key, value = split_hostname(host)
+                        self.runs.append((key, value, value, size))
+                        size += 1
+                    continue
+                # trailing digits of the prefix belong to the integer value of the host
+                prefix_match = re.match(r"^(.*?)(\d*)$", prefix)
+                alpha_prefix, prefix_digits = prefix_match.groups()
+                for first, last, width in ranges:
+                    # split range where the number of digits changes (e.g. 8-12 -> 8-9, 10-12)
+                    begin = first
+                    while begin <= last:
+                        num_digits = max(width, len(str(begin)))
+                        end = min(last, 10**num_digits - 1)
+                        key = (alpha_prefix, suffix, len(prefix_digits) + num_digits)
+                        offset = int(prefix_digits) * 10**num_digits if prefix_digits else 0
+                        self.runs.append((key, offset + begin, offset + end, size))
+                        size += end - begin + 1
+                        begin = end + 1
+        self.size = size
+
+        self._sorted_runs = sorted(self.runs, key=lambda run: (run[0], run[1]))
+        self._sorted_keys = [(run[0], run[1]) for run in self._sorted_runs]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for (prefix, suffix, num_digits), first, last, _ in self.runs:
+            for value in range(first, last + 1):
+                digits = _format_number(value, num_digits) if num_digits > 0 else ''
+                yield prefix + digits + suffix
+
+    def index(self, hostname):
+        """Index of hostname in the node list (raises ValueError if not found)"""
+        key, value = split_hostname(hostname)
+        i = bisect_right(self._sorted_keys, (key, value)) - 1
+        if i >= 0:
+            run_key, first, last, start = self._sorted_runs[i]
+            if run_key == key and first <= value <= last:
+                return start + value - first
+        raise ValueError(f"Host {hostname} not in node list")
+
+    def __contains__(self, hostname):
+        try:
+            self.index(hostname)
+            return True
+        except ValueError:
+            return False
+
+
+class TasksPerNode:
+    """SLURM tasks per node list (e.g. 2(x21),1(x6)) stored as runs of nodes with the same number of tasks"""
+
+    def __init__(self, tasks_per_node):
+        self.runs = []  # (index of first node, number of nodes, tasks)
+        size = 0
+        for group in tasks_per_node.strip().split(','):
+            match = re.match(r"^(\d+)(?:\(x(\d+)\))?$", group.strip())
+            if match is None:
+                raise ValueError(f"Invalid tasks per node '{group}'")
+            count = int(match.group(2)) if match.group(2) is not None else 1
+            self.runs.append((size, count, int(match.group(1))))
+            size += count
+        self.size = size
+        self._starts = [run[0] for run in self.runs]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for _, count, ntasks in self.runs:
+            for _ in range(count):
+                yield ntasks
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(f"Node index {index} out of range (number of nodes {self.size})")
+        return self.runs[bisect_right(self._starts, index) - 1][2]
+
+
+def get_local_ntasks(nodelist, tasks_per_node, hostname):
+    """Number of tasks on hostname for a SLURM node list and tasks per node list"""
+
+    hosts = Hostlist(nodelist)
+    ntasks = TasksPerNode(tasks_per_node)
+    assert len(hosts) == len(ntasks)
+    try:
+        return ntasks[hosts.index(hostname)]
+    except ValueError:
+        raise RuntimeError("Could not find " + hostname + " in nodes (ntasks) " +
+                           ', '.join([node + " (" + str(n) + ")" for node, n in zip(hosts, ntasks)]) + '.')
+
+
+def get_local_ntasks_env(nodelist, tasks_per_node):
+    """Shell export statements for the number of tasks per node (looked up in encfs_mount_and_run)"""
+
+    ntasks = TasksPerNode(tasks_per_node)
+    env = {'ENCFS_MPI_LOCAL_SIZE_KEY': f"{nodelist};{tasks_per_node}"}
+    if len(ntasks.runs) == 1:  # same number of tasks on all nodes
+        env['ENCFS_MPI_LOCAL_SIZE'] = str(ntasks.runs[0][2])
+    else:
+        hosts = Hostlist(nodelist)
+        assert len(hosts) == len(ntasks)
+        env['ENCFS_MPI_LOCAL_SIZE_MAP'] = ' ' + ' '.join(f"{node}={n}" for node, n in zip(hosts, ntasks)) + ' '
+    return '\n'.join(f"export {k}={shlex.quote(v)}" for k, v in env.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Get number of tasks (or index) of the local host "
+                                                 "in the current SLURM step.")
+    parser.add_argument("--index", action='store_true',
+                        help="Print index of host in node list instead of number of tasks")
+    parser.add_argument("--export-env", action='store_true',
+                        help="Print shell export statements with the number of tasks of all nodes in the node list")
+    parser.add_argument("--hostname", type=str, default=None,
+                        help="Host to look up (default: local hostname)")
+    parser.add_argument("--nodelist", type=str, default=None,
+                        help="SLURM node list (default: SLURM_STEP_NODELIST)")
+    parser.add_argument("--tasks-per-node", type=str, default=None,
+                        help="SLURM tasks per node (default: SLURM_STEP_TASKS_PER_NODE)")
+    args = parser.parse_args()
+
+    nodelist = args.nodelist if args.nodelist is not None else \
+        os.environ['SLURM_STEP_NODELIST']  # "nid0[2285-2289,2718-2723,5883-5890,7672-7679]" # "nid0[4278-4279],nid04280"
+    hostname = args.hostname if args.hostname is not None else socket.gethostname()
+
+    if args.export_env:
+        tasks_per_node = args.tasks_per_node if args.tasks_per_node is not None else \
+            os.environ['SLURM_STEP_TASKS_PER_NODE']
+        print(get_local_ntasks_env(nodelist, tasks_per_node))
+    elif args.index:
+        print(Hostlist(nodelist).index(hostname), end='')
+    else:
+        tasks_per_node = args.tasks_per_node if args.tasks_per_node is not None else \
+            os.environ['SLURM_STEP_TASKS_PER_NODE']  # "2(x21),1(x6)" # "2(x2),1"
+        print(get_local_ntasks(nodelist, tasks_per_node, hostname), end='')
+
+
+if __name__ == '__main__':
+    main()
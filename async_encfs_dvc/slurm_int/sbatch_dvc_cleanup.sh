@@ -11,6 +11,14 @@ set -euxo pipefail
 dvc_stage_name="$1"
 shift
 
+if [[ "${DVC_SLURM_RUNTIME_HISTORY:-NO}" == "YES" ]]; then  # elapsed time of a timed out stage job is a lower bound for its --time prediction
+    python3 -m async_encfs_dvc.slurm_int.stage_runtime_history record-failure "${DVC_STAGE_APP_YAML}" "${DVC_STAGE_TYPE}" \
+        "${dvc_stage_name}" "$(cat "${dvc_stage_name}".dvc_stage_jobid)" || echo "sbatch_dvc_cleanup.sh: Warning: Failed to record failed run of ${dvc_stage_name}."
+fi
+if [[ "${DVC_SLURM_RETRY:-NO}" == "YES" ]] && python3 -m async_encfs_dvc.slurm_int.dvc_stage_retry retry "${dvc_stage_name}"; then
+    echo "Resubmitted dvc stage ${dvc_stage_name} after a transient failure (cf. ${dvc_stage_name}.dvc_retries)."
+    exit 0
+fi
 echo "Cleaning up failed dvc stage ${dvc_stage_name} (${SLURM_JOB_NAME}) with outs $@."
 ls -al 
 if [ -f "${dvc_stage_name}".dvc_pending ]; then
@@ -20,5 +28,10 @@ elif [ -f "${dvc_stage_name}".dvc_started ]; then
     mv "${dvc_stage_name}".dvc_started "${dvc_stage_name}".dvc_failed && fsync "${dvc_stage_name}".dvc_failed  # could protect by flock
     echo "Stage was started - skipping \'rm -r "$@"\' to enable post-mortem analysis"
 fi
-rm dvc.lock  # ensure that this stage gets re-executed upon dvc repro
+# ensure that this stage gets re-executed upon dvc repro
+if [ "${DVC_STAGE_DVC_YAML:-dvc.yaml}" == dvc.yaml ]; then
+    rm dvc.lock
+else  # shared dvc.yaml of a sharded stage layout (only remove this stage's entry, cf. dvc_layout.py)
+    python3 -m async_encfs_dvc.dvc_layout unlock "${DVC_STAGE_DVC_YAML}:${dvc_stage_name}"
+fi
 
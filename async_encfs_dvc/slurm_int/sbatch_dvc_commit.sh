@@ -26,11 +26,22 @@ case $1 in
 esac
 dvc_stage_name="$2"
 shift 2
+dvc_stage_dvc_yaml="${DVC_STAGE_DVC_YAML:-dvc.yaml}"  # shared dvc.yaml of a sharded stage layout (cf. dvc_layout.py)
+
+# per-phase timing spans (cf. dvc_timing.py)
+if [[ -n "${DVC_TIMING_LOG:-}" ]]; then
+    eval "$(python3 -m async_encfs_dvc.dvc_timing shell)"
+    export DVC_TIMING_STAGE="${dvc_stage_name}"
+else
+    dvc_timing_start () { :; }
+    dvc_timing_end () { :; }
+fi
 
 
 if [[ ${in_repo} == NO ]]; then
   source "$(dvc root)"/../dvc_tools/slurm_int/dvc_out_of_repo.sh
   stage_dir=$(realpath --relative-to=$(dvc root) .)
+  stage_dvc_yaml=$(realpath --relative-to=$(dvc root) "${dvc_stage_dvc_yaml}")
   repo_dir=$(realpath --relative-to=$(dvc root)/.. $(dvc root))
 
   if [[ ${out_of_repo_commit} == NO ]]; then 
@@ -40,7 +51,9 @@ if [[ ${in_repo} == NO ]]; then
     dvc_out_of_repo_init
 
     echo "Committing dvc stage $@ out of repo (prepare step, ${SLURM_JOB_NAME})."
-    time srun --nodes 1 --ntasks 1 dvc commit --verbose --force "${stage_dir}/dvc.yaml:${dvc_stage_name}"
+    dvc_timing_start commit_prepare
+    time srun --nodes 1 --ntasks 1 dvc commit --verbose --force "${stage_dvc_yaml}:${dvc_stage_name}"
+    dvc_timing_end commit_prepare
      
     # dvc_out_of_repo_cleanup must be called in subsequent job that pushes to local remote
   else
@@ -53,8 +66,10 @@ if [[ ${in_repo} == NO ]]; then
         
     dvc remote add --verbose local_temp ../${aux_repo_dir}/.dvc/cache  # extra local dvc pull (safer)
     echo "Committing dvc stage $@ out of repo (commit step, ${SLURM_JOB_NAME})."
-    time srun --nodes 1 --ntasks 1  dvc pull --remote local_temp "${stage_dir}/dvc.yaml:${dvc_stage_name}"  # FIXME: still triggers hash computation on pulled files - need to find a way to pull also cache.db content
+    dvc_timing_start commit
+    time srun --nodes 1 --ntasks 1  dvc pull --remote local_temp "${stage_dvc_yaml}:${dvc_stage_name}"  # FIXME: still triggers hash computation on pulled files - need to find a way to pull also cache.db content
     rm "${stage_dir}/${dvc_stage_name}".dvc_complete  # could protect by flock
+    dvc_timing_end commit
     dvc remote remove --verbose local_temp
 
     # cleanup auxiliary repo
@@ -77,12 +92,14 @@ if [[ ${in_repo} == NO ]]; then
 else
   ## in-repo commit
   echo "Committing dvc stage $@ (${SLURM_JOB_NAME})."
-  time srun --nodes 1 --ntasks 1 dvc commit --verbose --force "${dvc_stage_name}"  # echo y | dvc commit $@
+  dvc_timing_start commit
+  time srun --nodes 1 --ntasks 1 dvc commit --verbose --force "${dvc_stage_dvc_yaml}:${dvc_stage_name}"  # echo y | dvc commit $@
   autostage=$(python3 -c "from dvc.repo import Repo; print(Repo().config['core']['autostage'])")
   if [ "${autostage}" == "True" ]; then
-      git add dvc.lock
+      git add "$(dirname "${dvc_stage_dvc_yaml}")"/dvc.lock
   fi
   rm "${dvc_stage_name}".dvc_complete  # could protect by flock
+  dvc_timing_end commit
   # dvc push for now in separate job, but could be integrated with this one as an additional SLURM step
 fi
 
@@ -0,0 +1,9 @@
+#!/bin/bash -l
+
+# Singleton fallback job of the preferred node lists of stage jobs (submitted by dvc_node_affinity.py with --begin in
+# the DVC root): clears the ReqNodeList of stage jobs eligible to start for longer than DVC_SLURM_NODE_AFFINITY_TIMEOUT
+# and resubmits itself as long as any preferred node list is set.
+
+set -euo pipefail
+
+python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity fallback --resubmit
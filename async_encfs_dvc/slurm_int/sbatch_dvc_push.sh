@@ -21,6 +21,16 @@ case $1 in
 esac
 dvc_stage_name="$2"
 shift 2
+dvc_stage_address="${DVC_STAGE_DVC_YAML:-dvc.yaml}:${dvc_stage_name}"  # cf. dvc_layout.py
+
+# per-phase timing spans (cf. dvc_timing.py)
+if [[ -n "${DVC_TIMING_LOG:-}" ]]; then
+    eval "$(python3 -m async_encfs_dvc.dvc_timing shell)"
+    export DVC_TIMING_STAGE="${dvc_stage_name}"
+else
+    dvc_timing_start () { :; }
+    dvc_timing_end () { :; }
+fi
 
 if [[ ${in_repo} == NO ]]; then
   source "$(dvc root)"/../dvc_tools/slurm_int/dvc_out_of_repo.sh
@@ -28,8 +38,15 @@ if [[ ${in_repo} == NO ]]; then
   dvc_out_of_repo_init
 fi
 
-echo "Running dvc push --verbose $@ (${SLURM_JOB_NAME})."
-time srun --nodes 1 --ntasks 1 dvc push --verbose "${dvc_stage_name}"
+dvc_timing_start push
+if [[ "${DVC_SWIFT_PUSH:-NO}" == "YES" ]]; then  # exported by slurm_enqueue.sh
+  echo "Running segmented, parallel Swift upload of ${dvc_stage_name} (${SLURM_JOB_NAME})."
+  time srun --nodes 1 --ntasks 1 python3 -m async_encfs_dvc.swift_int.swift_push "${dvc_stage_address}"
+else
+  echo "Running dvc push --verbose $@ (${SLURM_JOB_NAME})."
+  time srun --nodes 1 --ntasks 1 dvc push --verbose "${dvc_stage_address}"
+fi
+dvc_timing_end push
 
 if [[ ${in_repo} == NO ]]; then
   # cleanup auxiliary repo
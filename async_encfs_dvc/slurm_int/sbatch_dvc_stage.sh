@@ -9,6 +9,21 @@ set -euo pipefail
 
 dvc_stage_name="$1"
 shift
+dvc_stage_start_time="${EPOCHREALTIME:-$(date +%s.%N)}"  # recorded in the runtime history (cf. stage_runtime_history.py)
+
+# per-phase timing spans (cf. dvc_timing.py), functions exported to encfs_mount_and_run on each rank
+if [[ -n "${DVC_TIMING_LOG:-}" ]]; then
+    eval "$(python3 -m async_encfs_dvc.dvc_timing shell)"
+    export -f dvc_timing_start dvc_timing_end
+    export DVC_TIMING_STAGE="${dvc_stage_name}"
+    if [[ -n "${DVC_TIMING_SUBMIT_TIME:-}" && "${SLURM_RESTART_COUNT:-0}" -eq 0 ]]; then  # exported by slurm_enqueue.sh
+        dvc_timing_end queue_wait "${DVC_TIMING_SUBMIT_TIME}"
+    fi
+else
+    dvc_timing_start () { :; }
+    dvc_timing_end () { :; }
+fi
+dvc_timing_start stage
 
 if [[ "${SLURM_PROCID}" -eq 0 ]]; then
     echo "sbatch_dvc_stage.sh: Clean up of any left-overs from previous run (in case of requeue)"
@@ -22,7 +37,7 @@ if [[ "${SLURM_PROCID}" -eq 0 ]]; then
 # dvc_get_stage_outs.py
 import yaml
 
-with open("dvc.yaml") as f:
+with open("${DVC_STAGE_DVC_YAML:-dvc.yaml}") as f:
     dvc_yaml = yaml.load(f, Loader=yaml.FullLoader)
 
 print('\n'.join([p for out in dvc_yaml['stages']["${dvc_stage_name}"]['outs']
@@ -30,16 +45,37 @@ print('\n'.join([p for out in dvc_yaml['stages']["${dvc_stage_name}"]['outs']
 EOF
 )
 
-    for out in "${dvc_stage_outs[@]}"; do # coordinate outs-persist-handling with dvc_create_stage
-        ls -I dvc_stage_out.log  "${out}" | xargs -I {} rm -r "${out}"/{} || true # correct dvc stage add --outs-persist behavior (used to avoid accidentally deleting files of completed, but not committed stages), requires mkdir -p <out_1> <out_2> ... in command
-        mkdir -p "${out}" # output deps must be avaiable (as dirs) upon submission for dvc repro --no-commit --no-lock to succeed
-    done
+    # coordinate outs-persist-handling with dvc_create_stage (keeps dvc_stage_out.log, old outputs deleted in the background)
+    python3 -m async_encfs_dvc.slurm_int.dvc_reset_outs "${dvc_stage_outs[@]}"  # recorded as reset_outs span
 fi
 
 set -x
 echo "sbatch_dvc_stage.sh: Running DVC stage ${SLURM_JOB_NAME}."
 mv "${dvc_stage_name}".dvc_pending "${dvc_stage_name}".dvc_started && fsync "${dvc_stage_name}".dvc_started  # could protect by flock
+# resolve the number of tasks per node once per stage for encfs_mount_and_run (no Python interpreter launched on each rank,
+# valid for job steps spanning the whole allocation, other steps fall back to slurm_step_get_local_ntasks.py)
+eval "$(python3 -m async_encfs_dvc.slurm_int.hostlist --export-env --nodelist "${SLURM_JOB_NODELIST}" --tasks-per-node "${SLURM_TASKS_PER_NODE}")"
+if [[ "${DVC_CONTAINER_PREPULL:-NO}" == "YES" ]]; then  # warm node-local docker image stores (the image was pulled on the submission host)
+    dvc_timing_start container_pull
+    srun --nodes="${SLURM_JOB_NUM_NODES}" --ntasks-per-node=1 python3 -m async_encfs_dvc.slurm_int.container_prepull pull -- "$@" || \
+        echo "sbatch_dvc_stage.sh: Warning: Failed to pre-pull container image of ${dvc_stage_name} on all nodes."
+    dvc_timing_end container_pull
+fi
 {{ slurm_stage_env or '' }}
+dvc_timing_start srun  # incl. encfs_mount/payload/encfs_unmount spans of encfs_mount_and_run
 time srun --wait=300 "$@"  # --wait to allow more asymmetric task completion than 30 sec, especially with encfs (TODO: separate srun from sbatch options in dvc_app.yaml)
+dvc_timing_end srun
+if [[ -f dvc_compression.yaml ]]; then  # compress the outputs declared in the stage policy (cf. stage_compression.py)
+    python3 -m async_encfs_dvc.stage_compression apply --stage "${dvc_stage_name}"  # recorded as compression span
+fi
+if [[ "${DVC_SLURM_NODE_AFFINITY:-NO}" == "YES" ]]; then  # exported by slurm_enqueue.sh, before the downstream stage jobs become eligible
+    python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity record "${dvc_stage_name}" || \
+        echo "sbatch_dvc_stage.sh: Warning: Failed to record nodes of ${dvc_stage_name}."
+fi
 mv "${dvc_stage_name}".dvc_started "${dvc_stage_name}".dvc_complete && fsync "${dvc_stage_name}".dvc_complete  # could protect by flock
+if [[ "${DVC_SLURM_RUNTIME_HISTORY:-NO}" == "YES" ]]; then  # exported by slurm_enqueue.sh
+    python3 -m async_encfs_dvc.slurm_int.stage_runtime_history record "${DVC_STAGE_APP_YAML}" "${DVC_STAGE_TYPE}" \
+        "${dvc_stage_name}" "${dvc_stage_start_time/,/.}" || echo "sbatch_dvc_stage.sh: Warning: Failed to record runtime of ${dvc_stage_name}."
+fi
+dvc_timing_end stage
 
@@ -39,16 +39,33 @@ log_error () {
 DVC_SLURM_DVC_OP_OUT_OF_REPO=${DVC_SLURM_DVC_OP_OUT_OF_REPO:-NO}  # run commit (and eventually push) out of repo (currently no speedup)
 DVC_SLURM_DVC_OP_NO_HOLD=${DVC_SLURM_DVC_OP_NO_HOLD:-NO}          # put pending/running dvc commit/push ops on hold to enable continued use of dvc and then manual scontrol release
 DVC_SLURM_DVC_PUSH_ON_COMMIT=${DVC_SLURM_DVC_PUSH_ON_COMMIT:-NO}  # don't enqueue dvc push job by default, leave this to user later
+DVC_SWIFT_PUSH=${DVC_SWIFT_PUSH:-NO}                              # push with segmented, parallel and resumable Swift uploads instead of dvc push (cf. swift_push.py)
+DVC_CONTAINER_PREPULL=${DVC_CONTAINER_PREPULL:-NO}                # pull container image once per repo before submission and pin stage command to its digest
+DVC_TIMING_LOG=${DVC_TIMING_LOG:-}                                # append timing spans of all stage phases to this file (JSON lines, report with dvc_timing.py)
+DVC_SLURM_RUNTIME_HISTORY=${DVC_SLURM_RUNTIME_HISTORY:-YES}      # record stage runtimes in .dvc/tmp/stage_runtime_history.jsonl (cf. stage_runtime_history.py)
+DVC_SLURM_TIME_PREDICTION=${DVC_SLURM_TIME_PREDICTION:-NO}        # predict --time of stage jobs from the runtime history (SUGGEST only logs it, YES sets it)
+DVC_SLURM_CRITICAL_PATH=${DVC_SLURM_CRITICAL_PATH:-NO}            # lower the priority (--nice) of stage jobs off the critical path of the pipeline (cf. dvc_critical_path.py)
+DVC_SLURM_NODE_AFFINITY=${DVC_SLURM_NODE_AFFINITY:-NO}            # prefer the nodes of upstream stages for stage jobs (ReqNodeList with fallback, cf. dvc_node_affinity.py)
+DVC_SLURM_RETRY=${DVC_SLURM_RETRY:-NO}                            # resubmit stage jobs that failed transiently (NODE_FAIL, PREEMPTED, ...) with backoff (cf. dvc_stage_retry.py)
+
+# per-phase timing spans (cf. dvc_timing.py), propagated through sbatch/srun to the jobs of this stage
+if [[ -n "${DVC_TIMING_LOG}" ]]; then
+    export DVC_TIMING_LOG="$(realpath -m "${DVC_TIMING_LOG}")"
+    export DVC_TIMING_STAGE="${dvc_stage_name}"
+    eval "$(python3 -m async_encfs_dvc.dvc_timing shell)"
+else
+    dvc_timing_start () { :; }
+    dvc_timing_end () { :; }
+fi
+dvc_timing_start enqueue
 
 dvc_stage_from_dep () {
     echo "${1##*:}"
 }
 
-dvc_yaml_from_dep () {
-    echo "${1%:*}"
-}
-
 dvc_root="$(dvc root)"
+export DVC_STAGE_DVC_YAML="${DVC_STAGE_DVC_YAML:-dvc.yaml}"  # dvc.yaml of this stage relative to its working directory (exported by dvc_cmd, cf. dvc_layout.py)
+dvc_stage_address="${DVC_STAGE_DVC_YAML}:${dvc_stage_name}"
 
 # TODO: separate script to source
 # Append dvc root to SLURM job ID (due to repo-level lock)
@@ -68,13 +85,21 @@ dvc_slurm_cleanup_name="$(get_dvc_slurm_job_name "cleanup_${dvc_stage_name}")"
 
 if [[ "${DVC_SLURM_DVC_OP_NO_HOLD}" != "YES" ]]; then  # YES is potentially unsafe
     log "Info: Putting any concurrent dvc commit or push operations on hold (use dvc_scontrol release later). Warning: Concurrent dvc operations cause a potential conflict for acquiring $(dvc root)/.dvc/tmp/rwlock) and dvc commands (incl. repro) will error out if they detect this."
-    dvc_scontrol hold commit  # put commit jobs on hold due to potential race condition for DVC's rwlock
-    dvc_scontrol hold push
+    dvc_scontrol hold commit,push  # put commit/push jobs on hold due to potential race condition for DVC's rwlock (single squeue snapshot)
+fi
+
+if [[ "${DVC_CONTAINER_PREPULL}" == "YES" ]]; then
+    mapfile -d '' pinned_command < <(python3 -m async_encfs_dvc.slurm_int.container_prepull pin -- "$@")
+    if [ ${#pinned_command[@]} -eq $# ]; then
+        set -- "${pinned_command[@]}"
+    else
+        log "Warning: Failed to pin container image of stage command - using it unmodified."
+    fi
 fi
 
 # Compute SLURM job opts, TODO: separately supply srun options (currently only sbatch supported)
 slurm_int_path="$(python -c 'from async_encfs_dvc import slurm_int; print(slurm_int.__path__[0])')"
-dvc_slurm_opts_stage_job="$(python3 -m async_encfs_dvc.slurm_int.slurm_get_job_opts ${dvc_stage_app_yaml} ${dvc_stage_app_yaml_stage_name} stage)"
+export ENCFS_INT_PATH="$(dirname "${slurm_int_path}")/encfs_int"  # propagated through sbatch/srun to encfs_mount_and_run on each rank
 dvc_slurm_opts_dvc_job="$(python3 -m async_encfs_dvc.slurm_int.slurm_get_job_opts ${dvc_stage_app_yaml} ${dvc_stage_app_yaml_stage_name} dvc)"
 
 # Check encfs and sarus configuration
@@ -103,19 +128,22 @@ if [[ "$*" =~ sarus ]]; then
 fi
 
 # Get stage dependencies (dvc dag --dot doesn't need to move repo-lock temporarily)
+dvc_timing_start dependency_resolution
 dvc_stage_deps=()
-while IFS= read -r dep; do
+dvc_stage_dep_dirs=()  # working directories of the dependencies (with their status files)
+while IFS=$'\t' read -r dep_dir dep; do
     if [ -n "${dep}" ]; then
         dvc_stage_deps+=("${dep}")
+        dvc_stage_dep_dirs+=("${dep_dir}")
     fi
-done <<< "$(python3 -m async_encfs_dvc.slurm_int.dvc_get_stage_deps ${dvc_stage_name})"
+done <<< "$(python3 -m async_encfs_dvc.slurm_int.dvc_get_stage_deps ${dvc_stage_address})"
 
 dvc_stage_outs=()
 while IFS= read -r out; do
     if [ -n "${out}" ]; then
         dvc_stage_outs+=("${out}")
     fi
-done <<< "$(python3 -m async_encfs_dvc.slurm_int.dvc_get_stage_outs ${dvc_stage_name})"
+done <<< "$(python3 -m async_encfs_dvc.slurm_int.dvc_get_stage_outs ${dvc_stage_address})"
 
 log "DVC stage deps of ${dvc_stage_name}: ${dvc_stage_deps[*]}"
 log "DVC stage outs of ${dvc_stage_name}: ${dvc_stage_outs[*]}"
@@ -124,9 +152,10 @@ debug set -x  # debugging
 
 # Get status of dependencies - pending/started/complete/committed (stage can fail at any of the first two)
 dep_slurm_stage_jobids=()
-for dep in "${dvc_stage_deps[@]}"; do
+for i in "${!dvc_stage_deps[@]}"; do
+    dep="${dvc_stage_deps[$i]}"
     log "Looking for state of DVC dependency ${dep}."
-    dep_dvc_dir="$(dirname "$(dvc_yaml_from_dep "${dep}")")"
+    dep_dvc_dir="${dvc_stage_dep_dirs[$i]}"
     dep_dvc_stage_name="$(dvc_stage_from_dep "${dep}")"
     dep_slurm_stage_name="$(get_dvc_slurm_job_name "${dep}")"
     dep_slurm_stage_jobid=$(squeue --name="${dep_slurm_stage_name}" --Format=JobID --sort=-S -h)
@@ -156,9 +185,7 @@ for dep in "${dvc_stage_deps[@]}"; do
     else
          log "No SLURM status (pending/started/complete/failed) set for DVC dependency ${dep} - assuming committed, skipping this dependency."
 #        # This is probably unnecessary for dependencies as dvc repro would descend into it and reproduce it (otherwise with --single-item this is desired behavior)
-#        mv "${dvc_root}"/.dvc/tmp/rwlock{,.bak}  # this causes the repro to fail if another dvc command (e.g. repro) acquires the rwlock before status has it
-#        dep_status="$(dvc status --json "${dep}")"  # interpret with https://dvc.org/doc/command-reference/status#local-workspace-status
-#        mv "${dvc_root}"/.dvc/tmp/rwlock{.bak,}  # silent failure if lock taken by other process (use atomic RENAME_EXCHANGE with renameat2 and check rwlock.bak content)
+#        dep_status="$(cd "${dep_dvc_dir}" && python3 -m async_encfs_dvc.slurm_int.dvc_stage_status --json "${dep_dvc_stage_name}")"  # read-only, no need to move the rwlock aside
 #        if [[ "${dep_status}" == "{}" ]]; then
 #            log "DVC dependency ${dep} has been committed already - skipping this dependency."
 #        else
@@ -166,6 +193,22 @@ for dep in "${dvc_stage_deps[@]}"; do
 #        fi
     fi
 done
+dvc_timing_end dependency_resolution "" "deps=$(for dep in "${dvc_stage_deps[@]}"; do printf "%s," "$(dvc_stage_from_dep "${dep}")"; done)"
+
+# Stage job opts (--time predicted from runtime history if all deps are available to measure the input size)
+export DVC_SLURM_RUNTIME_HISTORY DVC_SLURM_TIME_PREDICTION DVC_SLURM_NODE_AFFINITY DVC_SLURM_RETRY DVC_SWIFT_PUSH  # propagated through sbatch to sbatch_dvc_stage/cleanup/push.sh
+export DVC_SLURM_NODE_AFFINITY_JOB_OPTS="${dvc_slurm_opts_dvc_job}"  # sbatch options of the fallback job of preferred node lists (cf. dvc_node_affinity.py)
+if [[ "${DVC_SLURM_RUNTIME_HISTORY}" == "YES" ]]; then
+    export DVC_STAGE_APP_YAML="$(realpath "${dvc_stage_app_yaml}")"
+    export DVC_STAGE_TYPE="${dvc_stage_app_yaml_stage_name}"
+fi
+if [[ "${DVC_SLURM_TIME_PREDICTION}" != "NO" && ${#dep_slurm_stage_jobids[@]} -eq 0 ]]; then
+    export DVC_STAGE_INPUT_SIZE="$(python3 -m async_encfs_dvc.slurm_int.stage_runtime_history input-size ${dvc_stage_address})"
+fi
+dvc_slurm_opts_stage_job="$(python3 -m async_encfs_dvc.slurm_int.slurm_get_job_opts ${dvc_stage_app_yaml} ${dvc_stage_app_yaml_stage_name} stage)"
+if [[ "${DVC_SLURM_CRITICAL_PATH}" == "YES" ]]; then  # stages on the longest remaining chain are scheduled first
+    dvc_slurm_opts_stage_job+=" $(python3 -m async_encfs_dvc.slurm_int.dvc_critical_path nice ${dvc_stage_name})"
+fi
 
 # DVC stage job depends on all dependencies' stage jobs
 if [ ${#dep_slurm_stage_jobids[@]} -gt 0 ]; then
@@ -203,7 +246,7 @@ elif [[ -f "${dvc_stage_name}".dvc_pending || -f "${dvc_stage_name}".dvc_started
         fi
         sleep 1
     done
-    log_error "Error: Could not find SLURM job for ${dvc_stage_name} (job name ${dvc_slurm_stage_name}) despite status pending or started - abort. Handle this stage manually by removing the status file $(ls "${dvc_stage_name}".dvc_{pending,started}) and running 'dvc repro ${dvc_stage_name}' (or by running 'dvc commit ${dvc_stage_name}' if stage has completed)."
+    log_error "Error: Could not find SLURM job for ${dvc_stage_name} (job name ${dvc_slurm_stage_name}) despite status pending or started - abort. Handle this stage manually by removing the status file $(ls "${dvc_stage_name}".dvc_{pending,started}) and running 'dvc repro ${dvc_stage_address}' (or by running 'dvc commit ${dvc_stage_address}' if stage has completed)."
 elif [ -f ${dvc_stage_name}.dvc_complete ]; then  # stage has completed, but is not yet committed
   # (detected with a file created before completion of run, removed upon completion of commit)
   log "DVC stage ${dvc_stage_name} completed successfully, but not yet committed - do not resubmit. Commit/push jobs may still be running. Commit manually if needed with 'sbatch --job-name "${dvc_slurm_commit_name}" --dependency singleton --nodes 1 --ntasks 1 ${dvc_slurm_opts_dvc_job} "${slurm_int_path}/sbatch_dvc_commit.sh" in-repo "${dvc_stage_name}"'"
@@ -217,9 +260,8 @@ elif [ -f ${dvc_stage_name}.dvc_complete ]; then  # stage has completed, but is
       exit 0
   fi
 else  # stage was either committed since dvc repro invoked this (probably not possible?) or it must be re-run
-  mv "${dvc_root}"/.dvc/tmp/rwlock{,.bak}  # see comment above (is this really necessary?)
-  stage_status="$(dvc status --json ${dvc_stage_name})"
-  mv "${dvc_root}"/.dvc/tmp/rwlock{.bak,}
+  # read-only equivalent of dvc status (dvc repro holds the rwlock, cf. dvc_stage_status.py)
+  stage_status="$(python3 -m async_encfs_dvc.slurm_int.dvc_stage_status --json ${dvc_stage_address})"
   if [[ "${stage_status}" == "{}" ]]; then
       push_jobids=($(get_dvc_slurm_job_ids "${dvc_slurm_push_name}" push "${dvc_stage_name}"))
       if [ "${#push_jobids[@]}" -eq 0  ]; then 
@@ -238,6 +280,7 @@ else  # stage was either committed since dvc repro invoked this (probably not po
 fi
 
 log_submitted_jobs=()
+dvc_timing_start submission
 if [[ "${DVC_SLURM_DVC_OP_NO_HOLD}" != "YES" ]]; then  # YES is potentially unsafe, the user invoking this must be aware of pot race condition
     dvc_slurm_hold_opts="--hold"
 else
@@ -251,13 +294,12 @@ if [[ "${run_stage}" == "YES" ]]; then
     # Launch SLURM sbatch jobs
 
     # Clean up of any left-overs from previous run, put into sbatch_dvc_stage.sh as well (in case of requeue)
-    for out in "${dvc_stage_outs[@]}"; do # coordinate outs-persist-handling with dvc_create_stage
-        ls -I dvc_stage_out.log  "${out}" | xargs -I {} rm -r "${out}"/{} || true # correct dvc stage add --outs-persist behavior (used to avoid accidentally deleting files of completed, but not committed stages), requires mkdir -p <out_1> <out_2> ... in command
-        mkdir -p "${out}" # output deps must be avaiable (as dirs) upon submission for dvc repro --no-commit --no-lock to succeed
-    done
+    # coordinate outs-persist-handling with dvc_create_stage: correct dvc stage add --outs-persist behavior (used to avoid accidentally deleting files of completed, but not committed stages)
+    # keeping only dvc_stage_out.log, output deps must be avaiable (as dirs) upon submission for dvc repro --no-commit --no-lock to succeed
+    python3 -m async_encfs_dvc.slurm_int.dvc_reset_outs "${dvc_stage_outs[@]}"  # old outputs are deleted in the background
     
     # Remove status/commit/cleanup logs from previous execution
-    rm -f ${dvc_stage_name}.dvc_{pending,started,complete,failed}
+    rm -f ${dvc_stage_name}.dvc_{pending,started,complete,failed,retries}
     rm -f dvc_sbatch.dvc_commit.*.{out,err}
     rm -f dvc_sbatch.dvc_push.*.{out,err}
     rm -f slurm_enqueue_dvc_push_${dvc_stage_name}.sh
@@ -266,15 +308,26 @@ if [[ "${run_stage}" == "YES" ]]; then
     python3 -m async_encfs_dvc.slurm_int.slurm_render_sbatch ${dvc_stage_app_yaml} \
         ${dvc_stage_app_yaml_stage_name} stage ${dvc_stage_name} && \
         chmod u+x sbatch_dvc_stage_${dvc_stage_name}.sh
-    stage_jobid=$(sbatch --parsable --job-name "${dvc_slurm_stage_name}" ${dvc_slurm_stage_deps} ${dvc_slurm_hold_opts} ${dvc_slurm_opts_stage_job} "sbatch_dvc_stage_${dvc_stage_name}.sh" "${dvc_stage_name}" "$@")
+    export DVC_TIMING_SUBMIT_TIME="${EPOCHREALTIME:-$(date +%s.%N)}"  # queue wait measured by sbatch_dvc_stage.sh
+    stage_sbatch_args=(--job-name "${dvc_slurm_stage_name}" ${dvc_slurm_opts_stage_job} "sbatch_dvc_stage_${dvc_stage_name}.sh" "${dvc_stage_name}" "$@")
+    stage_jobid=$(sbatch --parsable ${dvc_slurm_stage_deps} ${dvc_slurm_hold_opts} "${stage_sbatch_args[@]}")
     echo "$@" > ${dvc_stage_name}.dvc_pending && fsync ${dvc_stage_name}.dvc_pending
     echo ${stage_jobid} > ${dvc_stage_name}.dvc_stage_jobid # useful to figure out run job id
     log_submitted_jobs+=("stage: ${stage_jobid}")
+    if [[ "${DVC_SLURM_NODE_AFFINITY}" == "YES" && ${#dep_slurm_stage_jobids[@]} -eq 0 ]]; then  # else set by the last upstream stage job
+        python3 -m async_encfs_dvc.slurm_int.dvc_node_affinity prefer ${dvc_stage_name} ${stage_jobid} || \
+            log "Warning: Failed to set preferred nodes of stage job ${stage_jobid}."
+    fi
 
-    cleanup_jobid=$(sbatch --parsable --job-name "${dvc_slurm_cleanup_name}" --dependency afternotok:${stage_jobid} \
-    --nodes 1 --ntasks 1 ${dvc_slurm_opts_dvc_job} "${slurm_int_path}/sbatch_dvc_cleanup.sh" "${dvc_stage_name}" "${dvc_stage_outs[@]}")
+    cleanup_sbatch_args=(--job-name "${dvc_slurm_cleanup_name}" --nodes 1 --ntasks 1 ${dvc_slurm_opts_dvc_job} \
+    "${slurm_int_path}/sbatch_dvc_cleanup.sh" "${dvc_stage_name}" "${dvc_stage_outs[@]}")
+    cleanup_jobid=$(sbatch --parsable --dependency afternotok:${stage_jobid} "${cleanup_sbatch_args[@]}")
     echo ${cleanup_jobid} > ${dvc_stage_name}.dvc_cleanup_jobid
     log_submitted_jobs+=("cleanup: ${cleanup_jobid}")
+    if [[ "${DVC_SLURM_RETRY}" == "YES" ]]; then  # resubmitted by the cleanup job after a transient failure
+        printf '%s\0' "${stage_sbatch_args[@]}" > ${dvc_stage_name}.dvc_stage_sbatch_args
+        printf '%s\0' "${cleanup_sbatch_args[@]}" > ${dvc_stage_name}.dvc_cleanup_sbatch_args
+    fi
 fi
 
 # dvc commit
@@ -321,6 +374,7 @@ if [[ "${run_stage}" == "YES" || "${run_commit}" == "YES" || "${run_push}" == "Y
 set -euxo pipefail
 
 cd "\$\(dirname "\$0"\)"
+export DVC_SWIFT_PUSH=\${DVC_SWIFT_PUSH:-${DVC_SWIFT_PUSH}}  # as configured on enqueue unless overridden
 push_jobid=\$(sbatch --parsable --job-name "${dvc_slurm_push_name}" ${dvc_slurm_push_deps} \
 --nodes 1 --ntasks 1 ${dvc_slurm_opts_dvc_job} "${slurm_int_path}"/sbatch_dvc_push.sh in-repo "${dvc_stage_name}")
 echo \${push_jobid} > ${dvc_stage_name}.dvc_push_jobid # useful to figure out which push job (all named equally) commits this stage
@@ -333,6 +387,7 @@ fi
 
 log_submitted_jobs=$(printf ", %s" "${log_submitted_jobs[@]}")
 log "Submitted all jobs for stage ${dvc_stage_name} (${log_submitted_jobs:2})."
+dvc_timing_end submission
 
 if [[ "${DVC_SLURM_DVC_OP_NO_HOLD}" != "YES" ]]; then  # YES is potentially unsafe, the user invoking this must be aware of pot race condition
     log "All jobs submitted on hold to enable further DVC usage. When ready, use 'scontrol release <job-id1> <job-id2> ...' to selectively unblock invidual jobs or 'dvc_scontrol release (stage|commit|push)' to unblock all jobs of particular type in this DVC repo."
@@ -340,4 +395,5 @@ else
     log "Warning: None of the jobs put on hold. Running more DVC commands may cause job failure (commit/push) due to conflict for $(dvc root)/.dvc/tmp/rwlock and induce unintentional hash recomputations. If you need to run further dvc commands, first put all your DVC SLURM jobs in this repo on hold using dvc_scontrol."
 fi
 
+dvc_timing_end enqueue
 debug set +x
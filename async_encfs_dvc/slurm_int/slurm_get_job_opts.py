@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 # Get SLURM options from dvc stage sys.argv[2] in dvc_app.yaml at sys.argv[1] for --stage or --dvc job (sys.argv[3])
+# With DVC_SLURM_TIME_PREDICTION=SUGGEST|YES the --time of the stage job is predicted from the runtime history of
+# the stage type (for an input size of DVC_STAGE_INPUT_SIZE bytes, cf. stage_runtime_history.py) and logged or set.
 
+import os
 import sys
 import yaml
 
@@ -20,6 +23,22 @@ if 'slurm_opts' in dvc_app_yaml['app']['stages'][stage_type]:
 else:
     opts = {}
 
+if slurm_job_type == 'stage' and os.environ.get('DVC_SLURM_TIME_PREDICTION', 'NO') in ['SUGGEST', 'YES']:
+    from async_encfs_dvc.slurm_int.stage_runtime_history import predict, format_slurm_time
+    input_size = os.environ.get('DVC_STAGE_INPUT_SIZE')
+    prediction, static_time_limit = predict(dvc_app_yaml, stage_type, int(input_size) if input_size else None)
+    static_time = format_slurm_time(static_time_limit) if static_time_limit is not None else '(unset)'
+    if prediction is None:
+        print(f"slurm_get_job_opts: Not enough runtime history for stage type {stage_type} to predict --time - "
+              f"keeping {static_time}.", file=sys.stderr)
+    elif os.environ['DVC_SLURM_TIME_PREDICTION'] == 'YES':
+        print(f"slurm_get_job_opts: Setting --time {format_slurm_time(prediction)} (predicted from runtime history, "
+              f"static: {static_time}).", file=sys.stderr)
+        opts.pop('-t', None)
+        opts['--time'] = format_slurm_time(prediction)
+    else:
+        print(f"slurm_get_job_opts: Suggested --time {format_slurm_time(prediction)} (predicted from runtime history, "
+              f"static: {static_time}).", file=sys.stderr)
 
 if slurm_job_type == 'stage':
     print(' '.join([f"{opt} {val}" for opt, val in opts.items()]), end='')
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# Runtime history of SLURM DVC stages and walltime (--time) prediction from it
+#
+# Usage: python3 -m async_encfs_dvc.slurm_int.stage_runtime_history input-size [DVC_YAML:]STAGE_NAME
+#          prints the total size in bytes of the deps of the stage in its dvc.yaml (exported by slurm_enqueue.sh)
+#        python3 -m async_encfs_dvc.slurm_int.stage_runtime_history record APP_YAML STAGE_TYPE STAGE_NAME START [END]
+#          appends the runtime and input size of a completed stage (run by sbatch_dvc_stage.sh)
+#        python3 -m async_encfs_dvc.slurm_int.stage_runtime_history record-failure APP_YAML STAGE_TYPE STAGE_NAME JOB_ID
+#          appends the SLURM state and elapsed time of a failed stage job (run by sbatch_dvc_cleanup.sh)
+#        python3 -m async_encfs_dvc.slurm_int.stage_runtime_history predict APP_YAML STAGE_TYPE [INPUT_SIZE]
+#        python3 -m async_encfs_dvc.slurm_int.stage_runtime_history validate [--quantile Q] [--margin M] [HISTORY_FILE]
+#          replays the history in order, predicting each runtime from the preceding records only, and reports how
+#          often the predicted walltime would have been exceeded and how much it over-requests compared to the
+#          static --time in the app yaml
+#
+# Records are appended as JSON lines to <dvc root>/.dvc/tmp/stage_runtime_history.jsonl (or DVC_RUNTIME_HISTORY) and
+# keyed by app name, stage type and input size (power-of-2 buckets). The predicted walltime is the quantile
+# (DVC_SLURM_TIME_PREDICTION_QUANTILE, default: 0.95) of the runtimes of matching records times a safety margin
+# (DVC_SLURM_TIME_PREDICTION_MARGIN, default: 1.25), never below MIN_TIME_LIMIT and never above the static --time.
+# The elapsed time of a stage job that ran into its walltime (TIMEOUT) is a lower bound of the runtime of the stage:
+# until a later matching run completes in at least that time, the prediction is at least TIMEOUT_BACKOFF times it (and
+# so reaches the static --time after repeated timeouts). Other failed runs are recorded, but not used for predictions.
+# slurm_get_job_opts.py uses it for the stage job when DVC_SLURM_TIME_PREDICTION is SUGGEST (log only) or YES.
+
+import os
+import sys
+import re
+import json
+import math
+import time
+import argparse
+import subprocess as sp
+
+import yaml
+
+from async_encfs_dvc.dvc_layout import get_stage_wdir, split_stage_address
+from async_encfs_dvc.dvc_timing import percentile
+from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root
+from async_encfs_dvc.slurm_int.dvc_stage_retry import TIMEOUT_STATES
+
+
+MIN_SAMPLES = 5        # matching records required for a prediction
+MIN_TIME_LIMIT = 300.  # secs, lower bound for predicted walltimes (job startup, file system jitter)
+TIMEOUT_BACKOFF = 2.   # factor on the elapsed time of a timed out stage job for the next prediction
+
+
+def get_history_file(dvc_root=None):
+    return os.environ.get('DVC_RUNTIME_HISTORY') or \
+        os.path.join(dvc_root or find_dvc_root(), '.dvc', 'tmp', 'stage_runtime_history.jsonl')
+
+
+def get_quantile():
+    return float(os.environ.get('DVC_SLURM_TIME_PREDICTION_QUANTILE', 0.95))
+
+
+def get_margin():
+    return float(os.environ.get('DVC_SLURM_TIME_PREDICTION_MARGIN', 1.25))
+
+
+def parse_slurm_time(value):
+    """Secs of a SLURM time limit (MM, MM:SS, HH:MM:SS, D-HH, D-HH:MM, D-HH:MM:SS)"""
+    value = str(value).strip()
+    days, _, value = value.rpartition('-')
+    parts = [int(p) for p in value.split(':')]
+    if days != '':
+        parts = parts + [0] * (3 - len(parts))  # D-HH[:MM[:SS]]
+        hours, minutes, secs = parts
+    elif len(parts) == 3:
+        hours, minutes, secs = parts
+    else:
+        hours, minutes, secs = 0, parts[0], parts[1] if len(parts) == 2 else 0
+    return float((int(days or 0) * 24 + hours) * 3600 + minutes * 60 + secs)
+
+
+def format_slurm_time(secs):
+    """SLURM time limit (D-HH:MM:SS, rounded up to minutes)"""
+    minutes = int(math.ceil(secs / 60.))
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{days}-{hours:02d}:{minutes:02d}:00" if days > 0 else f"{hours:02d}:{minutes:02d}:00"
+
+
+def get_static_time_limit(dvc_app_yaml, stage_type):
+    """Secs of the --time of the stage job in the app yaml (None if not set)"""
+    slurm_opts = dvc_app_yaml['app']['stages'][stage_type].get('slurm_opts', {})
+    opts = dict(slurm_opts.get('all', {}))
+    opts.update(slurm_opts.get('stage', {}))
+    for opt in ['--time', '-t']:
+        if opt in opts:
+            return parse_slurm_time(opts[opt])
+    return None
+
+
+def get_job_runtime(job_id):
+    """State, elapsed secs and time limit in secs (None if unknown) of a finished job (sacct, scontrol as fallback)"""
+    result = sp.run(['sacct', '--jobs', job_id, '-X', '-n', '-P', '--format=State,Elapsed,Timelimit'],
+                    capture_output=True)
+    lines = result.stdout.decode('utf-8').strip().splitlines() if result.returncode == 0 else []
+    if len(lines) > 0 and len(lines[0].split('|')) == 3:
+        state, elapsed, time_limit = lines[0].split('|')
+        state = state.split()[0] if state.strip() != '' else 'UNKNOWN'
+    else:
+        result = sp.run(['scontrol', 'show', 'job', job_id], capture_output=True)
+        fields = dict(re.findall(r"(\w+)=(\S*)", result.stdout.decode('utf-8'))) if result.returncode == 0 else dict()
+        state, elapsed, time_limit = fields.get('JobState', 'UNKNOWN'), fields.get('RunTime', ''), \
+            fields.get('TimeLimit', '')
+
+    def secs(value):
+        try:
+            return parse_slurm_time(value)
+        except ValueError:  # empty, UNLIMITED, Partition_Limit
+            return None
+    return state, secs(elapsed), secs(time_limit)
+
+
+def get_path_size(path):
+    """Size in bytes of a file or the files in a directory"""
+    size = 0
+    if os.path.isfile(path):
+        size += os.stat(path).st_size
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                size += os.stat(os.path.join(root, filename)).st_size  # follow links to the DVC cache
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def get_input_size(stage, dvc_yaml_filename=None):
+    """Total size in bytes of the deps of a stage [DVC_YAML:]STAGE (files and directories)"""
+    dvc_yaml_filename, stage_name = split_stage_address(stage, dvc_yaml_filename)
+    with open(dvc_yaml_filename) as f:
+        stage_def = yaml.load(f, Loader=yaml.FullLoader)['stages'][stage_name]
+    wdir = get_stage_wdir(dvc_yaml_filename, stage_def)
+    return sum(get_path_size(os.path.join(wdir, dep)) for dep in stage_def.get('deps', []))
+
+
+def size_bucket(input_size):
+    return None if input_size is None else int(math.log2(input_size)) if input_size > 0 else -1
+
+
+def load_history(history_file):
+    records = []
+    if not os.path.exists(history_file):
+        return records
+    with open(history_file) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:  # partially written line
+                continue
+    return records
+
+
+def record_runtime(history_file, app, stage_type, stage, runtime, input_size=None, time_limit=None, **attrs):
+    record = dict(app=app, stage_type=stage_type, stage=stage, input_size=input_size, runtime=runtime,
+                  time_limit=time_limit, end=time.time(), job_id=os.environ.get('SLURM_JOB_ID', ''),
+                  nodes=os.environ.get('SLURM_JOB_NUM_NODES', ''))
+    record.update(attrs)
+    # a single write of a short line to a file opened with O_APPEND does not interleave with concurrent writers
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def is_completed(record):
+    return record.get('state', 'COMPLETED') == 'COMPLETED'  # records without state are from completed stages
+
+
+def matching_records(records, app, stage_type, input_size=None):
+    """Completed records of the same app/stage type, restricted to neighbouring input size buckets if enough"""
+    records = [r for r in records if r['app'] == app and r['stage_type'] == stage_type and is_completed(r)]
+    bucket = size_bucket(input_size)
+    if bucket is not None:
+        same_size = [r for r in records if r.get('input_size') is not None and
+                     abs(size_bucket(r['input_size']) - bucket) <= 1]
+        if len(same_size) >= MIN_SAMPLES:
+            records = same_size
+    return records
+
+
+def matching_runtimes(records, app, stage_type, input_size=None):
+    return sorted(r['runtime'] for r in matching_records(records, app, stage_type, input_size))
+
+
+def timeout_lower_bound(records, app, stage_type, input_size=None):
+    """Longest elapsed time of timed out stage jobs of the same app/stage type (and neighbouring input size bucket)
+    that no later completed run has reached (None if there is none)"""
+    bucket = size_bucket(input_size)
+    completed = matching_records(records, app, stage_type, input_size)
+    timeouts = [r for r in records if r['app'] == app and r['stage_type'] == stage_type and
+                r.get('state') in TIMEOUT_STATES and
+                (bucket is None or r.get('input_size') is None or abs(size_bucket(r['input_size']) - bucket) <= 1)]
+    return max((r['runtime'] for r in timeouts
+                if not any(c['end'] > r['end'] and c['runtime'] >= r['runtime'] for c in completed)), default=None)
+
+
+def predict_time_limit(records, app, stage_type, input_size=None, static_time_limit=None, quantile=None, margin=None):
+    """Predicted walltime in secs (None if there are not enough matching records)"""
+    runtimes = matching_runtimes(records, app, stage_type, input_size)
+    if len(runtimes) < MIN_SAMPLES:
+        return None
+    quantile = quantile if quantile is not None else get_quantile()
+    margin = margin if margin is not None else get_margin()
+    prediction = max(percentile(runtimes, quantile * 100.) * margin, MIN_TIME_LIMIT)
+    lower_bound = timeout_lower_bound(records, app, stage_type, input_size)
+    if lower_bound is not None:  # a stage job ran into its (predicted) walltime
+        prediction = max(prediction, lower_bound * TIMEOUT_BACKOFF)
+    return min(prediction, static_time_limit) if static_time_limit is not None else prediction
+
+
+def predict(dvc_app_yaml, stage_type, input_size=None, history_file=None):
+    """Predicted walltime (secs) and static --time (secs) of the stage job of an app yaml stage"""
+    static_time_limit = get_static_time_limit(dvc_app_yaml, stage_type)
+    records = load_history(history_file or get_history_file())
+    return predict_time_limit(records, dvc_app_yaml['app']['name'], stage_type, input_size, static_time_limit), \
+        static_time_limit
+
+
+def validate(records, quantile=None, margin=None):
+    """Replay the history in order, predicting each record only from the preceding ones"""
+    results = dict()
+    records = sorted(records, key=lambda r: r['end'])
+    for i, r in enumerate(records):
+        if not is_completed(r):  # only used to predict the following records
+            continue
+        prediction = predict_time_limit(records[:i], r['app'], r['stage_type'], r.get('input_size'),
+                                        r.get('time_limit'), quantile, margin)
+        result = results.setdefault((r['app'], r['stage_type']), dict(records=0, predicted=0, exceeded=0,
+                                                                      requested=[], static=[]))
+        result['records'] += 1
+        if prediction is not None:
+            result['predicted'] += 1
+            result['exceeded'] += r['runtime'] > prediction
+            result['requested'].append(prediction / max(r['runtime'], 1.))
+            if r.get('time_limit') is not None:
+                result['static'].append(r['time_limit'] / max(r['runtime'], 1.))
+    return [dict(app=app, stage_type=stage_type, records=result['records'], predicted=result['predicted'],
+                 exceeded=result['exceeded'],
+                 requested_p50=percentile(sorted(result['requested']), 50),
+                 static_p50=percentile(sorted(result['static']), 50))
+            for (app, stage_type), result in results.items()]
+
+
+def print_validation(results):
+    def ratio(value):
+        return f"{value:.2f}" if value is not None else 'n/a'
+    print(f"{'app':<40}{'stage type':<20}{'records':>8}{'predicted':>10}{'exceeded':>10}"
+          f"{'predicted/runtime':>18}{'static/runtime':>16}")
+    for r in results:
+        print(f"{r['app']:<40}{r['stage_type']:<20}{r['records']:>8}{r['predicted']:>10}{r['exceeded']:>10}"
+              f"{ratio(r['requested_p50']):>18}{ratio(r['static_p50']):>16}")
+
+
+def load_app_yaml(filename):
+    with open(filename) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runtime history of SLURM DVC stages and walltime prediction.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    size_parser = subparsers.add_parser('input-size', help="Print total size in bytes of the deps of a stage")
+    size_parser.add_argument('stage_name', type=str)
+    record_parser = subparsers.add_parser('record', help="Append the runtime of a completed stage to the history")
+    failure_parser = subparsers.add_parser('record-failure',
+                                           help="Append state and elapsed time of a failed stage job to the history")
+    predict_parser = subparsers.add_parser('predict', help="Print the predicted --time of a stage job")
+    for p in [record_parser, failure_parser, predict_parser]:
+        p.add_argument('app_yaml', type=str)
+        p.add_argument('stage_type', type=str)
+    for p in [record_parser, failure_parser]:
+        p.add_argument('stage_name', type=str)
+    failure_parser.add_argument('job_id', type=str, help="SLURM job id of the failed stage job")
+    record_parser.add_argument('start', type=float, help="Start time (secs since epoch)")
+    record_parser.add_argument('end', type=float, nargs='?', default=None, help="End time (default: now)")
+    for p in [record_parser, failure_parser]:
+        p.add_argument('--input-size', type=int, default=None,
+                       help="Input size in bytes (default: size of the stage deps in ./dvc.yaml)")
+    predict_parser.add_argument('input_size', type=int, nargs='?', default=None, help="Input size in bytes")
+    validate_parser = subparsers.add_parser('validate', help="Validate predictions against the recorded history")
+    validate_parser.add_argument('history_file', nargs='?', default=None,
+                                 help="Runtime history (default: DVC_RUNTIME_HISTORY or .dvc/tmp/...)")
+    validate_parser.add_argument('--quantile', type=float, default=None, help="Quantile of runtimes (default: 0.95)")
+    validate_parser.add_argument('--margin', type=float, default=None, help="Safety margin factor (default: 1.25)")
+    validate_parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    if args.subcommand == 'input-size':
+        print(get_input_size(args.stage_name))
+    elif args.subcommand == 'record':
+        dvc_app_yaml = load_app_yaml(args.app_yaml)
+        end = args.end if args.end is not None else time.time()
+        input_size = args.input_size if args.input_size is not None else get_input_size(args.stage_name)
+        record_runtime(get_history_file(), dvc_app_yaml['app']['name'], args.stage_type, args.stage_name,
+                       end - args.start, input_size, get_static_time_limit(dvc_app_yaml, args.stage_type),
+                       state='COMPLETED')
+    elif args.subcommand == 'record-failure':
+        dvc_app_yaml = load_app_yaml(args.app_yaml)
+        state, elapsed, job_time_limit = get_job_runtime(args.job_id)
+        if not elapsed:  # never started (e.g. cancelled while pending)
+            print(f"stage_runtime_history: Not recording job {args.job_id} of {args.stage_name} ({state}, never ran).",
+                  file=sys.stderr)
+            return
+        input_size = args.input_size if args.input_size is not None else get_input_size(args.stage_name)
+        record_runtime(get_history_file(), dvc_app_yaml['app']['name'], args.stage_type, args.stage_name,
+                       elapsed, input_size, get_static_time_limit(dvc_app_yaml, args.stage_type),
+                       state=state, job_time_limit=job_time_limit, job_id=args.job_id)
+    elif args.subcommand == 'predict':
+        prediction, static_time_limit = predict(load_app_yaml(args.app_yaml), args.stage_type, args.input_size)
+        if prediction is None:
+            print(f"No prediction (less than {MIN_SAMPLES} matching records) - keeping static --time "
+                  f"{format_slurm_time(static_time_limit) if static_time_limit is not None else '(unset)'}.")
+            sys.exit(1)
+        print(format_slurm_time(prediction))
+    elif args.subcommand == 'validate':
+        results = validate(load_history(args.history_file or get_history_file()), args.quantile, args.margin)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_validation(results)
+
+
+if __name__ == '__main__':
+    main()
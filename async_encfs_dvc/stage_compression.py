@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+# Opt-in compression of stage outputs before they are encrypted (zstd in the seekable format with independent frames)
+#
+# Usage: python3 -m async_encfs_dvc.stage_compression apply [--spec FILE] [--stage NAME]  (after the stage payload)
+#        python3 -m async_encfs_dvc.stage_compression {compress,decompress} [options] PATH ...
+#        python3 -m async_encfs_dvc.stage_compression cat PATH
+#        python3 -m async_encfs_dvc.stage_compression report [--json] [DIR ...]
+#
+# EncFS ciphertext does not compress, so outputs that are compressible are stored and transferred at full size in the
+# encrypted root, .dvc/cache and the remote. An output in the stage policy can declare compression (true, a level or a
+# dict with codec, level, frame_size, include, exclude and min_ratio), e.g.
+#
+#   output:
+#     simulation:
+#       stage_data: [*app_name, simulation, "{{run_label}}", output]
+#       compression: {level: 3, include: ["*.h5", "*.npy"]}
+#
+# dvc_create_stage then writes the resolved outputs to dvc_compression.yaml in the stage directory and the stage job
+# (sbatch_dvc_stage.sh, the local executor or dvc_cmd for synchronous stages) runs apply after the payload succeeded:
+# every matching file of the output is replaced by <file>.zst if it compresses by at least min_ratio (default: 1.05).
+# With EncFS, files are read and written in the encrypted root with encfs_io.py (no mount needed after srun). The
+# compression ratio, CPU and wall-clock time and the bytes saved per read, commit (hashing/copy to .dvc/cache) and push
+# are written to output/dvc_stage_compression.json and summarized over stages by report.
+#
+# Downstream stages read outputs with open(path), which falls back to <path>.zst and returns a random-access reader
+# (frames of frame_size bytes, default: 4M, are decompressed on demand), or stream them with cat. Python payloads can
+# also write compressed outputs directly with open(path, 'wb'). Frames are compressed in parallel in
+# DVC_COMPRESSION_THREADS threads (default: CPUs available to the process).
+
+import io
+import os
+import sys
+import json
+import time
+import glob
+import fnmatch
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from async_encfs_dvc.log_sink import parse_size
+from async_encfs_dvc.dvc_timing import span
+
+
+SPEC_FILE = 'dvc_compression.yaml'
+REPORT_FILE = os.path.join('output', 'dvc_stage_compression.json')
+SUFFIX = '.zst'
+DEFAULT_LEVEL = 3
+DEFAULT_FRAME_SIZE = 4 << 20
+DEFAULT_MIN_RATIO = 1.05
+# stage logs/status written next to the outputs of plain repos (and output/ of encfs repos)
+DEFAULT_EXCLUDE = ['dvc_*', '*.dvc_*', 'encfs_out_*', '*.log', '*.log.*', '*.resources.csv', '*' + SUFFIX]
+
+SKIPPABLE_MAGIC = 0x184D2A5E  # seek table frame (cf. zstd contrib/seekable_format)
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER_SIZE = 9
+
+
+def get_threads():
+    return int(os.environ.get('DVC_COMPRESSION_THREADS') or len(os.sched_getaffinity(0)))
+
+
+def get_spec(compression):
+    """Compression spec of an output from its compression value in the stage policy (None if not compressed)"""
+    if compression in [None, False, 'none']:
+        return None
+    if compression is True or compression == 'zstd':
+        compression = dict()
+    elif isinstance(compression, int):
+        compression = dict(level=compression)
+    elif not isinstance(compression, dict):
+        raise ValueError(f"Invalid compression {compression} in stage policy (true, level or dict expected).")
+    if compression.get('codec', 'zstd') != 'zstd':
+        raise ValueError(f"Unsupported compression codec {compression['codec']} (only zstd).")
+    include = compression.get('include', ['*'])
+    exclude = compression.get('exclude', [])
+    return dict(codec='zstd', level=int(compression.get('level', DEFAULT_LEVEL)),
+                frame_size=parse_size(compression.get('frame_size', DEFAULT_FRAME_SIZE)),
+                include=[include] if isinstance(include, str) else list(include),
+                exclude=[exclude] if isinstance(exclude, str) else list(exclude),
+                min_ratio=float(compression.get('min_ratio', DEFAULT_MIN_RATIO)))
+
+
+class SeekableZstdWriter(io.RawIOBase):
+    """Writes independently compressed frames of frame_size bytes followed by a seek table to fileobj"""
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, frame_size=DEFAULT_FRAME_SIZE, threads=None):
+        super().__init__()
+        import zstandard
+        self.fileobj = fileobj
+        self.level = level
+        self.frame_size = frame_size
+        self.threads = threads or get_threads()
+        self._zstandard = zstandard
+        self._local = threading.local()  # compressors are not thread-safe
+        self._executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.pending = bytearray()
+        self.frames = []  # (compressed size, decompressed size)
+
+    def writable(self):
+        return True
+
+    def _compress(self, data):
+        if not hasattr(self._local, 'compressor'):
+            self._local.compressor = self._zstandard.ZstdCompressor(level=self.level, write_checksum=True)
+        return self._local.compressor.compress(data)
+
+    def _write_frames(self, data):
+        chunks = [data[i:i + self.frame_size] for i in range(0, len(data), self.frame_size)]
+        frames = self._executor.map(self._compress, chunks) if self._executor else map(self._compress, chunks)
+        for chunk, frame in zip(chunks, frames):
+            self.fileobj.write(frame)
+            self.frames.append((len(frame), len(chunk)))
+
+    def write(self, b):
+        self.pending += b
+        batch = self.frame_size * self.threads
+        if len(self.pending) >= batch:
+            full = len(self.pending) // self.frame_size * self.frame_size
+            self._write_frames(bytes(self.pending[:full]))
+            del self.pending[:full]
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if len(self.pending) > 0:
+                    self._write_frames(bytes(self.pending))
+                    self.pending = bytearray()
+                entries = b''.join(c.to_bytes(4, 'little') + d.to_bytes(4, 'little') for c, d in self.frames)
+                self.fileobj.write(SKIPPABLE_MAGIC.to_bytes(4, 'little') +
+                                   (len(entries) + SEEK_TABLE_FOOTER_SIZE).to_bytes(4, 'little') + entries +
+                                   len(self.frames).to_bytes(4, 'little') + b'\0' +
+                                   SEEKABLE_MAGIC.to_bytes(4, 'little'))
+            finally:
+                if self._executor:
+                    self._executor.shutdown()
+                self.fileobj.close()
+        super().close()
+
+
+def read_seek_table(fileobj):
+    """Frame offsets and sizes [(compressed offset, compressed size, decompressed offset, decompressed size)] of a
+    seekable zstd file (None if it has no seek table)"""
+    size = fileobj.seek(0, io.SEEK_END)
+    if size < SEEK_TABLE_FOOTER_SIZE + 8:
+        return None
+    fileobj.seek(size - SEEK_TABLE_FOOTER_SIZE)
+    footer = fileobj.read(SEEK_TABLE_FOOTER_SIZE)
+    if int.from_bytes(footer[5:9], 'little') != SEEKABLE_MAGIC:
+        return None
+    num_frames, descriptor = int.from_bytes(footer[:4], 'little'), footer[4]
+    entry_size = 12 if descriptor & 0x80 else 8  # optional checksums
+    table_size = num_frames * entry_size + SEEK_TABLE_FOOTER_SIZE + 8
+    fileobj.seek(size - table_size)
+    table = fileobj.read(table_size - SEEK_TABLE_FOOTER_SIZE)
+    if int.from_bytes(table[:4], 'little') != SKIPPABLE_MAGIC:
+        return None
+    frames, c_offset, d_offset = [], 0, 0
+    for i in range(num_frames):
+        entry = table[8 + i * entry_size:8 + (i + 1) * entry_size]
+        c_size, d_size = int.from_bytes(entry[:4], 'little'), int.from_bytes(entry[4:8], 'little')
+        frames.append((c_offset, c_size, d_offset, d_size))
+        c_offset += c_size
+        d_offset += d_size
+    return frames
+
+
+class SeekableZstdReader(io.RawIOBase):
+    """Random access reads of a seekable zstd file (frames decompressed on demand, the last one cached)"""
+
+    def __init__(self, fileobj, frames):
+        super().__init__()
+        import zstandard
+        self.fileobj = fileobj
+        self.frames = frames
+        self.size = frames[-1][2] + frames[-1][3] if len(frames) > 0 else 0
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.pos = 0
+        self._cached = (None, b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.pos = max({io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence] + offset, 0)
+        return self.pos
+
+    def _frame(self, index):
+        if self._cached[0] != index:
+            c_offset, c_size, _, d_size = self.frames[index]
+            self.fileobj.seek(c_offset)
+            self._cached = (index, self.decompressor.decompress(self.fileobj.read(c_size), max_output_size=d_size))
+        return self._cached[1]
+
+    def _find_frame(self, pos):
+        lo, hi = 0, len(self.frames) - 1
+        while lo < hi:  # last frame starting at or before pos
+            mid = (lo + hi + 1) // 2
+            if self.frames[mid][2] <= pos:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def readinto(self, b):
+        n = max(min(len(b), self.size - self.pos), 0)
+        done = 0
+        index = self._find_frame(self.pos) if n > 0 else 0
+        while done < n:
+            data = self._frame(index)
+            start = self.pos - self.frames[index][2]
+            count = min(len(data) - start, n - done)
+            b[done:done + count] = data[start:start + count]
+            done += count
+            self.pos += count
+            index += 1
+        return done
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+
+def _open_raw(path, mode, volume):
+    """Unbuffered reader (buffered by the caller) or buffered writer (no short writes)"""
+    buffering = 0 if mode == 'rb' else -1
+    if volume is not None:
+        return volume.open(path, mode, buffering=buffering)
+    return io.open(path, mode, buffering=buffering)
+
+
+def _exists(path, volume):
+    return os.path.exists(volume.encrypted_path(path) if volume is not None else path)
+
+
+def open(path, mode='rb', volume=None, level=DEFAULT_LEVEL, frame_size=DEFAULT_FRAME_SIZE, threads=None):
+    """Binary file object of an output that may have been compressed (<path>.zst used if path does not exist) or a
+    writer of <path>.zst for mode 'wb' (optionally in an EncfsVolume of encfs_io.py)"""
+    if mode in ['w', 'wb']:
+        if not path.endswith(SUFFIX):
+            path += SUFFIX
+        return io.BufferedWriter(SeekableZstdWriter(_open_raw(path, 'wb', volume), level, frame_size, threads),
+                                 buffer_size=frame_size)
+    if mode not in ['r', 'rb']:
+        raise ValueError(f"Unsupported mode {mode} (only 'rb' and 'wb').")
+    if not path.endswith(SUFFIX) and (_exists(path, volume) or not _exists(path + SUFFIX, volume)):
+        return io.BufferedReader(_open_raw(path, 'rb', volume))
+    if not path.endswith(SUFFIX):
+        path += SUFFIX
+    raw = _open_raw(path, 'rb', volume)
+    frames = read_seek_table(raw)
+    if frames is None:  # plain zstd file, only sequential reads
+        import zstandard
+        raw.seek(0)
+        return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return io.BufferedReader(SeekableZstdReader(raw, frames), buffer_size=max(frames[0][3], io.DEFAULT_BUFFER_SIZE)
+                             if len(frames) > 0 else io.DEFAULT_BUFFER_SIZE)
+
+
+def exists(path, volume=None):
+    """Whether an output exists (possibly compressed)"""
+    return _exists(path, volume) or _exists(path + SUFFIX, volume)
+
+
+def copy(src, dst, chunk_size=DEFAULT_FRAME_SIZE):
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        dst.write(data)
+
+
+def matches(name, include, exclude):
+    return any(fnmatch.fnmatch(name, p) for p in include) and \
+        not any(fnmatch.fnmatch(name, p) for p in DEFAULT_EXCLUDE + exclude)
+
+
+def list_files(path, volume=None):
+    """Files under path (relative to the volume root with EncFS)"""
+    root = volume.encrypted_path(path) if volume is not None else path
+    if os.path.isfile(root):
+        return [path]
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        files += [os.path.normpath(os.path.join(path, rel_dir, f)) for f in sorted(filenames)]
+    return files
+
+
+def compress_file(path, spec, volume=None, threads=None):
+    """Replace path by path.zst if it compresses by at least min_ratio, returns (bytes in, bytes out, compressed)"""
+    size = volume.getsize(path) if volume is not None else os.path.getsize(path)
+    with open(path, 'rb', volume) as src, open(path, 'wb', volume, spec['level'], spec['frame_size'], threads) as dst:
+        copy(src, dst, spec['frame_size'])
+    out_path = volume.encrypted_path(path + SUFFIX) if volume is not None else path + SUFFIX
+    out_size = volume.getsize(path + SUFFIX) if volume is not None else os.path.getsize(out_path)
+    if size < out_size * spec['min_ratio']:  # incompressible, keep the original
+        os.remove(out_path)
+        return size, size, False
+    os.remove(volume.encrypted_path(path) if volume is not None else path)
+    return size, out_size, True
+
+
+def decompress_file(path, volume=None):
+    """Replace path.zst by path"""
+    path = path[:-len(SUFFIX)] if path.endswith(SUFFIX) else path
+    with open(path + SUFFIX, 'rb', volume) as src, _open_raw(path, 'wb', volume) as dst:
+        copy(src, dst)
+    os.remove(volume.encrypted_path(path + SUFFIX) if volume is not None else path + SUFFIX)
+
+
+def compress_output(path, spec, volume=None, threads=None):
+    """Compress the matching files of an output (file or directory), returns its statistics"""
+    stats = dict(path=path, files=0, files_compressed=0, bytes_in=0, bytes_out=0)
+    for filename in list_files(path, volume):
+        if not matches(os.path.basename(filename), spec['include'], spec['exclude']):
+            continue
+        bytes_in, bytes_out, compressed = compress_file(filename, spec, volume, threads)
+        stats['files'] += 1
+        stats['files_compressed'] += int(compressed)
+        stats['bytes_in'] += bytes_in
+        stats['bytes_out'] += bytes_out
+    return stats
+
+
+def apply(spec_file=SPEC_FILE, stage=None):
+    """Compress the outputs in spec_file (in the stage directory) and write the report"""
+    with io.open(spec_file) as f:
+        outputs = yaml.load(f, Loader=yaml.FullLoader)['outputs']
+    volumes = dict()
+    results = []
+    start, cpu_start = time.time(), time.process_time()
+    with span('compression', stage):
+        for output in outputs:
+            volume = None
+            if output.get('encfs_root'):
+                if output['encfs_root'] not in volumes:
+                    from async_encfs_dvc.encfs_int.encfs_io import EncfsVolume
+                    volumes[output['encfs_root']] = EncfsVolume(output['encfs_root'])
+                volume = volumes[output['encfs_root']]
+            stats = compress_output(output['path'], get_spec(output['compression']), volume)
+            results.append(dict(stats, output=output.get('output')))
+    bytes_in, bytes_out = sum(r['bytes_in'] for r in results), sum(r['bytes_out'] for r in results)
+    saved = bytes_in - bytes_out
+    report = dict(stage=stage, time=time.time(), codec='zstd', outputs=results,
+                  files=sum(r['files'] for r in results),
+                  files_compressed=sum(r['files_compressed'] for r in results), bytes_in=bytes_in,
+                  bytes_out=bytes_out, ratio=bytes_in / bytes_out if bytes_out > 0 else 1.0,
+                  cpu_sec=time.process_time() - cpu_start, wall_sec=time.time() - start,
+                  added_io_bytes=bytes_in + bytes_out,  # one pass reading the outputs and writing them compressed
+                  read_saved_bytes=saved, commit_saved_bytes=saved, push_saved_bytes=saved)
+    for volume in volumes.values():
+        volume.close()
+    os.makedirs(os.path.dirname(REPORT_FILE), exist_ok=True)
+    with io.open(REPORT_FILE, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(num_bytes) < 1024 or unit == 'GiB':
+            return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{num_bytes} B"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+def load_reports(dirs):
+    reports = []
+    for d in dirs:
+        for filename in sorted(glob.glob(os.path.join(d, '**', REPORT_FILE), recursive=True)):
+            with io.open(filename) as f:
+                reports.append(dict(json.load(f), stage_dir=os.path.relpath(os.path.dirname(
+                    os.path.dirname(filename)))))
+    return reports
+
+
+def print_report(reports):
+    print(f"{'stage':<40} {'files':>7} {'in':>12} {'out':>12} {'ratio':>6} {'cpu s':>8} {'saved/pass':>12}")
+    for r in reports:
+        print(f"{(r['stage'] or r['stage_dir'])[:40]:<40} {r['files_compressed']:>3}/{r['files']:<3} "
+              f"{format_bytes(r['bytes_in']):>12} {format_bytes(r['bytes_out']):>12} {r['ratio']:>6.2f} "
+              f"{r['cpu_sec']:>8.1f} {format_bytes(r['read_saved_bytes']):>12}")
+    if len(reports) > 1:
+        bytes_in, bytes_out = sum(r['bytes_in'] for r in reports), sum(r['bytes_out'] for r in reports)
+        print(f"{'total':<40} {sum(r['files_compressed'] for r in reports):>3}/"
+              f"{sum(r['files'] for r in reports):<3} {format_bytes(bytes_in):>12} {format_bytes(bytes_out):>12} "
+              f"{bytes_in / bytes_out if bytes_out > 0 else 1.0:>6.2f} {sum(r['cpu_sec'] for r in reports):>8.1f} "
+              f"{format_bytes(bytes_in - bytes_out):>12}")
+    print("Bytes saved per pass apply to every read by downstream stages, the commit (hashing and copy to "
+          ".dvc/cache) and every push/pull of the outputs.", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression of stage outputs (zstd, seekable format).")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    apply_parser = subparsers.add_parser('apply', help="Compress the outputs of the stage in the current directory "
+                                                       f"declared in {SPEC_FILE}")
+    apply_parser.add_argument('--spec', type=str, default=SPEC_FILE)
+    apply_parser.add_argument('--stage', type=str, default=os.environ.get('DVC_TIMING_STAGE'))
+    compress_parser = subparsers.add_parser('compress', help="Replace files (recursively) by compressed .zst files")
+    compress_parser.add_argument('--level', type=int, default=DEFAULT_LEVEL)
+    compress_parser.add_argument('--frame-size', type=str, default=str(DEFAULT_FRAME_SIZE))
+    compress_parser.add_argument('--min-ratio', type=float, default=DEFAULT_MIN_RATIO)
+    compress_parser.add_argument('--include', type=str, nargs='*', default=['*'])
+    compress_parser.add_argument('paths', type=str, nargs='+')
+    decompress_parser = subparsers.add_parser('decompress', help="Replace .zst files by their decompressed content")
+    decompress_parser.add_argument('paths', type=str, nargs='+')
+    cat_parser = subparsers.add_parser('cat', help="Write the (decompressed) content of an output file to stdout")
+    cat_parser.add_argument('path', type=str)
+    report_parser = subparsers.add_parser('report', help="Summarize the compression reports of stages")
+    report_parser.add_argument('--json', action='store_true', help="Print the reports as JSON")
+    report_parser.add_argument('dirs', type=str, nargs='*', default=['.'])
+    args = parser.parse_args()
+
+    if args.subcommand == 'apply':
+        report = apply(args.spec, args.stage)
+        print(f"stage_compression: Compressed {report['files_compressed']}/{report['files']} files from "
+              f"{format_bytes(report['bytes_in'])} to {format_bytes(report['bytes_out'])} (ratio "
+              f"{report['ratio']:.2f}) in {report['wall_sec']:.1f} s ({report['cpu_sec']:.1f} CPU s).",
+              file=sys.stderr)
+    elif args.subcommand == 'compress':
+        spec = get_spec(dict(level=args.level, frame_size=args.frame_size, min_ratio=args.min_ratio,
+                             include=args.include))
+        for path in args.paths:
+            stats = compress_output(path, spec)
+            print(f"{path}: {stats['files_compressed']}/{stats['files']} files, {format_bytes(stats['bytes_in'])} "
+                  f"-> {format_bytes(stats['bytes_out'])}")
+    elif args.subcommand == 'decompress':
+        for path in args.paths:
+            for filename in list_files(path):
+                if filename.endswith(SUFFIX):
+                    decompress_file(filename)
+    elif args.subcommand == 'cat':
+        with open(args.path) as f:
+            copy(f, sys.stdout.buffer)
+    elif args.subcommand == 'report':
+        reports = load_reports(args.dirs)
+        if args.json:
+            print(json.dumps(reports, indent=2))
+        else:
+            print_report(reports)
+
+
+if __name__ == '__main__':
+    main()
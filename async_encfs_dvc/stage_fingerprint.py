@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Fingerprints of generated DVC stages to find identical stages when re-running a sweep (used by dvc_create_stage)
+#
+# Usage: python3 -m async_encfs_dvc.stage_fingerprint list [--json]
+#
+# The fingerprint of a stage is the SHA-256 of its rendered full app YAML (without the original section), its resolved
+# input paths and its script command line. Values and path components equal to the run_label are replaced by a
+# placeholder, so that stages differing only in their run_label are identical (a run_label embedded in a longer value
+# makes stages differ). dvc_create_stage appends the fingerprint of every created stage to the index in
+# .dvc/tmp/stage_fingerprints.jsonl and reports an existing identical stage before creating a new one. With
+# --reuse-identical, it prints the address of the existing stage instead and creates nothing, so that nothing is
+# submitted or computed again (dvc repro of the existing stage is a no-op once it is committed). Entries whose stage
+# was removed from its dvc.yaml are ignored.
+
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import argparse
+
+import yaml
+
+
+RUN_LABEL_PLACEHOLDER = '<run_label>'
+
+
+def get_index_file(dvc_root):
+    return os.path.join(dvc_root, '.dvc', 'tmp', 'stage_fingerprints.jsonl')
+
+
+def replace_run_label(obj, run_label):
+    """Copy of a YAML/JSON structure with values and path components equal to run_label replaced by a placeholder"""
+    if isinstance(obj, dict):
+        return {k: replace_run_label(v, run_label) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [replace_run_label(v, run_label) for v in obj]
+    if isinstance(obj, str):
+        return '/'.join(RUN_LABEL_PLACEHOLDER if c == run_label else c for c in obj.split('/'))
+    return obj
+
+
+def get_fingerprint(full_app_yaml, run_label, input_paths, command):
+    """Fingerprint of a stage independent of its run_label"""
+    app_yaml = {k: v for k, v in full_app_yaml.items() if k != 'original'}
+    h = hashlib.sha256()
+    for part in [app_yaml, sorted(os.path.normpath(p) for p in input_paths), command]:
+        if run_label:
+            part = replace_run_label(part, str(run_label))
+        h.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def load_index(dvc_root):
+    """Index entries in order of creation (skipping malformed lines)"""
+    entries = []
+    try:
+        with open(get_index_file(dvc_root)) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def stage_exists(dvc_root, entry):
+    """Whether the stage of an index entry is still defined in its dvc.yaml"""
+    try:
+        with open(os.path.join(dvc_root, entry['dvc_yaml'])) as f:
+            dvc_yaml = yaml.load(f, Loader=yaml.FullLoader) or dict()
+    except (OSError, yaml.YAMLError):
+        return False
+    return entry['stage'] in (dvc_yaml.get('stages') or dict())
+
+
+def find_identical(dvc_root, fingerprint):
+    """Latest existing stage with the fingerprint (None if there is none)"""
+    for entry in reversed(load_index(dvc_root)):
+        if entry.get('fingerprint') == fingerprint and stage_exists(dvc_root, entry):
+            return entry
+    return None
+
+
+def get_stage_address(entry):
+    """Stage address relative to the DVC root (for dvc repro/commit)"""
+    return f"{entry['dvc_yaml']}:{entry['stage']}"
+
+
+def record(dvc_root, fingerprint, stage_name, dvc_yaml_filename, wdir, app, app_stage, run_label):
+    """Append a created stage to the index"""
+    entry = dict(fingerprint=fingerprint, stage=stage_name,
+                 dvc_yaml=os.path.relpath(os.path.abspath(dvc_yaml_filename), dvc_root),
+                 wdir=os.path.relpath(os.path.abspath(wdir), dvc_root), app=app, app_stage=app_stage,
+                 run_label=run_label, time=time.time())
+    index_file = get_index_file(dvc_root)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)  # concurrent dvc_create_stage calls of a sweep
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprints of generated DVC stages.")
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    list_parser = subparsers.add_parser('list', help="List the stages in the fingerprint index that still exist")
+    list_parser.add_argument('--json', action='store_true', help="Print the index entries as JSON")
+    args = parser.parse_args()
+
+    from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root
+    dvc_root = find_dvc_root()
+    entries = [entry for entry in load_index(dvc_root) if stage_exists(dvc_root, entry)]
+    if args.json:
+        print(json.dumps(entries, indent=2))
+        return
+    for entry in entries:
+        print(f"{entry['fingerprint'][:16]}  {entry['app']}/{entry['app_stage']}  {get_stage_address(entry)}")
+    print(f"{len(entries)} stages in the fingerprint index.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
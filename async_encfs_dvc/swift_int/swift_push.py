@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Segmented, parallel and resumable upload of the DVC cache objects of a stage to Swift (used by sbatch_dvc_push.sh
+# instead of dvc push with DVC_SWIFT_PUSH=YES)
+#
+# Usage: python3 -m async_encfs_dvc.swift_int.swift_push [--remote NAME] [--jobs N] [--segment-size SIZE] [--dry]
+#                                                        [DVC_YAML:]STAGE_NAME
+#
+# The cache objects of the outs of STAGE_NAME in ./dvc.lock (incl. the entries of .dir objects) are uploaded to the
+# container of the DVC remote (s3://CONTAINER/PREFIX or swift://CONTAINER/PREFIX - Castor serves the same objects
+# through the S3 and Swift APIs) under the same names as dvc push (PREFIX/xx/yyyy...), .dir objects last.
+# Objects already in the container are skipped after one listing per object prefix (HEAD only on size mismatches).
+# Objects larger than the segment size (DVC_SWIFT_PUSH_SEGMENT_SIZE, default: 512M) are uploaded as Static Large
+# Objects with their segments in CONTAINER+segments, all uploads run in parallel (DVC_SWIFT_PUSH_JOBS, default: 8).
+# Uploaded segments are recorded in a resume manifest in .dvc/tmp/swift_push/ so that an interrupted push only
+# uploads the missing segments. Authentication uses the environment of the swift client (OS_AUTH_URL, OS_USERNAME,
+# OS_PASSWORD, OS_PROJECT_NAME, ... or OS_STORAGE_URL and OS_AUTH_TOKEN).
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from async_encfs_dvc.slurm_int.dvc_scontrol import find_dvc_root
+from async_encfs_dvc.dvc_layout import split_stage_address
+from async_encfs_dvc.slurm_int.dvc_stage_status import read_dvc_config
+
+
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+OS_OPTIONS = ['project_name', 'project_id', 'user_domain_name', 'project_domain_name', 'region_name']  # from OS_*
+
+
+def log(message):
+    print(f"swift_push: {message}", flush=True)
+
+
+def parse_size(value):
+    """Bytes of a size with optional unit suffix (e.g. 512M, 1G)"""
+    value = str(value).strip().upper().rstrip('B')
+    unit = value[-1] if value[-1:] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def get_remote(dvc_root, remote=None):
+    """Container and object prefix of a DVC remote (default remote if None)"""
+    config = read_dvc_config(dvc_root)
+    remote = remote or config.get('core', {}).get('remote')
+    if remote is None:
+        raise RuntimeError("No DVC remote given and no default remote configured (core.remote).")
+    url = config.get(f'remote "{remote}"', {}).get('url')
+    if url is None:
+        raise RuntimeError(f"DVC remote {remote} not found in .dvc/config.")
+    parsed = urlparse(url)
+    if parsed.scheme not in ['s3', 'swift']:
+        raise RuntimeError(f"DVC remote {remote} with URL {url} is neither an S3 nor a Swift remote.")
+    return parsed.netloc, parsed.path.strip('/')
+
+
+def get_stage_objects(stage_name, dvc_root, dvc_lock_filename='dvc.lock'):
+    """Cache objects (md5, cache path, size) of the outs of a stage, .dir objects after their entries"""
+    with open(dvc_lock_filename) as f:
+        lock = yaml.load(f, Loader=yaml.FullLoader)['stages'][stage_name]
+    cache_dir = os.path.join(dvc_root, '.dvc', read_dvc_config(dvc_root).get('cache', {}).get('dir', 'cache'))
+
+    def cache_object(md5):
+        path = os.path.join(cache_dir, md5[:2], md5[2:])
+        return md5, path, os.path.getsize(path)
+
+    files, dirs = dict(), dict()
+    for out in lock.get('outs', []):
+        if 'md5' not in out:
+            continue
+        if out['md5'].endswith('.dir'):
+            dirs[out['md5']] = cache_object(out['md5'])
+            with open(dirs[out['md5']][1]) as f:
+                for entry in json.load(f):
+                    files[entry['md5']] = cache_object(entry['md5'])
+        else:
+            files[out['md5']] = cache_object(out['md5'])
+    return list(files.values()) + list(dirs.values())
+
+
+class SegmentReader:
+    """File-like view of a byte range of a file computing its md5 while it is read (for streamed uploads)"""
+
+    def __init__(self, path, offset, length):
+        self.f = open(path, 'rb')
+        self.offset, self.length = offset, length
+        self.seek(0)
+
+    def seek(self, pos):  # used by swiftclient to rewind on retries
+        if pos != 0:
+            raise ValueError("SegmentReader can only be rewound to its start.")
+        self.f.seek(self.offset)
+        self.remaining = self.length
+        self.md5 = hashlib.md5()
+
+    def tell(self):
+        return self.length - self.remaining
+
+    def read(self, size=-1):
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        self.md5.update(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class SwiftPush:
+    """Upload of cache objects to a Swift container (one connection per thread)"""
+
+    def __init__(self, dvc_root, container, prefix, segment_size, jobs):
+        self.container, self.prefix = container, prefix
+        self.segments_container = container + '+segments'
+        self.segment_size, self.jobs = segment_size, jobs
+        self.manifest_dir = os.path.join(dvc_root, '.dvc', 'tmp', 'swift_push')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = dict(skipped=0, uploaded=0, segments=0, resumed_segments=0, bytes=0)
+
+    @property
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            from swiftclient.client import Connection
+            env = os.environ
+            os_options = {option: env[f"OS_{option.upper()}"] for option in OS_OPTIONS if f"OS_{option.upper()}" in env}
+            self.local.connection = Connection(
+                authurl=env.get('OS_AUTH_URL'), user=env.get('OS_USERNAME'), key=env.get('OS_PASSWORD'),
+                auth_version=env.get('OS_IDENTITY_API_VERSION', '3'), os_options=os_options,
+                preauthurl=env.get('OS_STORAGE_URL'), preauthtoken=env.get('OS_AUTH_TOKEN'), retries=5)
+        return self.local.connection
+
+    def object_name(self, md5):
+        return '/'.join(p for p in [self.prefix, md5[:2], md5[2:]] if p != '')
+
+    def list_objects(self, container, prefix):
+        """Name -> (bytes, hash) of objects under prefix (empty if the container does not exist)"""
+        from swiftclient.client import ClientException
+        try:
+            _, listing = self.connection.get_container(container, prefix=prefix, full_listing=True)
+        except ClientException as e:
+            if e.http_status == 404:
+                return dict()
+            raise
+        return {o['name']: (o['bytes'], o.get('hash')) for o in listing}
+
+    def missing_objects(self, objects):
+        """Objects not yet in the container (one listing per object prefix, HEAD for size mismatches of SLOs)"""
+        prefixes = sorted(set(self.object_name(md5)[:-len(md5[2:])] for md5, _, _ in objects))
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            listing = dict()
+            for result in executor.map(lambda p: self.list_objects(self.container, p), prefixes):
+                listing.update(result)
+        missing = []
+        for md5, path, size in objects:
+            name = self.object_name(md5)
+            if name in listing and (listing[name][0] == size or self.remote_size(name) == size):
+                self.stats['skipped'] += 1
+            else:
+                missing.append((md5, path, size))
+        return missing
+
+    def remote_size(self, name):
+        headers = self.connection.head_object(self.container, name)  # total size also for SLO manifests
+        return int(headers.get('content-length', -1))
+
+    def put(self, container, name, path, offset, length, headers=None):
+        """Streamed upload of a byte range, verified against the ETag returned by Swift"""
+        reader = SegmentReader(path, offset, length)
+        try:
+            etag = self.connection.put_object(container, name, reader, content_length=length, headers=headers)
+        finally:
+            reader.close()
+        if etag.strip('"') != reader.md5.hexdigest():
+            raise RuntimeError(f"Upload of {container}/{name} corrupted (ETag {etag} != {reader.md5.hexdigest()}).")
+        with self.lock:
+            self.stats['bytes'] += length
+        return reader.md5.hexdigest()
+
+    def segment_prefix(self, md5, size):
+        return f"{self.object_name(md5)}/slo/{size}/{self.segment_size}/"
+
+    def load_resume_manifest(self, md5, size):
+        """Segments of a previous upload of this object (index -> segment) that still exist in Swift"""
+        manifest_file = os.path.join(self.manifest_dir, f"{md5}.jsonl")
+        if not os.path.exists(manifest_file):
+            return dict()
+        segments = dict()
+        with open(manifest_file) as f:
+            for line in f:
+                try:
+                    segment = json.loads(line)
+                except json.JSONDecodeError:  # partially written line
+                    continue
+                segments[segment['index']] = segment
+        uploaded = self.list_objects(self.segments_container, self.segment_prefix(md5, size))
+        return {i: s for i, s in segments.items()
+                if uploaded.get(s['path'].split('/', 2)[2]) == (s['size_bytes'], s['etag'])}
+
+    def upload_segment(self, md5, path, size, index):
+        offset = index * self.segment_size
+        length = min(self.segment_size, size - offset)
+        name = f"{self.segment_prefix(md5, size)}{index:08d}"
+        etag = self.put(self.segments_container, name, path, offset, length)
+        segment = dict(index=index, path=f"/{self.segments_container}/{name}", etag=etag, size_bytes=length)
+        with self.lock:  # a single write of a short line to a file opened with O_APPEND
+            with open(os.path.join(self.manifest_dir, f"{md5}.jsonl"), 'a') as f:
+                f.write(json.dumps(segment) + '\n')
+            self.stats['segments'] += 1
+        return segment
+
+    def put_manifest(self, md5, size, segments):
+        manifest = [dict(path=s['path'], etag=s['etag'], size_bytes=s['size_bytes'])
+                    for s in sorted(segments, key=lambda s: s['index'])]
+        self.connection.put_object(self.container, self.object_name(md5), json.dumps(manifest),
+                                   query_string='multipart-manifest=put')
+        os.remove(os.path.join(self.manifest_dir, f"{md5}.jsonl"))
+
+    def push(self, objects):
+        """Upload missing objects (small ones directly, large ones as SLOs), .dir objects after all others"""
+        missing = self.missing_objects(objects)
+        large = [o for o in missing if o[2] > self.segment_size and not o[0].endswith('.dir')]
+        if len(large) > 0:
+            os.makedirs(self.manifest_dir, exist_ok=True)
+            self.connection.put_container(self.segments_container)
+
+        tasks, segments = [], dict()
+        for md5, path, size in missing:
+            if md5.endswith('.dir'):
+                continue
+            if (md5, path, size) in large:
+                segments[md5] = list(self.load_resume_manifest(md5, size).values())
+                self.stats['resumed_segments'] += len(segments[md5])
+                done = set(s['index'] for s in segments[md5])
+                tasks += [(md5, path, size, i) for i in range((size - 1) // self.segment_size + 1) if i not in done]
+            else:
+                tasks.append((md5, path, size, None))
+
+        def run(task):
+            md5, path, size, index = task
+            if index is None:
+                self.put(self.container, self.object_name(md5), path, 0, size)
+                return md5, None
+            return md5, self.upload_segment(md5, path, size, index)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for md5, segment in executor.map(run, tasks):  # re-raises the first failed upload
+                if segment is not None:
+                    segments[md5].append(segment)
+            list(executor.map(lambda o: self.put_manifest(o[0], o[2], segments[o[0]]), large))
+        for md5, path, size in missing:
+            if md5.endswith('.dir'):  # only once all its entries are uploaded (as dvc push)
+                self.put(self.container, self.object_name(md5), path, 0, size)
+        self.stats['uploaded'] = len(missing)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segmented, parallel and resumable upload of the DVC cache objects "
+                                                 "of a stage to Swift (alternative to dvc push).")
+    parser.add_argument('stage', type=str, help="DVC stage [DVC_YAML:]STAGE_NAME (DVC_YAML defaults to "
+                                                "DVC_STAGE_DVC_YAML or ./dvc.yaml)")
+    parser.add_argument('--remote', type=str, default=None, help="DVC remote (default: core.remote)")
+    parser.add_argument('--jobs', type=int, default=int(os.environ.get('DVC_SWIFT_PUSH_JOBS', 8)),
+                        help="Number of parallel uploads (default: DVC_SWIFT_PUSH_JOBS or 8)")
+    parser.add_argument('--segment-size', type=str, default=os.environ.get('DVC_SWIFT_PUSH_SEGMENT_SIZE', '512M'),
+                        help="Segment size of Static Large Objects (default: DVC_SWIFT_PUSH_SEGMENT_SIZE or 512M)")
+    parser.add_argument('--dry', action='store_true', help="Only print the objects that would be uploaded")
+    args = parser.parse_args()
+
+    dvc_root = find_dvc_root()
+    container, prefix = get_remote(dvc_root, args.remote)
+    dvc_yaml_filename, stage_name = split_stage_address(args.stage)
+    objects = get_stage_objects(stage_name, dvc_root, os.path.join(os.path.dirname(dvc_yaml_filename), 'dvc.lock'))
+    pusher = SwiftPush(dvc_root, container, prefix, parse_size(args.segment_size), args.jobs)
+    start = time.time()
+    if args.dry:
+        for md5, path, size in pusher.missing_objects(objects):
+            print(f"{pusher.object_name(md5)} ({size} bytes{', segmented' if size > pusher.segment_size else ''})")
+        return
+    try:
+        pusher.push(objects)
+    except Exception as e:
+        log(f"Error: push of {stage_name} to {container} failed ({type(e).__name__}: {e}), rerun to resume.")
+        sys.exit(1)
+    duration = time.time() - start
+    log(f"{pusher.stats['uploaded']} objects pushed ({pusher.stats['segments']} segments, "
+        f"{pusher.stats['resumed_segments']} resumed), {pusher.stats['skipped']} already in {container}, "
+        f"{pusher.stats['bytes'] / 2**20:.1f} MiB in {duration:.1f} s "
+        f"({pusher.stats['bytes'] / 2**20 / max(duration, 1e-3):.1f} MiB/s).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env bash
+
+# Benchmark of DVC's stage collection cost with one dvc.yaml per stage directory ("stage_dir", the default layout of
+# dvc_create_stage) compared to shared dvc.yaml files with STAGES_PER_SHARD stages each ("sharded", cf. dvc_layout.py).
+#
+# For every number of stages, a repo with chains of CHAIN_LENGTH stages (each depending on the output of the previous
+# one) is generated directly (without dvc stage add) in both layouts, the stages keep their directory s/<stage>/ as
+# working directory. Measures the median wall-clock time over REPEATS runs of
+#   dvc status             (collects and parses all dvc.yaml files, as every dvc repro/commit does)
+#   dvc dag --dot TARGET   (dependencies of a single stage, as queried by slurm_enqueue.sh for every stage)
+# and writes CSV rows to RESULTS_CSV (default: benchmarks/results/dvc_layout_<hostname>.csv).
+#
+# Usage: ./dvc_layout_benchmark.sh [<stages> ...] (default: 100 1000 5000)
+
+set -euo pipefail
+
+SCRIPT_NAME="$(basename "$0")"
+log () {
+    echo "[${SCRIPT_NAME}] $1" >&2
+}
+
+log_error () {
+    log "$1"
+    exit 1
+}
+
+benchmark_dir="$(cd "$(dirname "$0")" && pwd)"
+git_root="$(cd "${benchmark_dir}" && git rev-parse --show-toplevel)"
+num_stages=("$@")
+if [ ${#num_stages[@]} -eq 0 ]; then
+    num_stages=(100 1000 5000)
+fi
+RESULTS_CSV="${RESULTS_CSV:-${git_root}/benchmarks/results/dvc_layout_$(hostname).csv}"
+WORK_DIR="${WORK_DIR:-$(mktemp -d)}"
+REPEATS="${REPEATS:-3}"
+CHAIN_LENGTH="${CHAIN_LENGTH:-10}"
+STAGES_PER_SHARD="${STAGES_PER_SHARD:-100}"
+
+for cmd in git dvc; do
+    if ! command -v "${cmd}" >/dev/null; then
+        log_error "Error: ${cmd} not found in PATH."
+    fi
+done
+
+if [ ! -f "${RESULTS_CSV}" ]; then
+    mkdir -p "$(dirname "${RESULTS_CSV}")"
+    echo "layout,stages,stages_per_shard,dvc_yaml_files,dvc_status_sec,dvc_dag_sec,dvc_version" > "${RESULTS_CSV}"
+fi
+
+generate_repo () {  # layout, number of stages (in the current directory)
+    python3 - "$1" "$2" "${CHAIN_LENGTH}" "${STAGES_PER_SHARD}" <<'EOF'
+import os
+import sys
+import yaml
+
+layout, num_stages, chain_length, stages_per_shard = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), \
+    int(sys.argv[4])
+dvc_yamls = dict()
+for i in range(num_stages):
+    stage_dir = os.path.join('s', f"{i:05d}")
+    os.makedirs(stage_dir)
+    stage = dict(cmd=f"dvc_cmd stage_{i:05d} bash -c 'date > output/done'", outs=['output'])
+    if i % chain_length > 0:
+        stage['deps'] = [f"../{i - 1:05d}/output"]
+    if layout == 'sharded':
+        dvc_yaml = os.path.join('.dvc_shards', 'benchmark', f"{i // stages_per_shard:04d}", 'dvc.yaml')
+        stage = dict(wdir=os.path.relpath(stage_dir, os.path.dirname(dvc_yaml)), **stage)
+    else:
+        dvc_yaml = os.path.join(stage_dir, 'dvc.yaml')
+    dvc_yamls.setdefault(dvc_yaml, dict())[f"stage_{i:05d}"] = stage
+for dvc_yaml, stages in dvc_yamls.items():
+    os.makedirs(os.path.dirname(dvc_yaml), exist_ok=True)
+    with open(dvc_yaml, 'w') as f:
+        yaml.dump(dict(stages=stages), f, sort_keys=False)
+print(len(dvc_yamls))
+EOF
+}
+
+median_time () {  # command... (median wall-clock secs over REPEATS runs)
+    local times=()
+    for _ in $(seq "${REPEATS}"); do
+        local start end
+        start=$(date +%s.%N)
+        "$@" > /dev/null 2>&1 || log_error "Error: $* failed in $(pwd)."
+        end=$(date +%s.%N)
+        times+=("$(python3 -c "print(${end} - ${start})")")
+    done
+    python3 -c "import statistics, sys; print(f'{statistics.median(map(float, sys.argv[1:])):.2f}')" "${times[@]}"
+}
+
+dvc_version="$(dvc --version)"
+for n in "${num_stages[@]}"; do
+    for layout in stage_dir sharded; do
+        log "Benchmarking ${n} stages with layout ${layout} (work dir ${WORK_DIR}/dvc_layout_${layout}_${n})."
+        repo_dir="${WORK_DIR}/dvc_layout_${layout}_${n}"
+        rm -rf "${repo_dir}" && mkdir -p "${repo_dir}"
+        cd "${repo_dir}"
+        git init -q && git config user.email "benchmark@localhost" && git config user.name "benchmark"
+        dvc init -q
+        dvc_yaml_files=$(generate_repo "${layout}" "${n}")
+        git add -A >/dev/null && git commit -q -m "Pipeline"
+
+        last_stage=$(( (n - 1) / CHAIN_LENGTH * CHAIN_LENGTH + CHAIN_LENGTH - 1 ))
+        last_stage=$(( last_stage < n ? last_stage : n - 1 ))
+        if [ "${layout}" == sharded ]; then
+            target=".dvc_shards/benchmark/$(printf '%04d' $((last_stage / STAGES_PER_SHARD)))/dvc.yaml:stage_$(printf '%05d' "${last_stage}")"
+        else
+            target="s/$(printf '%05d' "${last_stage}")/dvc.yaml:stage_$(printf '%05d' "${last_stage}")"
+        fi
+        status_sec=$(median_time dvc status)
+        dag_sec=$(median_time dvc dag --dot "${target}")
+
+        csv_row="${layout},${n},$([ "${layout}" == sharded ] && echo "${STAGES_PER_SHARD}" || echo 1),${dvc_yaml_files},${status_sec},${dag_sec},${dvc_version}"
+        echo "${csv_row}" >> "${RESULTS_CSV}"
+        log "Result (${RESULTS_CSV}): ${csv_row}"
+        cd "${WORK_DIR}"
+    done
+done
@@ -0,0 +1,108 @@
+#!/usr/bin/env bash
+
+# Benchmark of the FUSE-free EncFS library path (encfs_int/encfs_io.py) compared to reading/writing through an EncFS
+# mount as done by encfs_mount_and_run.
+#
+# Creates an EncFS volume with the config of examples/.encfs6.xml.tutorial (password 1234) in a temporary directory and
+# measures the throughput (MB/s of plaintext) of writing and reading a file of SIZE_MB MB (default: 256) of random data
+# with the library for every number of threads ("lib"). If encfs is available, the same file is written and read with
+# dd through a mount with the options of encfs_mount_and_run ("fuse") and the files written by each path are read
+# with the other one (fails if their contents differ). The page cache of the encrypted files is not dropped (no root
+# privileges), so the read throughputs are those of decryption rather than of the underlying file system.
+#
+# Usage: ./encfs_io_benchmark.sh [<threads> ...] (default: 1 2 4 8)
+
+set -euo pipefail
+
+SCRIPT_NAME="$(basename "$0")"
+log () {
+    echo "[${SCRIPT_NAME}] $1" >&2
+}
+
+log_error () {
+    log "$1"
+    exit 1
+}
+
+num_threads=("$@")
+if [ ${#num_threads[@]} -eq 0 ]; then
+    num_threads=(1 2 4 8)
+fi
+SIZE_MB="${SIZE_MB:-256}"
+PYTHON="${PYTHON:-python3}"
+
+"${PYTHON}" -c 'import async_encfs_dvc.encfs_int.encfs_io' || \
+    log_error "Error: async_encfs_dvc.encfs_int.encfs_io cannot be imported (requires the cryptography package)."
+config_file="$(cd "$(dirname "$0")/.." && pwd)/examples/.encfs6.xml.tutorial"
+
+benchmark_dir="$(mktemp -d)"
+mounted=0
+cleanup () {
+    if [ ${mounted} -eq 1 ]; then
+        fusermount -u "${benchmark_dir}/decrypted" || true
+    fi
+    rm -rf "${benchmark_dir}"
+}
+trap cleanup EXIT
+mkdir -p "${benchmark_dir}/encrypted" "${benchmark_dir}/decrypted"
+cp "${config_file}" "${benchmark_dir}/encrypted/.encfs6.xml"
+head -c $((SIZE_MB * 1024 * 1024)) /dev/urandom > "${benchmark_dir}/plain.bin"
+export ENCFS_PW=1234
+
+lib_throughput () {  # mode (write/read), threads, file in the volume
+    "${PYTHON}" - "$1" "$2" "$3" "${benchmark_dir}" <<'EOF'
+import os
+import sys
+import time
+from async_encfs_dvc.encfs_int.encfs_io import EncfsVolume
+
+mode, threads, filename, benchmark_dir = sys.argv[1], int(sys.argv[2]), sys.argv[3], sys.argv[4]
+volume = EncfsVolume(os.path.join(benchmark_dir, 'encrypted'), threads=threads)  # key derivation not timed
+plain_file = os.path.join(benchmark_dir, 'plain.bin')
+chunk_size = volume.read_size()
+start = time.perf_counter()
+if mode == 'write':
+    with open(plain_file, 'rb') as src, volume.open(filename, 'wb') as dst:
+        while data := src.read(chunk_size):
+            dst.write(data)
+else:
+    with volume.open(filename, 'rb') as src:
+        while src.read(chunk_size):
+            pass
+elapsed = time.perf_counter() - start
+print(f"{os.path.getsize(plain_file) / 1e6 / elapsed:.1f}")
+volume.close()
+EOF
+}
+
+echo "path,threads,size_mb,write_mb_s,read_mb_s"
+for threads in "${num_threads[@]}"; do
+    log "Library path with ${threads} threads."
+    write_mb_s=$(lib_throughput write "${threads}" "lib_${threads}.bin")
+    read_mb_s=$(lib_throughput read "${threads}" "lib_${threads}.bin")
+    echo "lib,${threads},${SIZE_MB},${write_mb_s},${read_mb_s}"
+done
+
+if ! command -v encfs > /dev/null; then
+    log "encfs not found in PATH - skipping the FUSE mount comparison."
+    exit 0
+fi
+log "FUSE mount (encfs)."
+echo "${ENCFS_PW}" | encfs -o max_write=1048576,big_writes --nocache -S "${benchmark_dir}/encrypted" \
+    "${benchmark_dir}/decrypted" || log_error "Error: mounting the EncFS volume failed."
+mounted=1
+dd_throughput () {  # input, output, dd options (MB/s from dd's summary line)
+    LC_ALL=C dd if="$1" of="$2" bs=1M "${@:3}" 2>&1 | awk '/copied/ {print $(NF - 1) * ($NF == "GB/s" ? 1000 : 1)}'
+}
+write_mb_s=$(dd_throughput "${benchmark_dir}/plain.bin" "${benchmark_dir}/decrypted/fuse.bin" conv=fsync)
+read_mb_s=$(dd_throughput "${benchmark_dir}/decrypted/fuse.bin" /dev/null)
+echo "fuse,-,${SIZE_MB},${write_mb_s},${read_mb_s}"
+
+log "Cross-checking the contents of the files written by the library and the mount."
+cmp "${benchmark_dir}/plain.bin" "${benchmark_dir}/decrypted/lib_${num_threads[0]}.bin" || \
+    log_error "Error: file written by the library differs when read through the mount."
+"${PYTHON}" -m async_encfs_dvc.encfs_int.encfs_io decrypt "${benchmark_dir}/encrypted" fuse.bin \
+    "${benchmark_dir}/fuse_lib.bin"
+cmp "${benchmark_dir}/plain.bin" "${benchmark_dir}/fuse_lib.bin" || \
+    log_error "Error: file written through the mount differs when read by the library."
+log "Contents match."
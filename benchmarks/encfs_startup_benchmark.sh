@@ -0,0 +1,100 @@
+#!/usr/bin/env bash
+
+# Benchmark of the startup of encfs_mount_and_run with many ranks per node, comparing the per-rank discovery
+# of the install path and the local number of tasks with Python ("python") to the values resolved once per stage
+# and exported to srun ("env", as done by slurm_enqueue.sh/sbatch_dvc_stage.sh).
+#
+# Runs on a single host without SLURM and EncFS: srun is replaced by a local stand-in that starts the ranks
+# as background processes with the SLURM step environment of one node, encfs by a stub that only consumes the
+# password. Reports wall-clock and CPU time (user+sys of all ranks) in CSV format. The wall-clock time includes
+# the 1 sec polling intervals of the mount/unmount barrier, the CPU time is dominated by the startup of the ranks.
+#
+# Usage: ./encfs_startup_benchmark.sh [<ranks-per-node> ...] (default: 1 64 512)
+
+set -euo pipefail
+
+ENCFS_STARTUP_BENCHMARK_DEBUGGING=0  # set to 1 for debugging
+debug() {
+    if [ "${ENCFS_STARTUP_BENCHMARK_DEBUGGING}" -eq 1 ]; then
+        "$@"
+    fi
+}
+
+SCRIPT_NAME="$(basename "$0")"
+log () {
+    echo "[${SCRIPT_NAME}] $1" >&2
+}
+
+log_error () {
+    log "$1"
+    exit 1
+}
+
+ranks_per_node=("$@")
+if [ ${#ranks_per_node[@]} -eq 0 ]; then
+    ranks_per_node=(1 64 512)
+fi
+
+encfs_int_path="$(python3 -c 'import async_encfs_dvc; print(async_encfs_dvc.__path__[0])')/encfs_int" || \
+    log_error "Error: async_encfs_dvc is not installed (or not on PYTHONPATH)."
+
+benchmark_dir="$(mktemp -d)"
+trap 'rm -rf "${benchmark_dir}"' EXIT
+mkdir -p "${benchmark_dir}/bin" "${benchmark_dir}/encrypted" "${benchmark_dir}/logs"
+
+# encfs stub (mount/unmount are no-ops, the sync-file barrier of encfs_mount_and_run is still exercised)
+cat > "${benchmark_dir}/bin/encfs" <<'EOF'
+#!/usr/bin/env bash
+[[ "$1" == "-u" ]] || cat > /dev/null
+EOF
+# fsync stub if not available on this host (required by the sync-file barrier)
+if [ ! -x "$(command -v fsync)" ]; then
+    printf '#!/usr/bin/env bash\nsync "$@"\n' > "${benchmark_dir}/bin/fsync"
+fi
+chmod +x "${benchmark_dir}"/bin/*
+
+# srun stand-in: start all ranks of a single-node step locally and wait for them
+local_srun () {
+    local ntasks="$1"
+    shift
+    local pids=()
+    for rank in $(seq 0 $((ntasks - 1))); do
+        SLURM_JOB_ID=$$ SLURM_STEP_ID=0 SLURM_PROCID=${rank} SLURM_LOCALID=${rank} SLURM_NTASKS=${ntasks} \
+        SLURM_STEP_NODELIST="${HOSTNAME}" SLURM_STEP_TASKS_PER_NODE="${ntasks}" \
+            "$@" > /dev/null &
+        pids+=($!)
+    done
+    local ret=0
+    for pid in "${pids[@]}"; do
+        wait ${pid} || ret=$?
+    done
+    return ${ret}
+}
+
+run_step () {
+    local mode="$1"
+    local ntasks="$2"
+    (
+        export PATH="${benchmark_dir}/bin:${PATH}"
+        export ENCFS_PW=benchmark
+        unset ENCFS_INT_PATH ENCFS_MPI_LOCAL_SIZE ENCFS_MPI_LOCAL_SIZE_MAP ENCFS_MPI_LOCAL_SIZE_KEY
+        if [[ "${mode}" == "env" ]]; then  # resolved once per stage
+            export ENCFS_INT_PATH="${encfs_int_path}"
+            eval "$(python3 -m async_encfs_dvc.slurm_int.hostlist --export-env --nodelist "${HOSTNAME}" --tasks-per-node "${ntasks}")"
+        fi
+        local_srun "${ntasks}" "${encfs_int_path}/encfs_mount_and_run" "${benchmark_dir}/encrypted" \
+            "${benchmark_dir}/decrypted" "${benchmark_dir}/logs/rank_{MPI_RANK}.log" true
+    )
+}
+
+echo "mode,ranks_per_node,real_s,user_s,sys_s"
+TIMEFORMAT="%R,%U,%S"
+for ntasks in "${ranks_per_node[@]}"; do
+    for mode in python env; do
+        log "Running ${ntasks} ranks with discovery mode ${mode}."
+        timing=$( { time run_step "${mode}" "${ntasks}" > /dev/null 2>&1 ; } 2>&1 ) || \
+            log_error "Error: step with ${ntasks} ranks (${mode}) failed."
+        debug log "${mode},${ntasks}: ${timing}"
+        echo "${mode},${ntasks},${timing}"
+    done
+done
@@ -0,0 +1,150 @@
+#!/usr/bin/env bash
+
+# Makespan of a pipeline with a long chain and a fan-out of short side branches on the offline SLURM simulator
+# (slurm_sim.py) with and without critical-path-aware job priorities (DVC_SLURM_CRITICAL_PATH, cf. dvc_critical_path.py)
+#
+# The pipeline consists of a chain of CHAIN_STAGES stages of CHAIN_SECS seconds each and SIDE_STAGES side stages of
+# SIDE_SECS seconds that all depend on the first chain stage. The side stages are enqueued before the rest of the chain
+# (dvc repro of a side stage, then of the last chain stage), so that they precede it in submission order, and all jobs
+# are released at once on SLURM_SIM_NODES (default: 2) nodes. The makespan is measured from the release until all
+# stages are committed, the lower bound is the length of the chain.
+#
+# Usage: critical_path_benchmark.sh [MODES...]  (default: NO YES, values of DVC_SLURM_CRITICAL_PATH)
+#
+# Writes CSV rows to RESULTS_CSV (default: benchmarks/results/critical_path_<hostname>.csv), keeps the work
+# directories under WORK_DIR (default: a temporary directory). Requires git, dvc and async_encfs_dvc to be installed.
+
+set -euo pipefail
+
+SCRIPT_NAME="$(basename "$0")"
+log () {
+    echo "[${SCRIPT_NAME}] $1"
+}
+
+log_error () {
+    log "$1"
+    exit 1
+}
+
+benchmark_dir="$(cd "$(dirname "$0")" && pwd)"
+git_root="$(cd "${benchmark_dir}" && git rev-parse --show-toplevel)"
+modes=("$@")
+if [ ${#modes[@]} -eq 0 ]; then
+    modes=(NO YES)
+fi
+RESULTS_CSV="${RESULTS_CSV:-${git_root}/benchmarks/results/critical_path_$(hostname).csv}"
+WORK_DIR="${WORK_DIR:-$(mktemp -d)}"
+TIMEOUT="${TIMEOUT:-3600}"  # max. secs to wait for all jobs of a pipeline to complete
+CHAIN_STAGES="${CHAIN_STAGES:-5}"
+CHAIN_SECS="${CHAIN_SECS:-8}"
+SIDE_STAGES="${SIDE_STAGES:-8}"
+SIDE_SECS="${SIDE_SECS:-4}"
+export SLURM_SIM_NODES="${SLURM_SIM_NODES:-2}"
+export SLURM_SIM_QUEUE_LATENCY="${SLURM_SIM_QUEUE_LATENCY:-0}"  # jobs compete by priority as soon as they are eligible
+
+for cmd in git dvc dvc_cmd slurm_enqueue.sh dvc_scontrol; do
+    if ! command -v "${cmd}" >/dev/null; then
+        log_error "Error: ${cmd} not found in PATH (install dvc and async_encfs_dvc first)."
+    fi
+done
+
+# simulated SLURM commands (and fsync if not available) first in PATH
+sim_bin="${WORK_DIR}/bin"
+python3 "${benchmark_dir}/slurm_sim.py" install "${sim_bin}"
+if ! command -v fsync >/dev/null; then
+    printf '#!/bin/bash\nsync "$@"\n' > "${sim_bin}/fsync" && chmod +x "${sim_bin}/fsync"
+fi
+export PATH="${sim_bin}:${PATH}"
+
+if [ ! -f "${RESULTS_CSV}" ]; then
+    mkdir -p "$(dirname "${RESULTS_CSV}")"
+    echo "critical_path,chain_stages,chain_secs,side_stages,side_secs,nodes,makespan_sec,lower_bound_sec,jobs_failed" > "${RESULTS_CSV}"
+fi
+
+stop_daemon () {
+    python3 "${benchmark_dir}/slurm_sim.py" stop || true
+}
+trap stop_daemon EXIT
+
+add_stage () {  # stage dir, stage type, secs, dep dir (optional)
+    local stage_dir="$1" stage_type="$2" secs="$3" dep_dir="${4:-}"
+    local stage_name="${stage_dir//\//_}"
+    mkdir -p "${stage_dir}"
+    cp app.yaml "${stage_dir}/app.yaml"
+    if [ -n "${dep_dir}" ]; then
+        dep_dir="$(realpath --relative-to="${stage_dir}" "${dep_dir}")"
+    fi
+    (cd "${stage_dir}" && \
+     dvc stage add --name "${stage_name}" ${dep_dir:+--deps "${dep_dir}/output"} \
+         --outs-persist output \
+         "dvc_cmd ${stage_name} slurm_enqueue.sh ${stage_name} app.yaml ${stage_type} bash -c 'sleep ${secs}; date +%s > output/done'" \
+         >/dev/null)
+}
+
+for mode in "${modes[@]}"; do
+    log "Benchmarking critical path priorities ${mode} (work dir ${WORK_DIR}/critical_path_${mode})."
+
+    run_dir="${WORK_DIR}/critical_path_${mode}"
+    rm -rf "${run_dir}" && mkdir -p "${run_dir}/repo"
+    export SLURM_SIM_DIR="${run_dir}/slurm_sim"
+    export DVC_SLURM_CRITICAL_PATH="${mode}"
+    python3 "${benchmark_dir}/slurm_sim.py" start
+
+    cd "${run_dir}/repo"
+    git init -q && git config user.email "benchmark@localhost" && git config user.name "benchmark"
+    dvc init -q && git commit -q -m "DVC repo"
+    cat > app.yaml <<EOF
+app:
+  name: critical_path_benchmark
+  stages:
+    chain:
+      slurm_opts:
+        stage:
+          --nodes: 1
+          --ntasks: 1
+          --time: '$(printf '00:%02d:%02d' $((CHAIN_SECS / 60)) $((CHAIN_SECS % 60)))'
+    side:
+      slurm_opts:
+        stage:
+          --nodes: 1
+          --ntasks: 1
+          --time: '$(printf '00:%02d:%02d' $((SIDE_SECS / 60)) $((SIDE_SECS % 60)))'
+EOF
+    add_stage chain/1 chain "${CHAIN_SECS}"
+    for i in $(seq 2 "${CHAIN_STAGES}"); do
+        add_stage chain/"${i}" chain "${CHAIN_SECS}" chain/$((i - 1))
+    done
+    for j in $(seq 1 "${SIDE_STAGES}"); do
+        add_stage side/"${j}" side "${SIDE_SECS}" chain/1
+    done
+    git add -A >/dev/null && git commit -q -m "Pipeline"
+
+    # side branches first in submission order (dvc repro holds the jobs, released at once below)
+    for j in $(seq 1 "${SIDE_STAGES}"); do
+        (cd side/"${j}" && dvc repro --no-commit >> "${run_dir}/dvc_repro.log" 2>&1) || \
+            log_error "Error: dvc repro failed (see ${run_dir}/dvc_repro.log)."
+    done
+    (cd chain/"${CHAIN_STAGES}" && dvc repro --no-commit >> "${run_dir}/dvc_repro.log" 2>&1) || \
+        log_error "Error: dvc repro failed (see ${run_dir}/dvc_repro.log)."
+    python3 -m async_encfs_dvc.slurm_int.dvc_critical_path show > "${run_dir}/dvc_critical_path.txt"
+
+    start=$(date +%s.%N)
+    SECONDS=0
+    dvc_scontrol release stage,commit,cleanup > "${run_dir}/dvc_scontrol.log" 2>&1
+    while [ -n "$(squeue -h --Format=JobID)" ] || \
+          [ -n "$(find . -name '*.dvc_pending' -o -name '*.dvc_started' -o -name '*.dvc_complete' | head -n 1)" ]; do
+        if [ "${SECONDS}" -gt "${TIMEOUT}" ]; then
+            log_error "Error: Pipeline did not complete within ${TIMEOUT} seconds (see ${SLURM_SIM_DIR})."
+        fi
+        sleep 0.5
+    done
+    committed=$(date +%s.%N)
+    stop_daemon
+
+    failed=$(python3 "${benchmark_dir}/slurm_sim.py" stats | \
+             python3 -c "import sys, json; print(json.load(sys.stdin)['jobs'].get('FAILED', dict(count=0))['count'])")
+    csv_row="${mode},${CHAIN_STAGES},${CHAIN_SECS},${SIDE_STAGES},${SIDE_SECS},${SLURM_SIM_NODES},$(python3 -c "print(f'{${committed} - ${start}:.2f}')"),$((CHAIN_STAGES * CHAIN_SECS)),${failed}"
+    echo "${csv_row}" >> "${RESULTS_CSV}"
+    log "Result (${RESULTS_CSV}): ${csv_row}"
+    cd "${WORK_DIR}"
+done
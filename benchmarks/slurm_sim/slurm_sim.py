@@ -0,0 +1,731 @@
+#!/usr/bin/env python3
+
+# Offline SLURM simulator for benchmarking the asynchronous DVC/SLURM pipeline on a single host
+#
+# Provides local stand-ins for sbatch, squeue, scontrol, scancel, sacct and srun (dispatched on the name the script is
+# invoked with, see 'install') that operate on a SQLite job table in SLURM_SIM_DIR, and a scheduler daemon that starts
+# pending jobs as local processes once their dependencies are satisfied. Supported are
+#   sbatch:   --parsable, --job-name, --dependency (after, afterany, afterok, afternotok, singleton), --hold, --begin,
+#             --nice, --nodes, --ntasks, --output, --error, --chdir and #SBATCH directives (other options are ignored)
+#   squeue:   --jobs, --name, --user, --states, --format (%A %i %j %T %t %o %r %M %L %Z %u %D %E), --Format, -h
+#   scontrol: hold, release, requeuehold, requeue, update JobID=... (Dependency, Nice, StartTime, ReqNodeList), show job
+#   scancel:  job ids, --name
+#   sacct:    --jobs, --format (JobID, JobName, State, ExitCode, Submit, Start, End, Elapsed, NodeList), -P, -n
+#   srun:     runs the command once per task with the SLURM step environment (--nodes, --ntasks, --ntasks-per-node)
+# Jobs with unsatisfiable dependencies are cancelled (as with kill_invalid_depend, disable with
+# SLURM_SIM_KILL_INVALID_DEPEND=NO). Every CLI invocation is counted as a scheduler RPC (see 'stats').
+#
+# Usage: slurm_sim.py install BIN_DIR   # create sbatch, squeue, ... symlinks in BIN_DIR (to prepend to PATH)
+#        slurm_sim.py start|stop|daemon # run scheduler daemon (in the background with start)
+#        slurm_sim.py stats             # scheduler RPC counts and job timings as JSON
+#        slurm_sim.py fail NODE [STATE] # end running jobs on NODE with STATE (default: NODE_FAIL, or PREEMPTED/TIMEOUT)
+#
+# Configuration (environment):
+#   SLURM_SIM_DIR            directory of the job table, scripts and daemon log (default: ~/.slurm_sim)
+#   SLURM_SIM_NODES          number of simulated nodes (default: 16, named sim[0001-...])
+#   SLURM_SIM_RPC_LATENCY    latency of every CLI call in secs (default: 0.05)
+#   SLURM_SIM_QUEUE_LATENCY  min. time in secs between a job becoming eligible and its start (default: 1)
+#   SLURM_SIM_TICK           scheduler interval in secs (default: 0.2)
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import signal
+import sqlite3
+import getpass
+import argparse
+import datetime
+import subprocess as sp
+
+
+SIM_COMMANDS = ['sbatch', 'squeue', 'scontrol', 'scancel', 'sacct', 'srun']
+ACTIVE_STATES = ['PENDING', 'RUNNING']
+STATE_CODES = {'PENDING': 'PD', 'RUNNING': 'R', 'COMPLETED': 'CD', 'FAILED': 'F', 'CANCELLED': 'CA', 'NODE_FAIL': 'NF',
+               'PREEMPTED': 'PR', 'TIMEOUT': 'TO'}
+
+SBATCH_FLAGS = ['--parsable', '--hold', '-H', '--requeue', '--no-requeue', '--exclusive', '--wait', '-W',
+                '--overcommit', '-O', '--contiguous', '--quiet', '-Q', '--verbose', '-v', '--test-only',
+                '--spread-job', '--use-min-nodes', '--no-kill', '-k']
+SRUN_FLAGS = ['--exclusive', '--overlap', '--overcommit', '-O', '--quiet', '-Q', '--verbose', '-v', '--label', '-l',
+              '--unbuffered', '-u', '--kill-on-bad-exit', '-K', '--no-kill', '-k', '--pty', '--mpi=none']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, user TEXT, state TEXT, reason TEXT, held INTEGER DEFAULT 0,
+    nice INTEGER DEFAULT 0, dependency TEXT DEFAULT '', begin_time REAL DEFAULT 0, req_nodelist TEXT DEFAULT '',
+    num_nodes INTEGER DEFAULT 1, num_tasks INTEGER DEFAULT 1, workdir TEXT, script TEXT, args TEXT, stdout TEXT,
+    stderr TEXT, env TEXT, nodelist TEXT DEFAULT '', exit_code INTEGER, restarts INTEGER DEFAULT 0, pid INTEGER,
+    submit_time REAL, eligible_time REAL, start_time REAL, end_time REAL
+);
+CREATE TABLE IF NOT EXISTS rpcs (command TEXT PRIMARY KEY, count INTEGER DEFAULT 0);
+"""
+
+
+def get_sim_dir():
+    return os.environ.get('SLURM_SIM_DIR', os.path.expanduser('~/.slurm_sim'))
+
+
+def get_num_nodes():
+    return int(os.environ.get('SLURM_SIM_NODES', 16))
+
+
+def get_node_names():
+    return [f"sim{i:04d}" for i in range(1, get_num_nodes() + 1)]
+
+
+def compact_nodelist(nodes):
+    """Compact node list (e.g. sim[0001-0003,0007]) of simulated nodes"""
+    if len(nodes) == 0:
+        return ''
+    if len(nodes) == 1:
+        return nodes[0]
+    numbers = sorted(int(n[3:]) for n in nodes)
+    ranges, first, last = [], numbers[0], numbers[0]
+    for n in numbers[1:] + [None]:
+        if n is not None and n == last + 1:
+            last = n
+            continue
+        ranges.append(f"{first:04d}" if first == last else f"{first:04d}-{last:04d}")
+        if n is not None:
+            first, last = n, n
+    return f"sim[{','.join(ranges)}]"
+
+
+def connect():
+    os.makedirs(get_sim_dir(), exist_ok=True)
+    db = sqlite3.connect(os.path.join(get_sim_dir(), 'jobs.db'), timeout=120, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def count_rpc(db, command):
+    db.execute("INSERT INTO rpcs (command, count) VALUES (?, 1) "
+               "ON CONFLICT(command) DO UPDATE SET count = count + 1", (command,))
+    latency = float(os.environ.get('SLURM_SIM_RPC_LATENCY', 0.05))
+    if latency > 0:
+        time.sleep(latency)
+
+
+def error(command, message, exit_code=1):
+    print(f"{command}: error: {message}", file=sys.stderr)
+    sys.exit(exit_code)
+
+
+def parse_options(args, flags, short_with_value=True):
+    """Split args into options (dict of lists) and positional arguments (from first non-option on)"""
+    opts = dict()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--':
+            i += 1
+            break
+        if not arg.startswith('-') or arg == '-':
+            break
+        if arg.startswith('--') and '=' in arg:
+            key, val = arg.split('=', 1)
+        elif arg in flags:
+            key, val = arg, None
+        elif not arg.startswith('--') and len(arg) > 2:  # e.g. -N2
+            key, val = arg[:2], arg[2:]
+        else:
+            key = arg
+            val = args[i + 1] if i + 1 < len(args) else None
+            i += 1
+        opts.setdefault(key, []).append(val)
+        i += 1
+    return opts, args[i:]
+
+
+def get_opt(opts, names, default=None):
+    for name in names:
+        if name in opts:
+            return opts[name][-1]
+    return default
+
+
+def parse_time(value, now=None):
+    """Parse --begin/StartTime (now+N[seconds|minutes|hours|days], HH:MM[:SS] or YYYY-MM-DD[THH:MM[:SS]])"""
+    now = now or time.time()
+    if value is None or value in ['', 'now', 'Unknown', 'None']:
+        return now
+    match = re.match(r"^now\+(\d+)(seconds|minutes|hours|days|s|m|h|d)?$", value)
+    if match:
+        units = {None: 1, 's': 1, 'seconds': 1, 'm': 60, 'minutes': 60, 'h': 3600, 'hours': 3600,
+                 'd': 86400, 'days': 86400}
+        return now + int(match.group(1)) * units[match.group(2)]
+    for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    match = re.match(r"^(\d+):(\d+)(?::(\d+))?$", value)
+    if match:
+        today = datetime.datetime.fromtimestamp(now).replace(hour=int(match.group(1)), minute=int(match.group(2)),
+                                                             second=int(match.group(3) or 0), microsecond=0)
+        return today.timestamp()
+    raise ValueError(f"Invalid time specification {value}")
+
+
+def parse_dependency(dependency):
+    """Parse dependency expression into list of (type, [job ids]) (all must hold, '?' treated like ',')"""
+    deps = []
+    for dep in re.split(r"[,?]", dependency or ''):
+        if dep == '':
+            continue
+        if dep == 'singleton':
+            deps.append(('singleton', []))
+            continue
+        dep_type, _, ids = dep.partition(':')
+        deps.append((dep_type, [int(i.split('+')[0].split('_')[0]) for i in ids.split(':') if i != '']))
+    return deps
+
+
+def format_duration(secs):
+    secs = int(max(secs, 0))
+    days, secs = divmod(secs, 86400)
+    hours, secs = divmod(secs, 3600)
+    mins, secs = divmod(secs, 60)
+    hms = f"{hours}:{mins:02d}:{secs:02d}" if hours > 0 else f"{mins}:{secs:02d}"
+    return f"{days}-{hours:02d}:{mins:02d}:{secs:02d}" if days > 0 else hms
+
+
+def format_timestamp(t):
+    return datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S') if t else 'Unknown'
+
+
+# --- sbatch ---
+
+def read_sbatch_directives(script):
+    """Options from #SBATCH lines at the beginning of a batch script"""
+    directives = []
+    for line in script.splitlines()[1:]:
+        if line.startswith('#SBATCH'):
+            directives += shlex.split(line[len('#SBATCH'):])
+        elif line.strip() != '' and not line.startswith('#'):
+            break
+    return directives
+
+
+def sbatch(argv):
+    db = connect()
+    count_rpc(db, 'sbatch')
+    opts, positional = parse_options(argv, SBATCH_FLAGS)
+    if len(positional) == 0:
+        error('sbatch', "Batch script from stdin not supported")
+    script_path, script_args = positional[0], positional[1:]
+    if not os.path.isfile(script_path):
+        error('sbatch', f"Unable to open file {script_path}")
+    with open(script_path) as f:
+        script = f.read()
+    directive_opts, _ = parse_options(read_sbatch_directives(script), SBATCH_FLAGS)
+    opts = {**directive_opts, **opts}
+
+    now = time.time()
+    workdir = os.path.abspath(get_opt(opts, ['--chdir', '-D'], os.getcwd()))
+    dependency = get_opt(opts, ['--dependency', '-d'], '')
+    try:
+        deps = parse_dependency(dependency)
+        begin_time = parse_time(get_opt(opts, ['--begin', '-b']), now)
+    except ValueError as e:
+        error('sbatch', str(e))
+    for _, ids in deps:
+        for dep_id in ids:
+            if db.execute("SELECT id FROM jobs WHERE id = ?", (dep_id,)).fetchone() is None:
+                error('sbatch', "Batch job submission failed: Job dependency problem")
+    num_nodes = int(str(get_opt(opts, ['--nodes', '-N'], 1)).split('-')[0])
+    if num_nodes > get_num_nodes():
+        error('sbatch', "Batch job submission failed: Requested node configuration is not available")
+    num_tasks = int(get_opt(opts, ['--ntasks', '-n'], num_nodes *
+                            int(get_opt(opts, ['--ntasks-per-node'], 1))))
+    env = {k: v for k, v in os.environ.items() if not k.startswith('SLURM_') or k.startswith('SLURM_SIM_')}
+    held = '--hold' in opts or '-H' in opts
+
+    db.execute("BEGIN IMMEDIATE")
+    cursor = db.execute(
+        "INSERT INTO jobs (name, user, state, reason, held, nice, dependency, begin_time, num_nodes, num_tasks, "
+        "workdir, script, args, stdout, stderr, env, submit_time) "
+        "VALUES (?, ?, 'PENDING', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (get_opt(opts, ['--job-name', '-J'], os.path.basename(script_path)), getpass.getuser(),
+         'JobHeldUser' if held else 'None', int(held), int(get_opt(opts, ['--nice'], 0)), dependency, begin_time,
+         num_nodes, num_tasks, workdir, script, json.dumps([os.path.abspath(script_path)] + script_args),
+         get_opt(opts, ['--output', '-o'], 'slurm-%j.out'), get_opt(opts, ['--error', '-e']), json.dumps(env), now))
+    job_id = cursor.lastrowid
+    db.execute("COMMIT")
+
+    if '--parsable' in opts:
+        print(job_id)
+    else:
+        print(f"Submitted batch job {job_id}")
+
+
+# --- squeue/sacct ---
+
+def job_field(job, field, now):
+    """Value of a job field for squeue/sacct (by format letter or long name)"""
+    command = ' '.join(json.loads(job['args']))
+    elapsed = (job['end_time'] or now) - job['start_time'] if job['start_time'] else 0
+    fields = {
+        'A': job['id'], 'i': job['id'], 'jobid': job['id'],
+        'j': job['name'], 'name': job['name'], 'jobname': job['name'],
+        'T': job['state'], 'state': job['state'],
+        't': STATE_CODES.get(job['state'], job['state']),
+        'o': command, 'command': command,
+        'r': job['reason'], 'reason': job['reason'],
+        'M': format_duration(elapsed), 'timeused': format_duration(elapsed), 'elapsed': format_duration(elapsed),
+        'L': 'UNLIMITED', 'timeleft': 'UNLIMITED',
+        'Z': job['workdir'], 'workdir': job['workdir'],
+        'u': job['user'], 'username': job['user'], 'user': job['user'],
+        'D': job['num_nodes'], 'numnodes': job['num_nodes'],
+        'Q': 4294967295 - 1000 * job['id'] - job['nice'] if not job['held'] else 0, 'priority': None,
+        'y': job['nice'], 'nice': job['nice'],
+        'E': job['dependency'] or '(null)', 'dependency': job['dependency'] or '(null)',
+        'N': job['nodelist'] or '', 'nodelist': job['nodelist'] or 'None assigned',
+        'exitcode': f"{job['exit_code'] if job['exit_code'] is not None else 0}:0",
+        'submit': format_timestamp(job['submit_time']), 'start': format_timestamp(job['start_time']),
+        'end': format_timestamp(job['end_time']),
+    }
+    fields['priority'] = fields['Q']
+    return fields.get(field, '')
+
+
+def render_format(jobs, fmt, header, now):
+    """Render jobs with squeue --format specification (e.g. %.30A,%.200j)"""
+    tokens = re.findall(r"%(\.)?(-)?(\d+)?([A-Za-z])|([^%]+)", fmt)
+    lines = []
+    if header:
+        names = {'A': 'JOBID', 'i': 'JOBID', 'j': 'NAME', 'T': 'STATE', 't': 'ST', 'o': 'COMMAND', 'r': 'REASON',
+                 'M': 'TIME', 'L': 'TIME_LEFT', 'Z': 'WORK_DIR', 'u': 'USER', 'D': 'NODES', 'Q': 'PRIORITY',
+                 'y': 'NICE', 'E': 'DEPENDENCY', 'N': 'NODELIST'}
+        jobs = [None] + list(jobs)
+    for job in jobs:
+        line = ''
+        for right, _, width, letter, literal in tokens:
+            if literal:
+                line += literal
+                continue
+            value = str(names.get(letter, letter) if job is None else job_field(job, letter, now))
+            if width:
+                value = value[:int(width)]
+                value = value.rjust(int(width)) if right else value.ljust(int(width))
+            line += value
+        lines.append(line)
+    return lines
+
+
+def squeue(argv):
+    db = connect()
+    count_rpc(db, 'squeue')
+    opts, _ = parse_options(argv, ['-h', '--noheader', '--me', '-l', '--long', '-a', '--all', '-r', '--array'])
+    query, params = "SELECT * FROM jobs WHERE state IN ('PENDING', 'RUNNING')", []
+    job_ids = get_opt(opts, ['--jobs', '-j'])
+    if job_ids is not None:
+        for job_id in job_ids.split(','):
+            if not job_id.isdigit():
+                error('squeue', f"Invalid job id: {job_id}")
+        query += f" AND id IN ({','.join('?' * len(job_ids.split(',')))})"
+        params += [int(i) for i in job_ids.split(',')]
+    names = get_opt(opts, ['--name', '-n'])
+    if names is not None:
+        query += f" AND name IN ({','.join('?' * len(names.split(',')))})"
+        params += names.split(',')
+    user = get_opt(opts, ['--user', '-u'], getpass.getuser() if '--me' in opts else None)
+    if user is not None:
+        query += " AND user = ?"
+        params.append(user)
+    states = get_opt(opts, ['--states', '-t'])
+    if states is not None and states.lower() != 'all':
+        state_names = {'PD': 'PENDING', 'R': 'RUNNING'}
+        states = [state_names.get(s.upper(), s.upper()) for s in states.split(',')]
+        query += f" AND state IN ({','.join('?' * len(states))})"
+        params += states
+    jobs = db.execute(query + " ORDER BY id DESC", params).fetchall()
+
+    header = '-h' not in opts and '--noheader' not in opts
+    now = time.time()
+    long_format = get_opt(opts, ['--Format', '-O'])
+    if long_format is not None:  # e.g. JobID,Name:30,State:.10
+        fields = []
+        for field in long_format.split(','):
+            name, _, width = field.partition(':')
+            right = width.startswith('.')
+            fields.append((name.lower(), int(width.lstrip('.') or 20), right))
+        if header:
+            print(''.join(name.upper().ljust(width)[:width] for name, width, _ in fields).rstrip())
+        for job in jobs:
+            print(''.join((str(job_field(job, name, now)).rjust(width) if right else
+                           str(job_field(job, name, now)).ljust(width))[:width] for name, width, right in fields))
+        return
+    fmt = get_opt(opts, ['--format', '-o'], "%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R")
+    fmt = fmt.replace('%P', 'sim').replace('%R', '%r')
+    for line in render_format(jobs, fmt.replace('%.9P', '      sim'), header, now):
+        print(line)
+
+
+def sacct(argv):
+    db = connect()
+    count_rpc(db, 'sacct')
+    opts, _ = parse_options(argv, ['-P', '--parsable2', '-p', '--parsable', '-n', '--noheader', '-X',
+                                   '--allocations', '-a', '--allusers'])
+    query, params = "SELECT * FROM jobs", []
+    job_ids = get_opt(opts, ['--jobs', '-j'])
+    if job_ids is not None:
+        ids = [int(i.split('.')[0]) for i in job_ids.split(',')]
+        query += f" WHERE id IN ({','.join('?' * len(ids))})"
+        params += ids
+    jobs = db.execute(query + " ORDER BY id", params).fetchall()
+    fields = [f.split('%')[0].lower() for f in
+              get_opt(opts, ['--format', '-o'], 'JobID,JobName,State,ExitCode').split(',')]
+    parsable = any(o in opts for o in ['-P', '--parsable2', '-p', '--parsable'])
+    now = time.time()
+    rows = [[f.upper() for f in fields]] if not ('-n' in opts or '--noheader' in opts) else []
+    rows += [[str(job_field(job, f, now)) for f in fields] for job in jobs]
+    for row in rows:
+        print('|'.join(row) if parsable else ' '.join(v.rjust(12) for v in row))
+
+
+# --- scontrol/scancel ---
+
+def parse_job_ids(ids):
+    return [int(i) for arg in ids for i in arg.split(',') if i != '']
+
+
+def set_state(db, job_ids, updates, condition="1"):
+    db.execute("BEGIN IMMEDIATE")
+    for job_id in job_ids:
+        db.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in updates)} WHERE id = ? AND {condition}",
+                   list(updates.values()) + [job_id])
+    db.execute("COMMIT")
+
+
+def scontrol(argv):
+    db = connect()
+    count_rpc(db, 'scontrol')
+    if len(argv) == 0:
+        error('scontrol', "No command given")
+    command, args = argv[0], argv[1:]
+    if command in ['hold', 'uhold']:
+        set_state(db, parse_job_ids(args), dict(held=1, reason='JobHeldUser'), "state = 'PENDING'")
+    elif command == 'release':
+        set_state(db, parse_job_ids(args), dict(held=0, reason='None'), "state = 'PENDING'")
+    elif command in ['requeuehold', 'requeue']:
+        held = int(command == 'requeuehold')
+        # the daemon kills running jobs that are not RUNNING in the job table anymore
+        set_state(db, parse_job_ids(args), dict(state='PENDING', held=held, reason='JobHeldUser' if held else 'None',
+                                                start_time=None, nodelist='', restarts=1, eligible_time=None),
+                  "state IN ('PENDING', 'RUNNING')")
+    elif command == 'update':
+        fields = dict(arg.split('=', 1) for arg in args)
+        job_id = fields.pop('JobID', fields.pop('JobId', fields.pop('jobid', None)))
+        if job_id is None:
+            error('scontrol', "No JobId given")
+        updates = dict()
+        for key, val in fields.items():
+            if key.lower() == 'dependency':
+                updates['dependency'] = val
+            elif key.lower() == 'nice':
+                updates['nice'] = int(val)
+            elif key.lower() == 'starttime':
+                updates['begin_time'] = parse_time(val)
+            elif key.lower() == 'reqnodelist':
+                updates['req_nodelist'] = val
+        if len(updates) > 0:
+            set_state(db, parse_job_ids([job_id]), updates, "state = 'PENDING'")
+    elif command == 'show' and len(args) > 0 and args[0] == 'job':
+        now = time.time()
+        query = "SELECT * FROM jobs" + (" WHERE id = ?" if len(args) > 1 else " WHERE state IN ('PENDING', 'RUNNING')")
+        for job in db.execute(query, [int(args[1])] if len(args) > 1 else []).fetchall():
+            print(f"JobId={job['id']} JobName={job['name']}\n   UserId={job['user']} Nice={job['nice']}\n"
+                  f"   JobState={job['state']} Reason={job['reason']} Dependency={job_field(job, 'E', now)}\n"
+                  f"   Requeue=1 Restarts={job['restarts']} ExitCode={job_field(job, 'exitcode', now)}\n"
+                  f"   RunTime={job_field(job, 'M', now)}\n   SubmitTime={format_timestamp(job['submit_time'])} "
+                  f"StartTime={format_timestamp(job['start_time'] or job['begin_time'])} "
+                  f"EndTime={format_timestamp(job['end_time'])}\n"
+                  f"   NodeList={job['nodelist'] or '(null)'} ReqNodeList={job['req_nodelist'] or '(null)'}\n"
+                  f"   NumNodes={job['num_nodes']} NumTasks={job['num_tasks']}\n"
+                  f"   Command={job_field(job, 'o', now)}\n   WorkDir={job['workdir']}\n")
+    else:
+        error('scontrol', f"Unsupported command {' '.join(argv)}")
+
+
+def scancel(argv):
+    db = connect()
+    count_rpc(db, 'scancel')
+    opts, positional = parse_options(argv, ['--quiet', '-Q', '--verbose', '-v', '--batch', '-b', '--full', '-f'])
+    job_ids = parse_job_ids(positional)
+    names = get_opt(opts, ['--name', '-n'])
+    if names is not None:
+        job_ids += [row['id'] for row in db.execute(
+            f"SELECT id FROM jobs WHERE state IN ('PENDING', 'RUNNING') AND name IN "
+            f"({','.join('?' * len(names.split(',')))})", names.split(',')).fetchall()]
+    set_state(db, job_ids, dict(state='CANCELLED', reason='None', end_time=time.time()),
+              "state IN ('PENDING', 'RUNNING')")
+
+
+# --- srun ---
+
+def srun(argv):
+    db = connect()
+    count_rpc(db, 'srun')
+    opts, command = parse_options(argv, SRUN_FLAGS)
+    if len(command) == 0:
+        error('srun', "No command given")
+    job_nodes = os.environ.get('SLURM_SIM_JOB_NODES', 'sim0001').split(',')
+    num_nodes = min(int(str(get_opt(opts, ['--nodes', '-N'], len(job_nodes))).split('-')[0]), len(job_nodes))
+    if get_opt(opts, ['--ntasks-per-node']) is not None:
+        num_tasks = num_nodes * int(get_opt(opts, ['--ntasks-per-node']))
+    elif get_opt(opts, ['--ntasks', '-n']) is not None:
+        num_tasks = int(get_opt(opts, ['--ntasks', '-n']))
+    else:
+        num_tasks = int(os.environ.get('SLURM_NTASKS', num_nodes)) if get_opt(opts, ['--nodes', '-N']) is None \
+            else num_nodes
+    num_nodes = min(num_nodes, num_tasks)
+
+    # block distribution of tasks to nodes
+    tasks_per_node = [num_tasks // num_nodes + (1 if n < num_tasks % num_nodes else 0) for n in range(num_nodes)]
+    groups = []
+    for n in tasks_per_node:
+        if len(groups) > 0 and groups[-1][0] == n:
+            groups[-1][1] += 1
+        else:
+            groups.append([n, 1])
+    step_env = dict(SLURM_STEP_NODELIST=compact_nodelist(job_nodes[:num_nodes]), SLURM_STEP_NUM_NODES=str(num_nodes),
+                    SLURM_STEP_NUM_TASKS=str(num_tasks),
+                    SLURM_STEP_TASKS_PER_NODE=','.join(f"{n}(x{c})" if c > 1 else str(n) for n, c in groups))
+    procs = []
+    rank = 0
+    for node, node_tasks in zip(job_nodes, tasks_per_node):
+        for local_rank in range(node_tasks):
+            env = dict(os.environ, **step_env, SLURM_PROCID=str(rank), SLURM_LOCALID=str(local_rank),
+                       SLURM_NODEID=str(job_nodes.index(node)), SLURMD_NODENAME=node)
+            procs.append(sp.Popen(command, env=env))
+            rank += 1
+    exit_code = 0
+    for proc in procs:
+        exit_code = max(exit_code, proc.wait())
+    sys.exit(exit_code)
+
+
+# --- scheduler daemon ---
+
+def dependency_status(db, job):
+    """Whether dependencies of a pending job are satisfied (True), pending (None) or never satisfiable (False)"""
+    satisfied = True
+    for dep_type, ids in parse_dependency(job['dependency']):
+        if dep_type == 'singleton':
+            if db.execute("SELECT id FROM jobs WHERE name = ? AND user = ? AND id < ? AND state IN "
+                          "('PENDING', 'RUNNING')", (job['name'], job['user'], job['id'])).fetchone() is not None:
+                satisfied = None
+            continue
+        for dep_id in ids:
+            dep = db.execute("SELECT state FROM jobs WHERE id = ?", (dep_id,)).fetchone()
+            state = dep['state'] if dep is not None else 'COMPLETED'
+            if state in ACTIVE_STATES:
+                satisfied = None
+            elif dep_type in ['afterok', 'aftercorr'] and state != 'COMPLETED':
+                return False
+            elif dep_type == 'afternotok' and state == 'COMPLETED':
+                return False
+    return satisfied
+
+
+def expand_output_pattern(pattern, job):
+    path = pattern.replace('%j', str(job['id'])).replace('%A', str(job['id'])).replace('%x', job['name']) \
+                  .replace('%u', job['user']).replace('%N', 'sim0001')
+    return os.path.join(job['workdir'], path)
+
+
+def start_job(db, job, nodes):
+    script_file = os.path.join(get_sim_dir(), 'scripts', f"job_{job['id']}.sh")
+    os.makedirs(os.path.dirname(script_file), exist_ok=True)
+    with open(script_file, 'w') as f:
+        f.write(job['script'])
+    os.chmod(script_file, 0o755)
+
+    args = json.loads(job['args'])
+    tasks_per_node = [job['num_tasks'] // len(nodes) + (1 if n < job['num_tasks'] % len(nodes) else 0)
+                      for n in range(len(nodes))]
+    env = dict(json.loads(job['env']), SLURM_JOB_ID=str(job['id']), SLURM_JOBID=str(job['id']),
+               SLURM_JOB_NAME=job['name'], SLURM_JOB_NODELIST=compact_nodelist(nodes),
+               SLURM_NODELIST=compact_nodelist(nodes), SLURM_JOB_NUM_NODES=str(len(nodes)),
+               SLURM_NNODES=str(len(nodes)), SLURM_NTASKS=str(job['num_tasks']),
+               SLURM_TASKS_PER_NODE=','.join(str(n) for n in tasks_per_node), SLURM_SUBMIT_DIR=job['workdir'],
+               SLURM_RESTART_COUNT=str(job['restarts']), SLURM_PROCID='0', SLURM_LOCALID='0', SLURM_NODEID='0',
+               SLURMD_NODENAME=nodes[0], SLURM_SIM_JOB_NODES=','.join(nodes))
+    stdout_file = expand_output_pattern(job['stdout'], job)
+    stderr_file = expand_output_pattern(job['stderr'], job) if job['stderr'] else stdout_file
+    os.makedirs(os.path.dirname(stdout_file), exist_ok=True)
+    os.makedirs(os.path.dirname(stderr_file), exist_ok=True)
+    first_line = job['script'].splitlines()[0] if job['script'] else ''
+    # bash scripts are run without -l (a login shell may reset PATH to exclude the simulated SLURM commands)
+    cmd = ['bash', script_file] + args[1:] if 'bash' in first_line else [script_file] + args[1:]
+    with open(stdout_file, 'ab') as out, open(stderr_file, 'ab') if stderr_file != stdout_file else out as err:
+        proc = sp.Popen(cmd, cwd=job['workdir'], env=env, stdout=out, stderr=err, stdin=sp.DEVNULL,
+                        start_new_session=True)
+    db.execute("UPDATE jobs SET state = 'RUNNING', reason = 'None', start_time = ?, nodelist = ?, pid = ? "
+               "WHERE id = ?", (time.time(), ','.join(nodes), proc.pid, job['id']))
+    return proc
+
+
+def kill_job(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def schedule(db, procs, kill_invalid_depend, queue_latency):
+    """One scheduler cycle: reap finished jobs, stop cancelled/requeued ones, start eligible pending ones"""
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    for job_id, proc in list(procs.items()):
+        job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job['state'] != 'RUNNING' or job['pid'] != proc.pid:  # cancelled or requeued
+            kill_job(proc)
+            del procs[job_id]
+        elif proc.poll() is not None:
+            db.execute("UPDATE jobs SET state = ?, exit_code = ?, end_time = ? WHERE id = ?",
+                       ('COMPLETED' if proc.returncode == 0 else 'FAILED', proc.returncode, now, job_id))
+            del procs[job_id]
+
+    busy = set(n for row in db.execute("SELECT nodelist FROM jobs WHERE state = 'RUNNING'").fetchall()
+               for n in row['nodelist'].split(',') if n != '')
+    free = [n for n in get_node_names() if n not in busy]
+    pending = db.execute("SELECT * FROM jobs WHERE state = 'PENDING' ORDER BY nice, id").fetchall()
+    for job in pending:
+        if job['held']:
+            continue
+        status = dependency_status(db, job)
+        if status is False:
+            if kill_invalid_depend:
+                db.execute("UPDATE jobs SET state = 'CANCELLED', reason = 'DependencyNeverSatisfied', end_time = ? "
+                           "WHERE id = ?", (now, job['id']))
+            else:
+                db.execute("UPDATE jobs SET reason = 'DependencyNeverSatisfied' WHERE id = ?", (job['id'],))
+            continue
+        if status is None:
+            db.execute("UPDATE jobs SET reason = 'Dependency', eligible_time = NULL WHERE id = ?", (job['id'],))
+            continue
+        if job['begin_time'] > now:
+            db.execute("UPDATE jobs SET reason = 'BeginTime' WHERE id = ?", (job['id'],))
+            continue
+        eligible_time = job['eligible_time']
+        if eligible_time is None:
+            db.execute("UPDATE jobs SET eligible_time = ?, reason = 'Priority' WHERE id = ?", (now, job['id']))
+            eligible_time = now  # startable in this cycle without queue latency (competing by nice with the others)
+        if now - eligible_time < queue_latency:
+            continue
+        candidates = free
+        if job['req_nodelist']:
+            candidates = [n for n in free if n in job['req_nodelist'].split(',')] + \
+                         [n for n in free if n not in job['req_nodelist'].split(',')]
+        if len(candidates) < job['num_nodes']:
+            db.execute("UPDATE jobs SET reason = 'Resources' WHERE id = ?", (job['id'],))
+            continue
+        nodes = candidates[:job['num_nodes']]
+        procs[job['id']] = start_job(db, job, nodes)
+        free = [n for n in free if n not in nodes]
+    db.execute("COMMIT")
+
+
+def daemon():
+    db = connect()
+    procs = dict()
+    kill_invalid_depend = os.environ.get('SLURM_SIM_KILL_INVALID_DEPEND', 'YES') == 'YES'
+    queue_latency = float(os.environ.get('SLURM_SIM_QUEUE_LATENCY', 1))
+    tick = float(os.environ.get('SLURM_SIM_TICK', 0.2))
+    stop = []
+    signal.signal(signal.SIGTERM, lambda *_: stop.append(True))
+    while not stop:
+        schedule(db, procs, kill_invalid_depend, queue_latency)
+        time.sleep(tick)
+    for proc in procs.values():
+        kill_job(proc)
+
+
+def get_pid_file():
+    return os.path.join(get_sim_dir(), 'daemon.pid')
+
+
+def start_daemon():
+    os.makedirs(get_sim_dir(), exist_ok=True)
+    connect().close()
+    with open(os.path.join(get_sim_dir(), 'daemon.log'), 'ab') as log:
+        proc = sp.Popen([sys.executable, os.path.abspath(__file__), 'daemon'], stdout=log, stderr=log,
+                        stdin=sp.DEVNULL, start_new_session=True)
+    with open(get_pid_file(), 'w') as f:
+        f.write(str(proc.pid))
+    print(f"slurm_sim: Started scheduler daemon (pid {proc.pid}, SLURM_SIM_DIR={get_sim_dir()}).")
+
+
+def stop_daemon():
+    if os.path.exists(get_pid_file()):
+        with open(get_pid_file()) as f:
+            pid = int(f.read())
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        os.remove(get_pid_file())
+
+
+def stats():
+    db = connect()
+    rpcs = {row['command']: row['count'] for row in db.execute("SELECT * FROM rpcs").fetchall()}
+    jobs = db.execute("SELECT state, COUNT(*) AS n, MIN(submit_time) AS first_submit, MAX(submit_time) AS "
+                      "last_submit, MAX(end_time) AS last_end FROM jobs GROUP BY state").fetchall()
+    print(json.dumps(dict(rpcs=rpcs, rpcs_total=sum(rpcs.values()),
+                          jobs={row['state']: dict(count=row['n'], first_submit=row['first_submit'],
+                                                   last_submit=row['last_submit'], last_end=row['last_end'])
+                                for row in jobs}), indent=2))
+
+
+def fail(node, state='NODE_FAIL'):
+    """End the running jobs on a node with a failure state (the daemon kills their processes)"""
+    db = connect()
+    job_ids = [row['id'] for row in db.execute("SELECT id, nodelist FROM jobs WHERE state = 'RUNNING'").fetchall()
+               if node in row['nodelist'].split(',')]
+    set_state(db, job_ids, dict(state=state, reason='None', exit_code=0, end_time=time.time()), "state = 'RUNNING'")
+    print(f"slurm_sim: Ended jobs {','.join(str(i) for i in job_ids) or '-'} on {node} with {state}.")
+
+
+def main():
+    command = os.path.basename(sys.argv[0])
+    if command in SIM_COMMANDS:
+        return globals()[command](sys.argv[1:])
+
+    parser = argparse.ArgumentParser(description="Offline SLURM simulator (sbatch, squeue, scontrol, scancel, "
+                                                 "sacct, srun stand-ins with a scheduler daemon).")
+    parser.add_argument("command", choices=['install', 'start', 'stop', 'daemon', 'stats', 'fail'] + SIM_COMMANDS)
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.command in SIM_COMMANDS:
+        globals()[args.command](args.args)
+    elif args.command == 'install':
+        bin_dir = args.args[0]
+        os.makedirs(bin_dir, exist_ok=True)
+        for sim_command in SIM_COMMANDS:
+            link = os.path.join(bin_dir, sim_command)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.abspath(__file__), link)
+    elif args.command == 'start':
+        start_daemon()
+    elif args.command == 'stop':
+        stop_daemon()
+    elif args.command == 'daemon':
+        daemon()
+    elif args.command == 'stats':
+        stats()
+    elif args.command == 'fail':
+        fail(*args.args)
+
+
+if __name__ == '__main__':
+    main()
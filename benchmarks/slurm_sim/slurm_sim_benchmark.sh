@@ -0,0 +1,141 @@
+#!/usr/bin/env bash
+
+# End-to-end benchmark of the asynchronous SLURM pipeline (slurm_enqueue.sh, sbatch_dvc_*.sh, dvc_scontrol) on the
+# offline SLURM simulator (slurm_sim.py): for each number of stages an iterative simulation pipeline is created in a
+# fresh DVC repo (as in iterative_sim_benchmark.sh), submitted with dvc repro --no-commit and released,
+# reporting time-to-submit (dvc repro), time-to-commit (until all jobs completed) and the scheduler RPCs per command
+# (and a per-phase timing report, see dvc_timing.py).
+#
+# Usage: slurm_sim_benchmark.sh [STAGE_COUNTS...]  (default: 10 100 1000)
+#
+# Writes CSV rows to RESULTS_CSV (default: benchmarks/results/slurm_sim_<hostname>.csv), keeps the work directories
+# under WORK_DIR (default: a temporary directory). The simulator is configured with the SLURM_SIM_* variables
+# (see slurm_sim.py, e.g. SLURM_SIM_QUEUE_LATENCY=1 SLURM_SIM_RPC_LATENCY=0.05). Requires git, dvc and
+# async_encfs_dvc to be installed.
+
+set -euo pipefail
+
+SLURM_SIM_BENCHMARK_DEBUGGING=0  # set to 1 for debugging
+debug() {
+    if [ "${SLURM_SIM_BENCHMARK_DEBUGGING}" -eq 1 ]; then
+        "$@"
+    fi
+}
+
+SCRIPT_NAME="$(basename "$0")"
+log () {
+    echo "[${SCRIPT_NAME}] $1"
+}
+
+log_error () {
+    log "$1"
+    exit 1
+}
+
+benchmark_dir="$(cd "$(dirname "$0")" && pwd)"
+git_root="$(cd "${benchmark_dir}" && git rev-parse --show-toplevel)"
+stage_counts=("$@")
+if [ ${#stage_counts[@]} -eq 0 ]; then
+    stage_counts=(10 100 1000)
+fi
+RESULTS_CSV="${RESULTS_CSV:-${git_root}/benchmarks/results/slurm_sim_$(hostname).csv}"
+WORK_DIR="${WORK_DIR:-$(mktemp -d)}"
+TIMEOUT="${TIMEOUT:-36000}"  # max. secs to wait for all jobs of a pipeline to complete
+
+for cmd in git dvc dvc_create_stage dvc_init_repo slurm_enqueue.sh; do
+    if ! command -v "${cmd}" >/dev/null; then
+        log_error "Error: ${cmd} not found in PATH (install dvc and async_encfs_dvc first)."
+    fi
+done
+
+# simulated SLURM commands (and fsync if not available) first in PATH
+sim_bin="${WORK_DIR}/bin"
+python3 "${benchmark_dir}/slurm_sim.py" install "${sim_bin}"
+if ! command -v fsync >/dev/null; then
+    printf '#!/bin/bash\nsync "$@"\n' > "${sim_bin}/fsync" && chmod +x "${sim_bin}/fsync"
+fi
+export PATH="${sim_bin}:${PATH}"
+
+if [ ! -f "${RESULTS_CSV}" ]; then
+    mkdir -p "$(dirname "${RESULTS_CSV}")"
+    echo "stages,submit_time_sec,commit_time_sec,jobs,jobs_failed,rpcs_total,rpcs_sbatch,rpcs_squeue,rpcs_scontrol,rpcs_scancel,rpcs_srun,queue_latency_sec,rpc_latency_sec" > "${RESULTS_CSV}"
+fi
+
+stop_daemon () {
+    python3 "${benchmark_dir}/slurm_sim.py" stop || true
+}
+trap stop_daemon EXIT
+
+for num_stages in "${stage_counts[@]}"; do
+    log "Benchmarking pipeline with ${num_stages} stages (work dir ${WORK_DIR}/stages_${num_stages})."
+
+    run_dir="${WORK_DIR}/stages_${num_stages}"
+    rm -rf "${run_dir}" && mkdir -p "${run_dir}/repo"
+    export SLURM_SIM_DIR="${run_dir}/slurm_sim"
+    export DVC_TIMING_LOG="${run_dir}/dvc_timing.jsonl"  # per-phase spans of all stages (cf. dvc_timing.py)
+    python3 "${benchmark_dir}/slurm_sim.py" start
+
+    # DVC repo with a frozen base stage (as in iterative_sim_benchmark.sh) and app_sim from this repo
+    cd "${run_dir}/repo"
+    git init -q && git config user.email "benchmark@localhost" && git config user.name "benchmark"
+    mkdir -p examples && cp -r "${git_root}/examples/app_sim" examples/
+    git add examples && git commit -q -m "app_sim"
+    mkdir -p dvc_root && dvc_init_repo dvc_root plain >/dev/null && cd dvc_root
+    git commit -q -m "DVC repo"
+
+    mkdir -p app_sim_v1/sim_dataset_v1/simulation/0/output
+    touch app_sim_v1/sim_dataset_v1/simulation/0/output/sim.0.dat
+    (cd app_sim_v1/sim_dataset_v1/simulation/0 && \
+     dvc stage add --run --name app_sim_v1_sim_dataset_v1_simulation_0 --outs-persist output true >/dev/null && \
+     dvc freeze app_sim_v1_sim_dataset_v1_simulation_0)
+
+    debug set -x
+    for i in $(seq 1 "${num_stages}"); do
+        dvc_create_stage --app-yaml "$(git rev-parse --show-toplevel)"/examples/app_sim/dvc_app_slurm_sim.yaml \
+            --stage simulation --run-label "$i" --input-simulation $((i-1)) \
+            --simulation-output-file-num-per-rank 1 --simulation-output-file-size 1K >/dev/null
+    done
+    debug set +x
+    git add -A >/dev/null && git commit -q -m "Pipeline with ${num_stages} stages"
+
+    # time-to-submit: dvc repro enqueues all stages (jobs are submitted on hold)
+    start=$(date +%s.%N)
+    SECONDS=0
+    (cd app_sim_v1/sim_dataset_v1/simulation/"${num_stages}" && \
+     dvc repro --no-commit app_sim_v1_sim_dataset_v1_simulation_"${num_stages}" > "${run_dir}/dvc_repro.log" 2>&1) || \
+        log_error "Error: dvc repro failed (see ${run_dir}/dvc_repro.log)."
+    submitted=$(date +%s.%N)
+
+    # time-to-commit: release all jobs and wait until the queue is drained and no stage is left uncommitted
+    dvc_scontrol release stage,commit,cleanup > "${run_dir}/dvc_scontrol.log"
+    while [ -n "$(squeue -h --Format=JobID)" ] || \
+          [ -n "$(find . -name '*.dvc_pending' -o -name '*.dvc_started' -o -name '*.dvc_complete' | head -n 1)" ]; do
+        if [ "${SECONDS}" -gt "${TIMEOUT}" ]; then
+            log_error "Error: Pipeline did not complete within ${TIMEOUT} seconds (see ${SLURM_SIM_DIR})."
+        fi
+        sleep 1
+    done
+    committed=$(date +%s.%N)
+    stop_daemon
+
+    stats="$(python3 "${benchmark_dir}/slurm_sim.py" stats)"
+    csv_row=$(python3 - "${stats}" <<EOF
+import sys
+import json
+
+stats = json.loads(sys.argv[1])
+rpcs = stats['rpcs']
+jobs = sum(s['count'] for s in stats['jobs'].values())
+failed = stats['jobs'].get('FAILED', dict(count=0))['count']  # cleanup jobs are cancelled after successful stages
+print(','.join(str(v) for v in [${num_stages}, f"{${submitted} - ${start}:.2f}", f"{${committed} - ${start}:.2f}",
+                                jobs, failed, stats['rpcs_total']] +
+               [rpcs.get(c, 0) for c in ['sbatch', 'squeue', 'scontrol', 'scancel', 'srun']] +
+               ["${SLURM_SIM_QUEUE_LATENCY:-1}", "${SLURM_SIM_RPC_LATENCY:-0.05}"]))
+EOF
+)
+    echo "${csv_row}" >> "${RESULTS_CSV}"
+    log "Result (${RESULTS_CSV}): ${csv_row}"
+    python3 -m async_encfs_dvc.dvc_timing report "${DVC_TIMING_LOG}" > "${run_dir}/dvc_timing_report.txt"
+    log "Phase timings and critical path in ${run_dir}/dvc_timing_report.txt."
+    cd "${WORK_DIR}"
+done
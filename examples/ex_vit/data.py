@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# CIFAR10 data pipeline for the Vision Transformer example: memory-mapped cache of the dataset at its native resolution
+# (uint8, written once per dataset version into DVC_DATA_CACHE_DIR, a shared directory outside of the DVC-tracked stage
+# outputs), batched reads from the cache resized on the device, DataLoaders with multi-worker prefetch and pinned
+# batches, as well as timing of data loading vs. compute per epoch.
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+import torchvision
+from torchvision.transforms import Compose, ToTensor, Resize
+
+
+def get_fingerprint(path):
+    """Size and mtime of a file or digest of the relative paths, sizes and mtimes of all files under a directory"""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, filename))
+            files.append([os.path.relpath(os.path.join(dirpath, filename), path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(files).encode('utf-8')).hexdigest()
+
+
+def get_cache_dir(config, root):
+    """Cache directory of the dataset at root in DVC_DATA_CACHE_DIR (None if data_cache is disabled or it is not set)"""
+    if not getattr(config, 'data_cache', False):
+        return None
+    cache_root = os.environ.get('DVC_DATA_CACHE_DIR')
+    if not cache_root:
+        print("Warning: data_cache requires DVC_DATA_CACHE_DIR (shared directory outside of the stage outputs) - "
+              "reading the dataset without cache.")
+        return None
+    return os.path.join(cache_root, 'cifar10', hashlib.sha1(json.dumps(get_fingerprint(root)).encode('utf-8'))
+                        .hexdigest()[:16])
+
+
+def cache_filenames(cache_dir, train):
+    split = 'train' if train else 'test'
+    return [os.path.join(cache_dir, f"cifar10_{split}_{name}.npy") for name in ['images', 'labels']]
+
+
+def write_cache(root, train, cache_dir):
+    """Store CIFAR10 as uint8 arrays (N, C, H, W) and labels (N,) in cache_dir"""
+    images_file, labels_file = cache_filenames(cache_dir, train)
+    dataset = torchvision.datasets.CIFAR10(root=root, train=train, download=False)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_images_file = images_file + f".tmp{os.getpid()}.npy"
+    np.save(tmp_images_file, np.ascontiguousarray(dataset.data.transpose(0, 3, 1, 2)))
+    np.save(labels_file + f".tmp{os.getpid()}.npy", np.asarray(dataset.targets, dtype=np.int64))
+    os.replace(labels_file + f".tmp{os.getpid()}.npy", labels_file)
+    os.replace(tmp_images_file, images_file)  # images last, marks the cache as complete
+
+
+class CachedCIFAR10(Dataset):
+    """CIFAR10 from the memory-mapped cache indexed by batches of sample indices (uint8 images, resized by to_device)"""
+
+    def __init__(self, cache_dir, train):
+        self.images_file, self.labels_file = cache_filenames(cache_dir, train)
+        self.labels = np.load(self.labels_file)
+        self.images = None  # opened lazily in each worker process
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, indices):
+        if self.images is None:
+            self.images = np.load(self.images_file, mmap_mode='r')
+        indices = np.sort(np.asarray(indices))  # sequential reads from the cache
+        return torch.from_numpy(self.images[indices]), torch.from_numpy(self.labels[indices])
+
+
+def get_dataset(root, train, img_size, cache_dir=None, barrier=None, rank=0):
+    """CIFAR10 resized to img_size, from the memory-mapped cache in cache_dir if given (written by rank 0 if missing)"""
+    if cache_dir is None:
+        return torchvision.datasets.CIFAR10(root=root, train=train, download=False,
+                                            transform=Compose([Resize((img_size, img_size)), ToTensor()]))
+    if rank == 0 and not os.path.exists(cache_filenames(cache_dir, train)[0]):
+        start = time.time()
+        write_cache(root, train, cache_dir)
+        print(f"Wrote {'training' if train else 'test'} data cache to {cache_dir} in {time.time() - start:.1f} s")
+    if barrier is not None:
+        barrier()
+    return CachedCIFAR10(cache_dir, train)
+
+
+def get_loader(dataset, batch_size, shuffle=False, sampler=None, num_workers=0, prefetch_factor=2, pin_memory=False):
+    """DataLoader with multi-worker prefetch and pinned batches (batches read at once from cached datasets)"""
+    opts = dict(num_workers=num_workers, pin_memory=pin_memory)
+    if num_workers > 0:
+        opts.update(prefetch_factor=prefetch_factor, persistent_workers=True)
+    if isinstance(dataset, CachedCIFAR10):
+        sampler = sampler or (RandomSampler(dataset) if shuffle else SequentialSampler(dataset))
+        return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None,
+                          **opts)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle if sampler is None else False, sampler=sampler,
+                      **opts)
+
+
+def to_device(images, labels, device, img_size=None):
+    """Move a batch to the device, converting cached uint8 images to floats in [0, 1] (as ToTensor) resized to
+    img_size (bilinear as Resize)"""
+    images = images.to(device, non_blocking=True)
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255.)
+        if img_size is not None and images.shape[-2:] != (img_size, img_size):
+            images = F.interpolate(images, size=(img_size, img_size), mode='bilinear', align_corners=False)
+    return images, labels.to(device, non_blocking=True)
+
+
+class EpochTimer:
+    """Split of the time of an epoch into waiting for data and compute (incl. host-device transfers)"""
+
+    def __init__(self, device):
+        self.device = device
+        self.start = time.time()
+        self.data_time = 0.
+        self.batches = 0
+
+    def timed(self, loader):
+        """Iterate over loader, accumulating the time spent waiting for batches"""
+        iterator = iter(loader)
+        while True:
+            start = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_time += time.time() - start
+            self.batches += 1
+            yield batch
+
+    def report(self, label):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        total = time.time() - self.start
+        compute = total - self.data_time
+        print(f"{label}: {self.batches} batches in {total:.2f} s - data {self.data_time:.2f} s "
+              f"({100. * self.data_time / max(total, 1e-9):.1f} %), compute {compute:.2f} s "
+              f"({100. * compute / max(total, 1e-9):.1f} %)")
+        return dict(total=total, data=self.data_time, compute=compute, batches=self.batches)
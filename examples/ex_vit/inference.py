@@ -1,43 +1,121 @@
 #!/usr/bin/env python3
 
+# Inference of the Vision Transformer example: predictions are streamed in chunks of inference_chunk_batches batches
+# into a pre-sized memory-mapped array in the stage output (dvc_resume_predicted_labels.npy, progress in
+# dvc_resume_predicted_labels.json after each chunk), so that memory stays bounded and a requeued stage resumes after
+# the last written chunk (dvc_resume_* files are kept by dvc_reset_outs, resumed only with the same model weights,
+# input and config, where files are compared by size and mtime as they are replaced by a DVC checkout of another
+# version). On completion, the array is renamed to predicted_labels.npy and predicted_labels.pkl (list of per-batch
+# label arrays) is written.
+
 import os
+import json
 import argparse
 import yaml
 import pickle
 from types import SimpleNamespace
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-import torchvision
-from torchvision.transforms import Compose, ToTensor, Resize
 from torch.hub import tqdm
 
 from model import ViT
-
-
-def eval_fn(config, model, inference_loader, criterion, device):
+from data import get_cache_dir, get_dataset, get_fingerprint, get_loader, to_device, EpochTimer
+
+
+class PredictionWriter:
+    """Chunked writes of predicted labels to a memory-mapped array with a progress file to resume from"""
+
+    def __init__(self, output_dir, num_samples, signature):
+        self.partial_file = os.path.join(output_dir, 'dvc_resume_predicted_labels.npy')
+        self.progress_file = os.path.join(output_dir, 'dvc_resume_predicted_labels.json')
+        self.output_file = os.path.join(output_dir, 'predicted_labels.npy')
+        self.signature = signature
+        progress = self.load_progress(num_samples)
+        if progress is not None:
+            self.labels = np.load(self.partial_file, mmap_mode='r+')
+            self.done, self.total_loss, self.batches = progress['done'], progress['total_loss'], progress['batches']
+            print(f"Resuming inference after {self.done}/{num_samples} samples from {self.partial_file}")
+        else:
+            self.labels = np.lib.format.open_memmap(self.partial_file, mode='w+', dtype=np.int64,
+                                                    shape=(num_samples,))
+            self.done, self.total_loss, self.batches = 0, 0.0, 0
+            self.save_progress()
+
+    def load_progress(self, num_samples):
+        """Progress of a previous run with the same signature (None if there is none)"""
+        try:
+            with open(self.progress_file) as f:
+                progress = json.load(f)
+            labels = np.load(self.partial_file, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if progress.get('signature') != self.signature or labels.shape != (num_samples,):
+            print(f"Discarding partial predictions in {self.partial_file} (model, input or config changed)")
+            return None
+        return progress
+
+    def save_progress(self):
+        tmp_file = self.progress_file + f".tmp{os.getpid()}"
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(signature=self.signature, done=self.done, total_loss=self.total_loss,
+                           batches=self.batches), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.progress_file)
+
+    def write(self, predictions, total_loss, batches):
+        """Append a chunk of predictions (flushed before the progress is updated)"""
+        self.labels[self.done:self.done + len(predictions)] = predictions
+        self.labels.flush()
+        self.done += len(predictions)
+        self.total_loss, self.batches = total_loss, batches
+        self.save_progress()
+
+    def finish(self, batch_size):
+        """Move the predictions to predicted_labels.npy/.pkl (truncated to the written samples after a dry run)"""
+        if self.done < len(self.labels):
+            np.save(self.output_file, self.labels[:self.done])
+            del self.labels
+            os.remove(self.partial_file)
+        else:
+            self.labels.flush()
+            del self.labels
+            os.replace(self.partial_file, self.output_file)
+        os.remove(self.progress_file)
+        labels = np.load(self.output_file, mmap_mode='r')
+        with open(os.path.join(os.path.dirname(self.output_file), "predicted_labels.pkl"), 'wb') as f:
+            pickle.dump([np.array(labels[i:i + batch_size]) for i in range(0, len(labels), batch_size)], f)
+
+
+def eval_fn(config, model, inference_loader, criterion, device, writer):
     model.eval()
-    total_loss = 0.0
-    tk = tqdm(inference_loader, desc="[INFERENCE]")
-
-    predictions = []
-
-    for t, data in enumerate(tk):
-        images, labels = data
-        images, labels = images.to(device), labels.to(device)
-
-        logits = model(images)
-        probabilities = nn.functional.softmax(logits, dim=-1)
-        predictions.append(torch.argmax(probabilities, dim=-1))
-
-        loss = criterion(logits, labels)
-
-        total_loss += loss.item()
-        tk.set_postfix({"Loss": "%6f" % float(total_loss / (t + 1))})
-        if config.dry_run:
-            break
-    
-    return predictions
+    total_loss = torch.tensor(writer.total_loss, device=device)  # synchronized once per chunk
+    batches = writer.batches
+    chunk_batches = getattr(config, 'inference_chunk_batches', 64)
+    timer = EpochTimer(device)
+    tk = tqdm(timer.timed(inference_loader), total=len(inference_loader), desc="[INFERENCE]")
+
+    chunk = []
+    with torch.inference_mode():
+        for data in tk:
+            images, labels = to_device(*data, device, config.img_size)
+
+            logits = model(images)
+            chunk.append(torch.argmax(logits, dim=-1))  # argmax of the softmax probabilities
+
+            total_loss += criterion(logits, labels)
+            batches += 1
+            if len(chunk) == chunk_batches:
+                writer.write(torch.cat(chunk).cpu().numpy(), total_loss.item(), batches)
+                chunk = []
+                tk.set_postfix({"Loss": "%6f" % float(writer.total_loss / batches)})
+            if config.dry_run:
+                break
+        if len(chunk) > 0:
+            writer.write(torch.cat(chunk).cpu().numpy(), total_loss.item(), batches)
+
+    timer.report("[INFERENCE]")
 
 
 def main():
@@ -51,7 +129,7 @@ def main():
                         help='YAML file with model hyperparameters')
     parser.add_argument('--inference-output', type=str,
                         help='Path to save inference results to')
-    
+
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='disables CUDA training')
     parser.add_argument('--dry-run', action='store_true', default=False,
@@ -69,32 +147,35 @@ def main():
     use_cuda = not config.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
 
-    transforms = Compose([
-        Resize((config.img_size, config.img_size)),
-        ToTensor()
-    ])
-
     # This is specifically for the CIFAR10 test dataset as an inference input for demonstration purposes
-    inference_data = torchvision.datasets.CIFAR10(root=config.inference_input, train=False, download=False, transform=transforms)
-    inference_loader = DataLoader(inference_data, batch_size=config.batch_size, shuffle=False)
+    # (memory-mapped cache of the dataset in DVC_DATA_CACHE_DIR, written once per dataset version)
+    inference_data = get_dataset(config.inference_input, False, config.img_size,
+                                 get_cache_dir(config, config.inference_input))
+
+    # resume after the last chunk of predictions written by a previous (interrupted) run with the same inputs
+    weights_file = os.path.join(config.training_output, "best-weights.pt")
+    signature = dict(weights=get_fingerprint(weights_file),
+                     inference_input=[os.path.realpath(config.inference_input),
+                                      get_fingerprint(config.inference_input)], samples=len(inference_data),
+                     config={k: v for k, v in vars(config).items() if k not in ['num_workers', 'prefetch_factor']})
+    writer = PredictionWriter(config.inference_output, len(inference_data), signature)
+
+    inference_loader = get_loader(inference_data, config.batch_size, sampler=range(writer.done, len(inference_data)),
+                                  num_workers=getattr(config, 'num_workers', 0),
+                                  prefetch_factor=getattr(config, 'prefetch_factor', 2), pin_memory=use_cuda)
 
     model = ViT(config).to(device)
 
-    model.load_state_dict(torch.load(
-        os.path.join(config.training_output, "best-weights.pt")))
+    model.load_state_dict(torch.load(weights_file))
 
     model = model.to(device)
 
     criterion = nn.CrossEntropyLoss()  # well-defined as using test set for demonstration
 
-    predictions = eval_fn(config, model, inference_loader, criterion, device)
-    if use_cuda:
-        predictions = [pred.cpu() for pred in predictions]
-
-    with open(os.path.join(config.inference_output,
-                        f"predicted_labels.pkl"), 'wb') as f:
-        pickle.dump([p.numpy() for p in predictions], f)
+    if writer.done < len(inference_data):
+        eval_fn(config, model, inference_loader, criterion, device, writer)
+    writer.finish(config.batch_size)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
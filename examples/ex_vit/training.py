@@ -6,9 +6,6 @@ import yaml
 from types import SimpleNamespace
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-import torchvision
-from torchvision.transforms import Compose, ToTensor, Resize
 from torch import optim
 import numpy as np
 from torch.hub import tqdm
@@ -20,6 +17,7 @@ except ImportError:
     pass
 
 from model import ViT
+from data import get_cache_dir, get_dataset, get_loader, to_device, EpochTimer
 
 
 class TrainEval:
@@ -37,11 +35,12 @@ class TrainEval:
     def train_fn(self, current_epoch):
         self.model.train()
         total_loss = 0.0
-        tk = tqdm(self.train_dataloader, desc="EPOCH" + "[TRAIN]" + str(current_epoch + 1) + "/" + str(self.epoch))
+        timer = EpochTimer(self.device)
+        tk = tqdm(timer.timed(self.train_dataloader), total=len(self.train_dataloader),
+                  desc="EPOCH" + "[TRAIN]" + str(current_epoch + 1) + "/" + str(self.epoch))
 
         for t, data in enumerate(tk):
-            images, labels = data
-            images, labels = images.to(self.device), labels.to(self.device)
+            images, labels = to_device(*data, self.device, self.args.img_size)
             self.optimizer.zero_grad()
             logits = self.model(images)
             loss = self.criterion(logits, labels)
@@ -55,17 +54,19 @@ class TrainEval:
             if self.args.dry_run:
                 break
 
+        timer.report("EPOCH" + "[TRAIN]" + str(current_epoch + 1))
         return total_loss / len(self.train_dataloader) / (1 if not self.args.dist else hvd.size())
 
 
     def eval_fn(self, current_epoch):
         self.model.eval()
         total_loss = 0.0
-        tk = tqdm(self.val_dataloader, desc="EPOCH" + "[VALID]" + str(current_epoch + 1) + "/" + str(self.epoch))
+        timer = EpochTimer(self.device)
+        tk = tqdm(timer.timed(self.val_dataloader), total=len(self.val_dataloader),
+                  desc="EPOCH" + "[VALID]" + str(current_epoch + 1) + "/" + str(self.epoch))
 
         for t, data in enumerate(tk):
-            images, labels = data
-            images, labels = images.to(self.device), labels.to(self.device)
+            images, labels = to_device(*data, self.device, self.args.img_size)
 
             logits = self.model(images)
             loss = self.criterion(logits, labels)
@@ -77,6 +78,7 @@ class TrainEval:
             if self.args.dry_run:
                 break
 
+        timer.report("EPOCH" + "[VALID]" + str(current_epoch + 1))
         return total_loss / len(self.val_dataloader) / (1 if not self.args.dist else hvd.size())
 
     def train(self):
@@ -150,20 +152,23 @@ def main():
     use_cuda = not config.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
 
-    transforms = Compose([
-        Resize((config.img_size, config.img_size)),
-        ToTensor()
-    ])
-    train_data = torchvision.datasets.CIFAR10(root=config.training_input, train=True, download=False, transform=transforms)
-    valid_data = torchvision.datasets.CIFAR10(root=config.test_input, train=False, download=False, transform=transforms)
+    # memory-mapped cache of the dataset in DVC_DATA_CACHE_DIR (written once per dataset version, not a stage output)
+    barrier = (lambda: hvd.allreduce(torch.zeros(1), name='data_cache_barrier')) if config.dist else None
+    rank = hvd.rank() if config.dist else 0
+    train_data = get_dataset(config.training_input, True, config.img_size,
+                             get_cache_dir(config, config.training_input), barrier, rank)
+    valid_data = get_dataset(config.test_input, False, config.img_size,
+                             get_cache_dir(config, config.test_input), barrier, rank)
+    loader_opts = dict(num_workers=getattr(config, 'num_workers', 0),
+                       prefetch_factor=getattr(config, 'prefetch_factor', 2), pin_memory=use_cuda)
     if config.dist:
         train_sampler = DistributedSampler(train_data, num_replicas=hvd.size(), rank=hvd.rank())
         valid_sampler = DistributedSampler(valid_data, num_replicas=hvd.size(), rank=hvd.rank())
-        train_loader = DataLoader(train_data, batch_size=config.batch_size, sampler=train_sampler)
-        valid_loader = DataLoader(valid_data, batch_size=config.batch_size, sampler=valid_sampler)
+        train_loader = get_loader(train_data, config.batch_size, sampler=train_sampler, **loader_opts)
+        valid_loader = get_loader(valid_data, config.batch_size, sampler=valid_sampler, **loader_opts)
     else:
-        train_loader = DataLoader(train_data, batch_size=config.batch_size, shuffle=True)
-        valid_loader = DataLoader(valid_data, batch_size=config.batch_size, shuffle=True)
+        train_loader = get_loader(train_data, config.batch_size, shuffle=True, **loader_opts)
+        valid_loader = get_loader(valid_data, config.batch_size, shuffle=True, **loader_opts)
 
     model = ViT(config).to(device)
 
@@ -20,9 +20,12 @@ setup(
         'python-swiftclient',
         'python-heatclient',
         'jinja2',
+        'cryptography',  # encfs_int/encfs_io.py
         'dvc[s3] @ git+https://github.com/lukasgd/dvc.git@fix_interpolate_env_var',
     ],
-    extras_require={},
+    extras_require={
+        'compression': ['zstandard'],  # stage_compression.py (outputs declaring compression in the stage policy)
+    },
     include_package_data=True,
     scripts=[
         'async_encfs_dvc/dvc_init_repo',
@@ -31,8 +34,11 @@ setup(
         'async_encfs_dvc/encfs_int/encfs_mount_and_run',
         'async_encfs_dvc/slurm_int/slurm_enqueue.sh',
         'async_encfs_dvc/slurm_int/dvc_scontrol',
+        'async_encfs_dvc/local_int/local_enqueue.sh',
+        'async_encfs_dvc/local_int/dvc_local',
     ],
     entry_points = {
-        'console_scripts': ['dvc_create_stage=async_encfs_dvc.dvc_create_stage:main']
+        'console_scripts': ['dvc_create_stage=async_encfs_dvc.dvc_create_stage:main',
+                            'dvc_multi_repo=async_encfs_dvc.dvc_multi_repo:main']
     }
 )
\ No newline at end of file
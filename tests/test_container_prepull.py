@@ -0,0 +1,114 @@
+# Tests of the container image pre-pull and digest pinning of DVC stage commands
+# (async_encfs_dvc/slurm_int/container_prepull.py) with a fake docker CLI (DVC_CONTAINER_DOCKER)
+
+import os
+import sys
+import json
+import subprocess as sp
+
+import pytest
+
+from async_encfs_dvc.slurm_int.container_prepull import pin_command, warm
+
+
+FAKE_DOCKER = '''
+import os
+import sys
+import json
+import hashlib
+
+state_dir = os.environ['FAKE_DOCKER_STATE']
+with open(os.path.join(state_dir, 'calls.jsonl'), 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + '\\n')
+images_file = os.path.join(state_dir, 'images.json')
+images = json.load(open(images_file)) if os.path.exists(images_file) else dict()
+
+
+def repo_digest(image):
+    repo = image.rsplit(':', 1)[0] if ':' in image.split('/')[-1] else image
+    return repo + '@sha256:' + hashlib.sha256(repo.encode()).hexdigest()
+
+
+if sys.argv[1] == 'pull':
+    image = sys.argv[2]
+    if image.split('/')[-1].startswith('missing'):
+        sys.exit(1)
+    images[image] = images[repo_digest(image.split('@')[0])] = repo_digest(image.split('@')[0])
+    json.dump(images, open(images_file, 'w'))
+elif sys.argv[1:3] == ['image', 'inspect']:
+    image = sys.argv[-1]
+    if image not in images:
+        sys.exit(1)
+    print(json.dumps([images[image]]) if 'RepoDigests' in sys.argv[-2] else 'sha256:0123')
+'''
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    """Fake docker CLI recording its calls and pulled images in tmp_path"""
+    state_dir = tmp_path / 'docker'
+    state_dir.mkdir()
+    (state_dir / 'docker.py').write_text(FAKE_DOCKER)
+    monkeypatch.setenv('FAKE_DOCKER_STATE', str(state_dir))
+    monkeypatch.setenv('DVC_CONTAINER_DOCKER', f"{sys.executable} {state_dir / 'docker.py'}")
+
+    def calls(subcommand='pull'):
+        if not (state_dir / 'calls.jsonl').exists():
+            return []
+        with open(state_dir / 'calls.jsonl') as f:
+            return [call[1:] for call in map(json.loads, f) if call[0] == subcommand]
+    return calls
+
+
+def stage_command(image):
+    return ['encfs_mount_and_run', 'docker', 'run', '--rm', '-v', '/data:/data', '--entrypoint', 'bash', image,
+            '-c', 'python3 simulate.py']
+
+
+def test_pin(docker, tmp_path):
+    cache_file = str(tmp_path / 'container_images.json')
+    pinned = pin_command(stage_command('registry.example.com/sim:1.0'), cache_file)
+    assert pinned[8].startswith('registry.example.com/sim@sha256:')
+    assert pinned == stage_command(pinned[8])
+
+    # pulled only once per repo, pinned commands are not pulled again
+    assert pin_command(stage_command('registry.example.com/sim:1.0'), cache_file) == pinned
+    assert pin_command(pinned, cache_file) == pinned
+    assert docker() == [['registry.example.com/sim:1.0']]
+    with open(cache_file) as f:
+        assert json.load(f)['registry.example.com/sim:1.0']['digest'] == pinned[8]
+
+    assert pin_command(['bash', '-c', 'docker ps'], cache_file) == ['bash', '-c', 'docker ps']
+    with pytest.raises(RuntimeError, match='Failed to pull'):
+        pin_command(stage_command('registry.example.com/missing:1.0'), cache_file)
+
+
+def test_warm(docker, tmp_path):
+    dvc_yaml = tmp_path / 'dvc.yaml'
+    dvc_yaml.write_text(json.dumps(dict(stages={
+        f"stage_{i}": dict(cmd=' '.join(stage_command(f"registry.example.com/sim:{i % 2}"))) for i in range(4)})))
+    cache_file = str(tmp_path / 'container_images.json')
+    warm([str(dvc_yaml)], cache_file=cache_file)
+    warm([str(dvc_yaml)], cache_file=cache_file)
+    assert sorted(docker()) == [['registry.example.com/sim:0'], ['registry.example.com/sim:1']]
+
+    warm([str(dvc_yaml)], refresh=True, cache_file=cache_file)
+    assert len(docker()) == 4
+
+
+def run_pull(image):
+    return sp.run([sys.executable, '-m', 'async_encfs_dvc.slurm_int.container_prepull', 'pull', '--'] +
+                  stage_command(image), capture_output=True,
+                  env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+
+def test_pull_on_node(docker, tmp_path):
+    pinned = pin_command(stage_command('registry.example.com/sim:1.0'), str(tmp_path / 'container_images.json'))[8]
+    os.remove(tmp_path / 'docker' / 'images.json')  # other node with an empty image store
+
+    assert run_pull(pinned).returncode == 0
+    assert run_pull(pinned).returncode == 0  # already present
+    assert docker() == [['registry.example.com/sim:1.0'], [pinned]]
+
+    result = run_pull('registry.example.com/missing:1.0')
+    assert result.returncode == 1 and b'Warning' in result.stderr
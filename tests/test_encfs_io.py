@@ -0,0 +1,104 @@
+# Tests of the FUSE-free access to EncFS volumes (async_encfs_dvc/encfs_int/encfs_io.py) against the volume config
+# written by EncFS 1.9.5 in examples/.encfs6.xml.tutorial (password 1234) and, if encfs is installed, against files
+# written and read through an EncFS FUSE mount of the same volume
+
+import os
+import shutil
+import subprocess as sp
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from async_encfs_dvc.encfs_int.encfs_io import EncfsVolume, HEADER_SIZE  # noqa: E402
+
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples',
+                           '.encfs6.xml.tutorial')
+PASSWORD = '1234'
+BLOCK_SIZE = 4096
+
+
+@pytest.fixture(scope='module')
+def encfs_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('encrypted')
+    shutil.copy(CONFIG_FILE, root / '.encfs6.xml')
+    return root
+
+
+@pytest.fixture(scope='module')
+def volume(encfs_root):
+    volume = EncfsVolume(str(encfs_root), password=PASSWORD, threads=4)  # key derivation once per module
+    yield volume
+    volume.close()
+
+
+def test_volume_key(encfs_root, volume):
+    # the key checksum of the config verifies the key derivation and stream decoding against EncFS
+    assert volume.config.block_size == BLOCK_SIZE and volume.config.unique_iv and volume.config.allow_holes
+    assert len(volume.key.key) == 32
+    with pytest.raises(ValueError, match='Invalid EncFS password'):
+        EncfsVolume(str(encfs_root), password='4321')
+
+
+def get_plain_data():
+    """Multi-block data with a hole (all-zero block) and a partial last block"""
+    data = bytearray(os.urandom(5 * BLOCK_SIZE + 1234))
+    data[2 * BLOCK_SIZE:3 * BLOCK_SIZE] = bytes(BLOCK_SIZE)
+    return bytes(data)
+
+
+def test_write_read(encfs_root, volume):
+    data = get_plain_data()
+    volume.write_bytes('data.bin', data)
+    assert os.path.getsize(encfs_root / 'data.bin') == HEADER_SIZE + len(data)
+    with open(encfs_root / 'data.bin', 'rb') as f:
+        assert f.read()[HEADER_SIZE:HEADER_SIZE + BLOCK_SIZE] != data[:BLOCK_SIZE]
+    assert volume.getsize('data.bin') == len(data)
+    assert volume.read_bytes('data.bin') == data
+
+    with volume.open('data.bin', 'rb') as f:  # random access across block boundaries and into the last block
+        for offset, size in [(BLOCK_SIZE - 10, 20), (2 * BLOCK_SIZE + 5, BLOCK_SIZE), (5 * BLOCK_SIZE + 1000, 1000)]:
+            f.seek(offset)
+            assert f.read(size) == data[offset:offset + size]
+
+    with volume.open('chunked.bin', 'wb') as f:  # sequential writes not aligned to blocks
+        for i in range(0, len(data), 1000):
+            f.write(data[i:i + 1000])
+    assert volume.read_bytes('chunked.bin') == data
+    volume.write_bytes('empty.bin', b'')
+    assert volume.read_bytes('empty.bin') == b''
+    assert volume.listdir() == ['chunked.bin', 'data.bin', 'empty.bin']
+
+
+@pytest.fixture
+def encfs_mount(tmp_path):
+    """EncFS FUSE mount of a volume with the tutorial config (requires encfs in ENCFS_INSTALL_DIR or PATH)"""
+    encfs = os.path.join(os.environ.get('ENCFS_INSTALL_DIR', ''), 'bin', 'encfs')
+    encfs = encfs if os.path.isfile(encfs) else shutil.which('encfs')
+    if encfs is None or shutil.which('fusermount') is None or not os.path.exists('/dev/fuse'):
+        pytest.skip("encfs (FUSE) not available")
+    root, mount_dir = tmp_path / 'encrypted', tmp_path / 'decrypted'
+    root.mkdir()
+    mount_dir.mkdir()
+    shutil.copy(CONFIG_FILE, root / '.encfs6.xml')
+    sp.run([encfs, '--nocache', '-S', str(root), str(mount_dir)], input=(PASSWORD + '\n').encode(), check=True)
+    yield root, mount_dir
+    sp.run(['fusermount', '-u', str(mount_dir)], check=True)
+
+
+def test_encfs_mount(encfs_mount):
+    root, mount_dir = encfs_mount
+    volume = EncfsVolume(str(root), password=PASSWORD, mount_dir=str(mount_dir))
+    data = get_plain_data()
+
+    # decrypt a file written by encfs
+    with open(mount_dir / 'from_encfs.bin', 'wb') as f:
+        f.write(data)
+    assert volume.read_bytes(str(mount_dir / 'from_encfs.bin')) == data
+
+    # re-encrypt it and read it back through the mount
+    volume.write_bytes(str(mount_dir / 'to_encfs.bin'), volume.read_bytes('from_encfs.bin'))
+    with open(mount_dir / 'to_encfs.bin', 'rb') as f:
+        assert f.read() == data
+    volume.close()
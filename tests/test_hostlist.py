@@ -0,0 +1,115 @@
+# Tests of the compact SLURM node list and tasks per node parsing (async_encfs_dvc/slurm_int/hostlist.py) and of the
+# slurm_get_local_ntasks.py/slurm_step_get_local_ntasks.py wrappers used by encfs_mount_and_run
+
+import os
+import sys
+import subprocess as sp
+
+import pytest
+
+from async_encfs_dvc.slurm_int.hostlist import Hostlist, TasksPerNode, get_local_ntasks, get_local_ntasks_env
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENCFS_INT_PATH = os.path.join(REPO_ROOT, 'async_encfs_dvc', 'encfs_int')
+
+
+@pytest.mark.parametrize('nodelist, hosts', [
+    ('rack[1-2]n[01-16]', [f"rack{r}n{n:02d}" for r in [1, 2] for n in range(1, 17)]),
+    ('login,nid[01-02]', ['login', 'nid01', 'nid02']),
+    ('a[1-2]-ib[3-4]', ['a1-ib3', 'a1-ib4', 'a2-ib3', 'a2-ib4']),
+    ('nid0[2285-2289,2718-2723]', [f"nid0{n}" for n in list(range(2285, 2290)) + list(range(2718, 2724))]),
+    ('nid00[1-3]x', ['nid001x', 'nid002x', 'nid003x']),
+    ('nid0[4278-4279],nid04280', ['nid04278', 'nid04279', 'nid04280']),
+    ('c[8-12]', ['c8', 'c9', 'c10', 'c11', 'c12']),
+])
+def test_hostlist_index(nodelist, hosts):
+    hostlist = Hostlist(nodelist)
+    assert len(hostlist) == len(hosts)
+    assert list(hostlist) == hosts
+    for i, host in enumerate(hosts):
+        assert hostlist.index(host) == i
+
+
+@pytest.mark.parametrize('nodelist, host', [
+    ('rack[1-2]n[01-16]', 'rack3n01'),
+    ('rack[1-2]n[01-16]', 'rack1n17'),
+    ('rack[1-2]n[01-16]', 'rack1n1'),  # not zero-padded
+    ('nid0[2285-2289,2718-2723]', 'nid02290'),
+    ('nid0[2285-2289,2718-2723]', 'nid2285'),
+    ('nid00[1-3]x', 'nid001'),
+    ('nid00[1-3]x', 'nid01x'),
+    ('login,nid[01-02]', 'login1'),
+])
+def test_hostlist_missing_host(nodelist, host):
+    hostlist = Hostlist(nodelist)
+    assert host not in hostlist
+    with pytest.raises(ValueError):
+        hostlist.index(host)
+
+
+def test_hostlist_compact_runs():
+    assert len(Hostlist('nid0[2285-2289,2718-2723]').runs) == 2
+    assert len(Hostlist('rack[1-2]n[01-16]').runs) == 2
+    assert len(Hostlist('c[8-12]').runs) == 2  # split where the number of digits changes
+
+
+@pytest.mark.parametrize('nodelist', ['nid[01-02', 'nid01-02]', 'nid[a-b]'])
+def test_hostlist_invalid(nodelist):
+    with pytest.raises(ValueError):
+        Hostlist(nodelist)
+
+
+@pytest.mark.parametrize('tasks_per_node, ntasks', [
+    ('2(x21),1(x6)', [2] * 21 + [1] * 6),
+    ('2(x2),1', [2, 2, 1]),
+    ('4', [4]),
+    ('1,3(x2),2', [1, 3, 3, 2]),
+])
+def test_tasks_per_node(tasks_per_node, ntasks):
+    tasks = TasksPerNode(tasks_per_node)
+    assert len(tasks) == len(ntasks)
+    assert list(tasks) == ntasks
+    assert [tasks[i] for i in range(len(ntasks))] == ntasks
+    with pytest.raises(IndexError):
+        tasks[len(ntasks)]
+
+
+def test_get_local_ntasks():
+    assert get_local_ntasks('rack[1-2]n[01-16]', '2(x16),1(x16)', 'rack1n16') == 2
+    assert get_local_ntasks('rack[1-2]n[01-16]', '2(x16),1(x16)', 'rack2n01') == 1
+    assert get_local_ntasks('login,nid[01-02]', '1,4(x2)', 'nid02') == 4
+    with pytest.raises(RuntimeError):
+        get_local_ntasks('login,nid[01-02]', '1,4(x2)', 'nid03')
+
+
+def test_get_local_ntasks_env():
+    assert get_local_ntasks_env('nid00[1-3]x', '2(x3)') == \
+        "export ENCFS_MPI_LOCAL_SIZE_KEY='nid00[1-3]x;2(x3)'\nexport ENCFS_MPI_LOCAL_SIZE=2"
+    env = get_local_ntasks_env('a[1-2]-ib[3-4]', '2(x3),1')
+    assert "export ENCFS_MPI_LOCAL_SIZE_MAP=' a1-ib3=2 a1-ib4=2 a2-ib3=2 a2-ib4=1 '" in env.split('\n')
+
+
+def run_script(script, *args, env=None):
+    return sp.run([sys.executable, os.path.join(ENCFS_INT_PATH, script)] + list(args), capture_output=True,
+                  check=True, env=dict(os.environ, PYTHONPATH=REPO_ROOT, **(env or {}))).stdout.decode('utf-8')
+
+
+@pytest.mark.parametrize('script', ['slurm_get_local_ntasks.py', 'slurm_step_get_local_ntasks.py'])
+def test_cli(script):
+    assert run_script(script, '--nodelist', 'nid0[2285-2289,2718-2723]', '--tasks-per-node', '2(x5),1(x6)',
+                      '--hostname', 'nid02718') == '1'
+    assert run_script(script, '--index', '--nodelist', 'nid0[2285-2289,2718-2723]',
+                      '--hostname', 'nid02718') == '5'
+    assert run_script(script, '--hostname', 'rack1n09', env=dict(SLURM_STEP_NODELIST='rack[1-2]n[01-16]',
+                                                                 SLURM_STEP_TASKS_PER_NODE='3(x16),1(x16)')) == '3'
+    assert run_script(script, '--export-env', '--nodelist', 'login,nid[01-02]', '--tasks-per-node', '1,4(x2)') == \
+        "export ENCFS_MPI_LOCAL_SIZE_KEY='login,nid[01-02];1,4(x2)'\n" \
+        "export ENCFS_MPI_LOCAL_SIZE_MAP=' login=1 nid01=4 nid02=4 '\n"
+
+
+@pytest.mark.parametrize('script', ['slurm_get_local_ntasks.py', 'slurm_step_get_local_ntasks.py'])
+def test_cli_missing_host(script):
+    with pytest.raises(sp.CalledProcessError) as e:
+        run_script(script, '--nodelist', 'login,nid[01-02]', '--tasks-per-node', '1,4(x2)', '--hostname', 'nid03')
+    assert b"Could not find nid03" in e.value.stderr
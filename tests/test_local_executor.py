@@ -0,0 +1,24 @@
+# Tests of the slot accounting of the local executor of asynchronous DVC stages
+# (async_encfs_dvc/local_int/local_executor.py)
+
+from async_encfs_dvc.local_int.local_executor import Executor
+
+
+def submit_stage(store, stage, slots, after=()):
+    return store.submit(type='stage', name=f"dvc_{stage}", stage=stage, stage_dir=store.dvc_root, command=['true'],
+                        ntasks=slots, cpus_per_task=1, slots=slots, after=list(after), env=dict())
+
+
+def test_slots_limited_to_executor(tmp_path, monkeypatch):
+    monkeypatch.setenv('DVC_LOCAL_SLOTS', '2')
+    executor = Executor(str(tmp_path))
+    started = []
+    monkeypatch.setattr(executor, 'start', lambda job: started.append(job['id']))
+
+    # enqueued with DVC_LOCAL_SLOTS=8 after the executor started with 2 slots
+    job = submit_stage(executor.store, 'large', slots=8)
+    executor.load_new_jobs()
+    assert executor.jobs[job['id']]['slots'] == 2
+    assert executor.store.load()[job['id']]['slots'] == 2
+    executor.schedule()
+    assert started == [job['id']]
@@ -0,0 +1,33 @@
+# Tests of the log sink with size-based rotation into compressed segments (async_encfs_dvc/log_sink.py)
+
+import pytest
+
+from async_encfs_dvc.log_sink import LogSink, parse_size, load_index, tail
+
+
+def test_parse_size():
+    assert parse_size('100M') == 100 << 20 and parse_size('2k') == 2048 and parse_size('512') == 512
+    assert parse_size(None) is None and parse_size('') is None and parse_size('0') is None  # no rotation
+    with pytest.raises(ValueError):
+        parse_size('-1K')
+
+
+def test_invalid_max_bytes(tmp_path):
+    for max_bytes in [0, -1]:
+        with pytest.raises(ValueError, match='max_bytes'):
+            LogSink(str(tmp_path / 'stage.log'), max_bytes=max_bytes)
+
+
+def test_rotation(tmp_path):
+    log_file = str(tmp_path / 'stage.log')
+    sink = LogSink(log_file, max_bytes=100, keep_head=1, keep_tail=1)
+    lines = [f"line {i:04d}\n".encode() for i in range(100)]
+    for i in range(0, len(lines), 7):
+        sink.write(b''.join(lines[i:i + 7]))
+    sink.close()
+
+    segments = load_index(log_file)['segments']
+    assert len(segments) == 10 and all(s['bytes'] <= 100 for s in segments)
+    assert [s['dropped'] for s in segments] == [False] + [True] * 8 + [False]
+    assert tail(log_file, 10) == lines[-10:]  # from the last segment
+    assert tail(log_file, 11)[0].startswith(b'... [segment 9 with 100 bytes dropped]')
@@ -0,0 +1,48 @@
+# Tests of the resource usage sampler of stage payloads (async_encfs_dvc/resource_sampler.py)
+
+import os
+import time
+import shutil
+import signal
+import subprocess as sp
+
+from async_encfs_dvc.resource_sampler import get_flags, sample, summarize_rank, summarize_stage
+
+
+THRESHOLDS = dict(cpu_threshold=0.5, mem_threshold=0.5, io_rate_threshold=10 << 20, fuse_share_threshold=0.25)
+
+
+def sample_process_tree(args, num_samples=2, **kwargs):
+    start = time.time()
+    proc = sp.Popen(args, start_new_session=True, **kwargs)
+    try:
+        samples = []
+        for _ in range(num_samples):
+            time.sleep(0.2)
+            samples.append({k: float(v) for k, v in sample(proc.pid, start).items()})
+        return samples
+    finally:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def test_process_tree():
+    samples = sample_process_tree(['bash', '-c', 'sleep 5 & wait'])
+    assert samples[-1]['procs'] == 2 and samples[-1]['container_clients'] == 0
+    usage = summarize_rank(dict(cpus=4, mem_bytes=1 << 30), samples)
+    assert usage['measured'] and usage['cpu_util'] < 0.5
+    assert get_flags(usage, **THRESHOLDS) == ['cpu-overprovisioned', 'mem-overprovisioned']
+
+
+def test_detached_container(tmp_path):
+    # client of a container running under the docker daemon (bash running the script "run" as docker)
+    os.symlink(shutil.which('bash'), tmp_path / 'docker')
+    (tmp_path / 'run').write_text("sleep 5\n")
+    samples = sample_process_tree(['bash', '-c', './docker run --rm image python3 payload.py; true'], cwd=tmp_path)
+    assert samples[-1]['container_clients'] == 1
+    usage = summarize_rank(dict(cpus=4, mem_bytes=1 << 30), samples)
+    assert not usage['measured'] and usage['cpu_util'] is None and usage['mem_util'] is None
+    assert get_flags(usage, **THRESHOLDS) == ['not-measured']
+
+    stage = summarize_stage('stage', [usage, dict(usage, measured=True, cpu_util=0.1, mem_util=0.1)])
+    assert stage['cpu_util'] is None and get_flags(stage, **THRESHOLDS) == ['not-measured']
@@ -0,0 +1,94 @@
+# Tests of the seekable zstd compression of stage outputs (async_encfs_dvc/stage_compression.py)
+
+import os
+
+import pytest
+
+zstandard = pytest.importorskip('zstandard')
+
+from async_encfs_dvc import stage_compression  # noqa: E402
+from async_encfs_dvc.stage_compression import SKIPPABLE_MAGIC, SEEKABLE_MAGIC, SEEK_TABLE_FOOTER_SIZE, \
+    SeekableZstdReader, compress_file, get_spec, read_seek_table  # noqa: E402
+
+
+FRAME_SIZE = 1000
+
+
+def get_data(size=10 * FRAME_SIZE + 123):
+    return b''.join(f"{i:08d}\n".encode() for i in range(size // 9 + 1))[:size]
+
+
+def write(path, data, threads):
+    with stage_compression.open(path, 'wb', frame_size=FRAME_SIZE, threads=threads) as f:
+        for i in range(0, len(data), 777):  # writes not aligned to frames
+            f.write(data[i:i + 777])
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_seek_table(tmp_path, threads):
+    data = get_data()
+    write(str(tmp_path / 'out.bin'), data, threads)
+    with open(tmp_path / 'out.bin.zst', 'rb') as f:
+        compressed = f.read()
+
+    num_frames = 11
+    footer = compressed[-SEEK_TABLE_FOOTER_SIZE:]
+    assert int.from_bytes(footer[:4], 'little') == num_frames and footer[4] == 0  # no checksums in the table
+    assert int.from_bytes(footer[5:], 'little') == SEEKABLE_MAGIC
+    table_start = len(compressed) - (num_frames * 8 + SEEK_TABLE_FOOTER_SIZE + 8)
+    assert int.from_bytes(compressed[table_start:table_start + 4], 'little') == SKIPPABLE_MAGIC
+    assert int.from_bytes(compressed[table_start + 4:table_start + 8], 'little') == \
+        num_frames * 8 + SEEK_TABLE_FOOTER_SIZE
+
+    with open(tmp_path / 'out.bin.zst', 'rb') as f:
+        frames = read_seek_table(f)
+    assert [d_size for _, _, _, d_size in frames] == [FRAME_SIZE] * 10 + [123]
+    assert frames[-1][0] + frames[-1][1] == table_start
+    for c_offset, c_size, d_offset, d_size in frames:  # independent frames
+        assert zstandard.ZstdDecompressor().decompress(compressed[c_offset:c_offset + c_size]) == \
+            data[d_offset:d_offset + d_size]
+    assert zstandard.ZstdDecompressor().stream_reader(compressed).read() == data  # also a plain zstd file
+
+
+def test_find_frame(tmp_path):
+    data = get_data()
+    write(str(tmp_path / 'out.bin'), data, threads=1)
+    with open(tmp_path / 'out.bin.zst', 'rb') as f:
+        frames = read_seek_table(f)
+    reader = SeekableZstdReader(open(tmp_path / 'out.bin.zst', 'rb'), frames)
+    for index, (_, _, d_offset, d_size) in enumerate(frames):
+        assert reader._find_frame(d_offset) == index
+        assert reader._find_frame(d_offset + d_size - 1) == index
+    assert reader._find_frame(len(data) + 10) == len(frames) - 1
+
+    for pos, size in [(FRAME_SIZE - 1, 2), (FRAME_SIZE, FRAME_SIZE), (3 * FRAME_SIZE - 5, 2 * FRAME_SIZE + 10),
+                      (len(data) - 10, 100), (len(data), 10)]:
+        reader.seek(pos)
+        assert reader.read(size) == data[pos:pos + size]
+    reader.close()
+
+    with stage_compression.open(str(tmp_path / 'out.bin')) as f:  # falls back to out.bin.zst
+        f.seek(-50, os.SEEK_END)
+        assert f.read() == data[-50:]
+
+
+def test_min_ratio(tmp_path):
+    spec = get_spec(dict(level=3))
+    spec['frame_size'] = FRAME_SIZE
+    (tmp_path / 'random.bin').write_bytes(os.urandom(5 * FRAME_SIZE))
+    (tmp_path / 'text.bin').write_bytes(get_data())
+
+    assert compress_file(str(tmp_path / 'random.bin'), spec, threads=1) == (5 * FRAME_SIZE, 5 * FRAME_SIZE, False)
+    assert sorted(os.listdir(tmp_path)) == ['random.bin', 'text.bin']  # incompressible file kept
+
+    size_in, size_out, compressed = compress_file(str(tmp_path / 'text.bin'), spec, threads=1)
+    assert compressed and size_in == len(get_data()) and size_out * spec['min_ratio'] <= size_in
+    assert sorted(os.listdir(tmp_path)) == ['random.bin', 'text.bin.zst']
+    with stage_compression.open(str(tmp_path / 'text.bin')) as f:
+        assert f.read() == get_data()
+
+    (tmp_path / 'text.bin.zst').unlink()
+    (tmp_path / 'text.bin').write_bytes(get_data())
+    spec['min_ratio'] = 1000.  # not reached
+    assert not compress_file(str(tmp_path / 'text.bin'), spec, threads=1)[2]
+    assert sorted(os.listdir(tmp_path)) == ['random.bin', 'text.bin']
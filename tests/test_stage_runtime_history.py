@@ -0,0 +1,74 @@
+# Tests of the walltime (--time) prediction from the runtime history of SLURM DVC stages
+# (async_encfs_dvc/slurm_int/stage_runtime_history.py), in particular after stage jobs ran into their walltime
+
+import os
+import sys
+import json
+import subprocess as sp
+
+from async_encfs_dvc.slurm_int.stage_runtime_history import MIN_TIME_LIMIT, TIMEOUT_BACKOFF, load_history, \
+    predict_time_limit, validate
+
+
+STATIC_TIME_LIMIT = 4 * 3600.
+
+
+def completed(runtime, end, input_size=2 ** 20):
+    return dict(app='app', stage_type='simulation', stage='s', input_size=input_size, runtime=runtime,
+                time_limit=STATIC_TIME_LIMIT, end=end, state='COMPLETED')
+
+
+def timed_out(elapsed, end, input_size=2 ** 20):
+    return dict(completed(elapsed, end, input_size), state='TIMEOUT', job_time_limit=elapsed)
+
+
+def predict(records, input_size=2 ** 20):
+    return predict_time_limit(records, 'app', 'simulation', input_size, STATIC_TIME_LIMIT, quantile=0.95, margin=1.25)
+
+
+def test_prediction():
+    records = [completed(1000. + 10 * i, end=i) for i in range(5)]
+    assert predict(records[:4]) is None
+    assert 1000. * 1.25 < predict(records) <= 1040. * 1.25
+    assert predict([completed(10., end=i) for i in range(5)]) == MIN_TIME_LIMIT
+
+
+def test_prediction_after_timeout():
+    records = [completed(1000. + 10 * i, end=i) for i in range(5)]
+    baseline = predict(records)
+    records.append(timed_out(1300., end=5))  # slower run, killed at the predicted walltime
+    assert predict(records) == 1300. * TIMEOUT_BACKOFF
+    assert predict(records + [timed_out(1800., end=6)]) == 1800. * TIMEOUT_BACKOFF  # timed out again
+    assert predict(records + [timed_out(3 * 3600., end=6)]) == STATIC_TIME_LIMIT  # falls back to the static --time
+
+    # timed out runs of other input sizes do not count, failed runs are not runtimes
+    assert predict(records, input_size=2 ** 30) == baseline
+    assert predict(records[:5] + [dict(timed_out(20., end=6), state='FAILED')]) == baseline
+
+    # until a later run completes within the elapsed time of the timed out job
+    assert predict(records + [completed(1200., end=6)]) == 1300. * TIMEOUT_BACKOFF
+    assert predict(records + [completed(1400., end=6)]) <= 1400. * 1.25
+
+
+def test_validate_skips_failed_runs():
+    records = [completed(1000., end=i) for i in range(5)] + [timed_out(1300., end=5), completed(1500., end=6)]
+    result, = validate(records, quantile=0.95, margin=1.25)
+    assert result['records'] == 6 and result['predicted'] == 1 and result['exceeded'] == 0
+
+
+def test_record_failure(tmp_path):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'sacct').write_text("#!/bin/bash\necho 'TIMEOUT|00:21:40|00:21:00'\n")
+    (bin_dir / 'sacct').chmod(0o755)
+    (tmp_path / 'app.yaml').write_text("app:\n  name: app\n  stages:\n    simulation:\n      slurm_opts:\n"
+                                       "        stage:\n          --time: '04:00:00'\n")
+    history_file = tmp_path / 'history.jsonl'
+    env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}", DVC_RUNTIME_HISTORY=str(history_file),
+               PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sp.run([sys.executable, '-m', 'async_encfs_dvc.slurm_int.stage_runtime_history', 'record-failure',
+            str(tmp_path / 'app.yaml'), 'simulation', 's', '1234', '--input-size', '100'], env=env, check=True)
+    record, = load_history(str(history_file))
+    assert (record['state'], record['runtime'], record['job_time_limit'], record['time_limit'], record['job_id']) == \
+        ('TIMEOUT', 1300., 1260., STATIC_TIME_LIMIT, '1234')
+    assert json.loads(history_file.read_text())['input_size'] == 100
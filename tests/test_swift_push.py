@@ -0,0 +1,235 @@
+# Tests of the segmented, parallel and resumable Swift upload of DVC cache objects
+# (async_encfs_dvc/swift_int/swift_push.py) against an in-memory stand-in of swiftclient.client.Connection
+
+import os
+import sys
+import json
+import types
+import hashlib
+import threading
+
+import pytest
+
+from async_encfs_dvc.swift_int.swift_push import SwiftPush, get_remote, get_stage_objects
+
+
+SEGMENT_SIZE = 1024
+
+
+class FakeClientException(Exception):
+
+    def __init__(self, msg, http_status=None):
+        super().__init__(msg)
+        self.http_status = http_status
+
+
+class FakeSwift:
+    """Containers of objects {name: (data, etag, SLO manifest or None)} shared by all connections, with a log of the
+    requests and failures/corruptions injected by predicates on (container, name)"""
+
+    def __init__(self):
+        self.containers = dict()
+        self.lock = threading.Lock()
+        self.puts = []
+        self.heads = []
+        self.fail_put = lambda container, name: False
+        self.corrupt_put = lambda container, name: False
+
+    def content(self, container, name):
+        data, _, manifest = self.containers[container][name]
+        if manifest is None:
+            return data
+        return b''.join(self.content(*s['path'].lstrip('/').split('/', 1)) for s in manifest)
+
+    def get(self, container, name):
+        if name not in self.containers.get(container, dict()):
+            raise FakeClientException(f"Object {container}/{name} not found", http_status=404)
+        return self.containers[container][name]
+
+
+class FakeConnection:
+
+    def __init__(self, swift, **kwargs):
+        self.swift = swift
+
+    def get_container(self, container, prefix='', full_listing=False):
+        with self.swift.lock:
+            if container not in self.swift.containers:
+                raise FakeClientException(f"Container {container} not found", http_status=404)
+            objects = self.swift.containers[container]
+            # SLO manifests are listed with the size and hash of the manifest (not of their segments)
+            return dict(), [dict(name=name, bytes=len(data), hash=etag)
+                            for name, (data, etag, _) in sorted(objects.items()) if name.startswith(prefix)]
+
+    def head_object(self, container, name):
+        with self.swift.lock:
+            self.swift.heads.append((container, name))
+            self.swift.get(container, name)
+            return {'content-length': str(len(self.swift.content(container, name)))}
+
+    def put_container(self, container):
+        with self.swift.lock:
+            self.swift.containers.setdefault(container, dict())
+
+    def put_object(self, container, name, contents, content_length=None, headers=None, query_string=None):
+        if isinstance(contents, str):
+            data = contents.encode('utf-8')
+        else:
+            data = b''
+            while len(chunk := contents.read(256)) > 0:
+                data += chunk
+        assert content_length is None or content_length == len(data)
+        with self.swift.lock:
+            if container not in self.swift.containers:
+                raise FakeClientException(f"Container {container} not found", http_status=404)
+            if self.swift.fail_put(container, name):
+                raise FakeClientException(f"Injected failure of {container}/{name}", http_status=503)
+            if query_string == 'multipart-manifest=put':
+                manifest = json.loads(data)
+                for s in manifest:
+                    segment_data, segment_etag, _ = self.swift.get(*s['path'].lstrip('/').split('/', 1))
+                    if (len(segment_data), segment_etag) != (s['size_bytes'], s['etag']):
+                        raise FakeClientException(f"Invalid segment {s['path']}", http_status=400)
+                etag = hashlib.md5(''.join(s['etag'] for s in manifest).encode('utf-8')).hexdigest()
+            else:
+                manifest = None
+                if self.swift.corrupt_put(container, name):
+                    data = bytes([data[0] ^ 0xff]) + data[1:]
+                etag = hashlib.md5(data).hexdigest()
+            self.swift.containers[container][name] = (data, etag, manifest)
+            self.swift.puts.append((container, name))
+            return f'"{etag}"'
+
+
+@pytest.fixture
+def swift(monkeypatch):
+    """In-memory Swift used by all connections of swift_push (in place of swiftclient.client)"""
+    fake_swift = FakeSwift()
+    client = types.ModuleType('swiftclient.client')
+    client.Connection = lambda **kwargs: FakeConnection(fake_swift, **kwargs)
+    client.ClientException = FakeClientException
+    swiftclient = types.ModuleType('swiftclient')
+    swiftclient.client = client
+    monkeypatch.setitem(sys.modules, 'swiftclient', swiftclient)
+    monkeypatch.setitem(sys.modules, 'swiftclient.client', client)
+    fake_swift.containers['dvc'] = dict()
+    return fake_swift
+
+
+def add_cache_object(dvc_root, data, md5=None):
+    md5 = md5 or hashlib.md5(data).hexdigest()
+    path = os.path.join(dvc_root, '.dvc', 'cache', md5[:2], md5[2:])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return md5
+
+
+@pytest.fixture
+def stage(tmp_path, monkeypatch):
+    """DVC repo with a stage whose outs are a small file and a directory with a large and a small file (cf. dvc.lock)"""
+    dvc_root = str(tmp_path)
+    os.makedirs(os.path.join(dvc_root, '.dvc'))
+    with open(os.path.join(dvc_root, '.dvc', 'config'), 'w') as f:
+        f.write("[core]\n    remote = castor\n['remote \"castor\"']\n    url = s3://dvc/cache\n")
+    large = os.urandom(10 * SEGMENT_SIZE + 100)
+    entries = [dict(md5=add_cache_object(dvc_root, large), relpath='large.bin'),
+               dict(md5=add_cache_object(dvc_root, b'small file in dir'), relpath='small.txt')]
+    dir_data = json.dumps(entries).encode('utf-8')
+    dir_md5 = add_cache_object(dvc_root, dir_data, hashlib.md5(dir_data).hexdigest() + '.dir')
+    file_md5 = add_cache_object(dvc_root, b'small output file')
+    with open(os.path.join(dvc_root, 'dvc.lock'), 'w') as f:
+        json.dump(dict(schema='2.0', stages=dict(simulation=dict(
+            cmd='true', outs=[dict(path='output/result.txt', md5=file_md5, size=17),
+                              dict(path='output/data', md5=dir_md5, nfiles=2)]))), f)
+    monkeypatch.chdir(dvc_root)
+    return types.SimpleNamespace(dvc_root=dvc_root, large_md5=entries[0]['md5'], large=large, dir_md5=dir_md5,
+                                 objects=get_stage_objects('simulation', dvc_root))
+
+
+def get_pusher(dvc_root):
+    container, prefix = get_remote(dvc_root)
+    return SwiftPush(dvc_root, container, prefix, SEGMENT_SIZE, jobs=4)
+
+
+def resume_manifest(stage):
+    return os.path.join(stage.dvc_root, '.dvc', 'tmp', 'swift_push', f"{stage.large_md5}.jsonl")
+
+
+def test_remote_and_stage_objects(stage):
+    assert get_remote(stage.dvc_root) == ('dvc', 'cache')
+    assert [md5 for md5, _, _ in stage.objects][-1] == stage.dir_md5  # .dir objects after their entries
+    assert len(stage.objects) == 4
+
+
+def test_push(swift, stage):
+    pusher = get_pusher(stage.dvc_root)
+    pusher.push(stage.objects)
+
+    assert pusher.stats['uploaded'] == 4 and pusher.stats['skipped'] == 0
+    assert pusher.stats['segments'] == 11 and pusher.stats['resumed_segments'] == 0
+    for md5, path, _ in stage.objects:
+        with open(path, 'rb') as f:
+            assert swift.content('dvc', pusher.object_name(md5)) == f.read()
+    _, _, manifest = swift.containers['dvc'][pusher.object_name(stage.large_md5)]
+    assert [s['path'] for s in manifest] == \
+        [f"/dvc+segments/cache/{stage.large_md5[:2]}/{stage.large_md5[2:]}/slo/{len(stage.large)}/{SEGMENT_SIZE}/"
+         f"{i:08d}" for i in range(11)]
+    assert swift.puts[-1] == ('dvc', pusher.object_name(stage.dir_md5))  # .dir object last
+    assert not os.path.exists(resume_manifest(stage))
+
+
+def test_skip_existing(swift, stage):
+    get_pusher(stage.dvc_root).push(stage.objects)
+    num_puts = len(swift.puts)
+
+    pusher = get_pusher(stage.dvc_root)
+    pusher.push(stage.objects)
+    assert pusher.stats['skipped'] == 4 and pusher.stats['uploaded'] == 0
+    assert len(swift.puts) == num_puts
+    assert swift.heads == [('dvc', pusher.object_name(stage.large_md5))]  # size mismatch of the SLO listing only
+
+    swift.containers['dvc'][pusher.object_name(stage.large_md5)] = (b'truncated', 'etag', None)
+    pusher = get_pusher(stage.dvc_root)
+    assert [md5 for md5, _, _ in pusher.missing_objects(stage.objects)] == [stage.large_md5]
+
+
+def test_resume(swift, stage):
+    failed_segment = f"{stage.large_md5[2:]}/slo/{len(stage.large)}/{SEGMENT_SIZE}/00000005"
+    swift.fail_put = lambda container, name: name.endswith(failed_segment)
+    pusher = get_pusher(stage.dvc_root)
+    with pytest.raises(FakeClientException, match='Injected failure'):
+        pusher.push(stage.objects)
+    assert pusher.object_name(stage.large_md5) not in swift.containers['dvc']
+    assert pusher.object_name(stage.dir_md5) not in swift.containers['dvc']  # not before all its entries
+    with open(resume_manifest(stage)) as f:
+        recorded = [json.loads(line) for line in f]
+    assert 5 not in [s['index'] for s in recorded] and len(recorded) > 0
+
+    # segments recorded in the resume manifest are only reused if they still exist in Swift
+    lost = recorded[0]
+    del swift.containers['dvc+segments'][lost['path'].split('/', 2)[2]]
+    with open(resume_manifest(stage), 'a') as f:
+        f.write('{"index": 9, "pa')  # partially written line of an interrupted push
+
+    swift.fail_put = lambda container, name: False
+    num_puts = len(swift.puts)
+    pusher = get_pusher(stage.dvc_root)
+    pusher.push(stage.objects)
+    assert pusher.stats['resumed_segments'] == len(recorded) - 1
+    assert pusher.stats['segments'] == 11 - pusher.stats['resumed_segments']
+    uploaded_segments = sorted(int(name.rsplit('/', 1)[1]) for container, name in swift.puts[num_puts:]
+                               if container == 'dvc+segments')
+    assert uploaded_segments == sorted(set(range(11)) - set(s['index'] for s in recorded[1:]))
+    assert swift.content('dvc', pusher.object_name(stage.large_md5)) == stage.large
+    assert swift.puts[-1] == ('dvc', pusher.object_name(stage.dir_md5))
+    assert not os.path.exists(resume_manifest(stage))
+
+
+def test_etag_mismatch(swift, stage):
+    corrupted = [md5 for md5, _, size in stage.objects if size < SEGMENT_SIZE and not md5.endswith('.dir')][0]
+    pusher = get_pusher(stage.dvc_root)
+    swift.corrupt_put = lambda container, name: name == pusher.object_name(corrupted)
+    with pytest.raises(RuntimeError, match='corrupted'):
+        pusher.push(stage.objects)
+    assert pusher.object_name(stage.dir_md5) not in swift.containers['dvc']